@@ -19,10 +19,13 @@ import shutil
 from tempfile import NamedTemporaryFile
 import sys
 from array import array
+from multiprocessing import Pool
 
 from crumbs.bam.flag import create_flag
 from crumbs.settings import get_setting
 from crumbs.utils.bin_utils import get_num_threads
+from crumbs.utils.file_utils import TemporaryDir
+from crumbs.bam.statistics import group_references, fetch_references
 from crumbs.utils.optional_modules import (AlignmentFile, view, index, faidx,
                                            calmd)
 LEFT_DOWNGRADED_TAG = 'dl'
@@ -205,80 +208,171 @@ def merge_sams(in_fpaths, out_fpath):
         sys.stdout.write(open(stdout.name).read())
 
 QUAL_TO_SUBSTRACT = 30
+# the bgzf block found at the end of every BAM file
+BGZF_EOF = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00'
+            '\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+_COPY_CHUNK_SIZE = 1048576
 
+# translation tables to change the quality strs in one go
+_PHRED_TO_SANGER = ''.join(chr(min(qual + 33, 255)) for qual in range(256))
+_SANGER_TO_PHRED = ''.join(chr(max(qual - 33, 0)) for qual in range(256))
+_SUBSTRACTION_TABLES = {}
 
-def downgrade_read_edges(in_fpath, out_fpath, size,
-                         qual_to_substract=QUAL_TO_SUBSTRACT):
+
+def _get_substraction_table(qual_to_substract):
+    'It returns a translation table that substracts the qual down to 0'
+    table = _SUBSTRACTION_TABLES.get(qual_to_substract)
+    if table is None:
+        table = ''.join(chr(max(qual - qual_to_substract, 0))
+                        for qual in range(256))
+        _SUBSTRACTION_TABLES[qual_to_substract] = table
+    return table
+
+
+def _downgrade_reads(in_fpath, out_fpath, size, qual_to_substract,
+                     references=None, include_unplaced=True):
+    '''It writes the reads with the edges downgraded into a new BAM.
+
+    If references are given only their reads are read using the BAM index.
+    '''
     in_sam = AlignmentFile(in_fpath)
+    if references is None:
+        reads = in_sam
+    else:
+        reads = fetch_references(in_sam, references, include_unplaced)
     out_sam = AlignmentFile(out_fpath, 'wb', template=in_sam)
-    for aligned_read in in_sam:
-        if (aligned_read.has_tag(LEFT_DOWNGRADED_TAG) or
-                aligned_read.has_tag(RIGTH_DOWNGRADED_TAG)):
-            raise RuntimeError('Edge qualities already downgraded\n')
+    try:
+        for aligned_read in reads:
+            if (aligned_read.has_tag(LEFT_DOWNGRADED_TAG) or
+                    aligned_read.has_tag(RIGTH_DOWNGRADED_TAG)):
+                raise RuntimeError('Edge qualities already downgraded\n')
+            _downgrade_edge_qualities(aligned_read, size,
+                                      qual_to_substract=qual_to_substract)
+            out_sam.write(aligned_read)
+    finally:
+        out_sam.close()
+        in_sam.close()
+
+
+def _downgrade_reads_in_worker(args):
+    in_fpath, out_fpath, size, qual_to_substract, references, unplaced = args
+    _downgrade_reads(in_fpath, out_fpath, size, qual_to_substract,
+                     references=references, include_unplaced=unplaced)
+    return out_fpath
+
+
+def _copy_file_section(in_fhand, out_fhand, start, end):
+    in_fhand.seek(start)
+    to_copy = end - start
+    while to_copy > 0:
+        chunk = in_fhand.read(min(_COPY_CHUNK_SIZE, to_copy))
+        if not chunk:
+            break
+        out_fhand.write(chunk)
+        to_copy -= len(chunk)
+
+
+def _append_bam_part(part_fpath, out_fhand, is_first):
+    '''It copies the bgzf blocks of a BAM part into the out fhand.
+
+    The EOF block and, for all the parts but the first one, the header are
+    not copied. The header has to be in its own bgzf blocks.
+    '''
+    if is_first:
+        start = 0
+    else:
+        part_sam = AlignmentFile(part_fpath)
+        virtual_offset = part_sam.tell()
+        part_sam.close()
+        if virtual_offset & 0xFFFF:
+            msg = 'The BAM header is not in its own bgzf blocks: '
+            raise RuntimeError(msg + part_fpath)
+        start = virtual_offset >> 16
+    end = os.path.getsize(part_fpath)
+    with open(part_fpath, 'rb') as part_fhand:
+        part_fhand.seek(max(end - len(BGZF_EOF), 0))
+        if part_fhand.read() == BGZF_EOF:
+            end -= len(BGZF_EOF)
+        _copy_file_section(part_fhand, out_fhand, start, end)
 
-        _downgrade_edge_qualities(aligned_read, size,
-                                  qual_to_substract=qual_to_substract)
-        out_sam.write(aligned_read)
+
+def downgrade_read_edges(in_fpath, out_fpath, size,
+                         qual_to_substract=QUAL_TO_SUBSTRACT, processes=1):
+    '''It downgrades the qualities of the read edges.
+
+    The indexed BAMs can be processed by groups of references in several
+    processes. Every process writes, and compresses, its own BAM and they
+    are joined copying their bgzf blocks, so the read order is kept.
+    '''
+    in_sam = AlignmentFile(in_fpath)
+    if (processes < 2 or not in_sam.is_bam or not in_sam.references or
+            not in_sam.has_index()):
+        in_sam.close()
+        _downgrade_reads(in_fpath, out_fpath, size, qual_to_substract)
+        return
+
+    tmp_dir = TemporaryDir(directory=os.path.dirname(out_fpath) or None)
+    tasks = []
+    last_ref = in_sam.references[-1]
+    groups = group_references(in_sam.references, in_sam.lengths,
+                              processes * 4)
+    for part_idx, references in enumerate(groups):
+        part_fpath = os.path.join(tmp_dir.name, '{}.bam'.format(part_idx))
+        tasks.append((in_fpath, part_fpath, size, qual_to_substract,
+                      references, references[-1] == last_ref))
+    in_sam.close()
+
+    workers = Pool(processes=processes)
+    try:
+        with open(out_fpath, 'wb') as out_fhand:
+            part_fpaths = workers.imap(_downgrade_reads_in_worker, tasks)
+            for part_idx, part_fpath in enumerate(part_fpaths):
+                _append_bam_part(part_fpath, out_fhand,
+                                 is_first=not part_idx)
+                os.remove(part_fpath)
+            out_fhand.write(BGZF_EOF)
+    finally:
+        workers.terminate()
+        workers.join()
+        tmp_dir.close()
 
 
 def _downgrade_edge_qualities(aligned_read, size, qual_to_substract):
     left_limit = aligned_read.qstart + size
     right_limit = aligned_read.qend - size
-    quals = list(aligned_read.query_qualities)
-
     if left_limit >= right_limit:
         right_limit = left_limit + 1
-    
+
+    quals = aligned_read.query_qualities.tostring()
     left_quals = quals[:left_limit]
     right_quals = quals[right_limit:]
-
-    def minus(qual):
-        qual -= qual_to_substract
-        if qual < 0:
-            qual = 0
-        return qual
-
-    downgraded_left_quals = list(map(minus, left_quals))
-    downgraded_right_quals = list(map(minus, right_quals))
-
-    new_quals = downgraded_left_quals
-    new_quals.extend(quals[left_limit:right_limit])
-    new_quals.extend(downgraded_right_quals)
-    try: 
-        assert len(quals) == len(new_quals)
-    except AssertionError:
-        print left_limit, right_limit
-        print left_quals, downgraded_left_quals
-        print right_quals, downgraded_right_quals
-        raise
+    substraction = _get_substraction_table(qual_to_substract)
+    new_quals = (left_quals.translate(substraction) +
+                 quals[left_limit:right_limit] +
+                 right_quals.translate(substraction))
     aligned_read.query_qualities = array('B', new_quals)
 
-    def to_sanger_qual(quals):
-        return ''.join(chr(33 + qual) for qual in quals)
-
-    aligned_read.set_tag(LEFT_DOWNGRADED_TAG, to_sanger_qual(left_quals),
+    aligned_read.set_tag(LEFT_DOWNGRADED_TAG,
+                         left_quals.translate(_PHRED_TO_SANGER),
                          value_type='Z')
-    aligned_read.set_tag(RIGTH_DOWNGRADED_TAG, to_sanger_qual(right_quals),
+    aligned_read.set_tag(RIGTH_DOWNGRADED_TAG,
+                         right_quals.translate(_PHRED_TO_SANGER),
                          value_type='Z')
 
 
 def _restore_qual_from_tag(aligned_read):
-    def to_phred_qual(quals):
-        return [ord(qual) - 33 for qual in quals]
-    left_quals, rigth_quals = [], []
+    left_quals, rigth_quals = '', ''
     if aligned_read.has_tag(LEFT_DOWNGRADED_TAG):
         left_quals = aligned_read.get_tag(LEFT_DOWNGRADED_TAG)
-        left_quals = to_phred_qual(left_quals)
     if aligned_read.has_tag(RIGTH_DOWNGRADED_TAG):
         rigth_quals = aligned_read.get_tag(RIGTH_DOWNGRADED_TAG)
-        rigth_quals = to_phred_qual(rigth_quals)
 
     if left_quals or rigth_quals:
-        recover_qual = left_quals
-        left_limit = len(left_quals)
-        rigth_limit = -len(rigth_quals) if len(rigth_quals) else None
-        recover_qual += aligned_read.query_qualities[left_limit:rigth_limit]
-        recover_qual += rigth_quals
+        quals = aligned_read.query_qualities.tostring()
+        rigth_limit = len(quals) - len(rigth_quals)
+        recover_qual = (left_quals.translate(_SANGER_TO_PHRED) +
+                        quals[len(left_quals):rigth_limit] +
+                        rigth_quals.translate(_SANGER_TO_PHRED))
         aligned_read.query_qualities = array('B', recover_qual)
 
 
@@ -13,49 +13,72 @@
 # You should have received a copy of the GNU General Public License
 # along with ngs_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
-from collections import Counter, namedtuple
+from collections import Counter, namedtuple, OrderedDict
+from array import array
+from bisect import bisect_left, bisect_right
+
 from crumbs.utils.optional_modules import AlignmentFile
+from crumbs.bam.statistics import FLAGS_SKIPPED_BY_PILEUP
 
 
 def pos_counter_by_pos(bam_fpath, positions):
+    '''It yields a Counter with the read positions found at every position.
+
+    The Counters are yielded in the order of the BAM references for the
+    positions covered by any read.
+    '''
     alignmentfile = AlignmentFile(bam_fpath)
-    ref_name_index = {}
-    for pileup_col in alignmentfile.pileup():
-        ref_id = pileup_col.reference_id
-        ref_pos = pileup_col.reference_pos
-        ref_name = ref_name_index.get(ref_id, alignmentfile.getrname(ref_id))
-        position = (ref_name, ref_pos)
-        if position in positions:
-            pos_counter = Counter()
-            print position
-            for pileup_read in pileup_col.pileups:
-                alignement = pileup_read.alignment
-                blocks = alignement.get_blocks()
-
-                if pileup_read.alignment.is_reverse:
-                    base_pos = (pileup_read.alignment.query_length -
-                                pileup_read.query_position - 1)
-                else:
-                    base_pos = pileup_read.query_position
-#
-#                 base_pos = pileup_read.query_position
-                print base_pos, pileup_read.alignment.qname
-                pos_counter[base_pos] += 1
-            yield pos_counter
+    poss_by_chrom = {}
+    for chrom, pos in positions:
+        if chrom not in poss_by_chrom:
+            poss_by_chrom[chrom] = set()
+        poss_by_chrom[chrom].add(pos)
+
+    for chrom in alignmentfile.references:
+        if chrom not in poss_by_chrom:
+            continue
+        chrom_poss = sorted(poss_by_chrom[chrom])
+        counters = OrderedDict((pos, Counter()) for pos in chrom_poss)
+        for read in alignmentfile.fetch(chrom, chrom_poss[0],
+                                        chrom_poss[-1] + 1):
+            if read.flag & FLAGS_SKIPPED_BY_PILEUP:
+                continue
+            start = bisect_left(chrom_poss, read.reference_start)
+            end = bisect_left(chrom_poss, read.reference_end, start)
+            if start == end:
+                continue
+            read_poss_in_win = chrom_poss[start:end]
+            coord = ReadRefCoord(read, alignmentfile)
+            read_poss = coord.get_read_poss(chrom, read_poss_in_win)
+            for pos, read_pos in zip(read_poss_in_win, read_poss):
+                if read_pos is not None:
+                    counters[pos][read_pos] += 1
+        for counter in counters.values():
+            if counter:
+                yield counter
 
 
 Block = namedtuple('Block', ['ref_start', 'ref_stop',
                              'read_start', 'read_stop'])
 
 
+_NO_READ_POS = -1
+
+
 class ReadRefCoord(object):
+    '''It transforms reference coordinates into read coordinates.
+
+    The read positions are counted from the 5' end of the read. The CIGAR
+    blocks are calculated only once.
+    '''
     def __init__(self, alig_read, sam, hard_clip_as_soft=False):
         self._alig_read = alig_read
         self._sam = sam
         self.hard_clip_as_soft = hard_clip_as_soft
         self._blocks = None
         self._read_len = None
-        self._last_position = None
+        self._coord_map = None
+        self._chrom = None
 
     @property
     def read_len(self):
@@ -67,7 +90,7 @@ class ReadRefCoord(object):
     def blocks(self):
         alig_read = self._alig_read
         if self._blocks is not None:
-            return self._block
+            return self._blocks
         ref_start = alig_read.reference_start
 
         cigar_tuples = alig_read.cigartuples
@@ -136,55 +159,70 @@ class ReadRefCoord(object):
                               blk_read_end)
                 rev_blocks.append(block)
             blocks = rev_blocks
-        self._block = blocks
+        self._blocks = blocks
         self._read_len = read_len
         return blocks
 
-    def get_read_pos(self, ref_pos):
-        if (self._last_position is not None and
-            self._last_position[0] == ref_pos):
-            return self._last_position[1]
-        alig_read = self._alig_read
-        sam = self._sam
-        chrom = sam.getrname(alig_read.reference_id)
-        if chrom != ref_pos[0]:
+    @property
+    def coord_map(self):
+        '''The reference start and stop and the read position at the start
+        of every block aligned to the reference, sorted by reference start.
+
+        The blocks not present in the read (deletions) have no read
+        position.
+        '''
+        if self._coord_map is None:
+            ref_starts = array('l')
+            ref_stops = array('l')
+            read_starts = array('l')
+            for block in self.blocks:
+                if block.ref_start is None:
+                    # insertion in read
+                    continue
+                ref_starts.append(block.ref_start)
+                ref_stops.append(block.ref_stop)
+                if block.read_start is None or block.read_stop is None:
+                    read_starts.append(_NO_READ_POS)
+                else:
+                    read_starts.append(block.read_start)
+            self._coord_map = ref_starts, ref_stops, read_starts
+        return self._coord_map
+
+    def _check_chrom(self, chrom):
+        if self._chrom is None:
+            self._chrom = self._sam.getrname(self._alig_read.reference_id)
+        if chrom != self._chrom:
             msg = 'The aligned read is not aligned to the given chrom: '
-            msg += chrom
+            msg += self._chrom
             raise ValueError(msg)
-        ref_pos = ref_pos[1]
-
-        blocks = self.blocks
-
-        block_with_ref_pos = None
-        for block in blocks:
-            if block.ref_start <= ref_pos <= block.ref_stop:
-                block_with_ref_pos = block
-                break
-        if block_with_ref_pos is None:
-            read_pos = None
-        else:
-            read_start = block_with_ref_pos.read_start
-            read_stop = block_with_ref_pos.read_stop
-
-            if read_start is None or read_stop is None:
-                read_pos = None
+
+    def get_read_poss(self, chrom, ref_poss):
+        '''It returns the read positions for the given reference positions.
+
+        The reference positions not aligned to a read base get None.
+        '''
+        self._check_chrom(chrom)
+        ref_starts, ref_stops, read_starts = self.coord_map
+        step = -1 if self._alig_read.is_reverse else 1
+        read_poss = []
+        for ref_pos in ref_poss:
+            idx = bisect_right(ref_starts, ref_pos) - 1
+            if (idx < 0 or ref_pos > ref_stops[idx] or
+                    read_starts[idx] == _NO_READ_POS):
+                read_poss.append(None)
             else:
-                ref_start = block_with_ref_pos.ref_start
-                ref_stop = block_with_ref_pos.ref_stop
+                read_poss.append(read_starts[idx] +
+                                 step * (ref_pos - ref_starts[idx]))
+        return read_poss
 
-                if alig_read.is_reverse:
-                    read_pos = read_start - (ref_pos - ref_start)
-                else:
-                    read_pos = read_stop - (ref_stop - ref_pos)
+    def get_read_poss_counting_from_end(self, chrom, ref_poss):
+        read_len = self.read_len
+        return [None if read_pos is None else read_pos - read_len
+                for read_pos in self.get_read_poss(chrom, ref_poss)]
 
-        self._last_position = ref_pos, read_pos
-        return read_pos
+    def get_read_pos(self, ref_pos):
+        return self.get_read_poss(ref_pos[0], [ref_pos[1]])[0]
 
     def get_read_pos_counting_from_end(self, ref_pos):
-        if self._last_position is None:
-            read_pos = self.get_read_pos(ref_pos)
-        else:
-            read_pos = self._last_position[1]
-        read_len = self.read_len
-        if read_pos is not None:
-            return read_pos - read_len
+        return self.get_read_poss_counting_from_end(ref_pos[0],
+                                                    [ref_pos[1]])[0]
@@ -18,20 +18,23 @@ from __future__ import division
 import os.path
 from subprocess import Popen, PIPE
 from operator import itemgetter
-from itertools import izip
+from itertools import izip, chain
 from array import array
 from collections import Counter, OrderedDict
+from multiprocessing import Pool
 import random
 
 from crumbs.utils.optional_modules import (histogram, zeros, median,
-                                           sum as np_sum)
+                                           sum as np_sum, bincount,
+                                           array as np_array)
 
 from crumbs.utils.optional_modules import AlignmentFile
 from crumbs.statistics import (draw_histogram_ascii, IntCounter, LABELS,
                                BestItemsKeeper)
 
 from crumbs.settings import get_setting
-from crumbs.bam.flag import SAM_FLAG_BINARIES, SAM_FLAGS
+from crumbs.bam.flag import (SAM_FLAG_BINARIES, SAM_FLAGS, SAM_FLAG_BITS,
+                             create_flag)
 from crumbs.utils.bin_utils import get_binary_path
 from crumbs.collectionz import RecentlyAddedCache
 from crumbs.iterutils import generate_windows, RandomAccessIterator
@@ -42,6 +45,7 @@ from crumbs.iterutils import generate_windows, RandomAccessIterator
 
 DEFAULT_N_BINS = get_setting('DEFAULT_N_BINS')
 DEFAULT_N_MOST_ABUNDANT_REFERENCES = get_setting('DEFAULT_N_MOST_ABUNDANT_REFERENCES')
+COVERAGE_CHUNK_SIZE = get_setting('COVERAGE_CHUNK_SIZE')
 
 
 def count_reads(ref_name, bams, start=None, end=None):
@@ -136,8 +140,11 @@ class ArrayWrapper(object):
 class ReferenceStats(object):
     def __init__(self, bams,
                  n_most_abundant_refs=DEFAULT_N_MOST_ABUNDANT_REFERENCES,
-                 bins=DEFAULT_N_BINS):
+                 bins=DEFAULT_N_BINS, reference_counts=None):
+        # reference_counts, if given, should have for every bam the counts
+        # returned by get_reference_counts
         self._bams = bams
+        self._reference_counts = reference_counts
         self._bins = bins
         self._rpkms = None
         self._tot_reads = 0
@@ -154,11 +161,15 @@ class ReferenceStats(object):
 
         first_bam = True
         n_reads = 0
-        for bam in self._bams:
+        reference_counts = self._reference_counts
+        if reference_counts is None:
+            reference_counts = (get_reference_counts(bam.filename)
+                                for bam in self._bams)
+        for bam, bam_counts in izip(self._bams, reference_counts):
             if bam.nreferences != nreferences:
                 msg = 'BAM files should have the same references'
                 raise ValueError(msg)
-            for index, count in enumerate(get_reference_counts(bam.filename)):
+            for index, count in enumerate(bam_counts):
                 n_reads += count['unmapped_reads'] + count['mapped_reads']
                 if count['reference'] is None:
                     # some non-mapped reads have reference = None
@@ -344,20 +355,173 @@ def calculate_window(start, end, window_len, seq_len):
     return start, end
 
 
+def _calculate_depths(row_idxs, starts, ends, n_rows, span):
+    '''It returns an array with the depths of every row and position.
+
+    The intervals (starts and ends) should be relative to the region start
+    and be clipped to the region span.
+    '''
+    if not len(row_idxs):
+        return zeros((n_rows, span), dtype='int32')
+    row_len = span + 1
+    size = n_rows * row_len
+    row_starts = np_array(row_idxs) * row_len
+    diffs = bincount(row_starts + np_array(starts), minlength=size)
+    diffs -= bincount(row_starts + np_array(ends), minlength=size)
+    diffs = diffs.reshape(n_rows, row_len)[:, :span]
+    return diffs.cumsum(axis=1)
+
+# The reads not taken into account by the pileup 'all' stepper
+FLAGS_SKIPPED_BY_PILEUP = create_flag(['is_unmapped', 'is_not_primary',
+                                        'failed_quality', 'is_duplicate'])
+
+
+class _ChunkDepthCalculator(object):
+    '''It calculates the depth of every sample in a region with numpy.
+
+    The reads of the region are fetched once and the depth is accumulated
+    adding 1 at the start of every read and -1 at its end. The samples are
+    taken from a precomputed read group to sample mapping.
+    It can be pickled to be used by several processes, every process will
+    open its own BAMs.
+    '''
+    def __init__(self, bam_fpaths, samples, sample_by_rg, sample_by_bam,
+                 min_mapq=None):
+        self.bam_fpaths = bam_fpaths
+        self.samples = samples
+        # sample indexes
+        self._sample_by_rg = sample_by_rg
+        self._sample_by_bam = sample_by_bam
+        self.min_mapq = min_mapq
+        self._bams = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_bams'] = None
+        return state
+
+    @property
+    def bams(self):
+        if self._bams is None:
+            self._bams = [AlignmentFile(fpath) for fpath in self.bam_fpaths]
+        return self._bams
+
+    def calculate_depths(self, chrom, start, end):
+        '''It returns an array with the depth per sample (rows) and position
+
+        The depth is the number of reads that span every position, as in the
+        pysam pileup columns.
+        '''
+        span = end - start
+        min_mapq = self.min_mapq
+        sample_by_rg = self._sample_by_rg
+        sample_idxs = array('l')
+        starts = array('l')
+        ends = array('l')
+        for bam, bam_sample in zip(self.bams, self._sample_by_bam):
+            for read in bam.fetch(chrom, start, end):
+                if read.flag & FLAGS_SKIPPED_BY_PILEUP:
+                    continue
+                if min_mapq is not None and read.mapq < min_mapq:
+                    continue
+                if bam_sample is None:
+                    try:
+                        sample_idx = sample_by_rg[read.opt('RG')]
+                    except KeyError:
+                        sample_idx = sample_by_rg[None]
+                else:
+                    sample_idx = bam_sample
+                sample_idxs.append(sample_idx)
+                starts.append(max(read.reference_start - start, 0))
+                ends.append(min(read.reference_end - start, span))
+
+        return _calculate_depths(sample_idxs, starts, ends,
+                                 len(self.samples), span)
+
+    def calculate_window_coverages(self, chrom, start, end, window, step,
+                                   ref_len):
+        '''It returns the mean depth per sample for the windows that start
+        between start and end.
+
+        The mean is calculated taking one position every step.
+        '''
+        depth_end = min(end + window - 1, ref_len)
+        depths = self.calculate_depths(chrom, start, depth_end)
+        n_wins = min(end, ref_len - window + 1) - start
+        offsets = range(0, window, step)
+        sums = zeros((len(self.samples), n_wins), dtype=depths.dtype)
+        for offset in offsets:
+            sums += depths[:, offset: offset + n_wins]
+        return sums, len(offsets)
+
+    def calculate_coverage_distribs(self, chrom, start, end, window=1,
+                                    step=1, ref_len=None):
+        '''It returns a coverage: counts dict for every sample.
+
+        Only the windows with some coverage in the sample are counted.
+        '''
+        if ref_len is None:
+            ref_len = end
+        sums, n_pos = self.calculate_window_coverages(chrom, start, end,
+                                                      window, step, ref_len)
+        distribs = []
+        for sample_sums in sums:
+            sample_sums = sample_sums[sample_sums > 0]
+            if n_pos > 1:
+                # round as python does for positive numbers
+                covs = (sample_sums / n_pos + 0.5).astype(int)
+            else:
+                covs = sample_sums
+            counts = bincount(covs) if len(covs) else []
+            distribs.append({cov: int(cnt) for cov, cnt in enumerate(counts)
+                             if cnt})
+        return distribs
+
+
+_WORKER_DEPTH_CALCULATOR = None
+
+
+def _init_depth_worker(depth_calculator):
+    global _WORKER_DEPTH_CALCULATOR
+    _WORKER_DEPTH_CALCULATOR = depth_calculator
+
+
+def _calculate_coverage_distribs_in_worker(chunk):
+    return _WORKER_DEPTH_CALCULATOR.calculate_coverage_distribs(*chunk)
+
+
 class BamCoverages2(object):
+    '''It calculates the coverages per sample of a set of BAMs.
+
+    By default the coverages are calculated using the pysam pileup. If
+    chunked is True the BAMs should be indexed and the reads of every region
+    chunk are fetched once to calculate all the depths with numpy. In
+    that case the regions can be processed by several processes and the
+    depths of a sample are added across BAMs, as in the windowed
+    coverages.
+    '''
     def __init__(self, bam_fpaths, min_mapq=None, window=1,
                  sampling_win_step=1,
-                 bam_pileup_stepper='all', bam_rg_field_for_vcf_sample='SM'):
+                 bam_pileup_stepper='all', bam_rg_field_for_vcf_sample='SM',
+                 chunked=False, processes=1,
+                 chunk_size=COVERAGE_CHUNK_SIZE):
         self.min_mapq = min_mapq
         self.window = window
         self.bam_pileup_stepper = bam_pileup_stepper
         self.bam_rg_field_for_vcf_sample = bam_rg_field_for_vcf_sample
         self._cov_cache = RecentlyAddedCache(window * 2)
         self.sampling_win_step = sampling_win_step
+        self.chunked = chunked
+        self.processes = processes
+        self.chunk_size = chunk_size
         self._bams = []
         self._rgs = {}
         self._ref_lens = {}
         self._prepare_bams(bam_fpaths)
+        self._depth_calculator = None
+        self._cached_depths = None
+        if chunked:
+            self._depth_calculator = self._create_depth_calculator(bam_fpaths)
 
     def _prepare_bams(self, bam_fpaths):
         bams = []
@@ -379,6 +543,113 @@ class BamCoverages2(object):
         ref_lens = {ref: le_ for ref, le_ in zip(bam.references, bam.lengths)}
         self._ref_lens = ref_lens
 
+    def _create_depth_calculator(self, bam_fpaths):
+        samples = []
+        for sample in self.samples:
+            if sample not in samples:
+                samples.append(sample)
+        # the reads with no RG in a BAM with several read groups
+        if None not in samples:
+            samples.append(None)
+        sample_idxs = {sample: idx for idx, sample in enumerate(samples)}
+
+        sample_field = self.bam_rg_field_for_vcf_sample
+        sample_by_rg = {rg_id: sample_idxs[read_group[sample_field]]
+                        for rg_id, read_group in self._rgs.items()}
+        sample_by_rg[None] = sample_idxs[None]
+        sample_by_bam = []
+        for bam in self._bams:
+            one_sample, sample = self._if_one_sample_get_it(bam)
+            sample_by_bam.append(sample_idxs[sample] if one_sample else None)
+        return _ChunkDepthCalculator(bam_fpaths, samples, sample_by_rg,
+                                     sample_by_bam, min_mapq=self.min_mapq)
+
+    def calculate_depths(self, chrom, start=None, end=None):
+        '''It returns a dict with a numpy array of depths for every sample.
+
+        It requires indexed BAMs.
+        '''
+        if self._depth_calculator is None:
+            self._depth_calculator = self._create_depth_calculator(
+                                [bam['bam'].filename for bam in self._bams])
+        calculator = self._depth_calculator
+        if start is None:
+            start = 0
+        if end is None:
+            end = self._ref_lens[chrom]
+        depths = calculator.calculate_depths(chrom, start, end)
+        return dict(zip(calculator.samples, depths))
+
+    def _get_cached_depths(self, chrom, start, end):
+        cached = self._cached_depths
+        if (cached is None or cached[0] != chrom or start < cached[1] or
+                end > cached[2]):
+            chunk_end = min(max(start + self.chunk_size, end),
+                            self._ref_lens[chrom])
+            depths = self._depth_calculator.calculate_depths(chrom, start,
+                                                             chunk_end)
+            cached = chrom, start, chunk_end, depths
+            self._cached_depths = cached
+        return cached[3][:, start - cached[1]: end - cached[1]]
+
+    def _calculate_coverages_in_win_chunked(self, chrom, start, end):
+        depths = self._get_cached_depths(chrom, start, end)
+        positions = range(0, end - start, self.sampling_win_step)
+        if not positions:
+            return {}
+        sums = depths[:, positions].sum(axis=1)
+        samples = self._depth_calculator.samples
+        n_pos = len(positions)
+        return {sample: sample_sum / n_pos
+                for sample, sample_sum in zip(samples, sums) if sample_sum}
+
+    def _calculate_coverage_distribs_chunked(self, regions):
+        window = self.window
+        step = self.sampling_win_step
+        chunk_size = self.chunk_size
+        chunks = []
+        for chrom, start, end in regions:
+            ref_len = self._ref_lens[chrom]
+            if window > 1:
+                # the windows cover the complete reference
+                start, end = 0, ref_len - window + 1
+            if start is None:
+                start = 0
+            if end is None:
+                end = ref_len
+            for chunk_start in xrange(start, end, chunk_size):
+                chunk_end = min(chunk_start + chunk_size, end)
+                chunks.append((chrom, chunk_start, chunk_end, window, step,
+                               ref_len))
+
+        calculator = self._depth_calculator
+        if self.processes > 1:
+            workers = Pool(processes=self.processes,
+                           initializer=_init_depth_worker,
+                           initargs=(calculator,))
+            distribs = workers.imap_unordered(
+                                        _calculate_coverage_distribs_in_worker,
+                                        chunks)
+        else:
+            workers = None
+            distribs = (calculator.calculate_coverage_distribs(*chunk)
+                        for chunk in chunks)
+
+        counts = {sample: IntCounter() for sample in calculator.samples}
+        try:
+            for chunk_distribs in distribs:
+                for sample, distrib in zip(calculator.samples,
+                                           chunk_distribs):
+                    counts[sample].update(distrib)
+        finally:
+            if workers is not None:
+                workers.close()
+                workers.join()
+        if window > 1:
+            counts = {sample: cnts for sample, cnts in counts.items()
+                      if cnts}
+        return counts
+
     def _if_one_sample_get_it(self, bam):
         n_rgs = len(bam['rgs'])
         if not n_rgs:
@@ -458,6 +729,8 @@ class BamCoverages2(object):
     def calculate_coverage_in_pos(self, chrom, pos):
         start, end = calculate_window(pos, pos + 1, self.window,
                                       self._ref_lens[chrom])
+        if self.chunked:
+            return self._calculate_coverages_in_win_chunked(chrom, start, end)
         return self._calculate_coverages_in_win(chrom, start, end)
 
     def _calculate_complete_coverage_distrib(self, region):
@@ -482,6 +755,13 @@ class BamCoverages2(object):
         return covs
 
     def calculate_coverage_distrib_in_region(self, region=None):
+        if self.chunked:
+            if region is None:
+                regions = [(ref, None, None) for ref in self._ref_lens]
+            else:
+                regions = [region]
+            return self._calculate_coverage_distribs_chunked(regions)
+
         if region is None:
             if self.window == 1:
                 regions = None
@@ -690,3 +970,322 @@ def mapped_count_by_rg(bam_fpaths, mapqx=None):
             else:
                 counter_by_rg[rg]['mapped'] += 1
     return counter_by_rg
+
+
+class _DepthDistribCounter(object):
+    '''It counts the positions with every depth in a coordinate sorted BAM.
+
+    The reads are added as (reference, start, end) intervals and the depths
+    are calculated with numpy every chunk_size bases, so only the reads that
+    overlap the current chunk are kept in memory.
+    '''
+    def __init__(self, chunk_size=COVERAGE_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.counts = IntCounter()
+        self._ref = None
+        self._chunk_start = 0
+        self._last_start = 0
+        self._starts = array('l')
+        self._ends = array('l')
+
+    def add(self, ref, start, end):
+        if ref != self._ref:
+            self.flush()
+            self._ref = ref
+            self._chunk_start = 0
+            self._last_start = 0
+        if start < self._last_start:
+            raise ValueError('The BAM should be sorted by coordinate')
+        self._last_start = start
+        if start >= self._chunk_start + self.chunk_size:
+            self._count_until(start)
+        self._starts.append(start)
+        self._ends.append(end)
+
+    def _count_until(self, limit):
+        chunk_start = self._chunk_start
+        starts, ends = self._starts, self._ends
+        if starts:
+            ends = np_array(ends)
+            span = min(limit, ends.max()) - chunk_start
+            depths = _calculate_depths(zeros(len(starts), dtype=int),
+                                       np_array(starts) - chunk_start,
+                                       ends.clip(max=limit) - chunk_start,
+                                       1, span)[0]
+            for depth, count in enumerate(bincount(depths)):
+                if depth and count:
+                    self.counts[depth] += int(count)
+            # the reads that continue after the limit are kept
+            ends = ends[ends > limit]
+            self._starts = array('l', [limit] * len(ends))
+            self._ends = array('l', ends.tolist())
+        self._chunk_start = limit
+
+    def flush(self):
+        if self._ends:
+            self._count_until(max(self._ends))
+
+
+def _count_flag_bits(flags):
+    'It returns the number of reads with every SAM flag bit set'
+    counts = [0] * len(SAM_FLAG_BINARIES)
+    for flag, n_reads in flags.items():
+        for flag_index in _flag_to_binary(flag):
+            counts[flag_index] += n_reads
+    return counts
+
+
+def fetch_references(bam, references, include_unplaced):
+    'It yields the reads of the references and, optionally, the unplaced ones'
+    for reference in references:
+        for read in bam.fetch(reference):
+            yield read
+    if include_unplaced and bam.nocoordinate:
+        # the unplaced reads are found after the reads of the last reference
+        for read in bam.fetch(until_eof=True):
+            yield read
+
+
+def _collect_bam_stats(bam_fpath, references=None, include_unplaced=True,
+                       mapqx=None, min_mapq=None, flags_to_skip=0,
+                       rgs_to_keep=None):
+    '''It collects the stats of the reads in a BAM reading them once.
+
+    If references are given only its reads are read using the BAM index. In
+    that case the unplaced reads are read after them if include_unplaced is
+    True, so the last reference should be included.
+    '''
+    bam = AlignmentFile(bam_fpath)
+    default_rg = os.path.splitext(os.path.basename(bam_fpath))[0]
+    if references is None:
+        reads = bam.fetch(until_eof=True)
+        ref_ids = None
+    else:
+        reads = fetch_references(bam, references, include_unplaced)
+        ref_ids = set(bam.gettid(reference) for reference in references)
+
+    references = bam.references
+    mapped = Counter()
+    unmapped = Counter()
+    flags = Counter()
+    mapqs = IntCounter()
+    rg_counts = {}
+    depths = _DepthDistribCounter()
+    for read in reads:
+        flag = read.flag
+        if flag & flags_to_skip:
+            continue
+        mapq = read.mapq
+        if min_mapq is not None and mapq < min_mapq:
+            continue
+        try:
+            read_group = read.opt('RG')
+        except KeyError:
+            read_group = default_rg
+        if rgs_to_keep is not None and read_group not in rgs_to_keep:
+            continue
+        ref_id = read.reference_id
+        if ref_ids is not None and ref_id >= 0 and ref_id not in ref_ids:
+            # the unplaced reads should be after the reads of the last
+            # reference, but just in case
+            continue
+
+        flags[flag] += 1
+        try:
+            rg_count = rg_counts[read_group]
+        except KeyError:
+            rg_count = IntCounter({'unmapped': 0, 'mapped': 0})
+            if mapqx is not None:
+                rg_count['bigger_mapqx'] = 0
+            rg_counts[read_group] = rg_count
+        if mapqx is not None and mapq >= mapqx:
+            rg_count['bigger_mapqx'] += 1
+
+        if flag & SAM_FLAG_BITS['is_unmapped']:
+            unmapped[ref_id] += 1
+            rg_count['unmapped'] += 1
+            continue
+        mapped[ref_id] += 1
+        rg_count['mapped'] += 1
+        mapqs[mapq] += 1
+        if not flag & FLAGS_SKIPPED_BY_PILEUP:
+            end = read.reference_end
+            if end is not None:
+                depths.add(ref_id, read.reference_start, end)
+    depths.flush()
+    return {'mapped': mapped, 'unmapped': unmapped, 'flags': flags,
+            'mapqs': mapqs, 'rg_counts': rg_counts, 'coverage': depths.counts}
+
+
+def group_references(references, lengths, n_groups):
+    'It splits the references in groups with similar total lengths'
+    group_len = sum(lengths) / n_groups
+    group, group_total = [], 0
+    for reference, length in zip(references, lengths):
+        group.append(reference)
+        group_total += length
+        if group_total >= group_len:
+            yield group
+            group, group_total = [], 0
+    if group:
+        yield group
+
+
+def _collect_bam_stats_in_worker(args):
+    bam_idx, bam_fpath, kwargs = args
+    return bam_idx, _collect_bam_stats(bam_fpath, **kwargs)
+
+
+class BamStats(object):
+    '''It calculates several BAM stats reading every read only once.
+
+    It calculates the reference counts, the ReferenceStats, the MAPQ and
+    flag counts, the mapped reads by read group and the coverage
+    distribution. The indexed BAMs are processed by reference in several
+    processes, the rest are read serially.
+    The coverage is calculated for every BAM as the CoverageCounter does,
+    so the BAMs should be sorted by coordinate.
+    '''
+    def __init__(self, bam_fpaths, mapqx=None, min_mapq=None,
+                 flags_to_skip=None, rgs_to_keep=None, processes=1,
+                 n_most_abundant_refs=DEFAULT_N_MOST_ABUNDANT_REFERENCES,
+                 bins=DEFAULT_N_BINS):
+        self._bam_fpaths = bam_fpaths
+        self.mapqx = mapqx
+        self.processes = processes
+        self._bins = bins
+        self._n_most_abundant_refs = n_most_abundant_refs
+        self._collect_kwargs = {'mapqx': mapqx, 'min_mapq': min_mapq,
+                                'rgs_to_keep': rgs_to_keep}
+        if flags_to_skip:
+            self._collect_kwargs['flags_to_skip'] = create_flag(flags_to_skip)
+
+        self.reference_counts = None
+        self.mapqs = IntCounter()
+        self.flag_counts = {}
+        self.mapped_by_rg = {}
+        self.coverages = IntCounter()
+        self._reference_stats = None
+        self._collect_stats()
+
+    def _create_tasks(self):
+        tasks = []
+        for bam_idx, bam_fpath in enumerate(self._bam_fpaths):
+            bam = AlignmentFile(bam_fpath)
+            if (self.processes < 2 or not bam.is_bam or not bam.references or
+                    not bam.has_index()):
+                tasks.append((bam_idx, bam_fpath, self._collect_kwargs))
+                continue
+            for references in group_references(bam.references, bam.lengths,
+                                               self.processes * 4):
+                kwargs = self._collect_kwargs.copy()
+                kwargs['references'] = references
+                last_ref = bam.references[-1]
+                kwargs['include_unplaced'] = references[-1] == last_ref
+                tasks.append((bam_idx, bam_fpath, kwargs))
+        return tasks
+
+    def _collect_stats(self):
+        tasks = self._create_tasks()
+        if self.processes > 1:
+            workers = Pool(processes=self.processes)
+            results = workers.imap_unordered(_collect_bam_stats_in_worker,
+                                             tasks)
+        else:
+            workers = None
+            results = (_collect_bam_stats_in_worker(task) for task in tasks)
+
+        mapped = [Counter() for _ in self._bam_fpaths]
+        unmapped = [Counter() for _ in self._bam_fpaths]
+        flags = Counter()
+        mapped_by_rg = self.mapped_by_rg
+        for bam_fpath in self._bam_fpaths:
+            readgroups = get_bam_readgroups(AlignmentFile(bam_fpath))
+            if readgroups is None:
+                bam_basename = os.path.splitext(os.path.basename(bam_fpath))[0]
+                readgroups = [bam_basename]
+            else:
+                readgroups = [read_group['ID'] for read_group in readgroups]
+            for read_group in readgroups:
+                counter = IntCounter({'unmapped': 0, 'mapped': 0})
+                if self.mapqx is not None:
+                    counter['bigger_mapqx'] = 0
+                mapped_by_rg[read_group] = counter
+        try:
+            for bam_idx, stats in results:
+                mapped[bam_idx].update(stats['mapped'])
+                unmapped[bam_idx].update(stats['unmapped'])
+                flags.update(stats['flags'])
+                self.mapqs.update(stats['mapqs'])
+                self.coverages.update(stats['coverage'])
+                for read_group, counts in stats['rg_counts'].items():
+                    if read_group in mapped_by_rg:
+                        mapped_by_rg[read_group].update(counts)
+                    else:
+                        mapped_by_rg[read_group] = counts
+        finally:
+            if workers is not None:
+                workers.close()
+                workers.join()
+
+        for count, flag_bin in zip(_count_flag_bits(flags),
+                                   SAM_FLAG_BINARIES):
+            self.flag_counts[SAM_FLAGS[flag_bin]] = count
+
+        reference_counts = []
+        for bam_fpath, bam_mapped, bam_unmapped in zip(self._bam_fpaths,
+                                                       mapped, unmapped):
+            bam = AlignmentFile(bam_fpath)
+            counts = []
+            for ref_id, (ref, length) in enumerate(zip(bam.references,
+                                                       bam.lengths)):
+                counts.append({'reference': ref, 'length': length,
+                               'mapped_reads': bam_mapped[ref_id],
+                               'unmapped_reads': bam_unmapped[ref_id]})
+            counts.append({'reference': None, 'length': None,
+                           'mapped_reads': bam_mapped[-1],
+                           'unmapped_reads': bam_unmapped[-1]})
+            reference_counts.append(counts)
+        self.reference_counts = reference_counts
+
+    @property
+    def reference_stats(self):
+        if self._reference_stats is None:
+            bams = [AlignmentFile(fpath) for fpath in self._bam_fpaths]
+            n_refs = self._n_most_abundant_refs
+            self._reference_stats = ReferenceStats(
+                                        bams, n_most_abundant_refs=n_refs,
+                                        bins=self._bins,
+                                        reference_counts=self.reference_counts)
+        return self._reference_stats
+
+    def __str__(self):
+        return self.write()
+
+    def write(self, max_rpkm=None):
+        result = self.reference_stats.write(max_rpkm=max_rpkm)
+        result += '\n'
+        result += 'MAPQs\n'
+        result += '-----\n'
+        result += str(self.mapqs)
+        result += '\n'
+        result += 'Flags\n'
+        result += '-----\n'
+        result += ''.join('{}: {}\n'.format(flag, self.flag_counts[flag])
+                          for flag in sorted(self.flag_counts))
+        result += '\n'
+        result += 'Mapped reads by read group\n'
+        result += '--------------------------\n'
+        for read_group in sorted(self.mapped_by_rg):
+            counts = self.mapped_by_rg[read_group]
+            result += '{}\tmapped: {}\tunmapped: {}'.format(
+                              read_group, counts['mapped'], counts['unmapped'])
+            if self.mapqx is not None:
+                result += '\tmapq >= {}: {}'.format(self.mapqx,
+                                                    counts['bigger_mapqx'])
+            result += '\n'
+        result += '\n'
+        result += 'Coverage\n'
+        result += '--------\n'
+        result += str(self.coverages)
+        return result
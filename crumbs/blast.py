@@ -15,12 +15,16 @@
 
 import os.path
 import subprocess
+import sys
 import tempfile
+import cStringIO
+from collections import deque
+from threading import Thread
 
-from crumbs.utils.optional_modules import NCBIWWW
 from crumbs.seq.seqio import seqio, guess_seq_type, write_seqs
 from crumbs.utils.bin_utils import (check_process_finishes, popen,
                                     get_binary_path)
+from crumbs.exceptions import ExternalBinaryError
 from crumbs.utils.tags import NUCL, PROT
 from crumbs.seq.alignment_result import (filter_alignments, ELONGATED, QUERY,
                                          covered_segments_from_match_parts,
@@ -44,6 +48,10 @@ TASKS = {'blastn': ('megablast', 'blastn', 'blastn-short', 'dc-megablast',
 
 REMOTE_BLAST_DBS = ['nt', 'nr']
 
+DEF_TABBLAST_FORMAT = ['query', 'subject', 'query_length', 'subject_length',
+                       'query_start', 'query_end', 'subject_start',
+                       'subject_end', 'expect', 'identity']
+
 
 def generate_tabblast_format(fmt):
     'Given a list with fields with our names it return one with the blast ones'
@@ -131,6 +139,7 @@ def _do_blast_remote(query_fpath, database, program, out_fpath, params=None):
     if task:
         ncbi_params['service'] = task
 
+    from crumbs.utils.optional_modules import NCBIWWW
     result_handle = NCBIWWW.qblast(**ncbi_params)
     out_fhand = open(out_fpath, 'w')
     out_fhand.write(result_handle.read())
@@ -176,8 +185,8 @@ def do_blast(query_fpath, db_fpath, program, out_fpath, params=None,
                         params=params)
 
 
-def _do_blast_local(query_fpath, db_fpath, program, out_fpath, params=None):
-    'It does a blast'
+def _get_blast_cmd(query_fpath, db_fpath, program, params=None):
+    'It returns the command to run a local blast'
     if not params:
         params = {}
     evalue, task = _parse_blast_params(params, program)
@@ -191,13 +200,20 @@ def _do_blast_local(query_fpath, db_fpath, program, out_fpath, params=None):
     if program not in ('blastn', 'blastp', 'blastx', 'tblastx', 'tblastn'):
         raise ValueError('The given program is invalid: ' + str(program))
     binary = get_binary_path(program)
-    cmd = [binary, '-query', query_fpath, '-db', db_fpath, '-out', out_fpath]
+    cmd = [binary, '-query', query_fpath, '-db', db_fpath]
     cmd.extend(['-evalue', str(evalue), '-outfmt', str(outfmt)])
     if task:
         cmd.extend(['-task', task])
     if params:
         for key, value in params.viewitems():
             cmd.extend(('-' + key, str(value)))
+    return cmd
+
+
+def _do_blast_local(query_fpath, db_fpath, program, out_fpath, params=None):
+    'It does a blast'
+    cmd = _get_blast_cmd(query_fpath, db_fpath, program, params=params)
+    cmd.extend(['-out', out_fpath])
     process = popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     check_process_finishes(process, binary=cmd[0])
 
@@ -222,9 +238,7 @@ def _do_blast_2(db_fpath, queries, program, dbtype=None, blast_format=None,
     else:
         blastdb = get_or_create_blastdb(db_fpath, dbtype=dbtype)
         if blast_format is None:
-            blast_format = ['query', 'subject', 'query_length', 'subject_length',
-                            'query_start', 'query_end', 'subject_start',
-                            'subject_end', 'expect', 'identity', ]
+            blast_format = DEF_TABBLAST_FORMAT
         fmt = generate_tabblast_format(blast_format)
 
     if params is None:
@@ -242,6 +256,126 @@ def _do_blast_2(db_fpath, queries, program, dbtype=None, blast_format=None,
     return blasts, blast_fhand
 
 
+class _BlastJob(object):
+    '''It blasts a packet of queries in a thread.
+
+    The queries are written to the blast stdin by another thread and the
+    tabular output is parsed while blast is writing it.
+    '''
+    def __init__(self, queries, cmd, blast_format):
+        self.blasts = []
+        self._cmd = cmd
+        self._blast_format = blast_format
+        self._process = None
+        self._error = None
+        self._thread = None
+        if queries:
+            self._thread = Thread(target=self._blast, args=(queries,))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _blast(self, queries):
+        try:
+            query_buffer = cStringIO.StringIO()
+            write_seqs(queries, query_buffer, file_format='fasta')
+            stderr = tempfile.TemporaryFile()
+            self._process = popen(self._cmd, stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE, stderr=stderr,
+                                  bufsize=-1)
+            writer = Thread(target=_write_to_stdin,
+                            args=(self._process.stdin,
+                                  query_buffer.getvalue()))
+            writer.daemon = True
+            writer.start()
+            lines = iter(self._process.stdout.readline, '')
+            self.blasts = list(TabularBlastParser(lines, self._blast_format))
+            writer.join()
+            self._process.stdout.close()
+            self._process.wait()
+            if self._process.returncode:
+                stderr.seek(0)
+                msg = '{:s} had a problem running\nstderr:\n{:s}\n'
+                msg = msg.format(self._cmd[0], stderr.read())
+                raise ExternalBinaryError(msg)
+        except BaseException:
+            self._error = sys.exc_info()
+
+    def join(self):
+        'It waits for the blast and it returns its results'
+        if self._thread is not None:
+            self._thread.join()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self.blasts
+
+    def kill(self):
+        process = self._process
+        if process is not None and process.poll() is None:
+            process.kill()
+
+
+def _write_to_stdin(stdin, content):
+    try:
+        stdin.write(content)
+    except IOError, error:
+        # blast could have died, it is checked by the reader
+        if 'Broken pipe' not in str(error):
+            raise
+    finally:
+        try:
+            stdin.close()
+        except IOError:
+            pass
+
+
+def blast_packets(packets, db_fpath, program, dbtype=None, params=None,
+                  processes=1, threads=None, get_queries=None):
+    '''It blasts a stream of packets and it yields the packets and blasts.
+
+    Up to processes blasts, each one with the given number of threads, run
+    at the same time, so the next packets are being blasted while the
+    results of the previous ones are used. The blast results of every packet
+    are yielded with it in the order of the packets.
+    get_queries should return the SeqWrappers to blast for a packet, by
+    default the packet should be a list of queries.
+    '''
+    blastdb = get_or_create_blastdb(db_fpath, dbtype=dbtype)
+    params = {} if params is None else params.copy()
+    params['outfmt'] = generate_tabblast_format(DEF_TABBLAST_FORMAT)
+    if threads is not None:
+        params['num_threads'] = threads
+    cmd = _get_blast_cmd('-', blastdb, program, params=params)
+
+    jobs = deque()
+    try:
+        for packet in packets:
+            finished = None
+            if len(jobs) >= processes:
+                # the oldest blast should finish before running a new one
+                finished_packet, job = jobs.popleft()
+                finished = finished_packet, job.join()
+            queries = packet if get_queries is None else get_queries(packet)
+            jobs.append((packet, _BlastJob(queries, cmd,
+                                           DEF_TABBLAST_FORMAT)))
+            if finished is not None:
+                yield finished
+        while jobs:
+            packet, job = jobs.popleft()
+            yield packet, job.join()
+    finally:
+        for _, job in jobs:
+            job.kill()
+
+
+def index_blasts_by_query(blasts, filters=None):
+    'It filters the blasts and it returns a dict with the query names as keys'
+    if filters is not None:
+        # filter_alignments modifies the filter configurations
+        filters = [filter_.copy() for filter_ in filters]
+        blasts = filter_alignments(blasts, config=filters)
+    return {blast['query']['name']: blast for blast in blasts}
+
+
 class BlasterForFewSubjects(object):
     '''It matches the given SeqRecords against the reads in the file.
 
@@ -356,10 +490,7 @@ class Blaster(object):
         blasts, blast_fhand = _do_blast_2(blastdb, seqrecords, self.program,
                                           params=self.params, dbtype=dbtype,
                                           remote=self._remote)
-        if self.filters is not None:
-            blasts = filter_alignments(blasts, config=self.filters)
-
-        blasts = {blast['query']['name']: blast for blast in blasts}
+        blasts = index_blasts_by_query(blasts, filters=self.filters)
         blast_fhand.close()
         return blasts
 
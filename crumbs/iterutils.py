@@ -15,13 +15,17 @@
 
 import random
 import sqlite3
+import sys
+from threading import Thread
+from Queue import Queue
 from itertools import izip_longest, islice, tee, izip
 import cPickle as pickle
+from bisect import bisect_left
 from tempfile import NamedTemporaryFile
 from collections import namedtuple
 
 from crumbs.utils.optional_modules import merge_sorted
-from crumbs.exceptions import SampleSizeError
+from crumbs.exceptions import SampleSizeError, ItemsNotSortedError
 
 # pylint: disable=C0111
 
@@ -74,12 +78,13 @@ class _ListLikeDb(object):
         return item
 
 
-def sample(iterator, sample_size, in_disk=False):
+def sample(iterator, sample_size, in_disk=False, random_seed=None):
     '''It makes a sample from the given iterator.
 
     It does not keep the order.
     Since it does not know before hand the size of the iterator it has to
     keep a buffer as large as the sample size in memory (default) or in disk.
+    The same sample is taken every time if a random seed is given.
     '''
     # This implementation holds the sampled items in memory
     # Example of the algorithm seen in:
@@ -93,14 +98,15 @@ def sample(iterator, sample_size, in_disk=False):
         sample_ = _ListLikeDb()
     else:
         sample_ = []
+    randint = random.Random(random_seed).randint
     too_big_sample = True
     for index, elem in enumerate(iterator):
         if len(sample_) < sample_size:
             sample_.append(elem)
         else:
             too_big_sample = False
-            if random.randint(0, index) < sample_size:
-                sample_[random.randint(0, sample_size - 1)] = elem
+            if randint(0, index) < sample_size:
+                sample_[randint(0, sample_size - 1)] = elem
     if too_big_sample:
         raise SampleSizeError('Sample larger than population')
     return iter(sample_)
@@ -204,6 +210,41 @@ def _rolling_window_iter(iterator, window, step):
             yield items
 
 
+_END_OF_ITER = 'end_of_iter'
+_ITER_ERROR = 'iter_error'
+
+
+def _put_items_in_queue(iterable, queue):
+    try:
+        for item in iterable:
+            queue.put((None, item))
+    except BaseException:
+        queue.put((_ITER_ERROR, sys.exc_info()))
+        return
+    queue.put((_END_OF_ITER, None))
+
+
+def iter_in_thread(iterable, buffer_size=4):
+    '''It consumes the iterable in a thread and it yields its items.
+
+    At most buffer_size items are kept in memory waiting to be yielded.
+    If the iterable fails the exception is raised in the consumer.
+    '''
+    queue = Queue(maxsize=buffer_size)
+    thread = Thread(target=_put_items_in_queue, args=(iterable, queue))
+    # the thread should not keep the process alive if the consumer stops
+    thread.daemon = True
+    thread.start()
+    while True:
+        tag, item = queue.get()
+        if tag == _END_OF_ITER:
+            break
+        elif tag == _ITER_ERROR:
+            raise item[0], item[1], item[2]
+        yield item
+    thread.join()
+
+
 def _pickle_items(items, tempdir):
     fhand = NamedTemporaryFile(suffix='.pickle', dir=tempdir)
     for item in items:
@@ -612,3 +653,109 @@ class RandomAccessChromIterator(object):
             else:
                 lo = mid + 1
         return lo
+
+
+_MIN_ITEMS_TO_PURGE = 1024
+
+
+class RandomAccessRegionIterator(object):
+    '''It iterates the items keeping the ones close to the current one.
+
+    location_getter should return the chrom and position of an item and the
+    items should be sorted by them. The items of the current chrom located
+    at max_distance or less from the last yielded item are kept in a buffer.
+    '''
+    def __init__(self, iterable, location_getter, max_distance):
+        if max_distance < 0:
+            raise ValueError('max_distance should not be negative')
+        self._stream = iter(iterable)
+        self._location_getter = location_getter
+        self._max_distance = max_distance
+        self._items = []
+        self._poss = []
+        # the buffered window is [_first:] and the current item is _curr
+        self._first = 0
+        self._curr = -1
+        self.chrom = None
+        self._next = None
+        self._read_next()
+
+    def _read_next(self):
+        prev = self._next
+        try:
+            item = self._stream.next()
+        except StopIteration:
+            self._next = None
+            return
+        chrom, pos = self._location_getter(item)
+        if prev is not None and prev[0] == chrom and pos < prev[1]:
+            raise ItemsNotSortedError('The items should be sorted by location')
+        self._next = chrom, pos, item
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        self._curr += 1
+        if self._curr >= len(self._items):
+            # no item close to the previous one remains, we start a new buffer
+            if self._next is None:
+                raise StopIteration
+            self.chrom = self._next[0]
+            self._items, self._poss = [], []
+            self._first, self._curr = 0, 0
+        items, poss = self._items, self._poss
+        chrom = self.chrom
+        max_distance = self._max_distance
+
+        pos = poss[self._curr] if poss else self._next[1]
+        max_pos = pos + max_distance
+        while self._next is not None:
+            next_chrom, next_pos, next_item = self._next
+            if next_chrom != chrom or next_pos > max_pos:
+                break
+            items.append(next_item)
+            poss.append(next_pos)
+            self._read_next()
+
+        min_pos = pos - max_distance
+        first = self._first
+        while poss[first] < min_pos:
+            first += 1
+        if first > _MIN_ITEMS_TO_PURGE and first * 2 > len(poss):
+            del items[:first]
+            del poss[:first]
+            self._curr -= first
+            first = 0
+        self._first = first
+        return items[self._curr]
+
+    @property
+    def pos(self):
+        return self._poss[self._curr]
+
+    def count_close(self):
+        'It returns the number of items at max_distance or less (itself too)'
+        return len(self._poss) - self._first
+
+    def close_items(self):
+        return self._items[self._first:]
+
+    def _region_idxs(self, start, end):
+        pos, max_distance = self.pos, self._max_distance
+        if start < pos - max_distance or end > pos + max_distance + 1:
+            raise IndexError('given region bigger than buffered window')
+        poss = self._poss
+        start_idx = bisect_left(poss, start, self._first)
+        end_idx = bisect_left(poss, end, start_idx)
+        return start_idx, end_idx
+
+    def fetch(self, start, end):
+        'It returns the items of the current chrom located in [start, end)'
+        start_idx, end_idx = self._region_idxs(start, end)
+        return self._items[start_idx:end_idx]
+
+    def count(self, start, end):
+        'It counts the items of the current chrom located in [start, end)'
+        start_idx, end_idx = self._region_idxs(start, end)
+        return end_idx - start_idx
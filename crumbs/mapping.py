@@ -206,6 +206,8 @@ def map_with_bowtie2(index_fpath, paired_fpaths=None,
 
     paired_seqs is a list of tuples, in which each tuple are paired seqs
     unpaired_seqs is a list of files
+    If unpaired_fpath is '-' the reads are read from the stdin of the
+    returned process.
     '''
     if readgroup is None:
         readgroup = {}
@@ -241,7 +243,12 @@ def map_with_bowtie2(index_fpath, paired_fpaths=None,
     else:
         stderr = open(log_fpath, 'w')
 
-    bowtie2 = popen(cmd, stderr=stderr, stdout=PIPE)
+    if unpaired_fpath == '-':
+        # the SAM is read line by line while the reads are being written
+        bowtie2 = popen(cmd, stderr=stderr, stdout=PIPE, stdin=PIPE,
+                        bufsize=-1)
+    else:
+        bowtie2 = popen(cmd, stderr=stderr, stdout=PIPE)
     return bowtie2
 
 
@@ -252,6 +259,8 @@ def map_with_hisat2(index_fpath, paired_fpaths=None,
 
     paired_seqs is a list of tuples, in which each tuple are paired seqs
     unpaired_seqs is a list of files
+    If unpaired_fpath is '-' the reads are read from the stdin of the
+    returned process.
     '''
     if readgroup is None:
         readgroup = {}
@@ -281,7 +290,12 @@ def map_with_hisat2(index_fpath, paired_fpaths=None,
             else:
                 cmd.extend(['--rg', '{0}:{1}'.format(key, value)])
 
-    hisat2 = popen(cmd, stderr=log_fhand, stdout=PIPE)
+    if unpaired_fpath == '-':
+        # the SAM is read line by line while the reads are being written
+        hisat2 = popen(cmd, stderr=log_fhand, stdout=PIPE, stdin=PIPE,
+                       bufsize=-1)
+    else:
+        hisat2 = popen(cmd, stderr=log_fhand, stdout=PIPE)
     return hisat2
 
 
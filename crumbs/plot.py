@@ -16,7 +16,6 @@
 from os.path import splitext
 
 from crumbs.exceptions import OptionalRequirementError
-from crumbs.utils.optional_modules import FigureCanvas, Figure, cm, Normalize
 
 
 FIGURE_SIZE = (15.0, 11.0)  # inche
@@ -41,6 +40,7 @@ def _guess_output_for_matplotlib(fhand):
 
 
 def get_fig_and_canvas(num_rows=1, num_cols=1, figsize=None):
+    from crumbs.utils.optional_modules import Figure, FigureCanvas
     if figsize is None:
         height = 5.0 * num_rows
         width = 7.5 * num_cols
@@ -253,6 +253,7 @@ def draw_histograms(counters, fhand, distrib_labels=None, num_cols=2,
 def get_canvas_and_axes(figure_size=FIGURE_SIZE, left=0.1, right=0.9, top=0.9,
                         bottom=0.1, plot_type=111):
     'It returns a matplotlib canvas and axes instance'
+    from crumbs.utils.optional_modules import Figure, FigureCanvas
     try:
         fig = Figure(figsize=FIGURE_SIZE)
         canvas = FigureCanvas(fig)
@@ -292,6 +293,7 @@ def build_histogram(values, fhand, bins=10, range_=None, stacked=False,
 
 def draw_scatter(groups, fhand, plot_lines=False, **kwargs):
     # groups is a list of x,y and color_intensity
+    from crumbs.utils.optional_modules import cm, Normalize
     canvas, axes = get_canvas_and_axes()
     plot_format = _guess_output_for_matplotlib(fhand)
 
@@ -0,0 +1,130 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of ngs_crumbs.
+# ngs_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# ngs_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with ngs_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''It finds the adapters in the reads with a semiglobal alignment.
+
+The reads are aligned with the adapter allowing a number of substitutions
+and indels proportional to the length of the aligned adapter. The adapters
+can be partial at the read ends.
+'''
+
+from crumbs.utils.optional_modules import (array, zeros, arange, maximum,
+                                           minimum, where, frombuffer, uint8,
+                                           int16)
+from crumbs.settings import get_setting
+from crumbs.utils.tags import FIVE_PRIME, THREE_PRIME, ANYWHERE
+
+_PADDING = '\n'
+_MAX_INT16 = 2 ** 15 - 1
+
+
+def _encode_seqs(str_seqs, max_len):
+    'It returns a matrix with a row of nucleotide codes for every seq'
+    str_seqs = ''.join([seq.upper().ljust(max_len, _PADDING)
+                        for seq in str_seqs])
+    return frombuffer(str_seqs, dtype=uint8).reshape(-1, max_len)
+
+
+def _align_to_5end(str_seqs, adapter, max_error_rate, min_overlap,
+                   anchored=False):
+    '''It returns where the adapter ends in every seq and the match score.
+
+    The adapter can be anywhere in the seq or it can lack its start if it is
+    found at the start of the seq. If anchored, the adapter has to start at
+    the seq start or before it. The edit distances are calculated for all
+    seqs at once, one adapter position at a time. The insertions in the
+    adapter, the only dependency along a row, are resolved with a cumulative
+    minimum. The end is the position after the last aligned base and -1 if
+    no alignment has an error rate low enough.
+    '''
+    num_seqs = len(str_seqs)
+    lengths = array([len(seq) for seq in str_seqs], dtype=int)
+    max_len = lengths.max()
+    nucls = _encode_seqs(str_seqs, max_len)
+    # the small ints are faster, but the errors can not overflow
+    dtype = int16 if max_len + len(adapter) < _MAX_INT16 else int
+    cols = arange(max_len + 1, dtype=dtype)
+
+    # an empty adapter aligns everywhere without errors, unless anchored
+    errors = zeros((num_seqs, max_len + 1), dtype=dtype)
+    if anchored:
+        errors += cols
+    for nucl in adapter.upper():
+        # the adapter nucleotide is not in the seq
+        new_errors = errors + 1
+        if nucl == 'N':
+            diagonal = errors[:, :-1]
+        else:
+            diagonal = errors[:, :-1] + (nucls != ord(nucl))
+        new_errors[:, 1:] = minimum(new_errors[:, 1:], diagonal)
+        # the adapter start can be out of the seq
+        new_errors[:, 0] = 0
+        # seq nucleotides not in the adapter
+        errors = minimum.accumulate(new_errors - cols, axis=1) + cols
+
+    ends = cols[1:]
+    errors = errors[:, 1:]
+    overlaps = minimum(ends, len(adapter))
+    max_errors = (overlaps * max_error_rate).astype(int)
+    aligned = ((errors <= max_errors) & (ends >= min_overlap) &
+               (ends <= lengths[:, None]))
+    scores = where(aligned, overlaps - 2 * errors, -1)
+    best_ends = scores.argmax(axis=1)
+    best_scores = scores[arange(num_seqs), best_ends]
+    best_ends = where(best_scores >= 0, best_ends + 1, -1)
+    return best_ends, best_scores
+
+
+def calc_adapter_free_regions(str_seqs, adapter, mode=THREE_PRIME,
+                        max_error_rate=get_setting('ADAPTER_MAX_ERROR_RATE'),
+                        min_overlap=get_setting('ADAPTER_MIN_OVERLAP')):
+    '''It returns the starts and ends of the seq regions left by the adapter.
+
+    In the 3' mode the adapter and the sequence after it are removed, in the
+    5' mode the adapter and the sequence before it. In the anywhere mode the
+    adapter is taken as a 5' one if its best alignment starts at the seq
+    start, or before it, and as a 3' one otherwise.
+    The ends are not included in the regions.
+    '''
+    if mode not in (FIVE_PRIME, THREE_PRIME, ANYWHERE):
+        raise ValueError('Unknown adapter mode: ' + str(mode))
+    min_overlap = max(min_overlap, 1)
+    lengths = array([len(seq) for seq in str_seqs], dtype=int)
+    starts = zeros(len(str_seqs), dtype=int)
+    ends = lengths.copy()
+    if not str_seqs or not lengths.max():
+        return starts, ends
+
+    if mode in (FIVE_PRIME, ANYWHERE):
+        ends5, scores5 = _align_to_5end(str_seqs, adapter, max_error_rate,
+                                        min_overlap,
+                                        anchored=mode == ANYWHERE)
+    if mode in (THREE_PRIME, ANYWHERE):
+        # a 3' adapter is a 5' one in the reversed seqs
+        ends3, scores3 = _align_to_5end([seq[::-1] for seq in str_seqs],
+                                        adapter[::-1], max_error_rate,
+                                        min_overlap)
+        ends3 = where(ends3 >= 0, lengths - ends3, -1)
+
+    if mode == FIVE_PRIME:
+        starts = maximum(starts, ends5)
+    elif mode == THREE_PRIME:
+        ends = where(ends3 >= 0, ends3, ends)
+    else:
+        # the ties are alignments that start at the seq start
+        is_5end = (ends5 >= 0) & (scores5 >= scores3)
+        starts = where(is_5end, ends5, starts)
+        ends = where(~is_5end & (ends3 >= 0), ends3, ends)
+    return starts, ends
@@ -60,7 +60,6 @@ import copy
 import os
 from math import log10
 
-from crumbs.utils.optional_modules import NCBIXML
 from crumbs.utils.tags import SUBJECT, QUERY, ELONGATED
 from crumbs.utils.segments_utils import merge_overlaping_segments
 
@@ -387,6 +386,7 @@ class BlastParser(object):
         # if there are no results we put None in our blast_parse results
         self._blast_parse = None
         if fhand.read(1) == '<':
+            from crumbs.utils.optional_modules import NCBIXML
             fhand.seek(0)
             self._blast_parse = NCBIXML.parse(fhand)
 
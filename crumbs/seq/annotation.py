@@ -19,14 +19,17 @@ import os.path
 from tempfile import NamedTemporaryFile
 from random import randint
 
-from crumbs.utils.optional_modules import SeqFeature, FeatureLocation
+from crumbs.utils.optional_modules import (SeqFeature, FeatureLocation,
+                                           array, zeros, arange, cumsum,
+                                           maximum, where, frombuffer, uint8)
 
 from crumbs.utils.bin_utils import (get_binary_path, popen,
                                     check_process_finishes)
-from crumbs.utils.tags import FIVE_PRIME, THREE_PRIME
-from crumbs.seq.seq import get_description, get_name, get_str_seq
+from crumbs.utils.tags import FIVE_PRIME, THREE_PRIME, SEQITEM
+from crumbs.seq.seq import (get_description, get_name, get_str_seq,
+                            get_feature_table)
 from crumbs.seq.seqio import write_seqs, read_seqs
-from crumbs.blast import Blaster
+from crumbs.blast import Blaster, blast_packets, index_blasts_by_query
 from crumbs.settings import get_setting
 
 # pylint: disable=R0903
@@ -76,7 +79,10 @@ def _read_estcan_results(pep_fhand, dna_fhand):
 
 
 class EstscanOrfAnnotator(object):
-    'It annotates the given seqrecords'
+    '''It annotates the given seqs.
+
+    The SeqRecords get SeqFeatures and the SeqItems a FeatureTable.
+    '''
     def __init__(self, usage_matrix):
         'Initiator'
         self._usage_matrix = usage_matrix
@@ -99,6 +105,10 @@ class EstscanOrfAnnotator(object):
             for (start, end, strand), str_seqs in orfs.viewitems():
                 start -= 1
                 # end is fine  -- end[
+                if seq.kind == SEQITEM:
+                    get_feature_table(seq).add('ORF', start, end, strand,
+                                               source='estscan')
+                    continue
                 feat = SeqFeature(location=FeatureLocation(start, end, strand),
                                   type='ORF', qualifiers=str_seqs)
                 feats.append(feat)
@@ -110,6 +120,62 @@ class EstscanOrfAnnotator(object):
         return seqs
 
 
+def _scan_tails(str_seqs, tail_nucl, min_len, max_cont_mismatches):
+    '''It returns the length of the tails and if the scan of the seq ended.
+
+    All seqs are scanned at once. They are joined in a byte array with a
+    separator in front of every seq that resets the counts. For every
+    position the tail and mismatch counts of the trimest loop are
+    calculated from cumulative sums taken since the last position that
+    reset them.
+    '''
+    lengths = array([len(seq) for seq in str_seqs])
+    # the position of the separator preceding every seq
+    seps = cumsum(lengths + 1) - lengths - 1
+    nucls = frombuffer(('\n' + '\n'.join(str_seqs)).upper(), dtype=uint8)
+    is_sep = nucls == ord('\n')
+    is_tail = nucls == ord(tail_nucl)
+    is_mismatch = ~(is_tail | is_sep | (nucls == ord('N')))
+    positions = arange(nucls.size)
+
+    def _count_since_last_reset(is_counted, resets):
+        counts = cumsum(is_counted)
+        last_resets = maximum.accumulate(where(resets, positions, 0))
+        return counts - counts[last_resets]
+
+    poly_counts = _count_since_last_reset(is_tail, is_mismatch | is_sep)
+    mismatch_counts = _count_since_last_reset(is_mismatch, is_tail | is_sep)
+
+    # the scan breaks after the first long enough run of mismatches
+    breaks = mismatch_counts > max_cont_mismatches
+    prev_breaks = _count_since_last_reset(breaks, is_sep) - breaks
+    in_tail = (prev_breaks == 0) & (poly_counts >= min_len) & ~is_sep
+    tail_ends = maximum.reduceat(where(in_tail, positions, 0), seps)
+    tail_lens = where(tail_ends > 0, tail_ends - seps, 0)
+    return tail_lens, maximum.reduceat(breaks, seps)
+
+
+def _calc_tail_lengths(str_seqs, tail_nucl, min_len, max_cont_mismatches,
+                       scan_len=32):
+    '''It returns the length of the tails found at the start of the seqs.
+
+    Like the trimest loop, it does not look at the whole seqs, only at a
+    prefix that is doubled for the seqs whose scan has not ended yet.
+    '''
+    tail_lens = zeros(len(str_seqs), dtype=int)
+    to_scan = arange(len(str_seqs))
+    while to_scan.size:
+        prefixes = [str_seqs[index][:scan_len] for index in to_scan]
+        prefix_tail_lens, ended = _scan_tails(prefixes, tail_nucl, min_len,
+                                              max_cont_mismatches)
+        ended |= array([len(prefix) < scan_len for prefix in prefixes],
+                       dtype=bool)
+        tail_lens[to_scan[ended]] = prefix_tail_lens[ended]
+        to_scan = to_scan[~ended]
+        scan_len *= 2
+    return tail_lens
+
+
 def _detect_polya_tail(seq, location, min_len, max_cont_mismatches):
     '''It detects 3' poylA or 5' polyT tails.
 
@@ -119,82 +185,45 @@ def _detect_polya_tail(seq, location, min_len, max_cont_mismatches):
     position won't be included in the poly-A.
     '''
     if location == FIVE_PRIME:
-        tail_nucl = 'T'
-        inc = 1
-        start = 0
-        end = len(seq)
+        tail_len = _calc_tail_lengths([seq], 'T', min_len,
+                                      max_cont_mismatches)[0]
+        result = (0, tail_len) if tail_len else None
     elif location == THREE_PRIME:
-        tail_nucl = 'A'
-        inc = -1
-        start = -1
-        end = -len(seq) - 1
+        tail_len = _calc_tail_lengths([seq[::-1]], 'A', min_len,
+                                      max_cont_mismatches)[0]
+        result = (len(seq) - tail_len, len(seq)) if tail_len else None
     else:
         msg = 'location should be five or three prime'
         raise ValueError(msg)
-
-    mismatch_count = 0
-    poly_count = 0
-    tail_len = 0
-    result = 0
-
-    for index in range(start, end, inc):
-        nucl = seq[index].upper()
-        if nucl == tail_nucl:
-            poly_count += 1
-            mismatch_count = 0
-        elif nucl == 'N':
-            pass
-        else:
-            poly_count = 0
-            mismatch_count += 1
-        if poly_count >= min_len:
-            result = tail_len + 1
-        if mismatch_count > max_cont_mismatches:
-            break
-        tail_len += 1
-    if result and location == FIVE_PRIME:
-        start = 0
-        end = result
-        result = start, end
-    elif result and location == THREE_PRIME:
-        end = len(seq)
-        start = end - result
-        result = start, end
-    else:
-        result = None
     return result
 
 
-def _annotate_polya(seq, min_len, max_cont_mismatches):
-    'It annotates the polyA with the EMBOSS trimest method'
-    str_seq = get_str_seq(seq)
-    polya = _detect_polya_tail(str_seq, THREE_PRIME, min_len,
-                               max_cont_mismatches)
-    polyt = _detect_polya_tail(str_seq, FIVE_PRIME, min_len,
-                               max_cont_mismatches)
-    a_len = polya[1] - polya[0] if polya else 0
-    t_len = polyt[1] - polyt[0] if polyt else 0
-    chosen_tail = None
-    if a_len > t_len:
-        chosen_tail = 'A'
-    elif t_len > a_len:
-        chosen_tail = 'T'
-    elif a_len and a_len == t_len:
-        if randint(0, 1):
-            chosen_tail = 'A'
-        else:
-            chosen_tail = 'T'
-    if chosen_tail:
-        strand = 1 if chosen_tail == 'A' else -1
-        start, end = polya if chosen_tail == 'A' else polyt
-        feat = SeqFeature(location=FeatureLocation(start, end, strand),
-                          type='polyA_sequence')
-        # We're assuming that the seq has a SeqRecord in it
-        seq.object.features.append(feat)
+def detect_polya_tails(str_seqs, min_len, max_cont_mismatches):
+    '''It detects the 3' poly-A or 5' poly-T tails of the given str seqs.
+
+    It uses the EMBOSS's trimest method, like _detect_polya_tail, but
+    processes all seqs at once. If a seq has both tails the longest one is
+    chosen. It returns three arrays with the start, end and strand of the
+    tail of every seq. The strand is 1 for the poly-As, -1 for the poly-Ts
+    and 0 for the seqs without tail.
+    '''
+    lengths = array([len(seq) for seq in str_seqs], dtype=int)
+    a_lens = _calc_tail_lengths([seq[::-1] for seq in str_seqs], 'A',
+                                min_len, max_cont_mismatches)
+    t_lens = _calc_tail_lengths(str_seqs, 'T', min_len, max_cont_mismatches)
+    strands = (a_lens > t_lens).astype(int) - (t_lens > a_lens)
+    for index in (((a_lens == t_lens) & (a_lens > 0)).nonzero()[0]):
+        strands[index] = 1 if randint(0, 1) else -1
+    starts = where(strands == 1, lengths - a_lens, 0)
+    ends = where(strands == 1, lengths, where(strands == -1, t_lens, 0))
+    return starts, ends, strands
 
 
 class PolyaAnnotator(object):
-    'It annotates the given seqrecords with poly-A or poly-T regions'
+    '''It annotates the given seqs with poly-A or poly-T regions.
+
+    The SeqRecords get SeqFeatures and the SeqItems a FeatureTable.
+    '''
     def __init__(self, min_len=get_setting('POLYA_ANNOTATOR_MIN_LEN'),
                 max_cont_mismatches=get_setting('POLYA_ANNOTATOR_MISMATCHES')):
         '''It inits the class.
@@ -206,18 +235,39 @@ class PolyaAnnotator(object):
         self._min_len = min_len
         self._max_cont_mismatches = max_cont_mismatches
 
+    def detect_tails(self, seqrecords):
+        '''It returns the start, end and strand arrays of the tails.
+
+        No feature is added to the seqs.
+        '''
+        str_seqs = [get_str_seq(seq) for seq in seqrecords]
+        return detect_polya_tails(str_seqs, self._min_len,
+                                  self._max_cont_mismatches)
+
     def __call__(self, seqrecords):
         'It runs the actual annotations'
-        max_cont_mismatches = self._max_cont_mismatches
-        min_len = self._min_len
-
-        for seq in seqrecords:
-            _annotate_polya(seq, min_len, max_cont_mismatches)
+        starts, ends, strands = self.detect_tails(seqrecords)
+        for seq, start, end, strand in zip(seqrecords, starts, ends, strands):
+            if not strand:
+                continue
+            if seq.kind == SEQITEM:
+                get_feature_table(seq).add('polyA_sequence', int(start),
+                                           int(end), int(strand))
+                continue
+            feat = SeqFeature(location=FeatureLocation(int(start), int(end),
+                                                       int(strand)),
+                              type='polyA_sequence')
+            # We're assuming that the seq has a SeqRecord in it
+            seq.object.features.append(feat)
         return seqrecords
 
 
 class BlastAnnotator(object):
-    'It annotates using blast'
+    '''It annotates using blast.
+
+    The SeqRecords get SeqFeatures and the SeqItems a FeatureTable with the
+    expect of the match parts as score and the blastdb as source.
+    '''
     def __init__(self, blastdb, program, dbtype=None, filters=None,
                  params=None, remote=False):
         'Initializes the class'
@@ -235,7 +285,28 @@ class BlastAnnotator(object):
         matcher = Blaster(seqrecords, self.blastdb, self._program,
                                self._dbtype, filters=self._filters,
                                params=self._params, remote=self._remote)
-        blasts = matcher.blasts
+        return self._annotate(seqrecords, matcher.blasts)
+
+    def annotate_packets(self, seq_packets, processes=1, threads=None):
+        '''It annotates a stream of packets of seqs.
+
+        Up to processes local blasts, with the given number of threads, run
+        at the same time while the previous packets are annotated.
+        '''
+        if self._remote:
+            for seqrecords in seq_packets:
+                yield self(seqrecords)
+            return
+        blasts = blast_packets(seq_packets, self.blastdb, self._program,
+                               dbtype=self._dbtype, params=self._params,
+                               processes=processes, threads=threads)
+        for seqrecords, packet_blasts in blasts:
+            packet_blasts = index_blasts_by_query(packet_blasts,
+                                                  filters=self._filters)
+            yield self._annotate(seqrecords, packet_blasts)
+
+    def _annotate(self, seqrecords, blasts):
+        'It adds the match_part features of the blasts to the seqs'
         blastdb = os.path.basename(self.blastdb)
         for seqrecord in seqrecords:
             align_result = blasts.get(get_name(seqrecord), None)
@@ -257,6 +328,12 @@ class BlastAnnotator(object):
 
                     query_start = match_part['query_start']
                     query_end = match_part['query_end']
+                    if seqrecord.kind == SEQITEM:
+                        table = get_feature_table(seqrecord)
+                        table.add('match_part', query_start, query_end,
+                                  strand, match_part['scores']['expect'],
+                                  source=blastdb)
+                        continue
                     qualifiers = {}
                     qualifiers['Target'] = {'start': subject_start,
                                             'end': subject_end,
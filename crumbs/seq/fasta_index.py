@@ -0,0 +1,235 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of ngs_crumbs.
+# ngs_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# ngs_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with ngs_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''Random access to the reference sequences through a fasta index.
+
+The index is the samtools .fai file. It is reused if it is found next to the
+fasta file and created otherwise. The sequences are read from a memory map of
+the fasta file, so only the requested regions are read from disk.
+'''
+
+import mmap
+import os
+from collections import OrderedDict, namedtuple
+
+from crumbs.exceptions import MalformedFile
+from crumbs.seq.seqio import read_seqs
+from crumbs.seq.seq import get_name, get_length
+from crumbs.utils.file_utils import peek_chunk_from_file, index_is_updated
+
+# pylint: disable=C0111
+
+FAI_EXTENSION = '.fai'
+_NEWLINE_COUNT_CHUNK = 16777216
+
+FaiEntry = namedtuple('FaiEntry', ['length', 'offset', 'line_bases',
+                                   'line_width'])
+
+
+def _count_newlines(fasta_map, start, end):
+    n_newlines = 0
+    for chunk_start in xrange(start, end, _NEWLINE_COUNT_CHUNK):
+        chunk_end = min(chunk_start + _NEWLINE_COUNT_CHUNK, end)
+        n_newlines += fasta_map[chunk_start:chunk_end].count('\n')
+    return n_newlines
+
+
+def _index_seq(fasta_map, name, start, end):
+    'It returns the FaiEntry of the sequence found between start and end'
+    # the trailing blank lines do not belong to the sequence
+    while end > start and fasta_map[end - 1] in '\r\n':
+        end -= 1
+    if end == start:
+        return FaiEntry(0, start, 0, 0)
+
+    first_newline = fasta_map.find('\n', start, end)
+    if first_newline == -1:
+        line_bases = end - start
+        line_width = line_bases + 1
+        if fasta_map[end:end + 2] == '\r\n':
+            line_width += 1
+        return FaiEntry(line_bases, start, line_bases, line_width)
+
+    line_width = first_newline + 1 - start
+    line_bases = line_width - 1
+    if fasta_map[first_newline - 1] == '\r':
+        line_bases -= 1
+    n_newlines = _count_newlines(fasta_map, start, end)
+    last_line_start = fasta_map.rfind('\n', start, end) + 1
+    last_line_bases = end - last_line_start
+    if (last_line_start - start != n_newlines * line_width or
+            not 0 < last_line_bases <= line_bases):
+        msg = 'The sequence lines should have the same length to be indexed: '
+        raise MalformedFile(msg + name)
+    length = n_newlines * line_bases + last_line_bases
+    return FaiEntry(length, start, line_bases, line_width)
+
+
+def _index_fasta_map(fasta_map):
+    'It yields the name and the FaiEntry of every sequence in the fasta map'
+    size = fasta_map.size()
+    header_start = 0
+    while header_start < size and fasta_map[header_start] in '\r\n':
+        header_start += 1
+    if header_start < size and fasta_map[header_start] != '>':
+        raise MalformedFile('The file to index should be a fasta file')
+    while header_start < size:
+        header_end = fasta_map.find('\n', header_start)
+        if header_end == -1:
+            header_end = size
+        header = fasta_map[header_start + 1:header_end].split()
+        if not header:
+            raise MalformedFile('A sequence without name was found')
+        name = header[0]
+        seq_start = min(header_end + 1, size)
+        next_header = fasta_map.find('\n>', header_end)
+        seq_end = size if next_header == -1 else next_header + 1
+        yield name, _index_seq(fasta_map, name, seq_start, seq_end)
+        header_start = seq_end
+
+
+def _open_map(fasta_fpath):
+    fhand = open(fasta_fpath, 'rb')
+    if not os.path.getsize(fasta_fpath):
+        # empty files can not be mapped
+        fhand.close()
+        return None
+    fasta_map = mmap.mmap(fhand.fileno(), 0, access=mmap.ACCESS_READ)
+    fhand.close()
+    return fasta_map
+
+
+def index_fasta(fasta_fpath):
+    '''It returns the fasta index of the given fasta file.
+
+    The index is an OrderedDict with a FaiEntry for every sequence name.
+    The file should be an uncompressed fasta file.
+    '''
+    fasta_map = _open_map(fasta_fpath)
+    index = OrderedDict()
+    if fasta_map is None:
+        return index
+    for name, entry in _index_fasta_map(fasta_map):
+        if name in index:
+            raise MalformedFile('Duplicated sequence name in fasta: ' + name)
+        index[name] = entry
+    fasta_map.close()
+    return index
+
+
+def write_fai(index, fai_fhand):
+    'It writes the index in the samtools .fai format'
+    for name, entry in index.items():
+        fai_fhand.write('\t'.join([name] + [str(field) for field in entry]))
+        fai_fhand.write('\n')
+    fai_fhand.flush()
+
+
+def read_fai(fai_fhand):
+    'It reads a samtools .fai file'
+    index = OrderedDict()
+    for line in fai_fhand:
+        line = line.rstrip()
+        if not line:
+            continue
+        items = line.split('\t')
+        index[items[0]] = FaiEntry(*[int(item) for item in items[1:5]])
+    return index
+
+
+def _get_fasta_index(fasta_fpath, fai_fpath=None):
+    '''It reads the .fai file or it creates it if it is missing or outdated.
+
+    If the .fai file can not be written the index is just kept in memory.
+    '''
+    if fai_fpath is None:
+        fai_fpath = fasta_fpath + FAI_EXTENSION
+    if index_is_updated(fasta_fpath, fai_fpath):
+        with open(fai_fpath) as fai_fhand:
+            return read_fai(fai_fhand)
+    index = index_fasta(fasta_fpath)
+    try:
+        with open(fai_fpath, 'w') as fai_fhand:
+            write_fai(index, fai_fhand)
+    except (IOError, OSError):
+        pass
+    return index
+
+
+class FastaReference(object):
+    '''It gives access to the lengths and regions of the reference seqs.
+
+    The regions are read from a memory map of the fasta file using the
+    .fai index, so the sequences are never parsed.
+    '''
+    def __init__(self, fasta_fpath, fai_fpath=None):
+        self.fpath = fasta_fpath
+        self._index = _get_fasta_index(fasta_fpath, fai_fpath=fai_fpath)
+        self._map = _open_map(fasta_fpath)
+
+    @property
+    def names(self):
+        return self._index.keys()
+
+    @property
+    def lengths(self):
+        return OrderedDict((name, entry.length)
+                           for name, entry in self._index.items())
+
+    def length(self, chrom):
+        return self._index[chrom].length
+
+    def __contains__(self, chrom):
+        return chrom in self._index
+
+    def fetch(self, chrom, start=0, end=None):
+        '''It returns the sequence str found between start and end.
+
+        The coordinates are 0-based and the end is not included, they are
+        clipped to the sequence limits.
+        '''
+        entry = self._index[chrom]
+        start = max(start, 0)
+        end = entry.length if end is None else min(end, entry.length)
+        if start >= end:
+            return ''
+        line_bases, line_width = entry.line_bases, entry.line_width
+        byte_start = (entry.offset + (start // line_bases) * line_width +
+                      start % line_bases)
+        last = end - 1
+        byte_end = (entry.offset + (last // line_bases) * line_width +
+                    last % line_bases + 1)
+        seq = self._map[byte_start:byte_end]
+        if byte_end - byte_start != end - start:
+            seq = seq.replace('\n', '').replace('\r', '')
+        return seq
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+
+
+def get_fasta_lengths(fhand):
+    '''It returns an OrderedDict with the lengths of the seqs in the file.
+
+    If the fhand is an uncompressed fasta file in disk the lengths are taken from
+    its .fai index, otherwise the seqs are read.
+    '''
+    fpath = getattr(fhand, 'name', None)
+    if (fpath is not None and os.path.isfile(fpath) and
+            peek_chunk_from_file(fhand, 1) == '>'):
+        return FastaReference(fpath).lengths
+    return OrderedDict((get_name(seq), get_length(seq))
+                       for seq in read_seqs([fhand]))
@@ -17,14 +17,21 @@
 # pylint: disable=C0111
 
 from __future__ import division
+import sys
+from itertools import chain
 from tempfile import NamedTemporaryFile
+from threading import Thread
+from Queue import Queue
+import cStringIO
 
 from crumbs.utils.tags import (SEQS_PASSED, SEQS_FILTERED_OUT, SEQITEM,
-                               SEQRECORD)
+                               SEQRECORD, FEATURE_TABLE)
 from crumbs.seq.utils.seq_utils import uppercase_length, get_uppercase_segments
-from crumbs.seq.seq import get_name, get_file_format, get_str_seq, get_length
+from crumbs.seq.seq import (get_name, get_file_format, get_str_seq,
+                            get_length, get_annotations)
 from crumbs.exceptions import WrongFormatError
-from crumbs.blast import Blaster, BlasterForFewSubjects
+from crumbs.blast import (Blaster, BlasterForFewSubjects, blast_packets,
+                          index_blasts_by_query)
 from crumbs.statistics import calculate_dust_score
 from crumbs.settings import get_setting
 from crumbs.mapping import map_with_bowtie2, map_process_to_bam
@@ -32,6 +39,10 @@ from crumbs.seq.seqio import write_seqs
 from crumbs.seq.pairs import group_pairs, group_pairs_by_name
 from crumbs.utils.optional_modules import AlignmentFile
 
+_SAM_UNMAPPED = 0x4
+_SAM_SECONDARY = 0x100
+_SAM_SUPPLEMENTARY = 0x800
+
 
 def seq_to_filterpackets(seq_packets, group_paired_reads=False):
     'It yields packets suitable for the filters'
@@ -61,6 +72,9 @@ class _BaseFilter(object):
 
     def __call__(self, filterpacket):
         self._setup_checks(filterpacket)
+        return self._check_packet(filterpacket)
+
+    def _check_packet(self, filterpacket):
         reverse = self.reverse
         failed_drags_pair = self.failed_drags_pair
         seqs_passed = []
@@ -95,8 +109,12 @@ class FilterByFeatureTypes(_BaseFilter):
                                            failed_drags_pair=failed_drags_pair)
 
     def _do_check(self, seq):
-        seq = seq.object
-        f_in_seq = [f.type for f in seq.features if f.type in self._feat_types]
+        if seq.kind == SEQITEM:
+            table = get_annotations(seq).get(FEATURE_TABLE, None)
+            types = [] if table is None else table.types
+        else:
+            types = [f.type for f in seq.object.features]
+        f_in_seq = [type_ for type_ in types if type_ in self._feat_types]
         return True if f_in_seq else False
 
 
@@ -260,30 +278,163 @@ class FilterBlastShort(_BaseFilter):
 class FilterBlastMatch(_BaseFilter):
     'It filters a seq if there is a match against a blastdb'
     def __init__(self, database, program, filters, dbtype=None,
-                 failed_drags_pair=True, reverse=False):
+                 failed_drags_pair=True, reverse=False, threads=None):
         '''The initiator
             database: path to a file with seqs or a blast database
             filter_params:
                 expect_threshold
                 similarty treshlod
                 min_length_percentaje
+            threads: number of threads for every blast
         '''
         self._blast_db = database
         self._blast_program = program
         self._filters = filters
         self._dbtype = dbtype
+        self.threads = threads
         super(FilterBlastMatch, self).__init__(reverse=reverse,
                                           failed_drags_pair=failed_drags_pair)
 
     def _setup_checks(self, filterpacket):
         seqs = [s for seqs in filterpacket[SEQS_PASSED]for s in seqs]
-        self._matcher = Blaster(seqs, self._blast_db, dbtype=self._dbtype,
-                                program=self._blast_program,
-                                filters=self._filters)
+        params = None if self.threads is None else {'num_threads':
+                                                    self.threads}
+        matcher = Blaster(seqs, self._blast_db, dbtype=self._dbtype,
+                          program=self._blast_program, filters=self._filters,
+                          params=params)
+        self._matched_seqs = matcher.blasts
 
     def _do_check(self, seq):
-        segments = self._matcher.get_matched_segments(get_name(seq))
-        return True if segments is None else False
+        return False if get_name(seq) in self._matched_seqs else True
+
+    def filter_packets(self, filterpackets, processes=1):
+        '''It filters a stream of filter packets.
+
+        The packets are blasted by up to processes blasts at the same time
+        while the previous packets are filtered.
+        '''
+        get_seqs = lambda packet: [seq for seqs in packet[SEQS_PASSED]
+                                   for seq in seqs]
+        blasts = blast_packets(filterpackets, self._blast_db,
+                               self._blast_program, dbtype=self._dbtype,
+                               processes=processes, threads=self.threads,
+                               get_queries=get_seqs)
+        for filterpacket, packet_blasts in blasts:
+            self._matched_seqs = index_blasts_by_query(packet_blasts,
+                                                       filters=self._filters)
+            yield self._check_packet(filterpacket)
+
+
+def _get_bowtie2_input_format(seq):
+    'It returns the file format and the bowtie2 params to map the seq'
+    seq_class = seq.kind
+    extra_params = []
+    # Which format do we need for the bowtie2 input read file fasta or
+    # fastq?
+    if seq_class == SEQRECORD:
+        if 'phred_quality' in seq.object.letter_annotations.viewkeys():
+            file_format = 'fastq'
+        else:
+            extra_params.append('-f')
+            file_format = 'fasta'
+    elif seq_class == SEQITEM:
+        file_format = get_file_format(seq)
+        if 'illumina' in file_format:
+            extra_params.append('--phred64')
+        elif 'fasta' in file_format:
+            extra_params.append('-f')
+        elif 'fastq' in file_format:
+            pass
+        else:
+            msg = 'For FilterBowtie2Match and SeqItems fastq or fasta '
+            msg += 'files are required'
+            raise RuntimeError(msg)
+    else:
+        raise NotImplementedError()
+    return file_format, extra_params
+
+
+def _read_mapped_reads_from_sam(sam_lines, num_reads, min_mapq=0):
+    '''It returns the names of the mapped reads found in the next records.
+
+    Only the given number of primary records are read from the SAM lines.
+    '''
+    mapped_reads = set()
+    while num_reads:
+        try:
+            line = sam_lines.next()
+        except StopIteration:
+            raise RuntimeError('Error in mapping process')
+        if line.startswith('@'):
+            continue
+        items = line.split('\t', 5)
+        flag = int(items[1])
+        if flag & (_SAM_SECONDARY | _SAM_SUPPLEMENTARY):
+            continue
+        num_reads -= 1
+        if (not flag & _SAM_UNMAPPED and
+                (not min_mapq or int(items[4]) > min_mapq)):
+            mapped_reads.add(items[0])
+    return mapped_reads
+
+
+class _Bowtie2Feeder(object):
+    '''It writes the seqs of the filter packets to bowtie2 in a thread.
+
+    Every packet is queued, with its number of seqs, before being written,
+    so the SAM reader knows which packet the next records belong to.
+    '''
+    def __init__(self, filterpackets, file_format, map_process):
+        self._filterpackets = filterpackets
+        self._file_format = file_format
+        self._map_process = map_process
+        self.packets = Queue()
+        self._stopped = False
+        self._error = None
+        self._thread = Thread(target=self._write_packets)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write_packets(self):
+        stdin = self._map_process.stdin
+        try:
+            for filterpacket in self._filterpackets:
+                if self._stopped:
+                    break
+                seqs = [seq for seqs in filterpacket[SEQS_PASSED]
+                        for seq in seqs]
+                self.packets.put((filterpacket, len(seqs)))
+                if not seqs:
+                    continue
+                buffer_ = cStringIO.StringIO()
+                write_seqs(seqs, buffer_, file_format=self._file_format)
+                try:
+                    stdin.write(buffer_.getvalue())
+                except IOError, error:
+                    # bowtie2 could have died, it is checked by the reader
+                    if 'Broken pipe' not in str(error):
+                        raise
+                    break
+        except BaseException:
+            self._error = sys.exc_info()
+        finally:
+            self.packets.put(None)
+            try:
+                stdin.close()
+            except IOError:
+                pass
+
+    def stop(self):
+        'It stops writing packets and waits for the thread to finish'
+        self._stopped = True
+        self._thread.join()
+
+    def join(self):
+        'It waits until every packet has been written'
+        self._thread.join()
+        error = self._error
+        if error is not None:
+            raise error[0], error[1], error[2]
 
 
 class FilterBowtie2Match(_BaseFilter):
@@ -300,30 +451,7 @@ class FilterBowtie2Match(_BaseFilter):
     def _setup_checks(self, filterpacket):
         index_fpath = self._index_fpath
         seqs = [s for seqs in filterpacket[SEQS_PASSED]for s in seqs]
-        seq_class = seqs[0].kind
-        extra_params = []
-        # Which format do we need for the bowtie2 input read file fasta or
-        # fastq?
-        if seq_class == SEQRECORD:
-            if 'phred_quality' in seqs[0].object.letter_annotations.viewkeys():
-                file_format = 'fastq'
-            else:
-                extra_params.append('-f')
-                file_format = 'fasta'
-        elif seq_class == SEQITEM:
-            file_format = get_file_format(seqs[0])
-            if 'illumina' in file_format:
-                extra_params.append('--phred64')
-            elif 'fasta' in file_format:
-                extra_params.append('-f')
-            elif 'fastq' in file_format:
-                pass
-            else:
-                msg = 'For FilterBowtie2Match and SeqItems fastq or fasta '
-                msg += 'files are required'
-                raise RuntimeError(msg)
-        else:
-            raise NotImplementedError()
+        file_format, extra_params = _get_bowtie2_input_format(seqs[0])
 
         reads_fhand = NamedTemporaryFile(suffix=file_format)
         write_seqs(seqs, reads_fhand, file_format=file_format)
@@ -341,6 +469,58 @@ class FilterBowtie2Match(_BaseFilter):
     def _do_check(self, seq):
         return False if get_name(seq) in self.mapped_reads else True
 
+    def filter_packets(self, filterpackets):
+        '''It filters a stream of filter packets with one bowtie2 process.
+
+        The index is loaded only once. The seqs are streamed to bowtie2 by
+        a thread that also reads the next packets, while the SAM of the
+        previous ones is parsed from bowtie2 stdout, so no temporary files
+        are required.
+        '''
+        filterpackets = iter(filterpackets)
+        first_packets = []
+        first_seq = None
+        for filterpacket in filterpackets:
+            first_packets.append(filterpacket)
+            if filterpacket[SEQS_PASSED]:
+                first_seq = filterpacket[SEQS_PASSED][0][0]
+                break
+        if first_seq is None:
+            self.mapped_reads = set()
+            for filterpacket in first_packets:
+                yield self._check_packet(filterpacket)
+            return
+
+        file_format, extra_params = _get_bowtie2_input_format(first_seq)
+        # the SAM records have to be in the same order as the reads
+        extra_params.append('--reorder')
+        map_process = map_with_bowtie2(self._index_fpath, unpaired_fpath='-',
+                                       extra_params=extra_params,
+                                       threads=self.threads)
+        feeder = _Bowtie2Feeder(chain(first_packets, filterpackets),
+                                file_format, map_process)
+        sam_lines = iter(map_process.stdout.readline, '')
+        try:
+            while True:
+                packet = feeder.packets.get()
+                if packet is None:
+                    break
+                filterpacket, num_seqs = packet
+                self.mapped_reads = _read_mapped_reads_from_sam(sam_lines,
+                                                                num_seqs,
+                                                                self.min_mapq)
+                yield self._check_packet(filterpacket)
+            feeder.join()
+            map_process.stdout.close()
+            map_process.wait()
+            if map_process.returncode:
+                raise RuntimeError('Error in mapping process')
+        finally:
+            if map_process.poll() is None:
+                map_process.kill()
+                map_process.wait()
+            feeder.stop()
+
 
 class FilterDustComplexity(_BaseFilter):
     'It filters a sequence according to its dust score'
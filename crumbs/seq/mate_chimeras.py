@@ -15,18 +15,37 @@
 
 
 from __future__ import division
+import re
 from tempfile import NamedTemporaryFile
+from collections import namedtuple
+from itertools import groupby, chain
+from operator import attrgetter
+from multiprocessing import Pool
 
 from crumbs.utils.tags import (SEQS_PASSED, SEQS_FILTERED_OUT, CHIMERA,
                                NON_CHIMERIC, UNKNOWN)
 from crumbs.statistics import IntCounter
 from crumbs.settings import get_setting
-from crumbs.mapping import (map_process_to_sortedbam, map_with_bwamem,
-                            alignedread_to_seqitem)
-from crumbs.seq.seqio import write_seqs
+from crumbs.mapping import map_with_bwamem, alignedread_to_seqitem
+from crumbs.seq.seqio import write_seqs, read_seqs
+from crumbs.iterutils import group_in_packets, sample
+from crumbs.exceptions import SampleSizeError
 from crumbs.seq.pairs import group_pairs, group_pairs_by_name
 from crumbs.utils.optional_modules import AlignmentFile
 
+# We add a tag to differenciate between mates afterwards. This tag should
+# be probably taken from the file
+MATE_TAGS = (' 1:N:0:GATCAG', ' 2:N:0:GATCAG')
+
+_CIGAR_OPS = 'MIDNSHP=X'
+_CIGAR_RE = re.compile(r'(\d+)([MIDNSHP=X])')
+# the operations that consume the reference: M, D, N, = and X
+_REF_CIGAR_OPS = (0, 2, 3, 7, 8)
+_PAIR_PACKET_SIZE = 1000
+_OUTIES = 'outies'
+_INNIES = 'innies'
+_OTHERS = 'others'
+
 
 def seq_to_filterpackets(seq_packets, group_paired_reads=False):
     'It yields packets suitable for the filters'
@@ -56,16 +75,14 @@ def _group_alignments_reads_by_qname(sorted_alignments):
 
 
 def _split_mates(alignments_group):
-    # We add a tag to differenciate between mates afterwards. This tag should
-    # be probably taken from the file
     forwards = []
     reverses = []
     for alignment_read in alignments_group:
         if alignment_read.is_read1:
-            alignment_read.qname += ' 1:N:0:GATCAG'
+            alignment_read.qname += MATE_TAGS[0]
             forwards.append(alignment_read)
         elif alignment_read.is_read2:
-            alignment_read.qname += ' 2:N:0:GATCAG'
+            alignment_read.qname += MATE_TAGS[1]
             reverses.append(alignment_read)
     return [forwards, reverses]
 
@@ -76,13 +93,6 @@ def _get_primary_alignment(alignments_group):
             return alignment
 
 
-def _get_ref_lengths(samfile):
-    lengths = {}
-    for ref in samfile.header['SQ']:
-        lengths[ref['SN']] = ref['LN']
-    return lengths
-
-
 def _count_cigar_char(cigar, numbers):
     counts = 0
     for element in cigar:
@@ -91,18 +101,6 @@ def _count_cigar_char(cigar, numbers):
     return counts
 
 
-def _find_distances_to_ends(alignment_read, samfile, reference_lengths):
-
-    start = alignment_read.pos
-    end = alignment_read.aend
-    name = samfile.getrname(alignment_read.rname)
-    length = reference_lengths[name]
-    if alignment_read.is_reverse:
-        start = alignment_read.aend
-        end = alignment_read.pos
-    return [start, length - end]
-
-
 def _read_is_totally_mapped(alignments_group, max_clipping):
     for alignment_read in alignments_group:
         if alignment_read.is_unmapped:
@@ -155,28 +153,6 @@ def _3end_mapped(alignment_read, max_clipping):
         return alignment_qend > alignment_qlen - max_clipping_positions
 
 
-def _find_distance(aligned_reads):
-    'It returns distance between two aligned_reads in the reference seq'
-    aligned_reads.sort(key=lambda x: x.pos)
-    return aligned_reads[1].aend - aligned_reads[0].pos
-
-
-def _mates_are_outies(mates):
-    mates.sort(key=lambda x: x.pos)
-    return mates[0].is_reverse and (not mates[1].is_reverse)
-
-
-def _mates_are_innies(mates):
-    mates.sort(key=lambda x: x.pos)
-    return (not mates[0].is_reverse) and mates[1].is_reverse
-
-
-def _get_totally_mapped_alignments(reads, max_clipping):
-    for aligned_read in reads:
-        if _read_is_totally_mapped([aligned_read], max_clipping):
-            yield aligned_read
-
-
 def _5end_mapped(aligned_read, max_clipping):
     if aligned_read.is_unmapped:
         return False
@@ -190,169 +166,395 @@ def _5end_mapped(aligned_read, max_clipping):
         return aligned_read_qstart < max_clipping_positions
 
 
-def _mates_are_not_chimeric(mates, max_clipping, mate_length_range, bamfile,
-                            reference_lengths):
-    for aligned_read1 in _get_totally_mapped_alignments(mates[0],
-                                                        max_clipping):
-        distances_to_end1 = _find_distances_to_ends(aligned_read1, bamfile,
-                                                    reference_lengths)
-        for aligned_read2 in _get_totally_mapped_alignments(mates[1],
-                                                            max_clipping):
-            if aligned_read1.rname == aligned_read2.rname:
-                aligned_reads = [aligned_read1, aligned_read2]
-                distance = _find_distance(aligned_reads)
-                # print 'distance: ', distance
-                if (_mates_are_outies(aligned_reads) and
-                    distance > mate_length_range[0] and
-                    distance < mate_length_range[1]):
+class _SamRecord(namedtuple('_SamRecord', ['qname', 'flag', 'reference',
+                                           'pos', 'cigar', 'seq', 'qual'])):
+    '''A light alignment that can be pickled and sent to other processes.
+
+    It has the AlignedSegment attributes used by the classification.
+    '''
+    __slots__ = ()
+
+    @property
+    def is_unmapped(self):
+        return bool(self.flag & 0x4)
+
+    @property
+    def is_reverse(self):
+        return bool(self.flag & 0x10)
+
+    @property
+    def is_read1(self):
+        return bool(self.flag & 0x40)
+
+    @property
+    def is_read2(self):
+        return bool(self.flag & 0x80)
+
+    @property
+    def is_secondary(self):
+        return bool(self.flag & 0x100)
+
+    @property
+    def alen(self):
+        return sum(length for operation, length in self.cigar
+                   if operation in _REF_CIGAR_OPS)
+
+    @property
+    def aend(self):
+        return self.pos + self.alen
+
+
+# The distance behind is the distance from the alignment to the reference end
+# that the read is not pointing to, the distance ahead is the distance to the
+# reference end that it points to.
+_MappedMate = namedtuple('_MappedMate', ['reference', 'pos', 'aend',
+                                         'is_reverse', 'is_totally_mapped',
+                                         'is_3end_mapped', 'distance_behind',
+                                         'distance_ahead'])
+
+
+def _parse_sam_line(line):
+    items = line.split('\t', 11)
+    reference = None if items[2] == '*' else items[2]
+    cigar = [(_CIGAR_OPS.index(operation), int(length))
+             for length, operation in _CIGAR_RE.findall(items[5])]
+    seq = None if items[9] == '*' else items[9]
+    qual = items[10].rstrip('\n')
+    qual = None if qual == '*' else qual
+    return _SamRecord(items[0], int(items[1]), reference, int(items[3]) - 1,
+                      cigar, seq, qual)
+
+
+def _read_sam(sam_lines):
+    '''It returns the reference lengths and the records found in a SAM.
+
+    The SAM lines are consumed as they are required, so a stream can be
+    given.
+    '''
+    sam_lines = iter(sam_lines)
+    ref_lengths = {}
+    first_line = None
+    for line in sam_lines:
+        if not line.startswith('@'):
+            first_line = line
+            break
+        if line.startswith('@SQ'):
+            fields = dict(field.split(':', 1)
+                          for field in line.rstrip('\n').split('\t')[1:])
+            ref_lengths[fields['SN']] = int(fields['LN'])
+    if first_line is None:
+        return ref_lengths, iter([])
+    records = (_parse_sam_line(line)
+               for line in chain([first_line], sam_lines) if line.strip())
+    return ref_lengths, records
+
+
+def _read_bam(bamfile):
+    'It returns the reference lengths and the records found in a BAM'
+    references = bamfile.references
+    ref_lengths = dict(zip(references, bamfile.lengths))
+    records = (_SamRecord(read.qname, read.flag,
+                          references[read.rname] if read.rname >= 0 else None,
+                          read.pos, read.cigar or [], read.seq, read.qual)
+               for read in bamfile)
+    return ref_lengths, records
+
+
+def _group_records_by_qname(records):
+    for _, group in groupby(records, key=attrgetter('qname')):
+        yield list(group)
+
+
+def _summarize_alignment(record, ref_lengths, max_clipping):
+    'It calculates the clipping and the distances to the ends once'
+    length = ref_lengths[record.reference]
+    if record.is_reverse:
+        distance_behind, distance_ahead = length - record.pos, record.aend
+    else:
+        distance_behind, distance_ahead = record.pos, length - record.aend
+    return _MappedMate(record.reference, record.pos, record.aend,
+                       record.is_reverse,
+                       _read_is_totally_mapped([record], max_clipping),
+                       _3end_mapped(record, max_clipping), distance_behind,
+                       distance_ahead)
+
+
+def _summarize_mates(records, ref_lengths, max_clipping):
+    '''It returns the mapped alignments and the primary one for each mate.
+
+    The mates are told apart by the read1 and read2 flags.
+    '''
+    mates = ([], [])
+    primaries = [None, None]
+    for record in records:
+        if record.is_read1:
+            mate_idx = 0
+        elif record.is_read2:
+            mate_idx = 1
+        else:
+            continue
+        if primaries[mate_idx] is None and not record.is_secondary:
+            primaries[mate_idx] = record
+        if not record.is_unmapped:
+            mates[mate_idx].append(_summarize_alignment(record, ref_lengths,
+                                                        max_clipping))
+    return mates, primaries
+
+
+def _get_layout(alignment1, alignment2):
+    'It returns the distance and the orientation of two alignments'
+    first, second = sorted((alignment1, alignment2), key=attrgetter('pos'))
+    distance = second.aend - first.pos
+    if first.is_reverse and not second.is_reverse:
+        kind = _OUTIES
+    elif not first.is_reverse and second.is_reverse:
+        kind = _INNIES
+    else:
+        kind = _OTHERS
+    return distance, kind
+
+
+def _mates_are_not_chimeric(mates, mate_length_range):
+    for alignment1 in mates[0]:
+        if not alignment1.is_totally_mapped:
+            continue
+        for alignment2 in mates[1]:
+            if not alignment2.is_totally_mapped:
+                continue
+            if alignment1.reference == alignment2.reference:
+                distance, kind = _get_layout(alignment1, alignment2)
+                if (kind == _OUTIES and
+                        mate_length_range[0] < distance < mate_length_range[1]):
                     return True
             else:
-                distances_to_end2 = _find_distances_to_ends(aligned_read2,
-                                                            bamfile,
-                                                            reference_lengths)
-                if aligned_read1.is_reverse:
-                    distances_sum = distances_to_end1[1]
-                    if aligned_read2.is_reverse:
-                        distances_sum += distances_to_end2[1]
-                    else:
-                        distances_sum += distances_to_end2[0]
-                else:
-                    distances_sum = distances_to_end1[0]
-                    if aligned_read2.is_reverse:
-                        distances_sum += distances_to_end2[1]
-                    else:
-                        distances_sum += distances_to_end2[0]
-                # print 'distances_sum: ', distances_sum
+                distances_sum = (alignment1.distance_behind +
+                                 alignment2.distance_behind)
                 if distances_sum < mate_length_range[1]:
                     return True
+        # only the first totally mapped alignment of the first mate is used
         return False
+    return False
 
 
-def _mates_are_chimeric(mates, samfile, max_clipping, max_insert_size,
-                        reference_lengths):
-    for aligned_read1 in mates[0]:
-        if _3end_mapped(aligned_read1, max_clipping):
-            distances_to_end1 = _find_distances_to_ends(aligned_read1, samfile,
-                                                        reference_lengths)
-            for aligned_read2 in mates[1]:
-                if _3end_mapped(aligned_read2, max_clipping):
-                    if aligned_read1.rname == aligned_read2.rname:
-                        aligned_reads = [aligned_read1, aligned_read2]
-                        distance = _find_distance(aligned_reads)
-                        if (_mates_are_innies(aligned_reads) and
-                            distance < max_insert_size):
-                            return True
-                    else:
-                        distances_to_end2 = _find_distances_to_ends(aligned_read2,
-                                                                    samfile,
-                                                             reference_lengths)
-                        if aligned_read1.is_reverse:
-                            distances_sum = distances_to_end1[0]
-                            if aligned_read2.is_reverse:
-                                distances_sum += distances_to_end2[0]
-                            else:
-                                distances_sum += distances_to_end2[1]
-                        else:
-                            distances_sum = distances_to_end1[1]
-                            if aligned_read2.is_reverse:
-                                distances_sum += distances_to_end2[0]
-                            else:
-                                distances_sum += distances_to_end2[1]
-                        if distances_sum < max_insert_size:
-                            return True
+def _mates_are_chimeric(mates, max_insert_size):
+    for alignment1 in mates[0]:
+        if not alignment1.is_3end_mapped:
+            continue
+        for alignment2 in mates[1]:
+            if not alignment2.is_3end_mapped:
+                continue
+            if alignment1.reference == alignment2.reference:
+                distance, kind = _get_layout(alignment1, alignment2)
+                if kind == _INNIES and distance < max_insert_size:
+                    return True
+            elif (alignment1.distance_ahead + alignment2.distance_ahead <
+                  max_insert_size):
+                return True
     return False
 
 
+def _classify_mates(records, ref_lengths, max_clipping, mate_length_range,
+                    max_pe_len):
+    '''It returns the pair of seqs and its kind.
+
+    The pair is None if the primary alignment of a mate is missing.
+    '''
+    mates, primaries = _summarize_mates(records, ref_lengths, max_clipping)
+    if _mates_are_not_chimeric(mates, mate_length_range):
+        kind = NON_CHIMERIC
+    elif _mates_are_chimeric(mates, max_pe_len):
+        kind = CHIMERA
+    else:
+        kind = UNKNOWN
+
+    pair = []
+    for primary, mate_tag in zip(primaries, MATE_TAGS):
+        if primary is not None:
+            primary = primary._replace(qname=primary.qname + mate_tag)
+        seq = alignedread_to_seqitem(primary)
+        if seq is None:
+            return None, kind
+        pair.append(seq)
+    return pair, kind
+
+
+def _init_classification_worker(classification_kwargs):
+    global _CLASSIFICATION_KWARGS
+    _CLASSIFICATION_KWARGS = classification_kwargs
+
+
+def _classify_packet_in_worker(packet):
+    return [_classify_mates(records, **_CLASSIFICATION_KWARGS)
+            for records in packet]
+
+
+def _classify_records(records, ref_lengths, mate_distance, settings,
+                      processes=1):
+    '''It classifies the pairs found in the name grouped alignment records.
+
+    The pairs are classified in packets by several processes and they are
+    yielded in the same order.
+    '''
+    variation = settings['MATE_DISTANCE_VARIATION']
+    kwargs = {'ref_lengths': ref_lengths,
+              'max_clipping': settings['MAX_CLIPPING'],
+              'max_pe_len': settings['MAX_PE_LEN'],
+              'mate_length_range': [mate_distance - variation,
+                                    mate_distance + variation]}
+    packets = group_in_packets(_group_records_by_qname(records),
+                               _PAIR_PACKET_SIZE)
+    if processes > 1:
+        workers = Pool(processes=processes,
+                       initializer=_init_classification_worker,
+                       initargs=(kwargs,))
+        classified_packets = workers.imap(_classify_packet_in_worker, packets)
+    else:
+        workers = None
+        classified_packets = ([_classify_mates(records, **kwargs)
+                               for records in packet] for packet in packets)
+    try:
+        for classified_packet in classified_packets:
+            for pair, kind in classified_packet:
+                if pair is not None:
+                    yield pair, kind
+    finally:
+        if workers is not None:
+            workers.terminate()
+            workers.join()
+
+
 def classify_mapped_reads(bam_fhand, mate_distance,
-                          settings=get_setting('CHIMERAS_SETTINGS')):
+                          settings=get_setting('CHIMERAS_SETTINGS'),
+                          processes=1):
     '''It classifies sequences from bam file in chimeric, unknown and
     non chimeric, according to its distance and orientation in the reference
     sequence'''
-    bamfile = AlignmentFile(bam_fhand.name)
-
-    # settings. Include in function properties with default values
-    max_clipping = settings['MAX_CLIPPING']
-    max_pe_len = settings['MAX_PE_LEN']
-    variation = settings['MATE_DISTANCE_VARIATION']
-    mate_length_range = [mate_distance - variation, mate_distance + variation]
-    reference_lengths = _get_ref_lengths(bamfile)
-    # It tries to find out the kind of each pair of sequences
-    for grouped_mates in _group_alignments_reads_by_qname(bamfile):
-        mates_alignments = _split_mates(grouped_mates)
-        if _mates_are_not_chimeric(mates_alignments, max_clipping,
-                                   mate_length_range, bamfile,
-                                   reference_lengths):
-            kind = NON_CHIMERIC
-        elif _mates_are_chimeric(mates_alignments, bamfile, max_clipping,
-                                 max_pe_len, reference_lengths):
-            kind = CHIMERA
-        else:
-            kind = UNKNOWN
+    ref_lengths, records = _read_bam(AlignmentFile(bam_fhand.name))
+    return _classify_records(records, ref_lengths, mate_distance, settings,
+                             processes=processes)
 
-        pair = [alignedread_to_seqitem(_get_primary_alignment(mates))
-                for mates in mates_alignments]
 
-        if None not in pair:
-            yield pair, kind
+def classify_mapped_sam_stream(sam_fhand, mate_distance,
+                               settings=get_setting('CHIMERAS_SETTINGS'),
+                               processes=1):
+    '''It classifies the pairs found in a SAM stream, like the mapper output.
 
+    The alignments of every pair should be together, as the mapper writes
+    them, so the SAM does not need to be sorted.
+    '''
+    ref_lengths, records = _read_sam(sam_fhand)
+    return _classify_records(records, ref_lengths, mate_distance, settings,
+                             processes=processes)
 
-def classify_chimeras(in_fhand, index_fpath, mate_distance, out_fhand,
-                      chimeras_fhand=None, unknown_fhand=None, tempdir=None,
-                      threads=None, settings=get_setting('CHIMERAS_SETTINGS')):
 
-    '''It maps sequences from input files, sorts them and writes to output
-    files according to its classification'''
-    bam_fhand = NamedTemporaryFile(suffix='.bam')
+def _map_interleaved_reads(interleave_fhand, index_fpath, threads=None):
     extra_params = ['-a', '-M']
-    bwa = map_with_bwamem(index_fpath, interleave_fpath=in_fhand.name,
-                          extra_params=extra_params)
-    map_process_to_sortedbam(bwa, bam_fhand.name, key='queryname',
-                             tempdir=tempdir)
+    return map_with_bwamem(index_fpath, interleave_fpath=interleave_fhand.name,
+                           extra_params=extra_params, threads=threads)
 
-    for pair, kind in classify_mapped_reads(bam_fhand, settings=settings,
-                                            mate_distance=mate_distance):
-        if kind is NON_CHIMERIC:
-            write_seqs(pair, out_fhand)
-        elif kind is CHIMERA and chimeras_fhand is not None:
-            write_seqs(pair, chimeras_fhand)
-        elif kind is UNKNOWN and unknown_fhand is not None:
-            write_seqs(pair, unknown_fhand)
+
+def _check_mapping_process(map_process):
+    map_process.stdout.close()
+    map_process.wait()
+    if map_process.returncode:
+        raise RuntimeError('Error in mapping process')
+
+
+def _write_classified_pairs(classified_pairs, fhands_by_kind):
+    'It writes the pairs in packets, one write per packet and kind'
+    for packet in group_in_packets(classified_pairs, _PAIR_PACKET_SIZE):
+        for kind, fhand in fhands_by_kind.items():
+            if fhand is None:
+                continue
+            seqs = [seq for pair, pair_kind in packet if pair_kind == kind
+                    for seq in pair]
+            if seqs:
+                write_seqs(seqs, fhand)
+
+
+def classify_chimeras(in_fhand, index_fpath, mate_distance, out_fhand,
+                      chimeras_fhand=None, unknown_fhand=None, threads=None,
+                      settings=get_setting('CHIMERAS_SETTINGS'),
+                      processes=1):
+
+    '''It maps sequences from input files and writes them to output
+    files according to its classification.
+
+    The mapper output is classified as it is produced, it is not sorted.
+    '''
+    bwa = _map_interleaved_reads(in_fhand, index_fpath, threads=threads)
+    classified_pairs = classify_mapped_sam_stream(bwa.stdout,
+                                                  mate_distance=mate_distance,
+                                                  settings=settings,
+                                                  processes=processes)
+    fhands_by_kind = {NON_CHIMERIC: out_fhand, CHIMERA: chimeras_fhand,
+                      UNKNOWN: unknown_fhand}
+    _write_classified_pairs(classified_pairs, fhands_by_kind)
+    _check_mapping_process(bwa)
+
+
+def _sample_pairs(interleave_fhand, sample_size, tempdir=None,
+                  random_seed=None):
+    '''It writes a random sample of the pairs into a new file.
+
+    If there are not enough pairs the given file is returned.
+    '''
+    pairs = group_pairs_by_name(read_seqs([interleave_fhand]))
+    try:
+        pairs = list(sample(pairs, sample_size, random_seed=random_seed))
+    except SampleSizeError:
+        return interleave_fhand
+    sample_fhand = NamedTemporaryFile(dir=tempdir)
+    write_seqs((seq for pair in pairs for seq in pair), sample_fhand)
+    sample_fhand.flush()
+    return sample_fhand
 
 
 def calculate_distance_distribution(interleave_fhand, index_fpath,
                                     max_clipping, max_distance=None,
-                                    tempdir=None, threads=None):
-    bam_fhand = NamedTemporaryFile(suffix='.bam')
-    extra_params = ['-a', '-M']
-    bwa = map_with_bwamem(index_fpath, interleave_fpath=interleave_fhand.name,
-                          extra_params=extra_params, threads=threads)
-    map_process_to_sortedbam(bwa, bam_fhand.name, key='queryname',
-                             tempdir=tempdir)
-    return calculate_distance_distribution_in_bam(bam_fhand,
-                                                  max_clipping=max_clipping,
-                                                  max_distance=max_distance)
+                                    tempdir=None, threads=None,
+                                    sample_size=None, random_seed=None):
+    '''It calculates the distance distribution of the mapped pairs.
+
+    If a sample size is given only that number of random pairs are mapped,
+    the same ones every time if a random seed is given.
+    '''
+    if sample_size is not None:
+        interleave_fhand = _sample_pairs(interleave_fhand, sample_size,
+                                         tempdir=tempdir,
+                                         random_seed=random_seed)
+    bwa = _map_interleaved_reads(interleave_fhand, index_fpath,
+                                 threads=threads)
+    ref_lengths, records = _read_sam(bwa.stdout)
+    stats = _calculate_distance_distribution(records, ref_lengths,
+                                             max_clipping=max_clipping,
+                                             max_distance=max_distance)
+    _check_mapping_process(bwa)
+    return stats
+
+
+def _calculate_distance_distribution(records, ref_lengths, max_clipping,
+                                     max_distance=None):
+    stats = {_OUTIES: IntCounter(), _INNIES: IntCounter(),
+             _OTHERS: IntCounter()}
+    for pair_records in _group_records_by_qname(records):
+        mates = _summarize_mates(pair_records, ref_lengths, max_clipping)[0]
+        for alignment1 in mates[0]:
+            if not alignment1.is_totally_mapped:
+                continue
+            for alignment2 in mates[1]:
+                if (not alignment2.is_totally_mapped or
+                        alignment1.reference != alignment2.reference):
+                    continue
+                distance, kind = _get_layout(alignment1, alignment2)
+                if max_distance is None or max_distance > distance:
+                    stats[kind][distance] += 1
+    return stats
 
 
 def calculate_distance_distribution_in_bam(bam_fhand, max_clipping,
                                            max_distance=None):
-    bamfile = AlignmentFile(bam_fhand.name)
-    stats = {'outies': IntCounter(), 'innies': IntCounter(),
-             'others': IntCounter()}
-    for grouped_mates in _group_alignments_reads_by_qname(bamfile):
-        mates = _split_mates(grouped_mates)
-        for aligned_read1 in _get_totally_mapped_alignments(mates[0],
-                                                            max_clipping):
-            for aligned_read2 in _get_totally_mapped_alignments(mates[1],
-                                                                max_clipping):
-                if aligned_read1.rname == aligned_read2.rname:
-                    aligned_reads = [aligned_read1, aligned_read2]
-                    distance = _find_distance(aligned_reads)
-                    if _mates_are_outies(aligned_reads):
-                        kind = 'outies'
-                    elif _mates_are_innies(aligned_reads):
-                        kind = 'innies'
-                    else:
-                        kind = 'others'
-                    if max_distance is None or max_distance > distance:
-                        stats[kind][distance] += 1
-    return stats
+    ref_lengths, records = _read_bam(AlignmentFile(bam_fhand.name))
+    return _calculate_distance_distribution(records, ref_lengths,
+                                            max_clipping=max_clipping,
+                                            max_distance=max_distance)
@@ -15,17 +15,22 @@
 
 
 import re
+import cPickle as pickle
 from itertools import izip_longest, chain
+from tempfile import NamedTemporaryFile
 
 from crumbs.exceptions import (PairDirectionError, InterleaveError,
                                ItemsNotSortedError)
-from crumbs.seq.seqio import write_seqs
+from crumbs.seq.seqio import write_seqs, ThreadedSeqWriter
 from crumbs.seq.seq import get_title, get_name
 from crumbs.utils.tags import FWD, REV
 from crumbs.utils.file_utils import flush_fhand
-from crumbs.iterutils import sorted_items, group_in_packets_fill_last
+from crumbs.iterutils import (sorted_items, group_in_packets_fill_last,
+                              _unpickle_items, group_in_packets,
+                              iter_in_thread)
 from crumbs.collectionz import KeyedSet
 from crumbs.utils.optional_modules import first
+from crumbs.settings import get_setting
 
 
 def _parse_pair_direction_and_name(seq):
@@ -51,9 +56,81 @@ def _parse_pair_direction_and_name_from_title(title):
     raise PairDirectionError(msg)
 
 
-def _get_paired_and_orphan(reads, ordered, max_reads_memory, temp_dir):
+def _spill_reads(reads, partitions):
+    'It writes the reads to the partition files according to the name hash'
+    n_partitions = len(partitions)
+    for name, read in reads.iteritems():
+        fhand = partitions[hash(name) % n_partitions]
+        fhand.write(pickle.dumps(read))
+        fhand.write('\n\n')
+
+
+def _pair_reads_by_name(reads, unmatched, max_reads_memory=None,
+                        partitions=None, temp_dir=None):
+    '''It yields the pairs as soon as the mate of a read is found.
+
+    The reads waiting for their mates are kept in the unmatched dict. If
+    there are more than max_reads_memory unmatched reads they are moved to
+    the partition files. The reads with no direction are yielded as orphans.
+    '''
+    for read in reads:
+        try:
+            name = _parse_pair_direction_and_name(read)[0]
+        except PairDirectionError:
+            yield [read]
+            continue
+        mate = unmatched.pop(name, None)
+        if mate is not None:
+            yield sorted([mate, read], key=get_title)
+            continue
+        unmatched[name] = read
+        if max_reads_memory and len(unmatched) >= max_reads_memory:
+            if not partitions:
+                n_partitions = get_setting('PAIR_MATCHING_HASH_PARTITIONS')
+                partitions.extend(NamedTemporaryFile(suffix='.pickle',
+                                                     dir=temp_dir)
+                                  for _ in range(n_partitions))
+            _spill_reads(unmatched, partitions)
+            unmatched.clear()
+
+
+def _get_paired_and_orphan_by_hash(reads, max_reads_memory, temp_dir):
+    '''It groups the reads by name without sorting them.
+
+    The pairs are yielded while the reads are read. The reads whose mates
+    were not found while they were in memory are paired at the end,
+    partition by partition.
+    '''
+    unmatched = {}
+    partitions = []
+    for pair in _pair_reads_by_name(reads, unmatched, max_reads_memory,
+                                    partitions, temp_dir):
+        yield pair
+
+    if partitions:
+        _spill_reads(unmatched, partitions)
+        unmatched.clear()
+    for orphan in sorted(unmatched.itervalues(), key=get_title):
+        yield [orphan]
+
+    for partition in partitions:
+        partition.flush()
+        unmatched = {}
+        reads = _unpickle_items(open(partition.name))
+        for pair in _pair_reads_by_name(reads, unmatched):
+            yield pair
+        partition.close()
+        for orphan in sorted(unmatched.itervalues(), key=get_title):
+            yield [orphan]
+
+
+def _get_paired_and_orphan(reads, ordered, max_reads_memory, temp_dir,
+                           group_by_hash=False):
     if ordered:
         sorted_reads = reads
+    elif group_by_hash:
+        return _get_paired_and_orphan_by_hash(reads, max_reads_memory,
+                                              temp_dir)
     else:
         def _key(seq):
             return get_title(seq)
@@ -63,12 +140,18 @@ def _get_paired_and_orphan(reads, ordered, max_reads_memory, temp_dir):
 
 def match_pairs(reads, out_fhand, orphan_out_fhand, out_format, ordered=True,
                 check_order_buffer_size=0, max_reads_memory=None,
-                temp_dir=None):
-    '''It matches the seq pairs in an iterator and splits the orphan seqs.'''
+                temp_dir=None, group_by_hash=False):
+    '''It matches the seq pairs in an iterator and splits the orphan seqs.
+
+    If the reads are not ordered they are sorted by title, unless
+    group_by_hash is True. In that case the reads waiting for its mate are
+    kept in memory and the ones that do not fit, according to
+    max_reads_memory, are written to disk in partitions by name hash.
+    '''
     counts = 0
     check_order_buffer = KeyedSet()
     for pair in _get_paired_and_orphan(reads, ordered, max_reads_memory,
-                                       temp_dir):
+                                       temp_dir, group_by_hash):
         if len(pair) == 1:
             write_seqs(pair, orphan_out_fhand, out_format)
             try:
@@ -139,6 +222,50 @@ def deinterleave_pairs(seqs, out_fhand1, out_fhand2, out_format):
     out_fhand2.flush()
 
 
+def interleave_pairs_threaded(seqs1, seqs2, out_fhand, out_format=None,
+                              skip_checks=False,
+                              packet_size=get_setting('PACKET_SIZE')):
+    '''It interleaves the paired reads and writes them to the out_fhand.
+
+    Every input is parsed in its own thread and the output is written in
+    another one. The pairs are checked, packet by packet, in the calling
+    thread. The output order is the same as the one of interleave_pairs.
+    '''
+    packets1 = iter_in_thread(group_in_packets(seqs1, packet_size))
+    packets2 = iter_in_thread(group_in_packets(seqs2, packet_size))
+    writer = ThreadedSeqWriter(out_fhand, out_format)
+    try:
+        for packet1, packet2 in izip_longest(packets1, packets2,
+                                             fillvalue=()):
+            seqs = list(interleave_pairs(packet1, packet2,
+                                         skip_checks=skip_checks))
+            writer.write(seqs)
+    finally:
+        writer.close()
+
+
+def deinterleave_pairs_threaded(seqs, out_fhand1, out_fhand2, out_format,
+                                packet_size=get_setting('PACKET_SIZE')):
+    '''It splits a sequence iterator with alternating paired reads in two.
+
+    The input is parsed in one thread and every output file is written in
+    its own thread.
+    '''
+    # the packets should not split a pair
+    packet_size += packet_size % 2
+    packets = iter_in_thread(group_in_packets(seqs, packet_size))
+    writer1 = ThreadedSeqWriter(out_fhand1, out_format)
+    writer2 = ThreadedSeqWriter(out_fhand2, out_format)
+    try:
+        for packet in packets:
+            pairs = list(group_pairs(packet, n_seqs_in_pair=2))
+            writer1.write([pair[0] for pair in pairs])
+            writer2.write([pair[1] for pair in pairs])
+    finally:
+        writer1.close()
+        writer2.close()
+
+
 def group_pairs_by_name(seqs, all_pairs_same_n_seqs=False):
     paired_seqs = []
     prev_name = None
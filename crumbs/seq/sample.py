@@ -0,0 +1,250 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of ngs_crumbs.
+# ngs_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# ngs_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with ngs_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''Two pass sequence sampling.
+
+In the first pass the start offset of every record is written to an index
+file, in the second one only the sampled records are read. The memory used
+depends on the sample size and not on the number of sequences in the files.
+'''
+
+import os
+import random
+from array import array
+from tempfile import NamedTemporaryFile
+
+from crumbs.utils.optional_modules import BgzfReader
+from crumbs.exceptions import SampleSizeError, IncompatibleFormatError
+from crumbs.seq.utils.file_formats import get_format
+from crumbs.seq.seqio import _itemize_fastx_multiline
+from crumbs.seq.seq import assing_kind_to_seqs
+from crumbs.utils.tags import SEQITEM
+from crumbs.utils.file_utils import index_is_updated
+
+# pylint: disable=C0111
+
+OFFSET_INDEX_EXTENSION = '.offsets'
+# unsigned long is 64 bits long in the 64 bit platforms
+_OFFSET_TYPECODE = 'L'
+_OFFSETS_IN_MEM = 65536
+_GZIP_MAGIC = '\037\213'
+
+
+def _open_seq_file(fpath):
+    '''It opens a plain or a BGZF sequence file.
+
+    It returns the fhand and True if the file is BGZF compressed.
+    '''
+    fhand = open(fpath, 'rb')
+    magic = fhand.read(2)
+    fhand.seek(0)
+    if magic != _GZIP_MAGIC:
+        return fhand, False
+    fhand.close()
+    try:
+        fhand = BgzfReader(fpath)
+    except ValueError:
+        msg = 'Only plain or BGZF compressed files can be sampled by offset: '
+        raise IncompatibleFormatError(msg + fpath)
+    return fhand, True
+
+
+def _lines_with_offsets(fhand, is_bgzf):
+    'It yields the lines and the offset in which each line starts'
+    if is_bgzf:
+        # the offsets are BGZF virtual offsets
+        tell = fhand.tell
+        readline = fhand.readline
+        while True:
+            offset = tell()
+            line = readline()
+            if not line:
+                break
+            yield offset, line
+    else:
+        offset = fhand.tell()
+        for line in fhand:
+            yield offset, line
+            offset += len(line)
+
+
+def _fasta_records(lines):
+    'It yields the start offset and the lines of every fasta record'
+    offset, record = None, None
+    for line_offset, line in lines:
+        if line[0] == '>':
+            if record is not None:
+                yield offset, record
+            offset, record = line_offset, [line]
+        elif record is not None:
+            record.append(line)
+    if record is not None:
+        yield offset, record
+
+
+def _fastq_records(lines):
+    'It yields the start offset and the lines of every fastq record'
+    for offset, line in lines:
+        if line[0] != '@':
+            # empty lines between records
+            continue
+        record = [line]
+        seq_len = 0
+        for _, line in lines:
+            record.append(line)
+            if line[0] == '+':
+                break
+            seq_len += len(line.rstrip())
+        qual_len = 0
+        while qual_len < seq_len:
+            try:
+                line = next(lines)[1]
+            except StopIteration:
+                msg = 'Malformed fastq file: quality line missing'
+                raise IncompatibleFormatError(msg)
+            record.append(line)
+            qual_len += len(line.rstrip())
+        yield offset, record
+
+
+def _records(fhand, is_bgzf, file_format):
+    lines = _lines_with_offsets(fhand, is_bgzf)
+    if 'fastq' in file_format:
+        return _fastq_records(lines)
+    elif file_format == 'fasta':
+        return _fasta_records(lines)
+    msg = 'Only fasta and fastq files can be sampled by offset, not: '
+    raise IncompatibleFormatError(msg + file_format)
+
+
+def _get_file_format(fpath):
+    fhand = _open_seq_file(fpath)[0]
+    file_format = get_format(fhand)
+    fhand.close()
+    return file_format
+
+
+def write_offset_index(fpath, index_fhand, file_format=None):
+    '''It writes the start offset of every record in the sequence file.
+
+    The offsets are written as an array of unsigned 64 bit integers.
+    It returns the number of records found.
+    '''
+    if file_format is None:
+        file_format = _get_file_format(fpath)
+    fhand, is_bgzf = _open_seq_file(fpath)
+    offsets = array(_OFFSET_TYPECODE)
+    num_records = 0
+    for offset, _ in _records(fhand, is_bgzf, file_format):
+        offsets.append(offset)
+        if len(offsets) >= _OFFSETS_IN_MEM:
+            index_fhand.write(offsets.tostring())
+            num_records += len(offsets)
+            offsets = array(_OFFSET_TYPECODE)
+    index_fhand.write(offsets.tostring())
+    num_records += len(offsets)
+    index_fhand.flush()
+    fhand.close()
+    return num_records
+
+
+def _get_offset_index(fpath, file_format, index_fpath=None):
+    '''It returns an fhand to the offset index and the number of records.
+
+    If an index path is given it is reused if it is more recent than the
+    sequence file, otherwise it is created. Without a path the index is
+    written into a temporary file.
+    '''
+    if index_fpath is None:
+        index_fhand = NamedTemporaryFile(suffix=OFFSET_INDEX_EXTENSION)
+        num_records = write_offset_index(fpath, index_fhand, file_format)
+    elif index_is_updated(fpath, index_fpath):
+        index_fhand = open(index_fpath, 'rb')
+        itemsize = array(_OFFSET_TYPECODE).itemsize
+        num_records = os.path.getsize(index_fpath) // itemsize
+    else:
+        with open(index_fpath, 'wb') as index_fhand:
+            num_records = write_offset_index(fpath, index_fhand,
+                                             file_format)
+        index_fhand = open(index_fpath, 'rb')
+    return index_fhand, num_records
+
+
+def _read_offsets(index_fhand, record_idxs):
+    'It reads the offsets for the given sorted record indexes'
+    itemsize = array(_OFFSET_TYPECODE).itemsize
+    for record_idx in record_idxs:
+        index_fhand.seek(record_idx * itemsize)
+        offset = array(_OFFSET_TYPECODE)
+        offset.fromstring(index_fhand.read(itemsize))
+        yield offset[0]
+
+
+def _read_records_at(fpath, offsets, file_format):
+    'It yields the SeqItems that start at the given offsets'
+    fhand, is_bgzf = _open_seq_file(fpath)
+    for offset in offsets:
+        fhand.seek(offset)
+        record = next(_records(fhand, is_bgzf, file_format))[1]
+        seq = next(_itemize_fastx_multiline(iter(record)))
+        yield seq
+    fhand.close()
+
+
+def _sample_seqs_from_file(fpath, file_format, index_fhand, record_idxs):
+    offsets = _read_offsets(index_fhand, record_idxs)
+    seqs = _read_records_at(fpath, offsets, file_format)
+    return assing_kind_to_seqs(SEQITEM, seqs, file_format)
+
+
+def sample_seqs_by_offset(fpaths, sample_size, index_fpaths=None):
+    '''It samples exactly sample_size seqs reading the files twice.
+
+    The files should be plain or BGZF compressed fasta or fastq files.
+    The sampled seqs are yielded in the order found in the files.
+    If index_fpaths are given the offset indexes are kept in those files
+    and they are reused if they are more recent than the sequence files.
+    '''
+    if sample_size <= 0:
+        raise SampleSizeError('No items to sample')
+    if index_fpaths is None:
+        index_fpaths = [None] * len(fpaths)
+    file_formats = [_get_file_format(fpath) for fpath in fpaths]
+    indexes = [_get_offset_index(fpath, file_format, index_fpath)
+               for fpath, file_format, index_fpath in zip(fpaths, file_formats,
+                                                          index_fpaths)]
+    total_records = sum(num_records for _, num_records in indexes)
+
+    if sample_size > total_records:
+        raise SampleSizeError('Sample larger than population')
+
+    selected = random.sample(xrange(total_records), sample_size)
+    selected.sort()
+    selected = array(_OFFSET_TYPECODE, selected)
+
+    first_record = 0
+    sel_idx = 0
+    for fpath, file_format, index in zip(fpaths, file_formats, indexes):
+        index_fhand, num_records = index
+        last_record = first_record + num_records
+        record_idxs = array(_OFFSET_TYPECODE)
+        while sel_idx < sample_size and selected[sel_idx] < last_record:
+            record_idxs.append(selected[sel_idx] - first_record)
+            sel_idx += 1
+        for seq in _sample_seqs_from_file(fpath, file_format, index_fhand,
+                                          record_idxs):
+            yield seq
+        index_fhand.close()
+        first_record = last_record
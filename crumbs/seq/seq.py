@@ -16,11 +16,13 @@
 
 from copy import deepcopy
 from collections import namedtuple
+from array import array
+from string import maketrans
 
 from crumbs.utils.optional_modules import SeqRecord
 from crumbs.utils.tags import (SEQITEM, SEQRECORD, ILLUMINA_QUALITY,
                                SANGER_QUALITY, SANGER_FASTQ_FORMATS,
-                               ILLUMINA_FASTQ_FORMATS)
+                               ILLUMINA_FASTQ_FORMATS, FEATURE_TABLE)
 
 # pylint: disable=C0111
 
@@ -38,6 +40,93 @@ class SeqItem(_SeqItem):
         return super(SeqItem, cls).__new__(cls, name, lines, annotations)
 
 
+# The feature types supported by the FeatureTable, their codes are the indexes
+FEATURE_TYPES = ('polyA_sequence', 'ORF', 'match_part')
+_FEATURE_TYPE_CODES = {type_: code for code, type_ in enumerate(FEATURE_TYPES)}
+
+
+class FeatureTable(object):
+    '''The features of a seq stored in parallel arrays.
+
+    It is a lightweight alternative to the Biopython SeqFeatures that can
+    also be used with SeqItems. Every feature has a type code (its index in
+    FEATURE_TYPES), a start and an end (like in a python slice), a strand
+    (1, -1 or 0 if unknown), a score (nan if unknown) and a source.
+    '''
+    __slots__ = ('type_codes', 'starts', 'ends', 'strands', 'scores',
+                 'sources')
+
+    def __init__(self):
+        self.type_codes = array('b')
+        self.starts = array('l')
+        self.ends = array('l')
+        self.strands = array('b')
+        self.scores = array('d')
+        self.sources = []
+
+    def __getstate__(self):
+        return [getattr(self, attr) for attr in self.__slots__]
+
+    def __setstate__(self, state):
+        for attr, value in zip(self.__slots__, state):
+            setattr(self, attr, value)
+
+    def __len__(self):
+        return len(self.type_codes)
+
+    def add(self, type_, start, end, strand=0, score=float('nan'),
+            source=None):
+        'It adds a feature'
+        try:
+            type_code = _FEATURE_TYPE_CODES[type_]
+        except KeyError:
+            raise ValueError('Feature type not supported: ' + str(type_))
+        self.type_codes.append(type_code)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.strands.append(0 if strand is None else strand)
+        self.scores.append(score)
+        self.sources.append(source)
+
+    def extend(self, table):
+        'It adds the features of the given table'
+        for attr in self.__slots__:
+            getattr(self, attr).extend(getattr(table, attr))
+
+    @property
+    def types(self):
+        return [FEATURE_TYPES[code] for code in self.type_codes]
+
+    def select(self, type_, source=None):
+        'It returns the indexes of the features of the given type and source'
+        type_code = _FEATURE_TYPE_CODES[type_]
+        return [index for index, code in enumerate(self.type_codes)
+                if code == type_code and (source is None or
+                                          self.sources[index] == source)]
+
+    def reverse_complement(self, seq_len):
+        'It returns the table of the reverse complemented seq'
+        table = FeatureTable()
+        table.type_codes = self.type_codes[:]
+        table.starts = array('l', [seq_len - end for end in self.ends])
+        table.ends = array('l', [seq_len - start for start in self.starts])
+        table.strands = array('b', [-strand for strand in self.strands])
+        table.scores = self.scores[:]
+        table.sources = self.sources[:]
+        return table
+
+
+def get_feature_table(seq):
+    'It returns the feature table of the seq, it is created if required'
+    annotations = seq.object.annotations
+    try:
+        table = annotations[FEATURE_TABLE]
+    except KeyError:
+        table = FeatureTable()
+        annotations[FEATURE_TABLE] = table
+    return table
+
+
 def get_title(seq):
     'Given a seq it returns the title'
     seq_class = seq.kind
@@ -312,6 +401,45 @@ def slice_seq(seq, start=None, stop=None):
     return SeqWrapper(seq.kind, object=seq_obj, file_format=seq.file_format)
 
 
+_COMPLEMENT = maketrans('ACGTURYKMBVDHNSWacgturykmbvdhnsw',
+                        'TGCAAYRMKVBHDNSWtgcaayrmkvbhdnsw')
+
+
+def _reverse_complement_seqitem(seqwrap):
+    # the SeqItems have their seq in one line, the multi-line fasta seqs are
+    # joined when they are read
+    fmt = seqwrap.file_format
+    seq_obj = seqwrap.object
+    lines = seq_obj.lines
+    str_seq = get_str_seq(seqwrap)
+    rev_seq = str_seq.translate(_COMPLEMENT)[::-1] + '\n'
+    if 'fasta' in fmt:
+        lines = [lines[0], rev_seq]
+    elif 'fastq' in fmt:
+        rev_qual = lines[3].rstrip()[::-1] + '\n'
+        lines = [lines[0], rev_seq, '+\n', rev_qual]
+    else:
+        raise ValueError('Unknown SeqItem type')
+    annotations = seq_obj.annotations.copy()
+    if FEATURE_TABLE in annotations:
+        table = annotations[FEATURE_TABLE]
+        annotations[FEATURE_TABLE] = table.reverse_complement(len(str_seq))
+    return SeqItem(name=seq_obj.name, lines=lines, annotations=annotations)
+
+
+def reverse_complement_seq(seq):
+    'It returns the reverse complement of the seq with its features'
+    seq_class = seq.kind
+    if seq_class == SEQITEM:
+        seq_obj = _reverse_complement_seqitem(seq)
+    elif seq_class == SEQRECORD:
+        seq_obj = seq.object.reverse_complement(id=True, description=True,
+                                                annotations=True,
+                                                features=True, dbxrefs=True,
+                                                name=True)
+    return SeqWrapper(seq.kind, object=seq_obj, file_format=seq.file_format)
+
+
 def assing_kind_to_seqs(kind, seqs, file_format):
     'It puts each seq into a NamedTuple named Seq'
     return (SeqWrapper(kind, seq, file_format) for seq in seqs)
@@ -13,17 +13,14 @@
 # You should have received a copy of the GNU General Public License
 # along with ngs_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
+import sys
 from itertools import chain, tee, ifilter
 from shutil import copyfileobj
 from tempfile import NamedTemporaryFile
+from threading import Thread
+from Queue import Queue
 import cStringIO
 
-from crumbs.utils.optional_modules import (FastaIterator, QualPhredIterator,
-                                           PairedFastaQualIterator,
-                                           FastqPhredIterator, write_seqrecs,
-                                           FastqSolexaIterator,
-                                           FastqIlluminaIterator,
-                                           parse_into_seqrecs)
 from crumbs.seq.utils.data import (ambiguous_rna_letters,
                                    ambiguous_dna_letters,
                                    extended_protein_letters)
@@ -32,7 +29,8 @@ from crumbs.exceptions import (MalformedFile, error_quality_disagree,
                                FileIsEmptyError, IsSingleLineFastqError)
 from crumbs.iterutils import group_in_packets, group_in_packets_fill_last
 from crumbs.utils.file_utils import rel_symlink, flush_fhand
-from crumbs.seq.utils.file_formats import get_format, peek_chunk_from_file
+from crumbs.seq.utils.file_formats import (get_format, peek_chunk_from_file,
+                                          read_fastq_chunk)
 
 from crumbs.utils.tags import (GUESS_FORMAT, SEQS_PASSED, SEQS_FILTERED_OUT,
                                SEQITEM, SEQRECORD, ORPHAN_SEQS,
@@ -54,6 +52,7 @@ def _clean_seqrecord_stream(seqs):
 
 def _write_seqrecords(seqs, fhand=None, file_format='fastq'):
     'It writes a stream of sequences to a file'
+    from crumbs.utils.optional_modules import write_seqrecs
     if fhand is None:
         fhand = NamedTemporaryFile(suffix='.' + file_format.replace('-', '_'))
     seqs = _clean_seqrecord_stream(seqs)
@@ -124,6 +123,60 @@ def _write_filter_trim_packets(passed_fhand, diverted_fhand, packets,
             raise
 
 
+class ThreadedSeqWriter(object):
+    '''It writes seq packets to a file in a separate thread.
+
+    Every packet is formatted in memory and written with a single call.
+    '''
+    def __init__(self, fhand, file_format=None, buffer_size=4):
+        self._fhand = fhand
+        self._file_format = file_format
+        self._queue = Queue(maxsize=buffer_size)
+        self._error = None
+        self._thread = Thread(target=self._write_packets)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write_packets(self):
+        fhand = self._fhand
+        queue = self._queue
+        while True:
+            seqs = queue.get()
+            if seqs is None:
+                break
+            if self._error is not None:
+                # we have to keep consuming to not block the producer
+                continue
+            try:
+                buffer_ = cStringIO.StringIO()
+                write_seqs(seqs, buffer_, self._file_format)
+                try:
+                    fhand.write(buffer_.getvalue())
+                except IOError, error:
+                    # The pipe could be already closed
+                    if 'Broken pipe' not in str(error):
+                        raise
+            except BaseException:
+                self._error = sys.exc_info()
+
+    def _raise_error(self):
+        error = self._error
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def write(self, seqs):
+        'It queues a packet of seqs to be written'
+        self._raise_error()
+        self._queue.put(seqs)
+
+    def close(self):
+        'It waits until every packet has been written'
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+        flush_fhand(self._fhand)
+
+
 def write_filter_packets(passed_fhand, filtered_fhand, filter_packets,
                          file_format='fastq', workers=None):
     'It writes the filter stream into passed and filtered out sequence files'
@@ -171,6 +224,12 @@ def _read_seqrecord_packets(fhands, size=get_setting('PACKET_SIZE')):
 
 def _read_seqrecords(fhands):
     'It returns an iterator of seqrecords'
+    from crumbs.utils.optional_modules import (FastaIterator,
+                                               QualPhredIterator,
+                                               FastqPhredIterator,
+                                               FastqSolexaIterator,
+                                               FastqIlluminaIterator,
+                                               parse_into_seqrecs)
     seq_iters = []
     for fhand in fhands:
         fmt = get_format(fhand)
@@ -195,6 +254,7 @@ def _read_seqrecords(fhands):
 
 def seqio(in_fhands, out_fhand, out_format, copy_if_same_format=True):
     'It converts sequence files between formats'
+    from crumbs.utils.optional_modules import write_seqrecs
     if out_format not in get_setting('SUPPORTED_OUTPUT_FORMATS'):
         raise IncompatibleFormatError("This output format is not supported")
 
@@ -221,6 +281,8 @@ def seqio(in_fhands, out_fhand, out_format, copy_if_same_format=True):
 
 def fastaqual_to_fasta(seq_fhand, qual_fhand, out_fhand):
     'It converts a fasta and a qual file into a fastq format file'
+    from crumbs.utils.optional_modules import (PairedFastaQualIterator,
+                                               write_seqrecs)
     seqrecords = PairedFastaQualIterator(seq_fhand, qual_fhand)
     try:
         write_seqrecs(seqrecords, out_fhand.name, 'fastq')
@@ -244,18 +306,23 @@ def guess_seq_type(fhand):
     chunk = peek_chunk_from_file(fhand, chunk_size)
     if not chunk:
         raise UnknownFormatError('The file is empty')
-    fhand_ = cStringIO.StringIO(chunk)
-    total_letters = 0
-    nucleotides = 0
-    for seq in read_seqs([fhand_]):
-        for letter in get_str_seq(seq):
-            total_letters += 1
-            if letter in ('gcatnuGCATNU'):
-                nucleotides += 1
-            if letter in only_prot:
-                return 'prot'
-    nucl_freq = nucleotides / total_letters
-    if nucl_freq > 0.8:
+    chunk_is_complete = len(chunk) < chunk_size
+    file_format = get_format(fhand)
+    # the seqs are taken from the chunk str, it is not parsed as a file
+    if file_format == 'fasta':
+        seqs = [line.strip() for line in chunk.splitlines()
+                if not line.startswith('>')]
+    elif 'fastq' in file_format:
+        seqs = [seq for seq, _ in read_fastq_chunk(chunk, chunk_is_complete)]
+    else:
+        seqs = [get_str_seq(seq)
+                for seq in read_seqs([cStringIO.StringIO(chunk)])]
+    letters = ''.join(seqs)
+    if set(letters).intersection(only_prot):
+        return 'prot'
+    total_letters = len(letters)
+    nucleotides = total_letters - len(letters.translate(None, 'gcatnuGCATNU'))
+    if total_letters and nucleotides / float(total_letters) > 0.8:
         return 'nucl'
 
     raise RuntimeError('unable to guess the seq type')
@@ -15,15 +15,29 @@
 
 
 from __future__ import division
-from array import array
+import os.path
+from shutil import copyfileobj
+from multiprocessing import Pool
 
-from crumbs.utils.optional_modules import SffIterator
+from crumbs.utils.optional_modules import zeros, frombuffer, uint8, arange
+from crumbs.utils.file_utils import TemporaryDir
+from crumbs.utils.tags import SEQRECORD
+from crumbs.seq.seq import assing_kind_to_seqs
+from crumbs.seq.seqio import write_seqs
+from crumbs.iterutils import group_in_packets
+from crumbs.settings import get_setting
 
 # pylint: disable=R0913
 
+# the order of the rows in the nucleotide counts
+_COUNTED_NUCLS = 'ATCG'
+_XML_HEADER = '<?xml version="1.0"?>\n<trace_volume>\n'
+_XML_FOOTER = '</trace_volume>\n'
+
 
 def _min_left_clipped_seqs(sff_fhand, trim, min_left_clip):
     'It generates sequences (as tuples) given a path to a SFF file.'
+    from crumbs.utils.optional_modules import SffIterator
     for record in SffIterator(sff_fhand, trim=False):
         annots = record.annotations
         clip_qual = annots['clip_qual_left']
@@ -45,14 +59,65 @@ def _min_left_clipped_seqs(sff_fhand, trim, min_left_clip):
         yield record
 
 
+def _count_nucls(str_seqs, nucls_to_check):
+    '''It counts the nucleotides found in every position of the seq starts.
+
+    The seq starts are put in a matrix, so every nucleotide is counted for
+    all seqs at once. The lowercase letters are not counted.
+    '''
+    counts = zeros((len(_COUNTED_NUCLS), nucls_to_check), dtype=int)
+    if not nucls_to_check:
+        return counts
+    str_seqs = ''.join([seq[:nucls_to_check].ljust(nucls_to_check, ' ')
+                        for seq in str_seqs])
+    nucls = frombuffer(str_seqs, dtype=uint8).reshape(-1, nucls_to_check)
+    for index, nucl in enumerate(_COUNTED_NUCLS):
+        counts[index] = (nucls == ord(nucl)).sum(axis=0)
+    return counts
+
+
+def _extract_sff_in_worker(task):
+    '''It extracts the reads of one SFF file to a fastq part file.
+
+    The xml traceinfo, without header and footer, is written to its own
+    part file. It returns the nucleotide counts of the file.
+    '''
+    (sff_fpath, trim, min_left_clip, nucls_to_check, fastq_fpath,
+     xml_fpath) = task
+    extractor = SffExtractor([open(sff_fpath, 'rb')], trim=trim,
+                             min_left_clip=min_left_clip,
+                             nucls_to_check=nucls_to_check)
+    seqs = assing_kind_to_seqs(SEQRECORD, extractor.seqs, None)
+    xml_fhand = None if xml_fpath is None else open(xml_fpath, 'w')
+    if xml_fhand is not None:
+        seqs = _write_xml_traces(seqs, xml_fhand)
+    with open(fastq_fpath, 'w') as fastq_fhand:
+        write_seqs(seqs, fastq_fhand, file_format='fastq')
+    if xml_fhand is not None:
+        xml_fhand.close()
+    return extractor.nucl_counts[sff_fpath]
+
+
+def _append_part(part_fpath, fhand):
+    with open(part_fpath) as part_fhand:
+        copyfileobj(part_fhand, fhand)
+    os.remove(part_fpath)
+
+
 class SffExtractor(object):
     'This class extracts the reads from an SFF file'
     def __init__(self, sff_fhands, trim=False, min_left_clip=0,
-                 nucls_to_check=50, max_nucl_freq_threshold=0.5):
-        'It inits the class'
+                 nucls_to_check=50, max_nucl_freq_threshold=0.5,
+                 processes=1):
+        '''It inits the class
+
+        When the reads are written several SFF files can be extracted at
+        the same time, one by process.
+        '''
         self.fhands = sff_fhands
         self.trim = trim
         self.min_left_clip = min_left_clip
+        self.processes = processes
 
         # checking
         self.nucls_to_check = nucls_to_check
@@ -62,34 +127,63 @@ class SffExtractor(object):
     @property
     def seqs(self):
         'It yields all sequences'
+        from crumbs.utils.optional_modules import SffIterator
         for fhand in self.fhands:
-            self._prepare_nucl_counts(fhand.name)
+            counts = zeros((len(_COUNTED_NUCLS), self.nucls_to_check),
+                           dtype=int)
+            self.nucl_counts[fhand.name] = counts
             if not self.min_left_clip:
                 seqs = SffIterator(fhand, trim=self.trim)
             else:
                 seqs = _min_left_clipped_seqs(fhand, self.trim,
                                               self.min_left_clip)
-            for record in seqs:
-                self._update_nucl_counts(str(record.seq), fhand.name)
-                yield record
-
-    def _prepare_nucl_counts(self, fpath):
-        'It prepares the structure to store the nucleotide counts'
-        counts = {'A': array('L', [0] * self.nucls_to_check),
-                  'T': array('L', [0] * self.nucls_to_check),
-                  'C': array('L', [0] * self.nucls_to_check),
-                  'G': array('L', [0] * self.nucls_to_check)}
-        self.nucl_counts[fpath] = counts
-
-    def _update_nucl_counts(self, seq, fpath):
-        'Given a seq (as a string) it updates the nucleotide counts'
-        seq = seq[:self.nucls_to_check]
-        counts = self.nucl_counts
-        for index, nucl in enumerate(seq):
-            try:
-                counts[fpath][nucl][index] += 1
-            except KeyError:
-                pass  # we do not count the lowercase letters
+            for records in group_in_packets(seqs, get_setting('PACKET_SIZE')):
+                str_seqs = [str(record.seq) for record in records]
+                counts += _count_nucls(str_seqs, self.nucls_to_check)
+                for record in records:
+                    yield record
+
+    def write(self, out_fhand, xml_fhand=None):
+        '''It writes the reads in fastq and, optionally, the xml traceinfo.
+
+        With several processes every SFF file is extracted to its own part
+        files and they are joined in the input order.
+        '''
+        if self.processes < 2 or len(self.fhands) < 2:
+            seqs = assing_kind_to_seqs(SEQRECORD, self.seqs, None)
+            if xml_fhand is not None:
+                seqs = write_xml_traceinfo(seqs, xml_fhand)
+            write_seqs(seqs, out_fhand, file_format='fastq')
+            return
+
+        tmp_dir = TemporaryDir()
+        tasks = []
+        for index, fhand in enumerate(self.fhands):
+            part_fpath = os.path.join(tmp_dir.name, str(index))
+            xml_fpath = None if xml_fhand is None else part_fpath + '.xml'
+            tasks.append((fhand.name, self.trim, self.min_left_clip,
+                          self.nucls_to_check, part_fpath + '.fastq',
+                          xml_fpath))
+
+        if xml_fhand is not None:
+            xml_fhand.write(_XML_HEADER)
+        workers = Pool(processes=self.processes)
+        try:
+            all_counts = workers.imap(_extract_sff_in_worker, tasks)
+            for task, counts in zip(tasks, all_counts):
+                sff_fpath, fastq_fpath, xml_fpath = (task[0], task[4],
+                                                     task[5])
+                self.nucl_counts[sff_fpath] = counts
+                _append_part(fastq_fpath, out_fhand)
+                if xml_fhand is not None:
+                    _append_part(xml_fpath, xml_fhand)
+        finally:
+            workers.terminate()
+            workers.join()
+            tmp_dir.close()
+        if xml_fhand is not None:
+            xml_fhand.write(_XML_FOOTER)
+            xml_fhand.flush()
 
     @property
     def clip_advice(self):
@@ -98,25 +192,24 @@ class SffExtractor(object):
         for fhand in self.fhands:
             fpath = fhand.name
             counts = self.nucl_counts[fpath]
-            treshold = self.max_nucl_freq_threshold
-            pos_above_threshold = 0
-            seq_above_threshold = ''
-            index = 0
-            for index in range(self.nucls_to_check):
-                num_nucls = [counts['A'][index], counts['T'][index],
-                             counts['C'][index], counts['G'][index]]
-                tot_nucls = sum(num_nucls)
-                if not tot_nucls:
-                    continue
-                freq_nucls = [i / tot_nucls for i in num_nucls]
-                above_threshold = [i >= treshold for i in freq_nucls]
-                if any(above_threshold):
-                    pos_above_threshold += 1
-                    seq_above_threshold += _get_nucl_with_max_freq('ATCG',
-                                                                   freq_nucls)
-                else:
-                    break
-            if pos_above_threshold:
+            tot_nucls = counts.sum(axis=0)
+            with_nucls = tot_nucls > 0
+            freq_nucls = counts / (tot_nucls + ~with_nucls)
+            above_threshold = (freq_nucls >= self.max_nucl_freq_threshold)
+            above_threshold = above_threshold.any(axis=0) & with_nucls
+            # the positions are checked until one is not above the threshold
+            below_threshold = with_nucls & ~above_threshold
+            if below_threshold.any():
+                index = below_threshold.argmax()
+                checked = arange(self.nucls_to_check) < index
+            else:
+                index = max(self.nucls_to_check - 1, 0)
+                checked = with_nucls
+            above_threshold &= checked
+            if above_threshold.any():
+                max_nucls = freq_nucls.argmax(axis=0)[above_threshold]
+                seq_above_threshold = ''.join(_COUNTED_NUCLS[nucl]
+                                              for nucl in max_nucls)
                 if self.trim:
                     # number of nucleotides to remove next time, the ones
                     # that we have detected plus the ones already removed
@@ -134,8 +227,6 @@ def _do_seq_xml(seq):
     annots = seq.annotations
     read_len = len(seq)
     read_name = seq.id
-    if 'E3MFGYR02FTGED' == read_name:
-        print annots, read_len
     qual_left = annots.get('clip_qual_left', 0)
     qual_right = annots.get('clip_qual_right', 0)
     vector_left = annots.get('clip_adapter_left', 0)
@@ -166,20 +257,17 @@ def _do_seq_xml(seq):
     return xml
 
 
-def write_xml_traceinfo(seqs, fhand):
-    fhand.write('<?xml version="1.0"?>\n<trace_volume>\n')
+def _write_xml_traces(seqs, fhand):
+    'It writes the xml trace of every seq as they are yielded'
     for seq in seqs:
         fhand.write(_do_seq_xml(seq))
         yield seq
-    fhand.write('</trace_volume>\n')
-    fhand.flush()
 
 
-def _get_nucl_with_max_freq(nucls, freq_nucls):
-    'It returns the nucleotide with the maximum frequency'
-    max_ = None
-    for index, freq in enumerate(freq_nucls):
-        if max_ is None or max_ < freq:
-            max_ = freq
-            nucl = nucls[index]
-    return nucl
+def write_xml_traceinfo(seqs, fhand):
+    'It writes the xml traceinfo of the seqs while they are yielded'
+    fhand.write(_XML_HEADER)
+    for seq in _write_xml_traces(seqs, fhand):
+        yield seq
+    fhand.write(_XML_FOOTER)
+    fhand.flush()
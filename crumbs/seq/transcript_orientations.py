@@ -14,20 +14,90 @@
 # along with ngs_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
 
-from itertools import compress
+import sys
 import os.path
+from collections import deque
+from itertools import tee, imap
+from threading import Thread
 
+from crumbs.utils.optional_modules import SeqRecord
 from crumbs.seq.annotation import (PolyaAnnotator, EstscanOrfAnnotator,
                                    BlastAnnotator)
 from crumbs.seq.utils.seq_utils import append_to_description
-from crumbs.utils.tags import SEQRECORD
-from crumbs.seq.seq import SeqWrapper
+from crumbs.utils.tags import SEQRECORD, SEQITEM, FEATURE_TABLE
+from crumbs.seq.seq import (SeqWrapper, SeqItem, get_feature_table,
+                            reverse_complement_seq)
+
+
+def _copy_seq(seq):
+    'It returns a copy of the seq without the features'
+    if seq.kind == SEQITEM:
+        # the lines are not modified by the annotators
+        return SeqWrapper(SEQITEM, SeqItem(seq.object.name, seq.object.lines),
+                          seq.file_format)
+    record = seq.object
+    record = SeqRecord(record.seq, id=record.id, name=record.name,
+                       description=record.description)
+    return SeqWrapper(SEQRECORD, record, None)
+
+
+def _copy_seqs(seqs):
+    'It returns copies of the seqs without the features'
+    return [_copy_seq(seq) for seq in seqs]
+
+
+class _AnnotationJob(object):
+    '''It annotates some seqs, in a thread if required.
+
+    The annotators that run external programs spend their time waiting for
+    them, so several of them can run at the same time in threads.
+    '''
+    def __init__(self, annotator, seqs, in_thread=True):
+        self._annotator = annotator
+        self.seqs = seqs
+        self._error = None
+        self._thread = None
+        if in_thread:
+            self._thread = Thread(target=self._annotate)
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._annotate()
+
+    def _annotate(self):
+        try:
+            self.seqs = self._annotator(self.seqs)
+        except BaseException:
+            self._error = sys.exc_info()
+
+    def join(self):
+        'It waits for the annotation and it returns the annotated seqs'
+        if self._thread is not None:
+            self._thread.join()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self.seqs
+
+
+class _StreamJob(object):
+    '''It takes the annotated seqs from a stream of annotated packets.
+
+    The stream annotates the next packets in the background, so the seqs
+    of a packet are ready, or on their way, when they are required.
+    '''
+    def __init__(self, annotated_packets):
+        self._annotated_packets = annotated_packets
+
+    def join(self):
+        'It returns the annotated seqs of the next packet'
+        return next(self._annotated_packets)
 
 
 class TranscriptOrientator(object):
     '''This class orientates the transcripts
 
-    It can take into account: poly-A, ORFs and blast matches'''
+    It can take into account: poly-A, ORFs and blast matches.
+    The SeqItems are annotated with FeatureTables instead of SeqFeatures.'''
 
     def __init__(self, polya_params=None, estscan_params=None,
                  blast_params=None):
@@ -84,10 +154,40 @@ class TranscriptOrientator(object):
         scores = [feat.qualifiers['score'] for feat in features]
         return features[scores.index(min(scores))]
 
+    @staticmethod
+    def _guess_orientation_from_table(table, annotator_name, blastdb):
+        'It returns the orientation given by the features of a FeatureTable'
+        if annotator_name == 'polyA':
+            indexes = table.select('polyA_sequence')[:1]
+        elif annotator_name == 'estscan_orf':
+            # the longest ORF
+            indexes = table.select('ORF')
+            lengths = [table.ends[idx] - table.starts[idx] for idx in indexes]
+            indexes = [indexes[lengths.index(max(lengths))]] if indexes else []
+        elif annotator_name == 'blast':
+            # the match_part with the best e-value
+            indexes = table.select('match_part',
+                                   source=os.path.basename(blastdb))
+            scores = [table.scores[idx] for idx in indexes]
+            indexes = [indexes[scores.index(min(scores))]] if indexes else []
+        else:
+            raise NotImplementedError('This annotator type not supported')
+        strand = table.strands[indexes[0]] if indexes else 0
+        return strand if strand else None
+
     def _guess_orientations(self, seqs, annotator_name, blastdb):
         '''It returns the orientation of the annotated transcripts.'''
         orientations = []
         for seq in seqs:
+            if seq.kind == SEQITEM:
+                table = seq.object.annotations.get(FEATURE_TABLE, None)
+                if table is None:
+                    orientation = None
+                else:
+                    guess = self._guess_orientation_from_table
+                    orientation = guess(table, annotator_name, blastdb)
+                orientations.append(orientation)
+                continue
             if annotator_name == 'polyA':
                 feature = self._polya_selector(seq.object.features)
             elif annotator_name == 'estscan_orf':
@@ -102,7 +202,7 @@ class TranscriptOrientator(object):
             orientations.append(orientation)
         return orientations
 
-    def _get_annotator(self, annotator_name, blastdb):
+    def _get_annotator(self, annotator_name, blastdb, threads=None):
         'It prepares and returns the annotator'
         if annotator_name == 'polyA':
             annotator = PolyaAnnotator(**self._polya_params)
@@ -114,29 +214,54 @@ class TranscriptOrientator(object):
                 if blastdb == blast_param_['blastdb']:
                     blast_param = blast_param_
                     break
+            if threads is not None:
+                blast_param = blast_param.copy()
+                params = blast_param.get('params', None)
+                params = {} if params is None else params.copy()
+                params['num_threads'] = threads
+                blast_param['params'] = params
             annotator = BlastAnnotator(**blast_param)
         else:
             raise NotImplementedError('This annotator type not supported')
         return annotator
 
-    def __call__(self, seqs):
-        'It orientates seqs, that should have a SeqRecord in it'
-        orientations = None
-        orientation_log = [None] * len(seqs)
-
-        for annotator in self._annotators:
-            if orientations:
-                to_annalyze = [not o for o in orientations]
-                seqs_to_analyze = list(compress(seqs, to_annalyze))
-            else:
-                orientations = [None] * len(seqs)
-                seqs_to_analyze = seqs
+    def _annotate(self, seqs, threads=None, annotated_streams=None):
+        '''It starts the annotation of the seqs by every annotator.
 
+        Every annotator gets its own copies of the seqs, so they can run at
+        the same time. The annotators with a stream of annotated packets,
+        indexed by their position in the pipeline, take the seqs from it.
+        '''
+        if annotated_streams is None:
+            annotated_streams = {}
+        jobs = []
+        for index, annotator in enumerate(self._annotators):
             annotator_name = annotator['name']
             blastdb = annotator.get('blastdb', None)
-            annotator = self._get_annotator(annotator_name, blastdb)
+            if index in annotated_streams:
+                job = _StreamJob(annotated_streams[index])
+                jobs.append((annotator_name, blastdb, job))
+                continue
+            annotator = self._get_annotator(annotator_name, blastdb,
+                                            threads=threads)
+            # the poly-A annotation does not run any external program
+            in_thread = annotator_name != 'polyA'
+            job = _AnnotationJob(annotator, _copy_seqs(seqs),
+                                 in_thread=in_thread)
+            jobs.append((annotator_name, blastdb, job))
+        return jobs
+
+    def _orientate(self, seqs, jobs):
+        '''It orientates the seqs with the results of the annotation jobs.
 
-            annot_seqrecords = annotator(seqs_to_analyze)
+        The orientation of every seq is given by the first annotator, in the
+        order of the pipeline, that guesses it. Every seq gets the features
+        of the annotators up to that one.
+        '''
+        orientations = [None] * len(seqs)
+        orientation_log = [None] * len(seqs)
+        for annotator_name, blastdb, job in jobs:
+            annot_seqrecords = job.join()
             annot_strands = self._guess_orientations(annot_seqrecords,
                                                      annotator_name,
                                                      blastdb=blastdb)
@@ -144,28 +269,67 @@ class TranscriptOrientator(object):
             if blastdb:
                 annotator_name += ' ' + os.path.basename(blastdb)
 
-            analyzed_seqs_index = 0
             for index, orientation in enumerate(orientations):
                 if orientation is None:
-                    orientations[index] = annot_strands[analyzed_seqs_index]
-                    if annot_strands[analyzed_seqs_index] == -1:  # reverse
+                    annot_seq = annot_seqrecords[index]
+                    if annot_seq.kind == SEQITEM:
+                        table = annot_seq.object.annotations.get(FEATURE_TABLE,
+                                                                 None)
+                        if table is not None:
+                            get_feature_table(seqs[index]).extend(table)
+                    else:
+                        features = annot_seq.object.features
+                        seqs[index].object.features.extend(features)
+                    orientations[index] = annot_strands[index]
+                    if annot_strands[index] == -1:  # reverse
                         orientation_log[index] = annotator_name
-                    analyzed_seqs_index += 1
         # Now we reverse the seqs that we have guess that are reversed
         reorientated_seqrecords = []
         for orientation, seq, reason in zip(orientations, seqs,
                                             orientation_log):
             if orientation == -1:
-                rev_seqrecord = seq.object.reverse_complement(id=True,
-                                                              description=True,
-                                                              annotations=True,
-                                                              features=True,
-                                                              dbxrefs=True,
-                                                              name=True)
-                seq = SeqWrapper(SEQRECORD, rev_seqrecord, None)
+                seq = reverse_complement_seq(seq)
                 # we mark the reason why it has been reversed
                 text = '(reversed because of: {})'.format(reason)
                 append_to_description(seq, text)
 
             reorientated_seqrecords.append(seq)
         return reorientated_seqrecords
+
+    def __call__(self, seqs):
+        'It orientates seqs, that should have a SeqRecord in it'
+        return self._orientate(seqs, self._annotate(seqs))
+
+    def orientate_packets(self, seq_packets, processes=1, threads=None):
+        '''It orientates a stream of packets of seqs.
+
+        The annotators of a packet run at the same time, ESTScan and every
+        blast database as separate subprocesses. Up to processes packets are
+        annotated at the same time, so the next packets are being annotated
+        while the previous ones are orientated. Every blast database gets
+        its own stream of packets, blasted by up to processes blasts with
+        the given number of threads.
+        '''
+        blast_indexes = [index for index, annotator
+                         in enumerate(self._annotators)
+                         if annotator['name'] == 'blast']
+        seq_packets = tee(seq_packets, len(blast_indexes) + 1)
+        annotated_streams = {}
+        for index, packets in zip(blast_indexes, seq_packets[1:]):
+            blastdb = self._annotators[index]['blastdb']
+            annotator = self._get_annotator('blast', blastdb)
+            annotated_streams[index] = annotator.annotate_packets(
+                                                   imap(_copy_seqs, packets),
+                                                   processes=processes,
+                                                   threads=threads)
+        jobs = deque()
+        for seqs in seq_packets[0]:
+            finished = None
+            if len(jobs) >= processes:
+                finished = jobs.popleft()
+            jobs.append((seqs, self._annotate(seqs, threads=threads,
+                                        annotated_streams=annotated_streams)))
+            if finished is not None:
+                yield self._orientate(*finished)
+        while jobs:
+            yield self._orientate(*jobs.popleft())
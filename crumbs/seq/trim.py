@@ -13,22 +13,20 @@
 # You should have received a copy of the GNU General Public License
 # along with ngs_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
-import sys
-import subprocess
 from operator import itemgetter
 from tempfile import NamedTemporaryFile
 
-from crumbs.utils.optional_modules import Seq, AlignmentFile
-from crumbs.utils.tags import (TRIMMING_RECOMMENDATIONS, QUALITY, OTHER,
-                               VECTOR, TRIMMING_KINDS, SEQS_PASSED,
-                               ORPHAN_SEQS)
+from crumbs.utils.optional_modules import (Seq, AlignmentFile, array, zeros,
+                                           maximum, minimum)
+from crumbs.utils.tags import (TRIMMING_RECOMMENDATIONS, TRIMMING_KINDS,
+                               SEQS_PASSED, ORPHAN_SEQS)
 from crumbs.seq.utils.seq_utils import get_uppercase_segments
 from crumbs.seq.seq import (copy_seq, get_str_seq, get_annotations, get_length,
                             slice_seq, get_int_qualities, get_name)
 from crumbs.utils.segments_utils import (get_longest_segment, get_all_segments,
                                          get_longest_complementary_segment,
                                          merge_overlaping_segments)
-from crumbs.utils.tags import SEQRECORD
+from crumbs.utils.tags import SEQRECORD, THREE_PRIME
 from crumbs.iterutils import rolling_window
 from crumbs.blast import BlasterForFewSubjects
 from crumbs.seq.seqio import write_seqs
@@ -40,6 +38,7 @@ from crumbs.seq.mate_chimeras import (_split_mates, _get_primary_alignment,
                                       _group_alignments_reads_by_qname)
 from crumbs.mapping import (alignedread_to_seqitem, map_with_bwamem,
                             map_process_to_sortedbam)
+from crumbs.seq.adapters import calc_adapter_free_regions
 # pylint: disable=R0903
 
 
@@ -54,19 +53,92 @@ def seq_to_trim_packets(seq_packets, group_paired_reads=False):
         yield {SEQS_PASSED: packet, ORPHAN_SEQS: []}
 
 
+class _TrimSegments(object):
+    '''The trimming recommendations for the seqs of a trim packet.
+
+    For every seq, in the packet order, the region to keep is stored in the
+    starts and ends arrays (ends not included). The trimming segments that
+    reach the seq edges just narrow it. The segments found inside the seq,
+    much less common, are kept apart, because the region to keep can only
+    be decided once all segments are known.
+    '''
+    def __init__(self, seqs):
+        self.lengths = array([get_length(seq) for seq in seqs], dtype=int)
+        self.starts = zeros(len(seqs), dtype=int)
+        self.ends = self.lengths.copy()
+        self.inner_segments = {}
+
+    def add_segments(self, index, segments):
+        'It adds the trimming segments of the seq with the given index'
+        seq_len = self.lengths[index]
+        for start, end in segments:
+            if start > end:
+                start, end = end, start
+            if start <= 0:
+                self.starts[index] = max(self.starts[index], end + 1)
+            elif end >= seq_len - 1:
+                self.ends[index] = min(self.ends[index], start)
+            else:
+                self.inner_segments.setdefault(index, []).append((start,
+                                                                  end))
+
+    def narrow(self, starts, ends):
+        'It narrows the regions to keep of all seqs to the given ones'
+        self.starts = maximum(self.starts, starts)
+        self.ends = minimum(self.ends, ends)
+
+    def trim_edges(self, left, right):
+        'It trims the given number of bases from the edges of every seq'
+        if left:
+            self.starts = maximum(self.starts, left)
+        if right:
+            self.ends = minimum(self.ends, self.lengths - right)
+
+    def get_segments(self, index):
+        'It returns the trimming segments of the seq with the given index'
+        segments = []
+        if self.starts[index] > 0:
+            segments.append((0, int(self.starts[index]) - 1))
+        if self.ends[index] < self.lengths[index]:
+            segments.append((int(self.ends[index]),
+                             int(self.lengths[index]) - 1))
+        segments.extend(self.inner_segments.get(index, []))
+        return segments
+
+
+def _get_trim_segments(trim_packet):
+    'It returns the trimming recommendations of the packet'
+    trim_segments = trim_packet.get(TRIMMING_RECOMMENDATIONS, None)
+    if trim_segments is None:
+        seqs = [seq for seqs in trim_packet[SEQS_PASSED] for seq in seqs]
+        trim_segments = _TrimSegments(seqs)
+    return trim_segments
+
+
 class _BaseTrim(object):
     'Base Trim class'
     def __call__(self, trim_packet):
         'It trims the seqs'
         self._pre_trim(trim_packet)
-        trimmed_seqs = []
-        for paired_seqs in trim_packet[SEQS_PASSED]:
-            trimmed_seqs.append([self._do_trim(s) for s in paired_seqs])
+        trim_segments = _get_trim_segments(trim_packet)
+        self._add_trim_segments(trim_packet, trim_segments)
         self._post_trim()
-        return {SEQS_PASSED: trimmed_seqs,
-                ORPHAN_SEQS: trim_packet[ORPHAN_SEQS]}
+        return {SEQS_PASSED: trim_packet[SEQS_PASSED],
+                ORPHAN_SEQS: trim_packet[ORPHAN_SEQS],
+                TRIMMING_RECOMMENDATIONS: trim_segments}
+
+    def _add_trim_segments(self, trim_packet, trim_segments):
+        'It adds the trimming segments of every seq'
+        index = 0
+        for paired_seqs in trim_packet[SEQS_PASSED]:
+            for seq in paired_seqs:
+                segments = self._do_trim(seq)
+                if segments:
+                    trim_segments.add_segments(index, segments)
+                index += 1
 
     def _do_trim(self, seq):
+        'It returns the segments to trim from the seq'
         raise NotImplementedError()
 
     def _pre_trim(self, trim_packet):
@@ -91,27 +163,9 @@ class TrimLowercasedLetters(_BaseTrim):
             if segment[1] != len_seq - 1:
                 segments.append((segment[1] + 1, len_seq - 1))
 
-            _add_trim_segments(segments, seq, kind=OTHER)
-
         else:
             segments = [(0, len(seq))]
-            _add_trim_segments(segments, seq, kind=OTHER)
-        return seq
-
-
-def _add_trim_segments(segments, sequence, kind):
-    'It adds segments to the trimming recommendation in the annotation'
-    assert kind in TRIMMING_KINDS
-    if not segments:
-        return
-    annotations = sequence.object.annotations
-    if TRIMMING_RECOMMENDATIONS not in annotations:
-        annotations[TRIMMING_RECOMMENDATIONS] = {}
-        for trim_kind in TRIMMING_KINDS:
-            annotations[TRIMMING_RECOMMENDATIONS][trim_kind] = []
-
-    trim_rec = annotations[TRIMMING_RECOMMENDATIONS]
-    trim_rec[kind].extend(segments)
+        return segments
 
 
 class TrimEdges(_BaseTrim):
@@ -127,16 +181,9 @@ class TrimEdges(_BaseTrim):
         self.right = right
         super(TrimEdges, self).__init__()
 
-    def _do_trim(self, seq):
-        'It trims the edges of the given seqs.'
-        left = self.left
-        right = self.right
-        segments = [(0, left - 1)] if left else []
-        if right:
-            seq_len = get_length(seq)
-            segments.append((seq_len - right, seq_len - 1))
-        _add_trim_segments(segments, seq, kind=OTHER)
-        return seq
+    def _add_trim_segments(self, trim_packet, trim_segments):
+        'It trims the edges of all seqs at once.'
+        trim_segments.trim_edges(self.left, self.right)
 
 
 def _mask_sequence(seq, segments):
@@ -156,23 +203,89 @@ def _mask_sequence(seq, segments):
         if segment[1]:
             str_seq_ = str_seq_.lower()
         new_seq += str_seq_
+    return _copy_with_str_seq(seq, new_seq)
+
+
+def _copy_with_str_seq(seq, str_seq):
     if seq.kind == SEQRECORD:
-        new_seq = Seq(new_seq, alphabet=seq.object.seq.alphabet)
-    return copy_seq(seq, seq=new_seq)
+        str_seq = Seq(str_seq, alphabet=seq.object.seq.alphabet)
+    return copy_seq(seq, seq=str_seq)
+
+
+def _pop_annotated_segments(seq):
+    'It removes and returns the recommendations kept in the seq annotations'
+    annots = get_annotations(seq)
+    trim_rec = annots.pop(TRIMMING_RECOMMENDATIONS, None)
+    if trim_rec is None:
+        return None
+    segments = []
+    for trim_kind in TRIMMING_KINDS:
+        segments.extend(trim_rec.get(trim_kind, []))
+    return segments
+
+
+def _trim_or_mask_seqs(seqs, trim_segments, mask):
+    '''It trims or masks the seqs following the packet recommendations.
+
+    The regions to keep of all seqs are checked at once and only the seqs
+    with something to trim are copied. The trimmed out seqs are None.
+    '''
+    starts, ends = trim_segments.starts, trim_segments.ends
+    untouched = (starts == 0) & (ends == trim_segments.lengths)
+    inner_segments = trim_segments.inner_segments
+    new_seqs = []
+    for index, seq in enumerate(seqs):
+        if index in inner_segments:
+            # the general algorithm, the longest region without segments
+            segments = trim_segments.get_segments(index)
+            if mask:
+                seq = _mask_sequence(seq, segments)
+            else:
+                trim_limits = get_longest_complementary_segment(
+                                                segments, get_length(seq))
+                if trim_limits is None:
+                    seq = None
+                else:
+                    seq = slice_seq(seq, trim_limits[0], trim_limits[1] + 1)
+        elif not untouched[index]:
+            start, end = int(starts[index]), int(ends[index])
+            if mask:
+                str_seq = get_str_seq(seq)
+                end = max(start, end)
+                str_seq = (str_seq[:start].lower() + str_seq[start:end] +
+                           str_seq[end:].lower())
+                seq = _copy_with_str_seq(seq, str_seq)
+            elif start >= end:
+                # there's no sequence left
+                seq = None
+            else:
+                seq = slice_seq(seq, start, end)
+        new_seqs.append(seq)
+    return new_seqs
 
 
 class TrimOrMask(object):
-    'It trims and masks the Seq following the trimming recommendations.'
+    '''It trims and masks the Seq following the trimming recommendations.
+
+    The recommendations are taken from the trim packet and, if any, from the
+    seq annotations.
+    '''
     def __init__(self, mask=False):
         '''The initiator.'''
         self.mask = mask
 
     def __call__(self, trim_packet):
         'It trims the seqs'
+        paired_seqs = trim_packet[SEQS_PASSED]
+        trim_segments = _get_trim_segments(trim_packet)
+        seqs = [seq for seqs in paired_seqs for seq in seqs]
+        self._add_annotated_segments(seqs, trim_segments)
+        seqs = iter(_trim_or_mask_seqs(seqs, trim_segments, self.mask))
+
         trimmed_seqs = []
         orphan_seqs = trim_packet[ORPHAN_SEQS]
-        for paired_seqs in trim_packet[SEQS_PASSED]:
-            trimmed_paired_seqs = [self._do_trim(s) for s in paired_seqs]
+        for seqs_in_pair in paired_seqs:
+            trimmed_paired_seqs = [next(seqs) for _ in seqs_in_pair]
             # all sequences are trimed, no lost
             if None not in trimmed_paired_seqs:
                 trimmed_seqs.append(trimmed_paired_seqs)
@@ -187,47 +300,19 @@ class TrimOrMask(object):
         orphan_seqs = self._trim_orphans(orphan_seqs)
         return {SEQS_PASSED: trimmed_seqs, ORPHAN_SEQS: orphan_seqs}
 
-    def _do_trim(self, seq):
-        'It trims the edges of the given seqs.'
-        annots = get_annotations(seq)
-        if not TRIMMING_RECOMMENDATIONS in annots:
-            return seq
-
-        trim_rec = annots[TRIMMING_RECOMMENDATIONS]
-        # fixing the trimming recommendations
-        if TRIMMING_RECOMMENDATIONS in annots:
-            del annots[TRIMMING_RECOMMENDATIONS]
-
-        trim_segments = []
-        for trim_kind in TRIMMING_KINDS:
-            trim_segments.extend(trim_rec.get(trim_kind, []))
-
-        # masking
-        if self.mask:
-            seq = _mask_sequence(seq, trim_segments)
-        else:
-            # trimming
-            if trim_segments:
-                trim_limits = get_longest_complementary_segment(
-                                            trim_segments, get_length(seq))
-                if trim_limits is None:
-                    # there's no sequence left
-                    return None
-            else:
-                trim_limits = []
-
-            if trim_limits:
-                seq = slice_seq(seq, trim_limits[0], trim_limits[1] + 1)
-
-        return seq
+    @staticmethod
+    def _add_annotated_segments(seqs, trim_segments):
+        'It moves the recommendations in the seq annotations to the packet'
+        for index, seq in enumerate(seqs):
+            segments = _pop_annotated_segments(seq)
+            if segments:
+                trim_segments.add_segments(index, segments)
 
     def _trim_orphans(self, seqs):
-        new_seqs = []
-        for seq in seqs:
-            seq = self._do_trim(seq)
-            if seq is not None:
-                new_seqs.append(seq)
-        return new_seqs
+        trim_segments = _TrimSegments(seqs)
+        self._add_annotated_segments(seqs, trim_segments)
+        seqs = _trim_or_mask_seqs(seqs, trim_segments, self.mask)
+        return [seq for seq in seqs if seq is not None]
 
 
 def _get_bad_quality_segments(quals, window, threshold, trim_left=True,
@@ -299,12 +384,8 @@ class TrimByQuality(_BaseTrim):
         except KeyError:
             msg = 'Some of the input sequences do not have qualities: {}'
             msg = msg.format(get_name(seq))
-        segments = _get_bad_quality_segments(quals, window, threshold,
-                                            trim_left, trim_right)
-        if segments is not None:
-            _add_trim_segments(segments, seq, kind=QUALITY)
-
-        return seq
+        return _get_bad_quality_segments(quals, window, threshold, trim_left,
+                                         trim_right)
 
 
 class TrimWithBlastShort(_BaseTrim):
@@ -332,8 +413,7 @@ class TrimWithBlastShort(_BaseTrim):
         'It trims the masked segments of the SeqWrappers.'
         segments = self._matcher.get_matched_segments_for_read(get_name(seq))
         if segments is not None:
-            _add_trim_segments(segments[0], seq, kind=VECTOR)
-        return seq
+            return segments[0]
 
 
 def _get_longest_5end_alinged_read(aligned_reads, max_clipping):
@@ -387,21 +467,28 @@ class TrimMatePairChimeras(_BaseTrim):
                 else:
                     qend = get_length(seq) - _get_qstart(_5end)
                 segments = [(qend, get_length(seq) - 1)]
-        if segments is not None:
-            _add_trim_segments(segments, seq, kind=OTHER)
-        return seq
+        return seq, segments
 
     def __call__(self, trim_packet):
         'It trims the seqs'
         self._pre_trim(trim_packet)
         trimmed_seqs = []
+        seqs_segments = []
         bamfile = AlignmentFile(self._bam_fhand.name)
         for grouped_mates in _group_alignments_reads_by_qname(bamfile):
             for aligned_reads in _split_mates(grouped_mates):
-                trimmed_seqs.append([self._do_trim(aligned_reads)])
+                seq, segments = self._do_trim(aligned_reads)
+                trimmed_seqs.append([seq])
+                seqs_segments.append(segments)
         self._post_trim()
+        # the seqs come from the bam, so the recommendations start again
+        trim_segments = _TrimSegments([seqs[0] for seqs in trimmed_seqs])
+        for index, segments in enumerate(seqs_segments):
+            if segments:
+                trim_segments.add_segments(index, segments)
         return {SEQS_PASSED: trimmed_seqs,
-                ORPHAN_SEQS: trim_packet[ORPHAN_SEQS]}
+                ORPHAN_SEQS: trim_packet[ORPHAN_SEQS],
+                TRIMMING_RECOMMENDATIONS: trim_segments}
 
     def _post_trim(self):
         self._bam_fhand.close()
@@ -432,30 +519,39 @@ class TrimNexteraAdapters(_BaseTrim):
         'It trims the masked segments of the SeqWrappers.'
         segments = self._matcher.get_matched_segments_for_read(get_name(seq))
         if segments is not None:
-            segments = [(segment[0], get_length(seq) - 1) for segment in segments[0]]
-            _add_trim_segments(segments, seq, kind=OTHER)
-        return seq
+            return [(segment[0], get_length(seq) - 1)
+                    for segment in segments[0]]
 
-CUTADAPT = 'cutadapt'
-#cutadapt bin should be included somewhere else
-_5END = '5end'
-_3END = '3end'
-ANYWHERE = 'anywhere'
-
-def trim_with_cutadapt(in_fpath, out_fpath, oligos, error_rate=None,
-                       summary_fpath=None):
-    #TODO: include cutadapt in the code or remove this function
-    # This functionallity is not throughly tested
-    options = {_3END: '-a', ANYWHERE: '-b', _5END: '-g'}
-    cmd = [CUTADAPT, in_fpath, '-o', out_fpath]
-    for kind, oligo_seqs in oligos.items():
-        for oligo_seq in oligo_seqs:
-            cmd.extend([options[kind], oligo_seq])
-    if error_rate is not None:
-        cmd.append(str(error_rate))
-    if summary_fpath is None:
-        summary_fhand = sys.stdout
-    else:
-        summary_fhand = open(summary_fpath, 'w')
-    cutadapt = subprocess.Popen(cmd, stdout=summary_fhand)
-    cutadapt.wait()
+
+class TrimAdapters(_BaseTrim):
+    '''It trims the adapters found by a semiglobal alignment.
+
+    The adapters are searched in all the seqs of the packet at once and
+    they can be partial at the seq ends. In the 3' mode the adapter and the
+    sequence after it are trimmed, in the 5' mode the adapter and the
+    sequence before it.
+    '''
+    def __init__(self, oligos, mode=THREE_PRIME,
+                 max_error_rate=get_setting('ADAPTER_MAX_ERROR_RATE'),
+                 min_overlap=get_setting('ADAPTER_MIN_OVERLAP')):
+        '''The initiator.
+
+        The mode can be FIVE_PRIME, THREE_PRIME or ANYWHERE and the
+        max_error_rate is the number of errors allowed by aligned adapter base.
+        '''
+        self.oligos = [get_str_seq(oligo) for oligo in oligos]
+        self.mode = mode
+        self.max_error_rate = max_error_rate
+        self.min_overlap = min_overlap
+        super(TrimAdapters, self).__init__()
+
+    def _add_trim_segments(self, trim_packet, trim_segments):
+        'It trims the adapters of all seqs at once.'
+        str_seqs = [get_str_seq(seq) for seqs in trim_packet[SEQS_PASSED]
+                    for seq in seqs]
+        for oligo in self.oligos:
+            starts, ends = calc_adapter_free_regions(str_seqs, oligo,
+                                                     mode=self.mode,
+                                         max_error_rate=self.max_error_rate,
+                                         min_overlap=self.min_overlap)
+            trim_segments.narrow(starts, ends)
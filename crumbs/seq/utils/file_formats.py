@@ -14,11 +14,12 @@
 # along with ngs_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
 
-import cStringIO
+import os
+import stat
+import weakref
 from array import array
 import hashlib
 
-from crumbs.utils.optional_modules import FastqGeneralIterator
 from crumbs.settings import get_setting
 from crumbs.utils.file_utils import fhand_is_seekable, peek_chunk_from_file
 from crumbs.exceptions import (UnknownFormatError, UndecidedFastqVersionError,
@@ -29,37 +30,72 @@ STRINGIOTYPE = 'stringio'
 OTHERTYPE = 'othertype'
 
 
+def read_fastq_chunk(chunk, chunk_is_complete):
+    '''It yields the seq and qual strs of the fastq records found in a chunk.
+
+    The chunk is parsed as it is, so it does not need to be copied into a
+    file like object. The last record is ignored if it is incomplete and the
+    chunk is just the beginning of the file.
+    '''
+    lines = chunk.splitlines()
+    n_lines = len(lines)
+    line_idx = 0
+    while line_idx < n_lines:
+        header = lines[line_idx]
+        line_idx += 1
+        if not header:
+            continue
+        if header[0] != '@':
+            raise ValueError('Fastq records should start with @')
+        seq_lines = []
+        while line_idx < n_lines and not lines[line_idx].startswith('+'):
+            seq_lines.append(lines[line_idx])
+            line_idx += 1
+        seq = ''.join(seq_lines)
+        line_idx += 1
+        qual_lines = []
+        qual_len = 0
+        while line_idx < n_lines and qual_len < len(seq):
+            qual_lines.append(lines[line_idx])
+            qual_len += len(lines[line_idx])
+            line_idx += 1
+        if line_idx > n_lines or qual_len < len(seq):
+            if chunk_is_complete:
+                raise ValueError('Truncated fastq record')
+            return
+        if qual_len > len(seq):
+            raise ValueError('Lengths of sequence and quality values differ')
+        yield seq, ''.join(qual_lines)
+
+
 def _get_some_qual_and_lengths(fhand, force_file_as_non_seek):
     'It returns the quality characters and the lengths'
     seqs_to_peek = get_setting('SEQS_TO_GUESS_FASTQ_VERSION')
     chunk_size = get_setting('CHUNK_TO_GUESS_FASTQ_VERSION')
 
-    lengths = array('I')
-    seqs_analyzed = 0
     if fhand_is_seekable(fhand) and not force_file_as_non_seek:
-        fmt_fhand = fhand
-        chunk = fmt_fhand.read(chunk_size)
+        chunk = fhand.read(chunk_size)
         fhand.seek(0)
+        chunk_is_complete = len(chunk) < chunk_size
     else:
+        # a peeked chunk could be shorter than the available data
         chunk = peek_chunk_from_file(fhand, chunk_size)
-        fmt_fhand = cStringIO.StringIO(chunk)
+        chunk_is_complete = False
 
+    lengths = array('I')
     try:
-        for seq in FastqGeneralIterator(fmt_fhand):
-            qual = [ord(char) for char in seq[2]]
-            sanger_chars = [q for q in qual if q < 64]
-            if sanger_chars:
-                fhand.seek(0)
+        for _, qual in read_fastq_chunk(chunk, chunk_is_complete):
+            # the sanger quality chars are found below @
+            if qual and min(qual) < '@':
                 return None, True, chunk  # no quals, no lengths, is_sanger
             lengths.append(len(qual))
-            seqs_analyzed += 1
-            if seqs_analyzed > seqs_to_peek:
+            if len(lengths) > seqs_to_peek:
                 break
     except ValueError:
+        lengths = None
+    if not lengths:
         msg = 'The file is Fastq, but the version is difficult to guess'
         raise UndecidedFastqVersionError(msg)
-    finally:
-        fhand.seek(0)
     return lengths, None, chunk  # don't know if it's sanger
 
 
@@ -95,6 +131,11 @@ def _guess_fastq_version(fhand, force_file_as_non_seek):
         return 'fastq-illumina'
 
 FILEFORMAT_INVENTORY = {}
+# the inventory fhands are weakly kept because their ids can be reused
+_INVENTORY_FHANDS = {}
+# the formats of the files in disk are also kept by their path, size and mtime
+# so they are not guessed again for every new fhand
+_FORMATS_BY_FILE = {}
 
 
 def _get_instance_type(fhand):
@@ -125,17 +166,58 @@ def _get_fhand_id(fhand):
     return key
 
 
+def _get_file_key(fhand):
+    '''It returns the path, size and mtime of the file.
+
+    It returns None for the fhands that are not regular files in disk, like
+    stdin, StringIOs or the uncompressing wrappers.
+    '''
+    fpath = getattr(fhand, 'name', None)
+    # NamedTemporaryFile wraps the file
+    fhand = getattr(fhand, 'file', fhand)
+    if not isinstance(fhand, file) or not isinstance(fpath, basestring):
+        return None
+    try:
+        file_stat = os.fstat(fhand.fileno())
+        path_stat = os.stat(fpath)
+    except (OSError, ValueError):
+        return None
+    if (not stat.S_ISREG(file_stat.st_mode) or
+            not os.path.samestat(file_stat, path_stat)):
+        return None
+    return (os.path.realpath(fpath), file_stat.st_size, file_stat.st_mtime)
+
+
+def _remember_fhand(id_, fhand):
+    try:
+        _INVENTORY_FHANDS[id_] = weakref.ref(fhand)
+    except TypeError:
+        # some fhands, like cStringIO, can not be weakly referenced
+        _INVENTORY_FHANDS.pop(id_, None)
+
+
+def _is_inventory_fhand(id_, fhand):
+    'It checks that the id is not being reused by a new fhand'
+    fhand_ref = _INVENTORY_FHANDS.get(id_)
+    return fhand_ref is None or fhand_ref() is fhand
+
+
 def get_format(fhand):
     'It gets the format or it looks in the inventory'
     id_ = _get_fhand_id(fhand)
-    try:
-        file_format = FILEFORMAT_INVENTORY[id_]
-    except KeyError:
+    file_format = FILEFORMAT_INVENTORY.get(id_)
+    if file_format is not None and not _is_inventory_fhand(id_, fhand):
         file_format = None
 
     if file_format is None:
-        file_format = _guess_format(fhand, force_file_as_non_seek=False)
+        file_key = _get_file_key(fhand)
+        file_format = _FORMATS_BY_FILE.get(file_key)
+        if file_format is None:
+            file_format = _guess_format(fhand, force_file_as_non_seek=False)
+            if file_key is not None:
+                _FORMATS_BY_FILE[file_key] = file_format
         FILEFORMAT_INVENTORY[id_] = file_format
+        _remember_fhand(id_, fhand)
 
     return file_format
 
@@ -143,10 +225,11 @@ def get_format(fhand):
 def set_format(fhand, file_format):
     'It sets the file format in the global inventory variable'
     id_ = _get_fhand_id(fhand)
-    if id_ in FILEFORMAT_INVENTORY:
+    if id_ in FILEFORMAT_INVENTORY and _is_inventory_fhand(id_, fhand):
         msg = 'The given instance already setted its file format'
         raise RuntimeError(msg)
     FILEFORMAT_INVENTORY[id_] = file_format
+    _remember_fhand(id_, fhand)
 
 
 def _guess_format(fhand, force_file_as_non_seek):
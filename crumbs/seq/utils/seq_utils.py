@@ -18,7 +18,7 @@ import re
 import itertools
 from multiprocessing import Pool
 
-from crumbs.utils.tags import UPPERCASE, LOWERCASE, SWAPCASE
+from crumbs.utils.tags import UPPERCASE, LOWERCASE, SWAPCASE, SEQITEM
 from crumbs.seq.seq import get_description, get_name, get_str_seq, copy_seq
 
 
@@ -76,10 +76,17 @@ class ChangeCase(object):
 def append_to_description(seqrecord, text):
     'it appends the text to the seqrecord description'
     desc = get_description(seqrecord)
+    if desc is not None:
+        # the SeqItem descriptions keep the end of the title line
+        desc = desc.rstrip('\n')
     if desc in (None, get_name(seqrecord), '<unknown description>'):
         desc = ''
     desc += text
-    seqrecord.object.description = desc
+    if seqrecord.kind == SEQITEM:
+        lines = seqrecord.object.lines
+        lines[0] = lines[0][0] + get_name(seqrecord) + ' ' + desc + '\n'
+    else:
+        seqrecord.object.description = desc
 
 
 class _FunctionRunner(object):
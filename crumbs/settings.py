@@ -88,6 +88,11 @@ _POLYA_ANNOTATOR_MISMATCHES = 1
 _DEFAULT_QUALITY_TRIM_TRESHOLD = 25
 _DEFAULT_QUALITY_TRIM_WINDOW = 5
 
+# adapter trim
+_ADAPTER_MAX_ERROR_RATE = 0.1
+_ADAPTER_MIN_OVERLAP = 3
+_NEXTERA_ADAPTERS = ['CTGTCTCTTATACACATCT', 'AGATGTGTATAAGAGACAG']
+
 # dust score parameters
 _DUST_WINDOWSIZE = 64
 _DUST_WINDOWSTEP = 32
@@ -104,6 +109,8 @@ _DEFAULT_MIN_MAPQ = 0
 # buffer size and memory limit for match_pairs
 _MAX_READS_IN_MEMORY = 1000000
 _CHECK_ORDER_BUFFER_SIZE = 100000
+# number of files used to store the unmatched reads in match_pairs by hash
+_PAIR_MATCHING_HASH_PARTITIONS = 64
 
 # default parameters for chimera finding
 _CHIMERAS_SETTINGS = {}
@@ -112,6 +119,9 @@ _CHIMERAS_SETTINGS['MAX_PE_LEN'] = 750
 _CHIMERAS_SETTINGS['MATE_DISTANCE_VARIATION'] = 1000
 
 _DEFAULT_N_BINS = 80
+
+# length of the regions in which the BAM coverage is calculated with numpy
+_COVERAGE_CHUNK_SIZE = 100000
 _DEFAULT_N_MOST_ABUNDANT_REFERENCES = 40
 
 
@@ -216,6 +216,13 @@ def uncompress_gzip(in_fhand, uncompressed_fhand):
     check_call(cmd, stdout=uncompressed_fhand)
 
 
+def index_is_updated(fpath, index_fpath):
+    'It checks that the index exists and that it is newer than the file'
+    if not os.path.exists(index_fpath):
+        return False
+    return os.path.getmtime(index_fpath) >= os.path.getmtime(fpath)
+
+
 def index_vcf_with_tabix(in_fpath):
     cmd = ['tabix', '-p', 'vcf', in_fpath]
     tabix = Popen(cmd, stdout=PIPE, stderr=PIPE)
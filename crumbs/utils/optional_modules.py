@@ -17,6 +17,10 @@
 In this module all the imports of the optional modules are handled
 '''
 
+import sys
+from importlib import import_module
+from types import ModuleType
+
 from crumbs.exceptions import OptionalRequirementError
 
 MSG = 'A python package to run this executable is required,'
@@ -47,71 +51,18 @@ except ImportError:
     SeqFeature = create_fake_class(MSG + BIO)
     FeatureLocation = create_fake_class(MSG + BIO)
 try:
-    from Bio.Restriction.Restriction import (CommOnly, RestrictionBatch,
-                                             Analysis)
-except ImportError:
-    CommOnly = create_fake_class(MSG + BIO)
-    RestrictionBatch = create_fake_class(MSG + BIO)
-    Analysis = create_fake_class(MSG + BIO)
-try:
-    from Bio.SeqIO.SffIO import SffIterator
-except ImportError:
-    SffIterator = create_fake_class(MSG + BIO)
-
-try:
-    from Bio.bgzf import BgzfWriter
+    from Bio.bgzf import BgzfWriter, BgzfReader
 except ImportError:
     BgzfWriter = create_fake_class(MSG + BIO_BGZF)
+    BgzfReader = create_fake_class(MSG + BIO_BGZF)
 
 
-try:
-    from Bio.SeqIO.QualityIO import FastqGeneralIterator
-except ImportError:
-    FastqGeneralIterator = create_fake_class(MSG + BIO)
-
-try:
-    from Bio.SeqIO.FastaIO import FastaIterator
-except ImportError:
-    FastaIterator = create_fake_class(MSG + BIO)
-
-try:
-    from Bio.SeqIO.QualityIO import QualPhredIterator
-    from Bio.SeqIO.QualityIO import PairedFastaQualIterator
-    from Bio.SeqIO.QualityIO import FastqPhredIterator
-    from Bio.SeqIO.QualityIO import FastqSolexaIterator
-    from Bio.SeqIO.QualityIO import FastqIlluminaIterator
-    from Bio.SeqIO import parse as parse_into_seqrecs
-    from Bio.SeqIO import write as write_seqrecs
-except ImportError:
-    QualPhredIterator = create_fake_class(MSG + BIO)
-    PairedFastaQualIterator = create_fake_class(MSG + BIO)
-    FastqPhredIterator = create_fake_class(MSG + BIO)
-    FastqSolexaIterator = create_fake_class(MSG + BIO)
-    FastqIlluminaIterator = create_fake_class(MSG + BIO)
-    parse_into_seqrecs = create_fake_funct(MSG + BIO)
-    write_seqrecs = create_fake_funct(MSG + BIO)
-
-try:
-    from Bio.Blast import NCBIXML, NCBIWWW
-except ImportError:
-    NCBIXML = create_fake_class(MSG + BIO)
-    NCBIWWW = create_fake_class(MSG + BIO)
-
 try:
     from Bio._py3k import _bytes_to_string, _as_bytes
 except ImportError:
     _bytes_to_string = create_fake_funct(MSG + BIO)
     _as_bytes = create_fake_funct(MSG + BIO)
 
-try:
-    from Bio.SeqIO._index import SeqFileRandomAccess
-    from Bio.SeqIO._index import _FormatToRandomAccess
-    from Bio.SeqIO import index as seq_index
-except ImportError:
-    SeqFileRandomAccess = create_fake_class(MSG + BIO)
-    _FormatToRandomAccess = create_fake_class(MSG + BIO)
-    seq_index = create_fake_class(MSG + BIO)
-
 try:
     from Bio.Alphabet import Alphabet, AlphabetEncoder
 except ImportError:
@@ -162,7 +113,9 @@ except ImportError:
 # numpy
 try:
     from numpy import linspace, histogram, zeros, median, sum
-    from numpy import absolute, exp, array, percentile
+    from numpy import absolute, exp, array, percentile, bincount
+    from numpy import isnan, arange, frombuffer, unique
+    from numpy import cumsum, maximum, minimum, where, uint8, int16
 except ImportError:
     linspace = create_fake_funct(MSG + 'numpy')
     histogram = create_fake_funct(MSG + 'numpy')
@@ -173,49 +126,109 @@ except ImportError:
     exp = create_fake_funct(MSG + 'numpy')
     array = create_fake_funct(MSG + 'numpy')
     percentile = create_fake_funct(MSG + 'numpy')
-
-
-# matplotlib
-try:
-    from matplotlib.mlab import griddata
-    from matplotlib import cm
-    from matplotlib.colorbar import make_axes, Colorbar
-    from matplotlib.ticker import ScalarFormatter
-    from matplotlib.colors import LogNorm, Normalize
-except ImportError:
-    griddata = create_fake_funct(MSG + 'matplotlib')
-    cm = create_fake_funct(MSG + 'matplotlib')
-    make_axes = create_fake_funct(MSG + 'matplotlib')
-    Colorbar = create_fake_class(MSG + 'matplotlib')
-    ScalarFormatter = create_fake_class(MSG + 'matplotlib')
-    LogNorm = create_fake_class(MSG + 'matplotlib')
-    Normalize = create_fake_class(MSG + 'matplotlib')
-
-try:
-    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-    from matplotlib.figure import Figure
-except ImportError as error:
-    Figure = create_fake_class(MSG + 'matplotlib')
-    FigureCanvas = create_fake_class(MSG + 'matplotlib')
-
-try:
-    from mpl_toolkits.axes_grid1 import make_axes_locatable
-except ImportError as error:
-    make_axes_locatable = create_fake_funct(MSG + 'matplotlib')
-
-# scipy
-try:
-    from scipy.optimize import curve_fit
-    from scipy.stats.distributions import t
-    from scipy.stats import fisher_exact as scipy_fisher
-except ImportError:
-    curve_fit = create_fake_funct(MSG + 'scipy')
-    t = create_fake_funct(MSG + 'scipy')
-    scipy_fisher = create_fake_funct(MSG + 'scipy')
-
-# rpy2
-try:
-    from rpy2.robjects import IntVector, r
-except ImportError:
-    r = create_fake_funct(MSG + 'rpy')
-    IntVector = create_fake_funct(MSG + 'rpy')
+    bincount = create_fake_funct(MSG + 'numpy')
+    isnan = create_fake_funct(MSG + 'numpy')
+    arange = create_fake_funct(MSG + 'numpy')
+    frombuffer = create_fake_funct(MSG + 'numpy')
+    unique = create_fake_funct(MSG + 'numpy')
+    cumsum = create_fake_funct(MSG + 'numpy')
+    maximum = create_fake_funct(MSG + 'numpy')
+    minimum = create_fake_funct(MSG + 'numpy')
+    where = create_fake_funct(MSG + 'numpy')
+    uint8 = create_fake_class(MSG + 'numpy')
+    int16 = create_fake_class(MSG + 'numpy')
+
+# The heavy optional modules are imported the first time that one of their
+# objects is used, so the scripts that do not require them start faster.
+# name: (module, object in the module or None for the module, requirement,
+#        fake to use if the module is not installed)
+_LAZY_IMPORTS = {
+    # Biopython
+    'CommOnly': ('Bio.Restriction.Restriction', 'CommOnly', BIO,
+                 create_fake_class),
+    'RestrictionBatch': ('Bio.Restriction.Restriction', 'RestrictionBatch',
+                         BIO, create_fake_class),
+    'Analysis': ('Bio.Restriction.Restriction', 'Analysis', BIO,
+                 create_fake_class),
+    'SffIterator': ('Bio.SeqIO.SffIO', 'SffIterator', BIO, create_fake_class),
+    'FastqGeneralIterator': ('Bio.SeqIO.QualityIO', 'FastqGeneralIterator',
+                             BIO, create_fake_class),
+    'FastaIterator': ('Bio.SeqIO.FastaIO', 'FastaIterator', BIO,
+                      create_fake_class),
+    'QualPhredIterator': ('Bio.SeqIO.QualityIO', 'QualPhredIterator', BIO,
+                          create_fake_class),
+    'PairedFastaQualIterator': ('Bio.SeqIO.QualityIO',
+                                'PairedFastaQualIterator', BIO,
+                                create_fake_class),
+    'FastqPhredIterator': ('Bio.SeqIO.QualityIO', 'FastqPhredIterator', BIO,
+                           create_fake_class),
+    'FastqSolexaIterator': ('Bio.SeqIO.QualityIO', 'FastqSolexaIterator',
+                            BIO, create_fake_class),
+    'FastqIlluminaIterator': ('Bio.SeqIO.QualityIO', 'FastqIlluminaIterator',
+                              BIO, create_fake_class),
+    'parse_into_seqrecs': ('Bio.SeqIO', 'parse', BIO, create_fake_funct),
+    'write_seqrecs': ('Bio.SeqIO', 'write', BIO, create_fake_funct),
+    'NCBIXML': ('Bio.Blast.NCBIXML', None, BIO, create_fake_class),
+    'NCBIWWW': ('Bio.Blast.NCBIWWW', None, BIO, create_fake_class),
+    'SeqFileRandomAccess': ('Bio.SeqIO._index', 'SeqFileRandomAccess', BIO,
+                            create_fake_class),
+    '_FormatToRandomAccess': ('Bio.SeqIO._index', '_FormatToRandomAccess',
+                              BIO, create_fake_class),
+    'seq_index': ('Bio.SeqIO', 'index', BIO, create_fake_class),
+    # matplotlib
+    'griddata': ('matplotlib.mlab', 'griddata', 'matplotlib',
+                 create_fake_funct),
+    'cm': ('matplotlib.cm', None, 'matplotlib', create_fake_funct),
+    'make_axes': ('matplotlib.colorbar', 'make_axes', 'matplotlib',
+                  create_fake_funct),
+    'Colorbar': ('matplotlib.colorbar', 'Colorbar', 'matplotlib',
+                 create_fake_class),
+    'ScalarFormatter': ('matplotlib.ticker', 'ScalarFormatter', 'matplotlib',
+                        create_fake_class),
+    'LogNorm': ('matplotlib.colors', 'LogNorm', 'matplotlib',
+                create_fake_class),
+    'Normalize': ('matplotlib.colors', 'Normalize', 'matplotlib',
+                  create_fake_class),
+    'FigureCanvas': ('matplotlib.backends.backend_agg', 'FigureCanvasAgg',
+                     'matplotlib', create_fake_class),
+    'Figure': ('matplotlib.figure', 'Figure', 'matplotlib',
+               create_fake_class),
+    'make_axes_locatable': ('mpl_toolkits.axes_grid1', 'make_axes_locatable',
+                            'matplotlib', create_fake_funct),
+    # scipy
+    'curve_fit': ('scipy.optimize', 'curve_fit', 'scipy', create_fake_funct),
+    't': ('scipy.stats.distributions', 't', 'scipy', create_fake_funct),
+    'scipy_fisher': ('scipy.stats', 'fisher_exact', 'scipy',
+                     create_fake_funct),
+    # rpy2
+    'IntVector': ('rpy2.robjects', 'IntVector', 'rpy', create_fake_funct),
+    'r': ('rpy2.robjects', 'r', 'rpy', create_fake_funct),
+}
+
+
+class _OptionalModules(ModuleType):
+    'It imports the lazy objects the first time that they are requested'
+    def __getattr__(self, name):
+        try:
+            module, obj_name, requirement, fake_creator = _LAZY_IMPORTS[name]
+        except KeyError:
+            raise AttributeError(name)
+        try:
+            obj = import_module(module)
+            if obj_name is not None:
+                obj = getattr(obj, obj_name)
+        except ImportError:
+            obj = fake_creator(MSG + requirement)
+        setattr(self, name, obj)
+        return obj
+
+    def __dir__(self):
+        return sorted(set(self.__dict__).union(_LAZY_IMPORTS))
+
+
+_LAZY_MODULE = _OptionalModules(__name__, __doc__)
+_LAZY_MODULE.__dict__.update(globals())
+# the original module is kept because python 2 clears the globals of the
+# deleted modules
+_LAZY_MODULE.original_module = sys.modules[__name__]
+sys.modules[__name__] = _LAZY_MODULE
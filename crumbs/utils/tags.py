@@ -33,6 +33,7 @@ VECTOR = 'vector'
 QUALITY = 'quality'
 OTHER = 'other'
 TRIMMING_KINDS = [VECTOR, QUALITY, OTHER]
+FEATURE_TABLE = 'feature_table'
 ELONGATED = 'elongated'
 SUBJECT = 'subject'
 QUERY = 'query'
@@ -49,6 +50,7 @@ ERROR_ENVIRON_VARIABLE = 'ngs_crumbs_error_debugging'
 
 FIVE_PRIME = "5'"
 THREE_PRIME = "3'"
+ANYWHERE = 'anywhere'
 
 SEQS_PASSED = 'seqs_passed'
 SEQS_FILTERED_OUT = 'seqs_filtered_out'
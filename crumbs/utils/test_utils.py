@@ -15,6 +15,28 @@
 
 
 import os.path
+import atexit
+from shutil import copy
+
+from crumbs.utils.file_utils import TemporaryDir
 
 TEST_DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..',
                                              '..', 'test', 'test_data'))
+
+_TEMP_DATA_DIR = None
+
+
+def get_temp_data_copy(fname):
+    '''It returns the path to a copy of a test data file in a temporary dir.
+
+    The indexes created next to the copy, like the .fai files, are removed
+    with the temporary dir instead of being left in the test data dir.
+    '''
+    global _TEMP_DATA_DIR
+    if _TEMP_DATA_DIR is None:
+        _TEMP_DATA_DIR = TemporaryDir()
+        atexit.register(_TEMP_DATA_DIR.close)
+    fpath = os.path.join(_TEMP_DATA_DIR.name, fname)
+    if not os.path.exists(fpath):
+        copy(os.path.join(TEST_DATA_DIR, fname), fpath)
+    return fpath
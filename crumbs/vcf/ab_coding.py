@@ -20,12 +20,10 @@ from itertools import imap
 from array import array
 from warnings import warn
 
-from crumbs.utils.optional_modules import (Reader as pyvcfReader,
-                                           Figure, make_axes_locatable,
-                                           LogNorm)
+from crumbs.utils.optional_modules import Reader as pyvcfReader
 
 from crumbs.iterutils import RandomAccessIterator
-from crumbs.vcf.ld import _count_biallelic_haplotypes
+from crumbs.vcf.ld import WindowHaplotypeCounter
 from crumbs.vcf.filters import _print_figure
 
 # Missing docstring
@@ -41,6 +39,21 @@ DEF_AB_CODER_THRESHOLD = 0.9
 AlleleCoding = namedtuple('AlleleCoding', ['A', 'B'])
 
 
+def calc_recomb_weight(haplo_cnt):
+    'It returns the weight of a snp pair, the lower recomb the higher weight'
+    recomb_rate = (haplo_cnt.aB + haplo_cnt.Ab) / sum(haplo_cnt)
+    return 2 * (0.5 - recomb_rate) if recomb_rate < 0.5 else 0
+
+
+def get_window_haplotype_counter(counter, samples, window):
+    'It returns the given counter if it is for the samples or a new one'
+    if counter is not None and list(counter.samples) == list(samples):
+        return counter
+    # the cached snps should span the windows of the smoothing, that are
+    # formed only by the coded snps
+    return WindowHaplotypeCounter(samples, window=window * 4)
+
+
 class GetCoding(object):
     suspicious_no_parent_alleles = 200
 
@@ -123,6 +136,8 @@ class ABCoder(object):
         self.recomb_threshold = recomb_threshold
         self._recombs = array('B')
         self._smoothes = array('f')
+        self.haplotype_counter = None
+        self._smooth_haplotype_counter = None
 
     @property
     def offspring(self):
@@ -134,16 +149,14 @@ class ABCoder(object):
         self._offspring = offspring
         return offspring
 
-    def _deduce_coding(self, snp_and_coding, snp1_calls, snp2_idxs):
+    def _deduce_coding(self, snp_and_coding, snp1, snp2_idxs):
         votes = Counter()
-        offspring = self.offspring
+        haplotype_counter = self.haplotype_counter
         for snp2_idx in snp2_idxs:
             snp2, coding2 = snp_and_coding[snp2_idx]
             if coding2 is None:
                 continue
-            snp2_calls = [snp2.genotype(sample) for sample in offspring]
-            haplos = _count_biallelic_haplotypes(snp1_calls, snp2_calls,
-                                                 return_alleles=True)
+            haplos = haplotype_counter.count_haplotypes(snp1, snp2)
             if haplos is None:
                 continue
             else:
@@ -164,9 +177,7 @@ class ABCoder(object):
             allele1B = alleles_in_major_haplo[coding2.B]
             voted_coding1 = AlleleCoding(allele1A, allele1B)
 
-            recomb_rate = (haplo_cnt.aB + haplo_cnt.Ab) / sum(haplo_cnt)
-            weight = 2 * (0.5 - recomb_rate) if recomb_rate < 0.5 else 0
-            votes[voted_coding1] += weight
+            votes[voted_coding1] += calc_recomb_weight(haplo_cnt)
         if not votes or sum(votes.values()) == 0:
             deduced_coding1 = None
             self.log[NO_INFO] += 1
@@ -206,11 +217,10 @@ class ABCoder(object):
         win = self.window
         snp_and_coding = RandomAccessIterator(imap(mapper, self._reader),
                                               rnd_access_win=win)
-        offspring = self.offspring
+        self.haplotype_counter = get_window_haplotype_counter(
+                                  self.haplotype_counter, self.offspring, win)
         half_win = (win - 1) // 2
         for idx, (snp1, coding1) in enumerate(snp_and_coding):
-            snp1_calls = [snp1.genotype(sample) for sample in offspring]
-
             start = idx - half_win
             if start < 0:
                 start = 0
@@ -224,8 +234,7 @@ class ABCoder(object):
                 if snp2_chrom == snp1.CHROM:
                     snp2_idxs.append(snp2_idx)
 
-            coding1 = self._deduce_coding(snp_and_coding, snp1_calls,
-                                          snp2_idxs)
+            coding1 = self._deduce_coding(snp_and_coding, snp1, snp2_idxs)
             if coding1 is None:
                 # We haven't manage to deduce the AB coding for this snp
                 continue
@@ -251,9 +260,18 @@ class ABCoder(object):
                 last_gt = gt
         return recombs
 
+    def _get_smooth_haplotype_counter(self, samples):
+        # the haplotypes counted for the AB coding are reused if possible
+        counter = self.haplotype_counter
+        if counter is None or list(counter.samples) != list(samples):
+            counter = get_window_haplotype_counter(
+                               self._smooth_haplotype_counter, samples,
+                               self.window)
+            self._smooth_haplotype_counter = counter
+        return counter
+
     def _smooth(self, snp_idx_to_smooth, snp_gts, samples):
         snp1 = snp_gts[snp_idx_to_smooth][0]
-        snp1_calls = [snp1.genotype(sample) for sample in samples]
         chrom = snp1.CHROM
 
         # remove snps from other chromosomes
@@ -261,20 +279,13 @@ class ABCoder(object):
 
         snps, gt_for_snps_in_win = zip(*snp_gts)
 
-        # we need the recomb rates
-        # TODO, this is already calculated in ab coding, we have to cache
+        # we need the recomb rates, they are cached by the haplotype counter
+        haplotype_counter = self._get_smooth_haplotype_counter(samples)
         weights = []
         for snp2 in snps:
-            snp2_calls = [snp2.genotype(sample) for sample in samples]
-            haplos = _count_biallelic_haplotypes(snp1_calls, snp2_calls,
-                                                 return_alleles=True)
-            if haplos is None:
-                weight = 0
-            else:
-                haplo_cnt, alleles = haplos
-                recomb_rate = (haplo_cnt.aB + haplo_cnt.Ab) / sum(haplo_cnt)
-                weight = 2 * (0.5 - recomb_rate) if recomb_rate < 0.5 else 0
-            weights.append(weight)
+            haplos = haplotype_counter.count_haplotypes(snp1, snp2)
+            weights.append(0 if haplos is None else
+                           calc_recomb_weight(haplos[0]))
 
         # we have to transpose, we want the genotype for each indi not for
         # each snp
@@ -394,6 +405,7 @@ class ABCoder(object):
         return snps_ab_coding
 
     def plot_parent_coding_hist(self, fhand):
+        from crumbs.utils.optional_modules import Figure
         fig = Figure()
         axes = fig.add_subplot(111)
         axes.hist(self.indexes, fill=True, log=True, bins=20, rwidth=1)
@@ -403,6 +415,8 @@ class ABCoder(object):
         _print_figure(axes, fig, fhand, plot_legend=False)
 
     def plot_smooth_hist(self, fhand):
+        from crumbs.utils.optional_modules import (Figure, LogNorm,
+                                                   make_axes_locatable)
         bins = 20
         fig = Figure()
         axes2 = fig.add_subplot(111)
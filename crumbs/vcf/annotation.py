@@ -24,15 +24,14 @@ from array import array
 from crumbs.vcf.prot_change import (get_amino_change, IsIndelError,
                                     BetweenSegments, OutsideAlignment)
 from crumbs.vcf.snv import VCFReader
-from crumbs.iterutils import RandomAccessIterator
-from crumbs.utils.optional_modules import (parse_into_seqrecs, seq_index,
-                                           CommOnly, RestrictionBatch,
-                                           Analysis, Figure)
+from crumbs.iterutils import RandomAccessRegionIterator
+from crumbs.utils.optional_modules import Seq, SeqRecord
 from crumbs.settings import get_setting
 from crumbs.vcf.filters import _print_figure
 from crumbs.statistics import calculate_dust_score, IntCounter
 from crumbs.utils.tags import SEQRECORD
 from crumbs.seq.seq import SeqWrapper
+from crumbs.seq.fasta_index import FastaReference
 from crumbs.bam.statistics import calculate_window, BamCoverages2
 from crumbs.plot import HistogramPlotter, LINE
 
@@ -185,12 +184,8 @@ class CloseToSnv(BaseAnnotator):
         return True
 
 
-# TODO: use fai if it is available
-def _get_lengths(fhand):
-    lengths = {}
-    for seq in parse_into_seqrecs(fhand, 'fasta'):
-        lengths[seq.id] = len(seq)
-    return lengths
+def _get_snv_location(snv):
+    return snv.chrom, snv.pos
 
 
 class HighVariableRegion(BaseAnnotator):
@@ -199,48 +194,26 @@ class HighVariableRegion(BaseAnnotator):
     def __init__(self, max_variability, window_in_bp, ref_fpath):
         self.max_variability = max_variability
 
-        self._lengths = _get_lengths(open(ref_fpath))
+        self._lengths = FastaReference(ref_fpath).lengths
 
         if not window_in_bp % 2:
             raise ValueError('Window in bp must be a odd number')
         self.window_in_bp = window_in_bp
 
-        max_num_snps = (int(window_in_bp * max_variability) + 1) * 2
-        if not max_num_snps % 2:
-            max_num_snps += 1
-        self._max_num_snps = max_num_snps
-
         self.conf = {'max_variability': max_variability,
                      'window_in_bp': window_in_bp}
 
     def __call__(self, snvs):
-        # TODO: Randon acess iterator based on physical distance
-        # RandomAcessRegionIterator(items, location_getter)
-        # once we do this we can remove max_num_snps
-        snvs = RandomAccessIterator(snvs, self._max_num_snps)
-        half_win = (snvs._rnd_access_win - 1) // 2
         half_win_in_bp = (self.window_in_bp - 1) // 2
-        for idx, snv in enumerate(snvs):
+        # the snvs closer than half window are taken into account
+        max_distance = max(half_win_in_bp - 1, 0)
+        snvs = RandomAccessRegionIterator(snvs, _get_snv_location,
+                                          max_distance=max_distance)
+        for snv in snvs:
             self._clean_filter(snv)
             chrom = snv.chrom
             pos = snv.pos
-            start = idx - half_win
-            if start < 0:
-                start = 0
-            end = idx + half_win
-            snvs_in_win = snvs[start:end]
-
-            def snv_is_close(snv2):
-                if snv2.chrom != chrom:
-                    return False
-                if abs(snv2.pos - pos) < half_win_in_bp:
-                    return True
-                else:
-                    return False
-
-            close_snvs = filter(snv_is_close, snvs_in_win)
-
-            num_snvs = len(close_snvs)
+            num_snvs = snvs.count_close()
 
             win_len = self.window_in_bp
             # The studied window could be smaller than expected if it is
@@ -286,7 +259,7 @@ class CloseToLimit(BaseAnnotator):
 
     def __init__(self, distance, ref_fpath):
         self.distance = distance
-        self._lengths = _get_lengths(open(ref_fpath))
+        self._lengths = FastaReference(ref_fpath).lengths
         self.conf = {'distance': distance}
 
     def __call__(self, snv):
@@ -359,22 +332,15 @@ class CapEnzyme(BaseAnnotator):
 
     def __init__(self, all_enzymes, ref_fpath):
         self.all_enzymes = all_enzymes
-        self.ref_index = seq_index(ref_fpath, 'fasta')
+        self.ref_seqs = FastaReference(ref_fpath)
         self.conf = {'all_enzymes': all_enzymes}
-        self._last_chrom = None
 
     def __call__(self, snv):
         self._clean_filter(snv)
         alleles = snv.alleles
         enzymes = set()
         # we have to make all the posible conbinations
-        chrom = snv.chrom
-        last_chrom = self._last_chrom
-        if last_chrom is not None and chrom == self._last_chrom[0]:
-            ref = last_chrom[1]
-        else:
-            ref = self.ref_index[snv.chrom]
-            self._last_chrom = chrom, ref
+        prev_seq, post_seq = _get_seqs_around_snv(self.ref_seqs, snv)
         used_combinations = []
         for i_index in range(len(alleles)):
             for j_index in range(len(alleles)):
@@ -386,8 +352,7 @@ class CapEnzyme(BaseAnnotator):
                     continue
                 used_combinations.append((allelei, allelej))
                 i_j_enzymes = _cap_enzymes_between_alleles(allelei, allelej,
-                                                           ref, snv.pos,
-                                                           snv.end,
+                                                           prev_seq, post_seq,
                                                   all_enzymes=self.all_enzymes)
                 enzymes = enzymes.union(i_j_enzymes)
         if not enzymes:
@@ -423,27 +388,31 @@ class CapEnzyme(BaseAnnotator):
         return True
 
 
-def _cap_enzymes_between_alleles(allele1, allele2, reference, start, end,
+def _get_seqs_around_snv(ref_seqs, snv, length=100):
+    'It returns the reference sequences before and after the snv'
+    chrom, start, end = snv.chrom, snv.pos, snv.end
+    prev_seq = ref_seqs.fetch(chrom, start + 1 - length, start)
+    post_seq = ref_seqs.fetch(chrom, end, end + length)
+    return prev_seq, post_seq
+
+
+def _cap_enzymes_between_alleles(allele1, allele2, prev_seq, post_seq,
                                  all_enzymes=False):
     '''It looks in the enzymes that differenciate the given alleles.
 
     It returns a set.
     '''
 
-    start += 1
     # we have to build the two sequences
+    from crumbs.utils.optional_modules import (Analysis, CommOnly,
+                                               RestrictionBatch)
     if all_enzymes:
         restriction_batch = CommOnly
     else:
         restriction_batch = RestrictionBatch(COMMON_ENZYMES)
 
-    sseq = reference.seq
-    post_seq_start = start - 100 if start - 100 > 0 else 0
-    prev_seq = sseq[post_seq_start: start - 1]
-    post_seq = sseq[end: end + 100]
-
-    seq1 = prev_seq + allele1 + post_seq
-    seq2 = prev_seq + allele2 + post_seq
+    seq1 = Seq(prev_seq + str(allele1) + post_seq)
+    seq2 = Seq(prev_seq + str(allele2) + post_seq)
     anal1 = Analysis(restriction_batch, seq1, linear=True)
     enzymes1 = set(anal1.with_sites().keys())
     anal1 = Analysis(restriction_batch, seq2, linear=True)
@@ -754,6 +723,7 @@ class AminoChangeAnnotator(BaseAnnotator):
     'The aminoacid changes with the alternative allele'
 
     def __init__(self, ref_fpath, orf_seq_fpath):
+        from crumbs.utils.optional_modules import seq_index
         self.orf_suffix = '_orf_seq'
         self.ref_index = seq_index(ref_fpath, 'fasta')
         self.orf_seq_index = seq_index(orf_seq_fpath, 'fasta')
@@ -829,6 +799,7 @@ class AminoSeverityChangeAnnotator(BaseAnnotator):
     'Check if the change is severe  or not'
 
     def __init__(self, ref_fpath, orf_seq_fpath):
+        from crumbs.utils.optional_modules import seq_index
         self.orf_suffix = '_orf_seq'
         self.ref_index = seq_index(ref_fpath, 'fasta')
         self.orf_seq_index = seq_index(orf_seq_fpath, 'fasta')
@@ -897,24 +868,18 @@ class LowComplexityRegionAnnotator(BaseAnnotator):
                  window=DEF_SNP_DUST_WINDOW):
         self.threshold = dust_threshold
         self.window = window
-        self.ref_index = seq_index(ref_fpath, 'fasta')
-        self._last_chrom = None
+        self.ref_seqs = FastaReference(ref_fpath)
         self._scores = array('f')
 
     def __call__(self, snv):
         self._clean_filter(snv)
-        # we have to make all the posible conbinations
         chrom = snv.chrom
-        last_chrom = self._last_chrom
-        if last_chrom is not None and chrom == self._last_chrom[0]:
-            ref = last_chrom[1]
-        else:
-            ref = self.ref_index[snv.chrom]
-            self._last_chrom = chrom, ref
-
-        start, end = calculate_window(snv.pos, snv.end, self.window, len(ref))
+        ref_seqs = self.ref_seqs
+        start, end = calculate_window(snv.pos, snv.end, self.window,
+                                      ref_seqs.length(chrom))
 
-        snv_win_seq = SeqWrapper(SEQRECORD, ref[start:end], None)
+        win_seq = SeqRecord(Seq(ref_seqs.fetch(chrom, start, end)), id=chrom)
+        snv_win_seq = SeqWrapper(SEQRECORD, win_seq, None)
         score = calculate_dust_score(snv_win_seq)
         if score > self.threshold:
             snv.add_filter(self.name)
@@ -929,6 +894,7 @@ class LowComplexityRegionAnnotator(BaseAnnotator):
         return 'lcr'
 
     def draw_hist(self, fhand):
+        from crumbs.utils.optional_modules import Figure
         fig = Figure()
         axes = fig.add_subplot(111)
         axes.hist(self._scores, fill=True, log=True, bins=20,
@@ -19,7 +19,7 @@ import random
 from math import isinf, isnan
 from os.path import join as pjoin, exists
 from os import mkdir
-from collections import namedtuple, Counter, OrderedDict
+from collections import namedtuple, Counter, OrderedDict, deque
 from array import array
 from StringIO import StringIO
 from operator import itemgetter
@@ -29,10 +29,9 @@ import warnings
 from crumbs.iterutils import group_in_packets, RandomAccessIterator
 
 from crumbs.vcf.snv import VCFReader, VCFWriter, DEF_MIN_CALLS_FOR_POP_STATS
-from crumbs.vcf.ld import calc_recomb_rate
-from crumbs.utils.optional_modules import (Figure, FigureCanvas, curve_fit, t,
-                                           absolute, exp, percentile, r,
-                                           IntVector)
+from crumbs.vcf.ld import calc_recomb_rates, WindowHaplotypeCounter
+from crumbs.utils.optional_modules import (absolute, exp, percentile,
+                                           array as np_array)
 
 # Missing docstring
 # pylint: disable=C0111
@@ -53,6 +52,7 @@ DEF_MAX_ZERO_DIST_RECOMB = 0.01
 DEF_NUM_SNPS_IN_WIN_FOR_WEIRD_RECOMB = 51
 DEF_MIN_NUM_SNPS_WEIRD_RECOMB = 20
 DEF_MAX_RECOMB_RATE_WEIRD_RECOMB = 0.25
+DEF_RANDOM_SEED = 1
 
 
 def group_in_filter_packets(items, items_per_packet):
@@ -178,6 +178,7 @@ class _BaseFilter(object):
 
     def _plot_hist(self, fhand, values, xlabel, ylabel, min_value=None,
                    max_value=None):
+        from crumbs.utils.optional_modules import Figure
         fig = Figure()
         axes = fig.add_subplot(111)
         axes.hist(values, fill=True, log=True, bins=20, rwidth=1)
@@ -191,6 +192,7 @@ class _BaseFilter(object):
 
 
 def _print_figure(axes, figure, plot_fhand, plot_legend=True, fmt='png'):
+    from crumbs.utils.optional_modules import FigureCanvas
     if figure is None:
         return
     if plot_legend:
@@ -373,15 +375,91 @@ FISHER_CACHE = {}
 
 
 def _fisher_extact_rxc(counts_obs, counts_exp):
-    if (counts_obs, counts_exp) in FISHER_CACHE:
-        return FISHER_CACHE[(counts_obs, counts_exp)]
-    env = r.baseenv()
-    env['obs'] = IntVector(counts_obs)
-    env['expected'] = IntVector(counts_exp)
-    pvalue = r('fisher.test(cbind(obs, expected))$p.value')[0]
+    return _fisher_extact_rxc_tables([counts_obs], counts_exp)[0]
 
-    FISHER_CACHE[(counts_obs, counts_exp)] = pvalue
-    return pvalue
+
+def _fisher_extact_rxc_tables(tables_obs, counts_exp):
+    '''It returns an array with the pvalues of every observed counts table.
+
+    The tables not found in the cache are tested in a single R call.
+    '''
+    counts_exp = tuple(counts_exp)
+    tables_obs = [tuple(counts_obs) for counts_obs in tables_obs]
+    not_cached = OrderedDict((counts_obs, None) for counts_obs in tables_obs
+                             if (counts_obs, counts_exp) not in FISHER_CACHE)
+    if not_cached:
+        from crumbs.utils.optional_modules import IntVector, r
+        env = r.baseenv()
+        env['obs'] = IntVector(list(chain.from_iterable(not_cached)))
+        env['expected'] = IntVector(counts_exp)
+        rcmd = 'apply(matrix(obs, ncol=length(expected), byrow=TRUE), 1, '
+        rcmd += 'function(row) fisher.test(cbind(row, expected))$p.value)'
+        for counts_obs, pvalue in zip(not_cached, r(rcmd)):
+            FISHER_CACHE[(counts_obs, counts_exp)] = pvalue
+    return np_array([FISHER_CACHE[(counts_obs, counts_exp)]
+                     for counts_obs in tables_obs], dtype=float)
+
+
+class _SnvsAround(object):
+    '''It keeps the snvs around the snvs being filtered with their counts.
+
+    The snvs are read once from a sorted vcf and they are kept while they
+    can be found in a window, so the overlapping windows do not parse them
+    again. The regions are the ones of VCFReader.fetch_snvs and the biallelic
+    genotype counts of every snv are calculated only once.
+    '''
+    def __init__(self, snvs, samples=None):
+        self._snvs = iter(snvs)
+        self._next_snv = None
+        self.samples = samples
+        self._chrom = None
+        self._window = deque()
+
+    def _read_snv(self):
+        if self._next_snv is None:
+            self._next_snv = next(self._snvs, None)
+        return self._next_snv
+
+    def _go_to_chrom(self, chrom):
+        self._chrom = chrom
+        self._window.clear()
+        snv = self._read_snv()
+        while snv is not None and snv.chrom != chrom:
+            self._next_snv = None
+            snv = self._read_snv()
+
+    def _add_snvs_to(self, end):
+        snv = self._read_snv()
+        while (snv is not None and snv.chrom == self._chrom and
+               (end is None or snv.pos < end)):
+            snv_to_count = snv
+            if self.samples is not None:
+                snv_to_count = snv.filter_calls_by_sample(self.samples)
+            counts = snv_to_count.biallelic_genotype_counts
+            self._window.append((snv.pos, snv.end, snv, counts))
+            self._next_snv = None
+            snv = self._read_snv()
+
+    def fetch(self, chrom, start, end=None):
+        '''It returns the snvs and their biallelic genotype counts.
+
+        The chromosomes should be fetched in the order of the vcf.
+        '''
+        if chrom != self._chrom:
+            self._go_to_chrom(chrom)
+        start = int(start + 1)
+        if end is not None:
+            end = int(end)
+        self._add_snvs_to(end)
+        return [(snv, counts) for pos, snv_end, snv, counts in self._window
+                if snv_end > start and (end is None or pos < end)]
+
+    def remove_before(self, start):
+        'It removes the snvs that will not be fetched from the given start'
+        start = int(start + 1)
+        window = self._window
+        while window and window[0][1] <= start:
+            window.popleft()
 
 
 class WeirdSegregationFilter(object):
@@ -389,7 +467,7 @@ class WeirdSegregationFilter(object):
                  max_failed_freq=DEF_MAX_FAILED_FREQ, samples=None,
                  win_width=DEF_MAX_DIST, win_mask_width=DEF_MIN_DIST,
                  min_num_snvs_check_in_win=DEF_MIN_NUM_CHECK_SNPS_IN_WIN,
-                 debug_plot_dir=None):
+                 debug_plot_dir=None, random_seed=DEF_RANDOM_SEED):
         # We're assuming that most snps are ok and that a few have a weird
         # segregation
         self.alpha = alpha
@@ -409,12 +487,15 @@ class WeirdSegregationFilter(object):
         if debug_plot_dir is not None and not exists(debug_plot_dir):
             mkdir(debug_plot_dir)
         self.plot_dir = debug_plot_dir
+        # the snvs to check are sampled always in the same way
+        self._random = random.Random(random_seed)
 
     def filter_vcf(self, vcf_fpath, min_samples=DEF_MIN_CALLS_FOR_POP_STATS):
         reader = VCFReader(open(vcf_fpath),
                            min_calls_for_pop_stats=min_samples)
         snvs = reader.parse_snvs()
-        random_reader = VCFReader(open(vcf_fpath))
+        snvs_around = _SnvsAround(VCFReader(open(vcf_fpath)).parse_snvs(),
+                                  samples=self.samples)
 
         for snv_1 in snvs:
             self.tot_snps += 1
@@ -438,20 +519,21 @@ class WeirdSegregationFilter(object):
             if win_1_end < 0:
                 win_1_end = 0
             if win_1_end != 0:
-                snvs_win_1 = random_reader.fetch_snvs(snv_1.chrom,
-                                                      start=int(win_1_start),
-                                                      end=int(win_1_end))
+                snvs_win_1 = snvs_around.fetch(snv_1.chrom,
+                                               start=int(win_1_start),
+                                               end=int(win_1_end))
             else:
                 snvs_win_1 = []
 
             win_2_start = loc + (self.win_mask_width / 2)
             win_2_end = loc + (self.win_width / 2)
-            snvs_win_2 = random_reader.fetch_snvs(snv_1.chrom,
-                                                  start=win_2_start,
-                                                  end=win_2_end)
-            snvs_in_win = list(chain(snvs_win_1, snvs_win_2))
+            snvs_win_2 = snvs_around.fetch(snv_1.chrom, start=win_2_start,
+                                           end=win_2_end)
+            snvs_around.remove_before(win_1_start)
+            snvs_in_win = snvs_win_1 + snvs_win_2
             if len(snvs_in_win) > self.num_snvs_check:
-                snvs_in_win = random.sample(snvs_in_win, self.num_snvs_check)
+                snvs_in_win = self._random.sample(snvs_in_win,
+                                                  self.num_snvs_check)
             if len(snvs_in_win) < self.min_num_snvs_check_in_win:
                 # Not enough snps to check
                 continue
@@ -465,45 +547,36 @@ class WeirdSegregationFilter(object):
             if exp_cnts is None:
                 continue
 
-            test_values = []
-            for snv_2 in snvs_in_win:
-                if self.samples is not None:
-                    snv_2 = snv_2.filter_calls_by_sample(self.samples)
-                obs_cnts = snv_2.biallelic_genotype_counts
-                if obs_cnts is None:
-                    continue
-                test_values.append(_fisher_extact_rxc(obs_cnts, exp_cnts))
-
-                if plot_fhand:
-                    debug_plot_info.append({'pos': snv_2.pos,
-                                            'AA': obs_cnts[0],
-                                            'Aa': obs_cnts[1],
-                                            'aa': obs_cnts[2],
-                                            'close_snp': True})
-            alpha2 = self.alpha/len(test_values)
-            results = []
-            for idx, val in enumerate(test_values):
-                result = False if val is None else val > alpha2
-                results.append(result)
-
-                if plot_fhand:
-                    debug_plot_info[idx]['result'] = result
-
-            if len(test_values) < self.min_num_snvs_check_in_win:
+            snvs_in_win = [(snv_2, obs_cnts) for snv_2, obs_cnts in snvs_in_win
+                           if obs_cnts is not None]
+            if len(snvs_in_win) < self.min_num_snvs_check_in_win:
                 # few snps can be tested for segregation
                 continue
 
+            # all the genotype count tables of the window are tested at once
+            test_values = _fisher_extact_rxc_tables([obs_cnts for _, obs_cnts
+                                                     in snvs_in_win],
+                                                    exp_cnts)
             tot_checked = len(test_values)
             if tot_checked > 0:
-                failed_freq = results.count(False) / tot_checked
+                results = test_values > self.alpha / tot_checked
+                failed_freq = (tot_checked - results.sum()) / tot_checked
                 passed = self.max_failed_freq > failed_freq
             else:
+                results = []
                 failed_freq = None
                 passed = False
             if failed_freq is not None:
                 self._failed_freqs.append(failed_freq)
 
             if plot_fhand:
+                for (snv_2, obs_cnts), result in zip(snvs_in_win, results):
+                    debug_plot_info.append({'pos': snv_2.pos,
+                                            'AA': obs_cnts[0],
+                                            'Aa': obs_cnts[1],
+                                            'aa': obs_cnts[2],
+                                            'result': bool(result),
+                                            'close_snp': True})
                 debug_plot_info.append({'pos': snv_1.pos,
                                         'AA': exp_cnts[0],
                                         'Aa': exp_cnts[1],
@@ -517,6 +590,7 @@ class WeirdSegregationFilter(object):
 
     @staticmethod
     def _plot_segregation_debug(plot_info, fhand):
+        from crumbs.utils.optional_modules import Figure, FigureCanvas
         greens = ['#2d6e12', '#76b75b', '#164900']
         reds = ['#8f0007', '#fb1f2a', '#b90009']
         grays = ['0.5', '0.25', '0.75']
@@ -559,6 +633,7 @@ class WeirdSegregationFilter(object):
         fhand.flush()
 
     def plot_failed_freq_dist(self, fhand):
+        from crumbs.utils.optional_modules import Figure
         fig = Figure()
         axes = fig.add_subplot(111)
         axes.hist(self._failed_freqs, fill=True, log=True, bins=20,
@@ -588,16 +663,20 @@ def _calculate_segregation_rates(snvs, pop_type, snps_in_window,
                                  samples=None):
     half_win = (snps_in_window - 1) // 2
     prev_chrom = None
+    haplo_counter = None
     for index1, snp1 in enumerate(snvs):
-        calls1 = _get_calls(snp1, samples)
+        if haplo_counter is None:
+            snp_samples = [call.sample for call in _get_calls(snp1, samples)]
+            haplo_counter = WindowHaplotypeCounter(snp_samples,
+                                                   window=snps_in_window)
         start = index1 - half_win
         if start < 0:
             start = 0
-        rates = []
         chrom = snp1.chrom
         if chrom != prev_chrom:
             recomb_cache = {}
             prev_chrom = chrom
+        snps_in_win = []
         for index2 in range(start, index1 + half_win):
             try:
                 snp2 = snvs[index2]
@@ -605,20 +684,26 @@ def _calculate_segregation_rates(snvs, pop_type, snps_in_window,
                 continue
             if chrom != snp2.chrom:
                 continue
-            calls2 = _get_calls(snp2, samples)
-            index = tuple(sorted([index1, index2]))
-            if index1 == index2:
-                recomb_rate = 0
-            try:
-                recomb_rate = recomb_cache[index]
-            except KeyError:
-                recomb_rate = calc_recomb_rate(calls1, calls2, pop_type)
-                if recomb_rate is None:
-                    recomb_rate = float('nan')
-                else:
-                    recomb_rate = recomb_rate[0]
-                recomb_cache[index] = recomb_rate
-            rates.append(RecombRate(index2, snp2.pos, recomb_rate))
+            snps_in_win.append((index2, snp2))
+
+        # the pairs not found in the previous windows are calculated at once
+        new_pairs = [(index2, snp2) for index2, snp2 in snps_in_win
+                     if tuple(sorted([index1, index2])) not in recomb_cache]
+        haplo_counts = [haplo_counter.count_haplotypes(snp1.record,
+                                                       snp2.record)
+                        for _, snp2 in new_pairs]
+        haplo_counts = [None if haplos is None else haplos[0]
+                        for haplos in haplo_counts]
+        recomb_rates = calc_recomb_rates(haplo_counts, pop_type).tolist()
+        for (index2, _), recomb_rate in zip(new_pairs, recomb_rates):
+            recomb_cache[tuple(sorted([index1, index2]))] = recomb_rate
+
+        rates = [RecombRate(index2, snp2.pos,
+                            recomb_cache[tuple(sorted([index1, index2]))])
+                 for index2, snp2 in snps_in_win]
+        # the following windows start at start or after it
+        for index in [index for index in recomb_cache if index[0] < start]:
+            del recomb_cache[index]
         yield snp1, chrom, snp1.pos, rates
 
 
@@ -689,6 +774,7 @@ class WeirdRecombFilter(object):
         self.recomb_rates[index].append(recomb_at_0)
 
     def plot_recomb_at_0_dist_hist(self, fhand):
+        from crumbs.utils.optional_modules import Figure
         fig = Figure()
         axes = fig.add_subplot(111)
         data = [self.recomb_rates['ok'], self.recomb_rates['ok_conf_is_None'],
@@ -722,6 +808,7 @@ def _kosambi(phys_dist, phys_gen_dist_conversion, recomb_at_origin):
 
 
 def _fit_kosambi(dists, recombs, init_params):
+    from crumbs.utils.optional_modules import curve_fit
     try:
         return curve_fit(_kosambi, dists, recombs, p0=init_params)
     except RuntimeError:
@@ -739,6 +826,7 @@ def _calc_ajusted_recomb(dists, recombs, max_recomb, max_zero_dist_recomb,
     # between false recombination due to hidden segregation in the parents and
     # true recombination
 
+    from crumbs.utils.optional_modules import Figure, t
     if plot_fhand:
         fig = Figure()
         axes = fig.add_subplot(111)
@@ -16,10 +16,15 @@
 from __future__ import division
 from collections import Counter
 from StringIO import StringIO
+from multiprocessing import Pool
+from copy import deepcopy
 
-from crumbs.vcf.snv import VCFReader, VCFWriter
+from crumbs.vcf.snv import VCFReader, VCFWriter, Call
 from crumbs.statistics import IntCounter
 from crumbs.plot import HistogramPlotter
+from crumbs.iterutils import group_in_packets
+from crumbs.utils.optional_modules import (zeros, isnan, arange, bincount,
+                                           array)
 
 # Missing docstring
 # pylint: disable=C0111
@@ -29,12 +34,34 @@ from crumbs.plot import HistogramPlotter
 DEF_PROB_AA_THRESHOLD = 0.9999
 HW = 'hw'
 RIL_SELF = 'ril_self'
+DEF_SNVS_PER_GT_FILTER_CHUNK = 1000
+
+
+def _write_snvs(writer, snvs):
+    for snv in snvs:
+        try:
+            writer.write_snv(snv)
+        except IOError, error:
+            # The pipe could be already closed
+            if 'Broken pipe' in str(error):
+                return False
+            else:
+                raise
+    return True
 
 
 def run_genotype_filters(in_fhand, out_fhand, gt_filters, plots_dir=None,
-                         reader_kwargs=None):
+                         reader_kwargs=None, chunk_size=None, processes=1):
+    '''It applies the genotype filters to the SNVs of the input VCF.
+
+    If a chunk_size is given the genotypes of chunk_size SNVs are loaded into
+    arrays and every filter evaluates all of them at once. The chunks can be
+    filtered by several processes.
+    '''
     if reader_kwargs is None:
         reader_kwargs = {}
+    if processes > 1 and chunk_size is None:
+        chunk_size = DEF_SNVS_PER_GT_FILTER_CHUNK
 
     reader_kwargs['filename'] = 'pyvcf_bug_workaround'
     reader_kwargs['compressed'] = False
@@ -43,17 +70,225 @@ def run_genotype_filters(in_fhand, out_fhand, gt_filters, plots_dir=None,
     templa_reader = VCFReader(StringIO(reader.header))
     writer = VCFWriter(out_fhand, template_reader=templa_reader)
 
-    for snv in reader.parse_snvs():
-        for mapper in gt_filters:
-            snv = mapper(snv)
-        try:
-            writer.write_snv(snv)
-        except IOError, error:
-            # The pipe could be already closed
-            if 'Broken pipe' in str(error):
+    if chunk_size is None:
+        for snv in reader.parse_snvs():
+            for mapper in gt_filters:
+                snv = mapper(snv)
+            if not _write_snvs(writer, [snv]):
                 break
+    elif processes < 2:
+        for snvs in group_in_packets(reader.parse_snvs(), chunk_size):
+            chunk = _GenotypeChunk(snvs)
+            for gt_filter in gt_filters:
+                gt_filter.filter_chunk(chunk)
+            if not _write_snvs(writer, chunk.filtered_snvs()):
+                break
+    else:
+        _run_genotype_filters_in_processes(reader, writer, gt_filters,
+                                           reader_kwargs, chunk_size,
+                                           processes)
+    writer.flush()
+
+
+_WORKER_GT_FILTERS = None
+
+
+def _init_gt_filter_worker(header, gt_filters, reader_kwargs):
+    global _WORKER_GT_FILTERS
+    _WORKER_GT_FILTERS = header, gt_filters, reader_kwargs
+
+
+def _filter_genotypes_in_worker(lines):
+    header, gt_filters, reader_kwargs = _WORKER_GT_FILTERS
+    vcf = StringIO(header + '\n' + '\n'.join(lines) + '\n')
+    reader = VCFReader(vcf, **reader_kwargs)
+    # the filters accumulate the stats of this chunk only
+    gt_filters = deepcopy(gt_filters)
+    chunk = _GenotypeChunk(list(reader.parse_snvs()))
+    for gt_filter in gt_filters:
+        gt_filter.filter_chunk(chunk)
+
+    out_fhand = StringIO()
+    writer = VCFWriter(out_fhand, template_reader=VCFReader(StringIO(header)))
+    header_len = out_fhand.tell()
+    writer.write_snvs(chunk.filtered_snvs())
+    return out_fhand.getvalue()[header_len:], gt_filters
+
+
+def _run_genotype_filters_in_processes(reader, writer, gt_filters,
+                                       reader_kwargs, chunk_size, processes):
+    # the workers parse the VCF lines themselves
+    lines = reader.pyvcf_reader.reader
+    workers = Pool(processes=processes, initializer=_init_gt_filter_worker,
+                   initargs=(reader.header, gt_filters, reader_kwargs))
+    try:
+        results = workers.imap(_filter_genotypes_in_worker,
+                               group_in_packets(lines, chunk_size))
+        writer.flush()
+        out_fhand = writer.stream
+        for vcf_chunk, chunk_filters in results:
+            for gt_filter, chunk_filter in zip(gt_filters, chunk_filters):
+                gt_filter.merge_stats(chunk_filter)
+            try:
+                out_fhand.write(vcf_chunk)
+            except IOError, error:
+                if 'Broken pipe' in str(error):
+                    break
+                else:
+                    raise
+    finally:
+        workers.terminate()
+        workers.join()
+
+
+class _GenotypeChunk(object):
+    '''The genotypes of a group of SNVs stored in snvs x samples arrays.
+
+    The filters mark the genotypes to remove and once all filters have been
+    applied the modified SNVs are created.
+    '''
+    def __init__(self, snvs):
+        self.snvs = snvs
+        self.samples = [call.sample for call in snvs[0].record.samples]
+        shape = len(snvs), len(self.samples)
+        self.called = zeros(shape, dtype=bool)
+        for snv_idx, snv in enumerate(snvs):
+            self.called[snv_idx] = [call.called for call in snv.record.samples]
+        self._gts_to_remove = zeros(shape, dtype=bool)
+        self._low_evidence_gts = zeros(shape, dtype=bool)
+        self._gt_quals = None
+        self._depths = None
+        self._alleles = None
+
+    def _get_call_values(self, getter):
+        values = zeros(self.called.shape)
+        for snv_idx, snv in enumerate(self.snvs):
+            for sample_idx, call in enumerate(snv.calls):
+                value = getter(call)
+                values[snv_idx, sample_idx] = float('nan') if value is None else value
+        return values
+
+    @property
+    def gt_quals(self):
+        'The genotype qualities, nan for the missing ones'
+        if self._gt_quals is None:
+            self._gt_quals = self._get_call_values(lambda call: call.gt_qual)
+        return self._gt_quals
+
+    @property
+    def depths(self):
+        'The call depths, nan for the missing ones'
+        if self._depths is None:
+            self._depths = self._get_call_values(lambda call: call.depth)
+        return self._depths
+
+    @property
+    def alleles(self):
+        '''The int alleles of the originally called genotypes, -1 if missing.
+
+        The genotypes with a ploidy lower than the highest one in the chunk
+        are padded with -1.
+        '''
+        if self._alleles is None:
+            genotypes = [(snv_idx, sample_idx, call.int_alleles)
+                         for snv_idx, snv in enumerate(self.snvs)
+                         for sample_idx, call in enumerate(snv.calls)
+                         if call.called]
+            if genotypes:
+                ploidy = max(len(genotype) for _, _, genotype in genotypes)
             else:
-                raise
+                ploidy = self.snvs[0].ploidy
+            alleles = zeros(self.called.shape + (ploidy,), dtype=int) - 1
+            for snv_idx, sample_idx, genotype in genotypes:
+                alleles[snv_idx, sample_idx, :len(genotype)] = genotype
+            self._alleles = alleles
+        return self._alleles
+
+    @property
+    def is_het(self):
+        alleles = self.alleles
+        is_het = (alleles != alleles[:, :, :1]) & (alleles != -1)
+        return is_het.any(axis=2) & self.called
+
+    def hom_allele_depths(self):
+        'It returns the depths of the allele of the called homozygotes'
+        hom_calls = self.called & ~self.is_het
+        alleles = self.alleles
+        depths = zeros(self.called.shape) + float('nan')
+        for snv_idx, sample_idx in zip(*hom_calls.nonzero()):
+            call = Call(self.snvs[snv_idx].record.samples[sample_idx],
+                        self.snvs[snv_idx])
+            allele_depths = call.allele_depths
+            if not allele_depths:
+                continue
+            allele = alleles[snv_idx, sample_idx, 0]
+            depths[snv_idx, sample_idx] = allele_depths[allele]
+        return depths
+
+    def allele_freqs(self):
+        '''It returns the freq. of the called homozygotes alleles.
+
+        The freqs are nan for the SNVs without enough called genotypes to
+        calculate them.
+        '''
+        called = self.called
+        alleles = self.alleles
+        freqs = zeros(called.shape) + float('nan')
+        for snv_idx, snv in enumerate(self.snvs):
+            snv_called = called[snv_idx]
+            if snv_called.sum() < snv.min_calls_for_pop_stats:
+                continue
+            snv_alleles = alleles[snv_idx][snv_called]
+            sampled_alleles = snv_alleles[snv_alleles != -1]
+            if not sampled_alleles.size:
+                continue
+            allele_freqs = bincount(sampled_alleles) / sampled_alleles.size
+            freqs[snv_idx, snv_called] = allele_freqs[snv_alleles[:, 0]]
+        return freqs
+
+    def remove_gts(self, mask):
+        self._gts_to_remove |= mask
+        self.called &= ~mask
+
+    def set_low_evidence_gts(self, mask):
+        self._low_evidence_gts |= mask
+        self.called &= ~mask
+
+    def filtered_snvs(self):
+        'It yields the SNVs with the genotypes modified by the filters'
+        gts_to_remove = self._gts_to_remove
+        low_evidence_gts = self._low_evidence_gts
+        modified_snvs = (gts_to_remove | low_evidence_gts).any(axis=1)
+        for snv_idx, snv in enumerate(self.snvs):
+            if not modified_snvs[snv_idx]:
+                yield snv
+                continue
+            calls = []
+            for sample_idx, call in enumerate(snv.calls):
+                if gts_to_remove[snv_idx, sample_idx]:
+                    call = call.copy_setting_gt(gt=None,
+                                                return_pyvcf_call=True)
+                elif low_evidence_gts[snv_idx, sample_idx]:
+                    geno = call.call.data.GT[:-1] + '.'
+                    call = call.copy_setting_gt(gt=geno,
+                                                return_pyvcf_call=True)
+                else:
+                    call = call.call
+                calls.append(call)
+            yield snv.copy_mapping_calls(calls)
+
+
+def _update_counters_by_sample(counters, samples, values):
+    'It adds the int part of the non nan values to the sample counters'
+    for sample_idx, sample in enumerate(samples):
+        sample_values = values[:, sample_idx]
+        sample_values = sample_values[~isnan(sample_values)].astype(int)
+        if not sample_values.size:
+            continue
+        counter = counters[sample]
+        for value, count in enumerate(bincount(sample_values)):
+            if count:
+                counter[value] += int(count)
 
 
 class LowQualityGenotypeFilter(object):
@@ -74,6 +309,22 @@ class LowQualityGenotypeFilter(object):
                 self._scores[call.sample][int(call.gt_qual)] += 1
         return snv.remove_gt_from_low_qual_calls(min_qual=self._min_qual)
 
+    def filter_chunk(self, chunk):
+        if self._first_snv:
+            for sample in chunk.samples:
+                self._scores[sample] = IntCounter()
+            self._first_snv = False
+        gt_quals = chunk.gt_quals
+        _update_counters_by_sample(self._scores, chunk.samples, gt_quals)
+        if self._min_qual is not None:
+            # the calls without quality are also removed
+            chunk.remove_gts(isnan(gt_quals) | (gt_quals < self._min_qual))
+
+    def merge_stats(self, other):
+        for sample, scores in other._scores.items():
+            self._scores.setdefault(sample, IntCounter()).update(scores)
+        self._first_snv = self._first_snv and other._first_snv
+
     def draw_hist(self, fhand):
         counters = self._scores.values()
         samples = self._scores.keys()
@@ -107,6 +358,22 @@ class LowDepthGenotypeFilter(object):
                 self._scores[call.sample][int(call.depth)] += 1
         return snv.remove_gt_from_low_depth_calls(min_depth=self._min_depth)
 
+    def filter_chunk(self, chunk):
+        if self._first_snv:
+            for sample in chunk.samples:
+                self._scores[sample] = IntCounter()
+            self._first_snv = False
+        depths = chunk.depths
+        _update_counters_by_sample(self._scores, chunk.samples, depths)
+        if self._min_depth is not None:
+            # the calls without depth are also removed
+            chunk.remove_gts(isnan(depths) | (depths < self._min_depth))
+
+    def merge_stats(self, other):
+        for sample, scores in other._scores.items():
+            self._scores.setdefault(sample, IntCounter()).update(scores)
+        self._first_snv = self._first_snv and other._first_snv
+
     def draw_hist(self, fhand):
         counters = self._scores.values()
         samples = self._scores.keys()
@@ -127,6 +394,12 @@ class HetGenotypeFilter(object):
     def __call__(self, snv):
         return snv.remove_gt_from_het_calls()
 
+    def filter_chunk(self, chunk):
+        chunk.remove_gts(chunk.is_het)
+
+    def merge_stats(self, other):
+        pass
+
 
 def prob_aa_given_n_a_reads_hw(num_a_reads, freq_a_in_pop):
     'It assumes HW'
@@ -223,3 +496,73 @@ class LowEvidenceAlleleFilter(object):
                 log['tot'] += 1
             calls.append(filtered_call)
         return snv.copy_mapping_calls(calls)
+
+    def _calculate_probs(self, depths, allele_freqs):
+        kwargs = self.genotypic_freqs_kwargs.copy()
+        depths = depths.astype(int)
+        if self.genotypic_freqs_method == HW:
+            kwargs['freq_a_in_pop'] = allele_freqs
+            kwargs['num_a_reads'] = depths
+            return prob_aa_given_n_a_reads_hw(**kwargs)
+        # the probability only depends on the number of reads
+        kwargs['num_a_reads'] = arange(depths.max() + 1 if depths.size else 1)
+        probs = array(prob_aa_given_n_a_reads_ril_self(**kwargs))
+        return probs[depths]
+
+    def filter_chunk(self, chunk):
+        genotypic_freqs_method = self.genotypic_freqs_method
+        if genotypic_freqs_method not in PROB_AA_FUNCS:
+            msg = 'Method not implemented for genotypic freqs: '
+            msg += genotypic_freqs_method
+            raise NotImplementedError(msg)
+        log = self.log
+        called = chunk.called.copy()
+        hom_calls = called & ~chunk.is_het
+
+        if genotypic_freqs_method == HW:
+            allele_freqs = chunk.allele_freqs()
+            snvs_without_freqs = isnan(allele_freqs).all(axis=1)
+            if snvs_without_freqs.any():
+                num_samples = len(chunk.samples)
+                num_calls = int(snvs_without_freqs.sum()) * num_samples
+                log['not_enough_individuals'] += num_calls
+                log['tot'] += num_calls
+                no_freqs_mask = zeros(called.shape, dtype=bool)
+                no_freqs_mask[snvs_without_freqs] = True
+                chunk.remove_gts(no_freqs_mask)
+                snvs_with_freqs = ~snvs_without_freqs
+                called = called[snvs_with_freqs]
+                hom_calls_to_check = hom_calls & ~no_freqs_mask
+                hom_calls = hom_calls[snvs_with_freqs]
+            else:
+                hom_calls_to_check = hom_calls
+        else:
+            allele_freqs = None
+            hom_calls_to_check = hom_calls
+
+        depths = chunk.hom_allele_depths()[hom_calls_to_check]
+        if isnan(depths).any():
+            msg = 'Allele depths are required for the lowEvidence'
+            msg += 'Allele filter'
+            raise RuntimeError(msg)
+        if allele_freqs is not None:
+            allele_freqs = allele_freqs[hom_calls_to_check]
+        probs = self._calculate_probs(depths, allele_freqs)
+        enough_evidence = probs >= self._min_prob
+
+        low_evidence = zeros(hom_calls_to_check.shape, dtype=bool)
+        low_evidence[hom_calls_to_check] = ~enough_evidence
+        chunk.set_low_evidence_gts(low_evidence)
+
+        num_called = int(called.sum())
+        num_hom = int(hom_calls.sum())
+        num_enough = int(enough_evidence.sum())
+        counts = {'was_not_called': called.size - num_called,
+                  'was_het': num_called - num_hom,
+                  'enough_evidence': num_enough,
+                  'not_enough_evidence': num_hom - num_enough,
+                  'tot': num_called}
+        log.update({key: count for key, count in counts.items() if count})
+
+    def merge_stats(self, other):
+        self.log.update(other.log)
@@ -14,11 +14,11 @@
 # along with ngs_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import division
-from collections import Counter, namedtuple
+from collections import Counter, namedtuple, OrderedDict
 
 from crumbs.vcf.statistics import choose_samples
 from crumbs.iterutils import RandomAccessIterator
-from crumbs.utils.optional_modules import scipy_fisher
+from crumbs.utils.optional_modules import array, bincount, unique
 
 
 # Missing docstring
@@ -44,6 +44,7 @@ def calculate_ld_stats(snp1, snp2, samples=None):
 
 
 def _fisher_exact(haplo_counts):
+    from crumbs.utils.optional_modules import scipy_fisher
     if not haplo_counts:
         return None
     fish = scipy_fisher(([haplo_counts.AB, haplo_counts.Ab],
@@ -147,6 +148,12 @@ def _count_biallelic_haplotypes(calls1, calls2, return_alleles=False):
 
         haplo = (al_snp_1, al_snp_2)
         haplo_count[haplo] += 1
+    return _biallelic_haplo_counts(haplo_count, return_alleles=return_alleles)
+
+
+def _biallelic_haplo_counts(haplo_count, return_alleles=False):
+    # Invalid name. Due to using uppercases
+    # pylint: disable=C0103
     if not haplo_count:
         return None
 
@@ -180,26 +187,155 @@ def _count_biallelic_haplotypes(calls1, calls2, return_alleles=False):
         return counts
 
 
-def calc_recomb_rate(calls1, calls2, pop_type):
-    haplo_count = _count_biallelic_haplotypes(calls1, calls2)
-    if haplo_count is None:
+def _code_homozygous_alleles(snp, samples):
+    '''It returns the allele and the ploidy of the samples as int8 arrays.
+
+    The hets and the no calls are coded as -1, as they are not used to count
+    the haplotypes.
+    '''
+    alleles = []
+    ploidies = []
+    for sample in samples:
+        call = snp.genotype(sample)
+        if not call.called or call.is_het:
+            alleles.append(-1)
+            ploidies.append(0)
+        else:
+            gt_alleles = call.gt_alleles
+            alleles.append(int(gt_alleles[0]))
+            ploidies.append(len(gt_alleles))
+    return array(alleles, dtype='int8'), array(ploidies, dtype='int8')
+
+
+def _count_alleles_in_order(alleles, weights=None):
+    '''It returns the (allele, count) pairs in the order of first appearance.
+
+    A Counter filled with the pairs in this order is equal, ties included,
+    to one updated with the alleles one by one.
+    '''
+    uniq_alleles, first_idxs, inverse = unique(alleles, return_index=True,
+                                               return_inverse=True)
+    counts = bincount(inverse, weights=weights)
+    return [(int(uniq_alleles[idx]), int(counts[idx]))
+            for idx in first_idxs.argsort()]
+
+
+def _count_biallelic_coded_haplotypes(coded_snp1, coded_snp2,
+                                      return_alleles=False):
+    '''It counts the haplotypes like _count_biallelic_haplotypes.
+
+    It takes the alleles and ploidies coded by _code_homozygous_alleles.
+    '''
+    alleles1, ploidies1 = coded_snp1
+    alleles2, ploidies2 = coded_snp2
+    called = (alleles1 >= 0) & (alleles2 >= 0)
+    alleles1 = alleles1[called]
+    if not len(alleles1):
         return None
+    alleles2 = alleles2[called]
+
+    # We're transforming all markers in biallelic
+    haplo_alleles = []
+    for alleles, ploidies in ((alleles1, ploidies1[called]),
+                              (alleles2, ploidies2[called])):
+        allele_counts = Counter()
+        for allele, count in _count_alleles_in_order(alleles,
+                                                     weights=ploidies):
+            allele_counts[str(allele)] = count
+        freq_alleles = [int(allele)
+                        for allele, _ in allele_counts.most_common(2)]
+        if len(freq_alleles) > 1:
+            alleles = alleles.copy()
+            alleles[alleles != freq_alleles[0]] = freq_alleles[1]
+        haplo_alleles.append(alleles.astype('int16'))
+    haplos = haplo_alleles[0] * 128 + haplo_alleles[1]
+
+    haplo_count = Counter()
+    for haplo, count in _count_alleles_in_order(haplos):
+        haplo_count[(str(haplo // 128), str(haplo % 128))] = count
+    return _biallelic_haplo_counts(haplo_count, return_alleles=return_alleles)
+
+
+class WindowHaplotypeCounter(object):
+    '''It counts the haplotypes between the snps of a window.
+
+    The genotypes of every snp are coded once and the haplotype counts of
+    every pair are cached while the first snp is in the window, so they
+    can be shared by the AB coding and the smoothing.
+    '''
+    def __init__(self, samples, window):
+        self.samples = samples
+        self.window = window
+        self._coded_snps = OrderedDict()
+        self._haplo_counts = {}
+
+    def _code_snp(self, snp):
+        snp_id = id(snp)
+        try:
+            return self._coded_snps[snp_id][1]
+        except KeyError:
+            pass
+        coded_snp = _code_homozygous_alleles(snp, self.samples)
+        # the snp is kept to avoid its id to be reused
+        self._coded_snps[snp_id] = snp, coded_snp
+        if len(self._coded_snps) > self.window:
+            old_snp_id = self._coded_snps.popitem(last=False)[0]
+            self._haplo_counts.pop(old_snp_id, None)
+        return coded_snp
+
+    def count_haplotypes(self, snp1, snp2):
+        'It returns the HaploCount and the Alleles like in return_alleles'
+        coded_snp1 = self._code_snp(snp1)
+        coded_snp2 = self._code_snp(snp2)
+        haplo_counts = self._haplo_counts.setdefault(id(snp1), {})
+        try:
+            return haplo_counts[id(snp2)][1]
+        except KeyError:
+            pass
+        haplos = _count_biallelic_coded_haplotypes(coded_snp1, coded_snp2,
+                                                   return_alleles=True)
+        haplo_counts[id(snp2)] = snp2, haplos
+        return haplos
 
-    recomb_haplos = haplo_count.aB + haplo_count.Ab
-    tot_haplos = sum(haplo_count)
 
+def _calc_recomb_rate(recomb_haplos, tot_haplos, pop_type):
+    'It works with the haplotype numbers or with arrays of them'
     if pop_type == 'ril_self':
         recomb = recomb_haplos * (tot_haplos - recomb_haplos - 1)
-        recomb /= 2 * (tot_haplos - recomb_haplos) ** 2
+        recomb = recomb / (2 * (tot_haplos - recomb_haplos) ** 2)
     elif pop_type in ('test_cross', 'dihaploid'):
         recomb = recomb_haplos / tot_haplos
     else:
         msg = 'recomb. rate calculation not implemented for pop_type: %s'
         msg %= pop_type
         raise NotImplementedError(msg)
+    return recomb
+
+
+def calc_recomb_rate(calls1, calls2, pop_type):
+    haplo_count = _count_biallelic_haplotypes(calls1, calls2)
+    if haplo_count is None:
+        return None
+
+    recomb_haplos = haplo_count.aB + haplo_count.Ab
+    tot_haplos = sum(haplo_count)
+    recomb = _calc_recomb_rate(recomb_haplos, tot_haplos, pop_type)
     return recomb, haplo_count
 
 
+def calc_recomb_rates(haplo_counts, pop_type):
+    '''It calculates at once the recomb. rates of a list of HaploCounts.
+
+    It returns an array with a nan for the pairs without HaploCount (None).
+    '''
+    no_count = (float('nan'),) * len(HaploCount._fields)
+    counts = array([no_count if haplo_count is None else haplo_count
+                    for haplo_count in haplo_counts], dtype=float)
+    counts = counts.reshape(-1, len(HaploCount._fields))
+    recomb_haplos = counts[:, 1] + counts[:, 2]
+    return _calc_recomb_rate(recomb_haplos, counts.sum(axis=1), pop_type)
+
+
 class _LDStatsCache(object):
     def __init__(self):
         self.cache = {}
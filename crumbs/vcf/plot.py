@@ -15,7 +15,6 @@
 
 from crumbs.plot import get_fig_and_canvas
 from crumbs.vcf.snv import VCFReader
-from crumbs.utils.optional_modules import Figure, FigureCanvas
 
 FILTER_ALLELES_GT = None  # it could be an integer, i.e. 1 to keep only the
                             # 2 parental alleles in a F2
@@ -46,6 +45,7 @@ def _flatten_data(x_data, y_data):
 
 def plot_haplotypes(vcf_fhand, plot_fhand, genotype_mode=REFERENCE,
                     filter_alleles_gt=FILTER_ALLELES_GT):
+    from crumbs.utils.optional_modules import Figure, FigureCanvas
     reader = VCFReader(vcf_fhand)
 
     # collect data
@@ -17,7 +17,7 @@ import subprocess
 import os
 from tempfile import NamedTemporaryFile
 
-from crumbs.utils.optional_modules import Seq, write_seqrecs
+from crumbs.utils.optional_modules import Seq
 
 
 class IsIndelError(Exception):
@@ -265,6 +265,7 @@ def get_water_alignment(seq1, seq2, gap_open=10.0, gap_extend=0.5,
 
 def _do_water_alignment(seq1, seq2,  out_fhand, gap_open=10.0, gap_extend=0.5,
                         out_fmt='markx10', reverse2=False):
+    from crumbs.utils.optional_modules import write_seqrecs
     seq1_fhand = NamedTemporaryFile()
     seq2_fhand = NamedTemporaryFile()
 
@@ -16,11 +16,10 @@
 from collections import Counter, OrderedDict
 from array import array
 
-from crumbs.vcf.ab_coding import DEF_AB_CODING_WIN
+from crumbs.vcf.ab_coding import (DEF_AB_CODING_WIN, calc_recomb_weight,
+                                  get_window_haplotype_counter)
 from crumbs.iterutils import RandomAccessIterator
-from crumbs.vcf.ld import _count_biallelic_haplotypes
 from crumbs.vcf.filters import _print_figure
-from crumbs.utils.optional_modules import Figure, make_axes_locatable
 
 # Missing docstring
 # pylint: disable=C0111
@@ -31,6 +30,7 @@ class Smoother(object):
                  window=DEF_AB_CODING_WIN):
         # TODO a min number of genotypes to evaluate anything
         self.window = window
+        self._haplotype_counter = None
         self.smooth_threhsold = smooth_threhsold
         self.recomb_threshold = recomb_threshold
         self._recombs = array('B')
@@ -53,22 +53,16 @@ class Smoother(object):
     def _smooth(self, snp_idx_to_smooth, snp_gts, samples):
         snps, gt_for_snps_in_win = zip(*snp_gts)
 
-        # we need the recomb rates
-        # TODO, this is already calculated in ab coding, we have to cache
+        # we need the recomb rates, they are cached by the haplotype counter
         snp1 = snps[snp_idx_to_smooth]
-        snp1_calls = [snp1.genotype(sample) for sample in samples]
+        haplotype_counter = get_window_haplotype_counter(
+                              self._haplotype_counter, samples, self.window)
+        self._haplotype_counter = haplotype_counter
         weights = []
         for snp2 in snps:
-            snp2_calls = [snp2.genotype(sample) for sample in samples]
-            haplos = _count_biallelic_haplotypes(snp1_calls, snp2_calls,
-                                                 return_alleles=True)
-            if haplos is None:
-                weight = 0
-            else:
-                haplo_cnt, alleles = haplos
-                recomb_rate = (haplo_cnt.aB + haplo_cnt.Ab) / sum(haplo_cnt)
-                weight = 2 * (0.5 - recomb_rate) if recomb_rate < 0.5 else 0
-            weights.append(weight)
+            haplos = haplotype_counter.count_haplotypes(snp1, snp2)
+            weights.append(0 if haplos is None else
+                           calc_recomb_weight(haplos[0]))
 
         # we have to transpose, we want the genotype for each indi not for
         # each snp
@@ -133,6 +127,7 @@ class Smoother(object):
             yield snp, smoothed_genos
 
     def plot_hist(self, fhand):
+        from crumbs.utils.optional_modules import Figure, make_axes_locatable
         bins = 20
         fig = Figure()
         axes2 = fig.add_subplot(111)
@@ -22,8 +22,7 @@ from operator import itemgetter
 from io import BytesIO
 
 from crumbs.iterutils import generate_windows
-from crumbs.seq.seqio import read_seqs
-from crumbs.seq.seq import get_name, get_length
+from crumbs.seq.fasta_index import get_fasta_lengths
 from crumbs.utils.file_utils import flush_fhand
 # ouch, _Call is a private class, but we don't know how to modify a Call
 from crumbs.utils.optional_modules import (Reader as pyvcfReader,
@@ -109,8 +108,7 @@ class _SNPSlidingWindow(object):
                         chrom_lens[chrom] = loc
 
         else:
-            for read in read_seqs([self._ref_fhand]):
-                chrom_lens[get_name(read)] = get_length(read)
+            chrom_lens = get_fasta_lengths(self._ref_fhand)
         return chrom_lens
 
     def windows(self):
@@ -14,21 +14,27 @@
 # along with ngs_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import division
-from operator import itemgetter
+from operator import itemgetter, attrgetter
+from array import array
+from itertools import groupby, islice
+from bisect import bisect_left
+from multiprocessing import Pool
+import os.path
 
 import math
 
-from crumbs.seq.seq import get_name, get_length
-from crumbs.seq.seqio import read_seqs
+from crumbs.seq.fasta_index import get_fasta_lengths
 from crumbs.statistics import IntCounter, IntBoxplot
 from crumbs.plot import get_fig_and_canvas, draw_int_boxplot
 from crumbs.vcf.snv import (VARSCAN, GATK, FREEBAYES, HOM_REF, HET, HOM_ALT,
                             HOM, DEF_MIN_CALLS_FOR_POP_STATS, VCFReader,
                             pyvcfReader)
-from crumbs.utils.optional_modules import Reader
+from crumbs.utils.optional_modules import (Reader, frombuffer,
+                                           AlignmentFile)
 
 # TODO: This must be optional
 from crumbs.bam.coord_transforms import ReadRefCoord
+from crumbs.bam.statistics import FLAGS_SKIPPED_BY_PILEUP
 
 # Missing docstring
 # pylint: disable=C0111
@@ -103,13 +109,9 @@ class _AlleleDepths(object):
         return self._al_counts
 
 
-def _get_seq_lengths(fhand):
-    return {get_name(seq): get_length(seq) for seq in read_seqs([fhand])}
-
-
 def calc_n_bases_in_chrom_with_snp(counts, ref_fhand):
     n_bases = 0
-    ref_lengths = _get_seq_lengths(ref_fhand)
+    ref_lengths = get_fasta_lengths(ref_fhand)
     for ref_name, length in ref_lengths.items():
         if ref_name.strip() in counts:
             n_bases += length
@@ -118,7 +120,7 @@ def calc_n_bases_in_chrom_with_snp(counts, ref_fhand):
 
 def calc_n_bases_per_n_snps_in_chrom(counts, ref_fhand):
     distribution = {}
-    ref_lengths = _get_seq_lengths(ref_fhand)
+    ref_lengths = get_fasta_lengths(ref_fhand)
     for ref_name, length in ref_lengths.items():
         if ref_name.strip() in counts:
             n = counts[ref_name.strip()]
@@ -131,7 +133,7 @@ def calc_n_bases_per_n_snps_in_chrom(counts, ref_fhand):
 
 def calc_density_per_chrom(counts, ref_fhand, size=100):
     densities = {}
-    ref_lengths = _get_seq_lengths(ref_fhand)
+    ref_lengths = get_fasta_lengths(ref_fhand)
     for ref_name, length in ref_lengths.items():
         seq_count = counts[ref_name]
         if seq_count == 0:
@@ -154,42 +156,180 @@ def choose_samples(record, sample_names):
     return chosen_samples
 
 
+_GT_COMPARISON_CHUNK = 10000
+_UNCALLED_GT_CODE = 0
+
+
+def _get_sample_idxs(vcf_samples, sample_names):
+    if sample_names is None:
+        return range(len(vcf_samples))
+    sample_names = set(sample_names)
+    return [idx for idx, sample in enumerate(vcf_samples)
+            if sample in sample_names]
+
+
+def _encode_gt_types(record, sample_idxs):
+    '''It returns the genotype types of the chosen samples as a byte str.
+
+    Every genotype takes one byte, 0 for the uncalled ones and the gt_type
+    plus one for the rest.
+    '''
+    calls = record.samples
+    gt_types = array('b', [0] * len(sample_idxs))
+    for idx, sample_idx in enumerate(sample_idxs):
+        gt_type = calls[sample_idx].gt_type
+        if gt_type is not None:
+            gt_types[idx] = gt_type + 1
+    return gt_types.tostring()
+
+
+def _index_gt_types(records, sample_idxs):
+    '''It returns the genotype types of the records by chromosome.
+
+    For every chromosome there is an array with the sorted positions and an
+    int8 matrix with the genotype types, encoded as in _encode_gt_types, of
+    every position.
+    '''
+    positions, gt_types = {}, {}
+    for record in records:
+        chrom = record.CHROM
+        if chrom not in positions:
+            positions[chrom] = array('l')
+            gt_types[chrom] = []
+        positions[chrom].append(record.POS)
+        gt_types[chrom].append(_encode_gt_types(record, sample_idxs))
+
+    index = {}
+    for chrom, chrom_positions in positions.items():
+        chrom_positions = frombuffer(chrom_positions.tostring(), dtype='l')
+        chrom_gt_types = frombuffer(''.join(gt_types[chrom]), dtype='int8')
+        chrom_gt_types = chrom_gt_types.reshape((len(chrom_positions),
+                                                 len(sample_idxs)))
+        order = chrom_positions.argsort(kind='mergesort')
+        index[chrom] = chrom_positions[order], chrom_gt_types[order]
+    return index
+
+
+def _lookup_gt_types(index, chrom, pos):
+    'It returns the encoded genotype types found in a position or None'
+    if chrom not in index:
+        return None
+    positions, gt_types = index[chrom]
+    # the last one wins if a position is repeated
+    idx = positions.searchsorted(pos, side='right') - 1
+    if idx < 0 or positions[idx] != pos:
+        return None
+    return gt_types[idx].tostring()
+
+
+class _GtComparisonCounts(object):
+    'It accumulates the genotype comparisons between two sets of samples'
+    def __init__(self, n_samples1, n_samples2):
+        self._n_samples1 = n_samples1
+        self._n_samples2 = n_samples2
+        self._gts1 = []
+        self._gts2 = []
+        self.common = 0
+        self.uncalled = 0
+        self.different = 0
+
+    def add(self, gts1, gts2):
+        self._gts1.append(gts1)
+        self._gts2.append(gts2)
+        if len(self._gts1) >= _GT_COMPARISON_CHUNK:
+            self.flush()
+
+    def flush(self):
+        n_snvs = len(self._gts1)
+        if not n_snvs:
+            return
+        gts1 = frombuffer(''.join(self._gts1), dtype='int8')
+        gts1 = gts1.reshape((n_snvs, self._n_samples1))
+        gts2 = frombuffer(''.join(self._gts2), dtype='int8')
+        gts2 = gts2.reshape((n_snvs, self._n_samples2))
+        self._gts1, self._gts2 = [], []
+
+        # every sample in one set is compared with every one in the other
+        called1 = (gts1 != _UNCALLED_GT_CODE).sum(axis=1, dtype='int64')
+        called2 = (gts2 != _UNCALLED_GT_CODE).sum(axis=1, dtype='int64')
+        called_pairs = int((called1 * called2).sum())
+        common = 0
+        for gt_code in (HOM_REF + 1, HET + 1, HOM_ALT + 1):
+            with_gt1 = (gts1 == gt_code).sum(axis=1, dtype='int64')
+            with_gt2 = (gts2 == gt_code).sum(axis=1, dtype='int64')
+            common += int((with_gt1 * with_gt2).sum())
+        self.common += common
+        self.different += called_pairs - common
+        self.uncalled += (n_snvs * self._n_samples1 * self._n_samples2 -
+                          called_pairs)
+
+
 class VCFcomparisons(object):
+    '''It compares the genotypes of the SNVs found in two VCFs.
+
+    The genotype types of the reference VCF are kept as one byte per sample.
+    If the reference VCF is tabix indexed only the SNVs of the chromosome
+    being compared are kept in memory. If the VCF to compare is not sorted
+    by chromosome, once a chromosome is found again the whole reference VCF
+    is indexed in memory instead.
+    '''
 
     def __init__(self, vcf_path, samples=None):
         reader = Reader(filename=vcf_path)
-        self.index = {}
+        self._vcf_path = vcf_path
         self.samples = samples
-        for vcf_record in reader:
-            snp_name = create_snp_name(vcf_record)
-            self.index[snp_name] = vcf_record
+        self._sample_idxs = _get_sample_idxs(reader.samples, samples)
+        self._indexed = os.path.exists(vcf_path + '.tbi')
+        if self._indexed:
+            self._index = {}
+        else:
+            self._index = _index_gt_types(reader, self._sample_idxs)
+        self._indexed_chrom = None
+        self._left_chroms = set()
+
+    def _get_index(self, chrom):
+        if not self._indexed or chrom == self._indexed_chrom:
+            return self._index
+        if chrom in self._left_chroms:
+            # fetching the chromosomes again could read the reference VCF
+            # many times
+            reader = Reader(filename=self._vcf_path)
+            self._index = _index_gt_types(reader, self._sample_idxs)
+            self._indexed = False
+            return self._index
+        if self._indexed_chrom is not None:
+            self._left_chroms.add(self._indexed_chrom)
+        reader = Reader(filename=self._vcf_path)
+        try:
+            records = list(reader.fetch(chrom))
+        except (KeyError, ValueError):
+            records = []
+        self._index = _index_gt_types(records, self._sample_idxs)
+        self._indexed_chrom = chrom
+        return self._index
 
     def calculate_statistics(self, reader, samples=None):
+        sample_idxs = _get_sample_idxs(reader.samples, samples)
+        counts = _GtComparisonCounts(len(sample_idxs), len(self._sample_idxs))
         n_common_snps = 0
         total_snps = 0
-        common_genotypes = 0
-        uncalled_genotypes = 0
-        different_genotypes = 0
+        # every VCF to compare can go through the chromosomes again
+        self._left_chroms = set()
         for vcf_record in reader:
             total_snps += 1
-            snp_name = create_snp_name(vcf_record)
-            if snp_name not in self.index:
+            chrom = vcf_record.CHROM
+            ref_gts = _lookup_gt_types(self._get_index(chrom), chrom,
+                                       vcf_record.POS)
+            if ref_gts is None:
                 continue
             n_common_snps += 1
-            for call1 in choose_samples(vcf_record, samples):
-                for call2 in choose_samples(self.index[snp_name],
-                                            self.samples):
-                    if call1.gt_type is None or call2.gt_type is None:
-                        uncalled_genotypes += 1
-                    elif call1.gt_type == call2.gt_type:
-                        common_genotypes += 1
-                    else:
-                        different_genotypes += 1
+            counts.add(_encode_gt_types(vcf_record, sample_idxs), ref_gts)
+        counts.flush()
         common_snps_prc = n_common_snps / float(total_snps) * 100
         statistics = {'common_snps_prc': common_snps_prc,
-                      'common': common_genotypes,
-                      'uncalled': uncalled_genotypes,
-                      'different': different_genotypes}
+                      'common': counts.common,
+                      'uncalled': counts.uncalled,
+                      'different': counts.different}
         return statistics
 
 
@@ -565,110 +705,146 @@ class VcfStats(object):
         return self._snv_counters[DEPTHS]
 
 
-def calc_snv_read_pos_stats(sam, snvs, max_snps=None, max_pos=None):
-    "This implementation is using pysam pysam"
-    pileup_cols = sam.pileup()
-    read_5_pos_cnts_rg = {}
-    read_3_pos_cnts_rg = {}
-    read_5_pos_box_rg = {}
-    read_3_pos_box_rg = {}
-
-    for index, snv in enumerate(snvs):
-        if max_snps and index >= max_snps:
+READ_POS_STAT_KEYS = ('5_read_pos_counts', '3_read_pos_counts',
+                      '5_read_pos_boxplot', '3_read_pos_boxplot')
+# the bam and the max read pos of every worker process, set by its initializer
+_WORKER_READ_POS_CONF = None
+
+
+def _add_read_pos_to_stats(stats, read_group, read_pos, read_pos_end,
+                           snv_qual, max_pos):
+    read_5_pos_cnts_rg = stats['5_read_pos_counts']
+    if read_group not in read_5_pos_cnts_rg:
+        read_5_pos_cnts_rg[read_group] = IntCounter()
+        stats['3_read_pos_counts'][read_group] = IntCounter()
+        stats['5_read_pos_boxplot'][read_group] = IntBoxplot()
+        stats['3_read_pos_boxplot'][read_group] = IntBoxplot()
+
+    if read_pos is not None and (not max_pos or read_pos + 1 <= max_pos):
+        read_5_pos_cnts_rg[read_group][read_pos + 1] += 1
+        stats['5_read_pos_boxplot'][read_group].append(read_pos + 1,
+                                                       snv_qual)
+    if (read_pos_end is not None and
+            (not max_pos or abs(read_pos_end) <= max_pos)):
+        stats['3_read_pos_counts'][read_group][abs(read_pos_end)] += 1
+        stats['3_read_pos_boxplot'][read_group].append(abs(read_pos_end),
+                                                       snv_qual)
+
+
+def _merge_read_pos_stats(stats, other_stats):
+    for key in READ_POS_STAT_KEYS:
+        stats_by_rg = stats[key]
+        for read_group, other_stat in other_stats[key].items():
+            if read_group not in stats_by_rg:
+                stats_by_rg[read_group] = other_stat
+            elif isinstance(other_stat, IntBoxplot):
+                counts = stats_by_rg[read_group].counts
+                for category, cat_counts in other_stat.counts.items():
+                    if category in counts:
+                        counts[category].update(cat_counts)
+                    else:
+                        counts[category] = cat_counts
+            else:
+                stats_by_rg[read_group].update(other_stat)
+
+
+def _calc_read_pos_stats_in_chrom(sam, chrom, snvs, max_pos, stats):
+    '''It adds the read positions of the SNVs in one chromosome to the stats.
+
+    The SNVs, given as (pos, qual) tuples, and the reads are walked together,
+    so every read is read once and the read positions of all the SNVs that
+    it overlaps are looked up at once.
+    '''
+    snv_poss = [pos for pos, _ in snvs]
+    n_snvs = len(snvs)
+    first_snv_idx = 0
+    for read in sam.fetch(chrom):
+        if read.flag & FLAGS_SKIPPED_BY_PILEUP:
+            continue
+        read_end = read.reference_end
+        if read_end is None:
+            continue
+        first_snv_idx = bisect_left(snv_poss, read.reference_start,
+                                    first_snv_idx)
+        if first_snv_idx >= n_snvs:
             break
-        chrom = snv.chrom
-        ref_pos = snv.pos
-        snv_qual = snv.qual
-        snv_col = None
-        for col in pileup_cols:
-            ref_name = sam.getrname(col.reference_id)
-            if ref_name == chrom and col.reference_pos == ref_pos:
-                snv_col = col
-                break
-        if snv_col is None:
-            raise RuntimeError('No pileup found for snv {}:{}'.format(chrom,
-                                                                      ref_pos))
-
-        for pileup_read in snv_col.pileups:
-            try:
-                read_group = pileup_read.alignment.opt('RG')
-            except KeyError:
-                read_group = None
-            read_ref_coord = ReadRefCoord(pileup_read.alignment, sam)
-            read_pos = read_ref_coord.get_read_pos((chrom, ref_pos))
-            read_pos_end = read_ref_coord.get_read_pos_counting_from_end((chrom,
-                                                                          ref_pos))
-            if read_group not in read_5_pos_cnts_rg:
-                read_5_pos_cnts_rg[read_group] = IntCounter()
-                read_3_pos_cnts_rg[read_group] = IntCounter()
-                read_5_pos_box_rg[read_group] = IntBoxplot()
-                read_3_pos_box_rg[read_group] = IntBoxplot()
-            read_5_pos_cnts = read_5_pos_cnts_rg[read_group]
-            read_3_pos_cnts = read_3_pos_cnts_rg[read_group]
-            read_5_pos_box = read_5_pos_box_rg[read_group]
-            read_3_pos_box = read_3_pos_box_rg[read_group]
-
-            if (read_pos is not None and
-                    (not max_pos or read_pos + 1 <= max_pos)):
-                    read_5_pos_cnts[read_pos + 1] += 1
-                    read_5_pos_box.append(read_pos + 1, snv_qual)
-            if (read_pos_end is not None and (not max_pos or
-                                              abs(read_pos_end) <= max_pos)):
-                    read_3_pos_cnts[abs(read_pos_end)] += 1
-                    read_3_pos_box.append(abs(read_pos_end), snv_qual)
-
-    return {'5_read_pos_counts': read_5_pos_cnts_rg,
-            '3_read_pos_counts': read_3_pos_cnts_rg,
-            '5_read_pos_boxplot': read_5_pos_box_rg,
-            '3_read_pos_boxplot': read_3_pos_box_rg}
+        end_snv_idx = bisect_left(snv_poss, read_end, first_snv_idx)
+        if first_snv_idx == end_snv_idx:
+            # this read does not overlap any SNV
+            continue
+        try:
+            read_group = read.opt('RG')
+        except KeyError:
+            read_group = None
+        read_ref_coord = ReadRefCoord(read, sam)
+        poss = snv_poss[first_snv_idx:end_snv_idx]
+        quals = [qual for _, qual in snvs[first_snv_idx:end_snv_idx]]
+        read_poss = read_ref_coord.get_read_poss(chrom, poss)
+        read_poss_end = read_ref_coord.get_read_poss_counting_from_end(chrom,
+                                                                       poss)
+        for qual, read_pos, read_pos_end in zip(quals, read_poss,
+                                                read_poss_end):
+            _add_read_pos_to_stats(stats, read_group, read_pos, read_pos_end,
+                                   qual, max_pos)
+
+
+def _group_snvs_by_chrom(snvs, max_snps):
+    'It yields the chrom and (pos, qual) of the SNVs of every chrom'
+    if max_snps:
+        snvs = islice(snvs, max_snps)
+    for chrom, chrom_snvs in groupby(snvs, key=attrgetter('chrom')):
+        chrom_snvs = [(snv.pos, snv.qual) for snv in chrom_snvs]
+        poss = [pos for pos, _ in chrom_snvs]
+        if poss != sorted(poss):
+            raise ValueError('The SNVs should be sorted by position')
+        yield chrom, chrom_snvs
+
+
+def _init_read_pos_worker(bam_fpath, max_pos):
+    global _WORKER_READ_POS_CONF
+    _WORKER_READ_POS_CONF = bam_fpath, max_pos
+
+
+def _calc_read_pos_stats_in_worker(chrom_snvs):
+    bam_fpath, max_pos = _WORKER_READ_POS_CONF
+    chrom, snvs = chrom_snvs
+    stats = {key: {} for key in READ_POS_STAT_KEYS}
+    _calc_read_pos_stats_in_chrom(AlignmentFile(bam_fpath), chrom, snvs,
+                                  max_pos, stats)
+    return stats
+
+
+def calc_snv_read_pos_stats(sam, snvs, max_snps=None, max_pos=None,
+                            processes=1):
+    '''It calculates the distribution of the SNV positions along the reads.
+
+    The BAM should be indexed and the SNVs sorted by position. The reads of
+    every chromosome with SNVs are read once, every chromosome can be
+    processed in a different process.
+    '''
+    stats = {key: {} for key in READ_POS_STAT_KEYS}
+    snvs_by_chrom = _group_snvs_by_chrom(snvs, max_snps)
+    if processes > 1:
+        workers = Pool(processes=processes, initializer=_init_read_pos_worker,
+                       initargs=(sam.filename, max_pos))
+        try:
+            for chrom_stats in workers.imap(_calc_read_pos_stats_in_worker,
+                                            snvs_by_chrom):
+                _merge_read_pos_stats(stats, chrom_stats)
+        finally:
+            workers.terminate()
+            workers.join()
+    else:
+        for chrom, chrom_snvs in snvs_by_chrom:
+            _calc_read_pos_stats_in_chrom(sam, chrom, chrom_snvs, max_pos,
+                                          stats)
+    return stats
 
 
 def calc_snv_read_pos_stats2(sam, snvs, max_snps=None, max_pos=None):
-    "this implementation is using pysam fetch"
-    read_5_pos_cnts_rg = {}
-    read_3_pos_cnts_rg = {}
-    read_5_pos_box_rg = {}
-    read_3_pos_box_rg = {}
-
-    for index, snv in enumerate(snvs):
-        if max_snps and index >= max_snps:
-            break
-        chrom = snv.chrom
-        ref_pos = snv.pos
-        snv_qual = snv.qual
-        for alignment_read in sam.fetch(chrom, ref_pos, ref_pos + 1):
-            try:
-                read_group = alignment_read.opt('RG')
-            except KeyError:
-                read_group = None
-
-            read_ref_coord = ReadRefCoord(alignment_read, sam)
-            read_pos = read_ref_coord.get_read_pos((chrom, ref_pos))
-            read_pos_end = read_ref_coord.get_read_pos_counting_from_end((chrom,
-                                                                          ref_pos))
-            if read_group not in read_5_pos_cnts_rg:
-                read_5_pos_cnts_rg[read_group] = IntCounter()
-                read_3_pos_cnts_rg[read_group] = IntCounter()
-                read_5_pos_box_rg[read_group] = IntBoxplot()
-                read_3_pos_box_rg[read_group] = IntBoxplot()
-            read_5_pos_cnts = read_5_pos_cnts_rg[read_group]
-            read_3_pos_cnts = read_3_pos_cnts_rg[read_group]
-            read_5_pos_box = read_5_pos_box_rg[read_group]
-            read_3_pos_box = read_3_pos_box_rg[read_group]
-
-            if (read_pos is not None and
-                    (not max_pos or read_pos + 1 <= max_pos)):
-                    read_5_pos_cnts[read_pos + 1] += 1
-                    read_5_pos_box.append(read_pos + 1, snv_qual)
-            if (read_pos_end is not None and (not max_pos or
-                                              abs(read_pos_end) <= max_pos)):
-                    read_3_pos_cnts[abs(read_pos_end)] += 1
-                    read_3_pos_box.append(abs(read_pos_end), snv_qual)
-
-    return {'5_read_pos_counts': read_5_pos_cnts_rg,
-            '3_read_pos_counts': read_3_pos_cnts_rg,
-            '5_read_pos_boxplot': read_5_pos_box_rg,
-            '3_read_pos_boxplot': read_3_pos_box_rg}
+    'It calculates the same stats as calc_snv_read_pos_stats'
+    return calc_snv_read_pos_stats(sam, snvs, max_snps=max_snps,
+                                   max_pos=max_pos)
 
 
 def _draw_one_read_pos_stats(stats, axes, box_key, count_key, title):
@@ -39,6 +39,23 @@ def setup_basic_argparse(**kwargs):
     return parser
 
 
+def setup_genotype_filter_argparse(**kwargs):
+    'It prepares the command line argument parsing for the genotype filters'
+    parser = setup_basic_argparse(**kwargs)
+    msg = 'Num. of SNVs filtered together (default: one by one)'
+    parser.add_argument('--chunk_size', type=int, help=msg)
+    msg = 'Num. of processes used to filter the chunks (default: %(default)s)'
+    parser.add_argument('--processes', type=int, default=1, help=msg)
+    return parser
+
+
+def parse_genotype_filter_args(parser):
+    args, parsed_args = parse_basic_args(parser)
+    args['chunk_size'] = parsed_args.chunk_size
+    args['processes'] = parsed_args.processes
+    return args, parsed_args
+
+
 def setup_filter_argparse(**kwargs):
     'It prepares the command line argument parsing.'
     parser = setup_basic_argparse(**kwargs)
@@ -19,7 +19,8 @@ from array import array
 
 from crumbs.vcf.ab_coding import ABCoder, DEF_AB_CODER_THRESHOLD
 from crumbs.vcf.snv import get_or_create_id
-from crumbs.utils.optional_modules import Reader, seq_index
+from crumbs.utils.optional_modules import Reader
+from crumbs.seq.fasta_index import FastaReference
 
 
 # Missing docstring
@@ -108,7 +109,7 @@ class IlluminaWriter(object):
             raise ValueError(msg)
         self._min_len = min_length
 
-        self._ref_seqs = seq_index(ref_fpath, format='fasta')
+        self._ref_seqs = FastaReference(ref_fpath)
 
         if vcf_fpath:
             self._snvs = Reader(filename=vcf_fpath)
@@ -116,17 +117,10 @@ class IlluminaWriter(object):
             self._snvs = None
         self._out_fhand = out_fhand
         out_fhand.write(u'CHROM\tPOS\tID\tseq\n')
-        self._prev_chrom = None
 
     def write(self, snv):
-        chrom_name = snv.CHROM
-
-        prev_chrom = self._prev_chrom
-        if prev_chrom is None or prev_chrom.name != chrom_name:
-            chrom = self._ref_seqs[chrom_name]
-            self._prev_chrom = chrom
-        else:
-            chrom = prev_chrom
+        chrom = snv.CHROM
+        ref_seqs = self._ref_seqs
 
         length = self._len
         min_len = self._min_len
@@ -135,8 +129,8 @@ class IlluminaWriter(object):
         snv_end = snv.end       # 1 based
         desired_start = snv_start - length  # desired segment start
         end = snv_end + length      # desired segment end
-        chrom_seq = chrom.seq
-        first_segment = unicode(chrom_seq[desired_start:snv_start])
+        first_segment = unicode(ref_seqs.fetch(chrom, desired_start,
+                                               snv_start))
 
         if len(first_segment) < min_len:
             msg = "Not enough sequence in 3'. ID: %s, POS: %d, CHROM: %s"
@@ -145,13 +139,13 @@ class IlluminaWriter(object):
 
         if self._snvs:
             real_start = snv_start - len(first_segment)
-            close_snvs = self._snvs.fetch(chrom.name, start=real_start,
+            close_snvs = self._snvs.fetch(chrom, start=real_start,
                                           end=snv_start)
             first_segment = _replace_snvs_with_iupac(first_segment, close_snvs,
                                                      seq_offset=real_start)
 
         snv_segment = _build_snv_section(snv)
-        second_segment = unicode(chrom_seq[snv_end:end])
+        second_segment = unicode(ref_seqs.fetch(chrom, snv_end, end))
         if len(second_segment) < min_len:
             msg = "Not enough sequence in 5'. ID: %s, POS: %d, CHROM: %s"
             msg %= (snv.ID, snv.POS, snv.CHROM)
@@ -159,7 +153,7 @@ class IlluminaWriter(object):
 
         if self._snvs:
             real_end = snv_end + len(second_segment)
-            close_snvs = self._snvs.fetch(chrom.name, start=snv_end,
+            close_snvs = self._snvs.fetch(chrom, start=snv_end,
                                           end=real_end)
             second_segment = _replace_snvs_with_iupac(second_segment,
                                                       close_snvs,
@@ -15,10 +15,13 @@
 
 import unittest
 from tempfile import NamedTemporaryFile
+from collections import Counter
+from os.path import join
 
 import pysam
 
-from crumbs.bam.coord_transforms import ReadRefCoord
+from crumbs.bam.coord_transforms import ReadRefCoord, pos_counter_by_pos
+from crumbs.utils.test_utils import TEST_DATA_DIR
 
 
 SAM = '''@HD\tVN:1.3\tSO:coordinate
@@ -118,6 +121,70 @@ class BasePositionTest(unittest.TestCase):
         assert coords[7].get_read_pos(('ref', 16)) == 12
         assert coords[7].get_read_pos_counting_from_end(('ref', 16)) == -2
 
+    def test_many_positions(self):
+        fhand = NamedTemporaryFile(suffix='.sam')
+        fhand.write(SAM)
+        fhand.flush()
+        sam = pysam.AlignmentFile(fhand.name)
+        coords = [ReadRefCoord(read, sam) for read in sam]
+        assert coords[0].blocks is coords[0].blocks
+        # pysam does not support the padding, that does not change the coords
+        reads = list(pysam.AlignmentFile(fhand.name))
+        for read in reads:
+            read.cigartuples = [(operation, length)
+                                for operation, length in read.cigartuples
+                                if operation != 6]
+        poss = range(0, 45)
+        for read, coord in zip(reads, coords):
+            # the read positions given by pysam, from the 5' end of the read
+            expected = {}
+            for query_pos, ref_pos in read.get_aligned_pairs(
+                                                            matches_only=True):
+                if read.is_reverse:
+                    query_pos = read.query_length - query_pos - 1
+                expected[ref_pos] = query_pos
+
+            read_poss = coord.get_read_poss('ref', poss)
+            read_poss_end = coord.get_read_poss_counting_from_end('ref', poss)
+            for pos, read_pos, read_pos_end in zip(poss, read_poss,
+                                                   read_poss_end):
+                assert read_pos == expected.get(pos)
+                assert coord.get_read_pos(('ref', pos)) == read_pos
+                assert read_pos_end == (None if read_pos is None else
+                                        read_pos - read.query_length)
+        assert coords[0].get_read_poss('ref', [12, 18, 16]) == [6, None, 12]
+        try:
+            coords[0].get_read_poss('ref2', [12])
+            self.fail('ValueError expected')
+        except ValueError:
+            pass
+
+    def test_pos_counter_by_pos(self):
+        bam_fpath = join(TEST_DATA_DIR, 'seqs.bam')
+        positions = [('reference1', 186), ('reference1', 214),
+                     ('reference2', 349), ('reference2', 2000)]
+        counters = list(pos_counter_by_pos(bam_fpath, positions))
+
+        sam = pysam.AlignmentFile(bam_fpath)
+        expected = []
+        for col in sam.pileup():
+            position = sam.getrname(col.reference_id), col.reference_pos
+            if position not in positions:
+                continue
+            counter = Counter()
+            for pileup_read in col.pileups:
+                if pileup_read.query_position is None:
+                    continue
+                if pileup_read.alignment.is_reverse:
+                    read_pos = (pileup_read.alignment.query_length -
+                                pileup_read.query_position - 1)
+                else:
+                    read_pos = pileup_read.query_position
+                counter[read_pos] += 1
+            expected.append(counter)
+        assert len(counters) == 3
+        assert counters == expected
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'CalmdTest']
     unittest.main()
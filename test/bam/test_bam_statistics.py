@@ -28,7 +28,8 @@ from crumbs.bam.statistics import (count_reads, ReferenceStats, ReadStats,
                                    get_reference_counts_dict,
                                    get_genome_coverage, get_bam_readgroups,
                                    mapped_count_by_rg, BamCoverages1,
-                                   BamCoverages2)
+                                   BamCoverages2, BamStats,
+                                   _DepthDistribCounter)
 
 
 # pylint: disable=R0201
@@ -136,6 +137,57 @@ class StatsTest(unittest.TestCase):
         map_counts = mapped_count_by_rg([bam_fpath], mapqx=50)
         assert map_counts['sample_no_rg']['bigger_mapqx'] == 0
 
+    def test_bam_stats(self):
+        bam_fpath = os.path.join(TEST_DATA_DIR, 'seqs.bam')
+        for processes in (1, 2):
+            stats = BamStats([bam_fpath], mapqx=30, processes=processes,
+                             n_most_abundant_refs=1)
+            assert stats.reference_counts[0][1] == {'unmapped_reads': 0,
+                                                    'reference': 'reference2',
+                                                    'length': 1714,
+                                                    'mapped_reads': 9}
+            assert stats.reference_counts[0][2]['reference'] is None
+            refstats = stats.reference_stats
+            assert refstats.most_abundant_refs[0]['reference'] == 'reference1'
+            assert refstats.rpkms.max - 600240.1 < 0.1
+            assert stats.mapqs == ReadStats([pysam.Samfile(bam_fpath)]).mapqs
+            assert stats.flag_counts['is_unmapped'] == 0
+            assert stats.mapped_by_rg['group1+454']['mapped'] == 9
+            assert stats.mapped_by_rg['group1+454']['bigger_mapqx'] == 3
+            bam = pysam.Samfile(bam_fpath)
+            assert stats.coverages == CoverageCounter([bam])
+            assert 'Mapped reads by read group' in str(stats)
+
+        stats = BamStats([bam_fpath], rgs_to_keep=['group2+454'])
+        assert stats.mapqs.count == 9
+        assert stats.mapped_by_rg['group1+454']['mapped'] == 0
+
+        bam_fpath = os.path.join(TEST_DATA_DIR, 'sample_no_rg.bam')
+        stats = BamStats([bam_fpath])
+        assert stats.mapped_by_rg['sample_no_rg']['mapped'] == 1
+        assert 'bigger_mapqx' not in stats.mapped_by_rg['sample_no_rg']
+
+    def test_depth_distrib(self):
+        counter = _DepthDistribCounter(chunk_size=3)
+        for read in [(0, 0, 4), (0, 2, 6), (0, 10, 11), (1, 0, 2)]:
+            counter.add(*read)
+        counter.flush()
+        assert counter.counts == {1: 7, 2: 2}
+        try:
+            counter.add(1, 5, 6)
+            counter.add(1, 4, 6)
+            self.fail('ValueError expected')
+        except ValueError:
+            pass
+
+    def test_bin_bam_stats(self):
+        bam_fpath = os.path.join(TEST_DATA_DIR, 'seqs.bam')
+        bin_ = os.path.join(BAM_BIN_DIR, 'do_bam_stats')
+        cmd = [bin_, bam_fpath, '--single_pass', '-p', '2', '-s', 'group1+454']
+        output = check_output(cmd)
+        assert 'group1+454\tmapped: 9' in output
+        assert 'group2+454\tmapped: 0' in output
+
     def test_bin_mapped_counts(self):
         bam_fpath = os.path.join(TEST_DATA_DIR, 'seqs.bam')
 
@@ -202,6 +254,39 @@ class BamCoverageTest(unittest.TestCase):
                                                                None, None))
         assert res == {'group1+454': {18: 53, 12: 20, 6: 20}}
 
+    def test_bam_coverage2_chunked(self):
+        bam_fpath = os.path.join(TEST_DATA_DIR, 'seqs.bam')
+        region = ('reference1', None, None)
+        cov = BamCoverages2([bam_fpath], chunked=True, chunk_size=50)
+        assert cov.calculate_coverage_in_pos('reference1', 200) == {'group1+454': 9}
+        assert cov.calculate_coverage_in_pos('reference1', 0) == {}
+        res = cov.calculate_coverage_distrib_in_region(region=region)
+        assert res['group1+454'] == {9: 73}
+        assert not res['group2+454']
+        depths = cov.calculate_depths('reference1')
+        assert list(depths['group1+454']).count(9) == 73
+        assert not depths['group2+454'].any()
+
+        res = cov.calculate_coverage_distrib_in_region()
+        assert res['group2+454'] == {9: 73, 6: 1}
+
+        cov = BamCoverages2([bam_fpath], window=2, chunked=True,
+                            chunk_size=50)
+        res = cov.calculate_coverage_distrib_in_region(region=region)
+        assert res == {'group1+454': {9: 72, 5: 2}}
+
+        for processes in (1, 2):
+            cov = BamCoverages2([bam_fpath, bam_fpath], window=21,
+                                sampling_win_step=10, chunked=True,
+                                processes=processes, chunk_size=50)
+            res = cov.calculate_coverage_distrib_in_region(region=region)
+            assert res == {'group1+454': {18: 53, 12: 20, 6: 20}}
+
+        # the depths of a sample in different bams are added
+        cov = BamCoverages2([bam_fpath, bam_fpath], chunked=True)
+        res = cov.calculate_coverage_distrib_in_region(region=region)
+        assert res['group1+454'] == {18: 73}
+
     def test_bin_draw_cov_hist(self):
         bam_fpath = os.path.join(TEST_DATA_DIR, 'seqs.bam')
         binary = os.path.join(BAM_BIN_DIR, 'draw_coverage_hist')
@@ -219,6 +304,13 @@ class BamCoverageTest(unittest.TestCase):
         check_output(cmd)
         assert 'group2+454' in open(out_fhand2.name).read()
 
+        out_fhand = NamedTemporaryFile(suffix='.png')
+        out_fhand2 = NamedTemporaryFile(suffix='.txt')
+        cmd = [binary, bam_fpath, '-p', out_fhand.name, '-o', out_fhand2.name,
+               '--chunked', '--processes', '2']
+        check_output(cmd)
+        assert 'group2+454' in open(out_fhand2.name).read()
+
 if __name__ == "__main__":
     import sys;sys.argv = ['', 'BamCoverageTest.test_bam_coverage1_samples']
     unittest.main()
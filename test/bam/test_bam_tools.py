@@ -27,7 +27,8 @@ from crumbs.bam.bam_tools import (filter_bam, calmd_bam, realign_bam,
                                   index_bam, merge_sams,
                                   _downgrade_edge_qualities,
                                   _restore_qual_from_tag, LEFT_DOWNGRADED_TAG,
-                                  RIGTH_DOWNGRADED_TAG, mark_duplicates)
+                                  RIGTH_DOWNGRADED_TAG, mark_duplicates,
+                                  downgrade_read_edges)
 from crumbs.utils.file_utils import TemporaryDir
 
 # pylint: disable=C0111
@@ -260,6 +261,20 @@ class DowngradeQuality(unittest.TestCase):
         assert aligned_read.query_qualities[:5] == changed_lquals
         assert aligned_read.query_qualities[10:] == original_qual[10:]
 
+    def test_downgrade_read_edges_in_parallel(self):
+        for bam_fname in ('seqs.bam', 'sample.bam'):
+            bam_fpath = os.path.join(TEST_DATA_DIR, bam_fname)
+            out_fhand = NamedTemporaryFile(suffix='.bam')
+            downgrade_read_edges(bam_fpath, out_fhand.name, size=4)
+            par_out_fhand = NamedTemporaryFile(suffix='.bam')
+            downgrade_read_edges(bam_fpath, par_out_fhand.name, size=4,
+                                 processes=2)
+            reads = [str(read) for read in AlignmentFile(out_fhand.name)]
+            par_reads = [str(read)
+                         for read in AlignmentFile(par_out_fhand.name)]
+            assert len(reads) == len(list(AlignmentFile(bam_fpath)))
+            assert reads == par_reads
+
     def test_downgrade_read_edges_binary(self):
         binary = os.path.join(BAM_BIN_DIR, 'downgrade_bam_edge_qual')
         bam_fpath = os.path.join(TEST_DATA_DIR, 'sample_rev.bam')
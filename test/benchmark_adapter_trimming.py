@@ -0,0 +1,110 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of ngs_crumbs.
+# ngs_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# ngs_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with ngs_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''It measures the throughput of the Nextera adapter trimmers.
+
+It simulates a Nextera mate pair library in which half of the reads have
+an adapter, complete or partial at the 3' end and with some sequencing
+errors, and it trims it with the native and with the BLAST based trimmers.
+It is not a test, run it as: python test/benchmark_adapter_trimming.py
+[num_reads]
+'''
+
+import sys
+import time
+from random import choice, randint, random, seed
+
+from crumbs.seq.seq import SeqWrapper, SeqItem
+from crumbs.seq.trim import (TrimAdapters, TrimNexteraAdapters, TrimOrMask,
+                             seq_to_trim_packets)
+from crumbs.utils.tags import SEQITEM, SEQS_PASSED
+from crumbs.iterutils import group_in_packets
+from crumbs.settings import get_setting
+
+# pylint: disable=C0111
+
+READ_LEN = 100
+ERROR_RATE = 0.02
+
+
+def _add_errors(str_seq):
+    return ''.join(choice('ACGT') if random() < ERROR_RATE else nucl
+                   for nucl in str_seq)
+
+
+def _simulate_reads(num_reads, adapters):
+    'It returns the reads and the length that they should have once trimmed'
+    reads, expected_lens = [], []
+    for index in range(num_reads):
+        str_seq = ''.join(choice('ACGT') for _ in range(READ_LEN))
+        if index % 2:
+            insert_len = randint(20, READ_LEN - 5)
+            str_seq = str_seq[:insert_len] + _add_errors(choice(adapters))
+            str_seq = str_seq[:READ_LEN]
+        else:
+            insert_len = READ_LEN
+        name = 'read%d' % index
+        lines = ['@%s\n' % name, str_seq + '\n', '+\n',
+                 'I' * len(str_seq) + '\n']
+        reads.append(SeqWrapper(SEQITEM, SeqItem(name, lines), 'fastq'))
+        expected_lens.append(insert_len)
+    return reads, expected_lens
+
+
+def _time_trimmer(trimmer, reads, expected_lens):
+    'It returns the reads trimmed by second and the well trimmed fraction'
+    trim_or_mask = TrimOrMask()
+    packets = seq_to_trim_packets(group_in_packets(reads,
+                                                   get_setting('PACKET_SIZE')))
+    start = time.time()
+    trimmed_lens = {}
+    for packet in packets:
+        packet = trim_or_mask(trimmer(packet))
+        for seqs in packet[SEQS_PASSED]:
+            trimmed_lens[seqs[0].object.name] = len(seqs[0].object.lines[1]) - 1
+    elapsed = time.time() - start
+    well_trimmed = 0
+    for read, expected_len in zip(reads, expected_lens):
+        if trimmed_lens.get(read.object.name, 0) == expected_len:
+            well_trimmed += 1
+    return len(reads) / elapsed, well_trimmed / float(len(reads))
+
+
+def benchmark_adapter_trimming(out_fhand, num_reads=10000):
+    seed(42)
+    adapters = get_setting('NEXTERA_ADAPTERS')
+    reads, expected_lens = _simulate_reads(num_reads, adapters)
+    oligos = [SeqWrapper(SEQITEM, SeqItem('oligo%d' % index,
+                                          ['>oligo%d\n' % index,
+                                           adapter + '\n']), 'fasta')
+              for index, adapter in enumerate(adapters)]
+    out_fhand.write('trimmer\treads/s\twell trimmed\n')
+    for name, trimmer in (('native', TrimAdapters(oligos)),
+                          ('blast', TrimNexteraAdapters(oligos))):
+        try:
+            reads_by_sec, well_trimmed = _time_trimmer(trimmer, reads,
+                                                       expected_lens)
+        except Exception as error:
+            out_fhand.write('%s\t-\t-\t(%s)\n' % (name, error))
+            continue
+        out_fhand.write('%s\t%.0f\t%.3f\n' % (name, reads_by_sec,
+                                               well_trimmed))
+    out_fhand.flush()
+
+
+if __name__ == '__main__':
+    benchmark_adapter_trimming(sys.stdout,
+                            num_reads=int(sys.argv[1]) if len(sys.argv) > 1
+                            else 10000)
@@ -0,0 +1,104 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of ngs_crumbs.
+# ngs_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# ngs_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with ngs_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+'''It measures the startup time of the command line tools.
+
+For every script in bin it times the --help call and, for the sequence
+scripts that only require an input file, a run with 10 reads.
+It is not a test, run it as: python test/benchmark_startup.py [repeats]
+'''
+
+import os
+import sys
+import time
+from os.path import join, basename
+from random import choice, randint
+from subprocess import call
+from tempfile import NamedTemporaryFile
+
+from crumbs.utils.bin_utils import SEQ_BIN_DIR, BAM_BIN_DIR, VCF_BIN_DIR
+
+# pylint: disable=C0111
+
+NUM_READS = 10
+
+# the scripts run with the reads and the extra arguments they require
+SEQ_RUNS = {'calculate_stats': [], 'cat_seqs': [], 'count_seqs': [],
+            'filter_all_ns': [], 'filter_by_complexity': [],
+            'filter_by_length': [], 'filter_duplicates': [],
+            'guess_seq_format': [], 'orientate_transcripts': [],
+            'seq_head': [], 'trim_by_case': [], 'trim_edges': [],
+            'trim_quality': [], 'change_case': ['-a', 'upper'],
+            'convert_format': ['-f', 'fasta'],
+            'filter_by_quality': ['-q', '20'], 'sample_seqs': ['-n', '5']}
+
+
+def _write_reads(num_reads, length=100):
+    fhand = NamedTemporaryFile(suffix='.fastq')
+    for index in range(num_reads):
+        seq = ''.join(choice('ACGT') for _ in range(length))
+        qual = ''.join(chr(randint(53, 73)) for _ in range(length))
+        fhand.write('@read%d\n%s\n+\n%s\n' % (index, seq, qual))
+    fhand.flush()
+    return fhand
+
+
+def _time_cmd(cmd, repeats):
+    'It returns the best wall-clock time of the given command'
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeats):
+            start = time.time()
+            retcode = call(cmd, stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+            if retcode:
+                return None
+    return min(times)
+
+
+def _list_scripts():
+    for bin_dir in (SEQ_BIN_DIR, BAM_BIN_DIR, VCF_BIN_DIR):
+        for fname in sorted(os.listdir(bin_dir)):
+            fpath = join(bin_dir, fname)
+            if os.path.isfile(fpath) and os.access(fpath, os.X_OK):
+                yield fpath
+
+
+def benchmark_startup(out_fhand, repeats=3):
+    reads_fhand = _write_reads(NUM_READS)
+    out_fhand.write('script\thelp(s)\t%d reads(s)\n' % NUM_READS)
+    help_times = []
+    for script in _list_scripts():
+        name = basename(script)
+        help_time = _time_cmd([sys.executable, script, '--help'], repeats)
+        help_times.append(help_time)
+        run_time = None
+        if script.startswith(SEQ_BIN_DIR) and name in SEQ_RUNS:
+            cmd = [sys.executable, script] + SEQ_RUNS[name]
+            cmd.append(reads_fhand.name)
+            run_time = _time_cmd(cmd, repeats)
+        times = ['-' if time_ is None else '%.3f' % time_
+                 for time_ in (help_time, run_time)]
+        out_fhand.write('\t'.join([name] + times) + '\n')
+    help_times = [time_ for time_ in help_times if time_ is not None]
+    if help_times:
+        out_fhand.write('mean help time: %.3f\n' %
+                        (sum(help_times) / len(help_times)))
+    out_fhand.flush()
+
+
+if __name__ == '__main__':
+    benchmark_startup(sys.stdout,
+                      repeats=int(sys.argv[1]) if len(sys.argv) > 1 else 3)
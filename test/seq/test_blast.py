@@ -21,7 +21,8 @@ from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
 
 from crumbs.blast import (do_blast, BlasterForFewSubjects,
-                          get_or_create_blastdb, _blastdb_exists, Blaster)
+                          get_or_create_blastdb, _blastdb_exists, Blaster,
+                          blast_packets)
 from crumbs.utils.file_utils import TemporaryDir
 from crumbs.settings import get_setting
 from crumbs.utils.test_utils import TEST_DATA_DIR
@@ -149,6 +150,26 @@ class BlastMaterTest(unittest.TestCase):
 
 
 class BlasterTest(unittest.TestCase):
+    def test_blast_packets(self):
+        blastdb = os.path.join(TEST_DATA_DIR, 'blastdbs', 'arabidopsis_genes')
+        match = 'CCAAAGTACGGTCTCCCAAGCGGTCTCTTACCGGACACCGTCACCGATTTCACCCTCT'
+        seq = 'ATCATGTAGTTACACATGAACACACACATG' + match
+        seq1 = SeqWrapper(SEQRECORD, SeqRecord(Seq(seq), id='seq1'), None)
+        seq2 = SeqWrapper(SEQRECORD, SeqRecord(Seq(match), id='seq2'), None)
+        seq3 = SeqWrapper(SEQRECORD, SeqRecord(Seq('ACTGTTCAGTCG' * 4),
+                                               id='seq3'), None)
+        packets = [[seq1], [], [seq3, seq2], [seq3]]
+        for processes in (1, 2):
+            results = blast_packets(iter(packets), blastdb, 'blastn',
+                                    dbtype=NUCL, processes=processes)
+            results = list(results)
+            assert [packet for packet, _ in results] == packets
+            names = [[blast['query']['name'] for blast in blasts]
+                     for _, blasts in results]
+            assert names == [['seq1'], [], ['seq2'], []]
+            match = results[0][1][0]['matches'][0]
+            assert match['subject']['name'] == 'AT1G55265.1'
+
     def xtest_blaster(self):
         seq = 'GAGAAATTCCTTTGGAAGTTATTCCGTAGCATAAGAGCTGAAACTTCAGAGCAAGTTT'
         seq += 'TCATTGGGCAAAATGGGGGAACAACCTATCTTCAGCACTCGAGCTCATGTCTTCCAAATTGA'
@@ -0,0 +1,102 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of ngs_crumbs.
+# ngs_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# ngs_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with ngs_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=R0201
+# pylint: disable=R0904
+# pylint: disable=C0111
+
+import os
+import unittest
+from tempfile import NamedTemporaryFile
+from StringIO import StringIO
+
+from crumbs.seq.fasta_index import (FastaReference, index_fasta, read_fai,
+                                    get_fasta_lengths)
+from crumbs.exceptions import MalformedFile
+from crumbs.utils.file_utils import TemporaryDir
+
+FASTA = '>seq1 desc\nACTGA\nACCTT\nGG\n>seq2\nGGTT\n\n>seq3\r\nACG\r\nT\r\n'
+FASTA += '>seq4\n'
+
+
+def _make_fasta(content):
+    fhand = NamedTemporaryFile(suffix='.fasta')
+    fhand.write(content)
+    fhand.flush()
+    return fhand
+
+
+class FastaReferenceTest(unittest.TestCase):
+    def test_index(self):
+        fhand = _make_fasta(FASTA)
+        index = index_fasta(fhand.name)
+        assert index.keys() == ['seq1', 'seq2', 'seq3', 'seq4']
+        assert index['seq1'] == (12, 11, 5, 6)
+        assert index['seq2'] == (4, 32, 4, 5)
+        assert index['seq3'] == (4, 45, 3, 5)
+        assert index['seq4'].length == 0
+
+        fhand = _make_fasta('>seq1\nACTG\nACTGA\nA\n')
+        try:
+            index_fasta(fhand.name)
+            self.fail('MalformedFile expected')
+        except MalformedFile:
+            pass
+
+    def test_fetch(self):
+        fhand = _make_fasta(FASTA)
+        with TemporaryDir() as fai_dir:
+            fai_fpath = os.path.join(fai_dir.name, 'ref.fasta.fai')
+            ref = FastaReference(fhand.name, fai_fpath=fai_fpath)
+            assert os.path.exists(fai_fpath)
+            assert read_fai(open(fai_fpath)) == index_fasta(fhand.name)
+            assert ref.lengths == {'seq1': 12, 'seq2': 4, 'seq3': 4,
+                                   'seq4': 0}
+            assert ref.length('seq2') == 4
+            assert 'seq1' in ref
+            assert 'seq5' not in ref
+
+            seq1 = 'ACTGAACCTTGG'
+            for start in range(-2, 14):
+                for end in range(start, 14):
+                    assert ref.fetch('seq1', start, end) == seq1[max(start, 0):
+                                                                 max(end, 0)]
+            assert ref.fetch('seq1') == seq1
+            assert ref.fetch('seq3', 2) == 'GT'
+            assert ref.fetch('seq4') == ''
+            ref.close()
+
+            # the index is reused
+            ref = FastaReference(fhand.name, fai_fpath=fai_fpath)
+            assert ref.fetch('seq2', 1, 3) == 'GT'
+            assert not os.path.exists(fhand.name + '.fai')
+
+    def test_lengths(self):
+        fhand = _make_fasta(FASTA)
+        fai_fpath = NamedTemporaryFile(suffix='.fai').name
+        try:
+            ref = FastaReference(fhand.name, fai_fpath=fai_fpath)
+            assert ref.names == ['seq1', 'seq2', 'seq3', 'seq4']
+            assert get_fasta_lengths(open(fhand.name)) == ref.lengths
+        finally:
+            os.remove(fai_fpath)
+            os.remove(fhand.name + '.fai')
+
+        fhand = StringIO('>seq1\nACTG\nAC\n>seq2\nA\n')
+        assert get_fasta_lengths(fhand) == {'seq1': 6, 'seq2': 1}
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'FastaReferenceTest.test_fetch']
+    unittest.main()
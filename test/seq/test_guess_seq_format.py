@@ -20,7 +20,8 @@ from tempfile import NamedTemporaryFile
 from StringIO import StringIO
 
 from crumbs.utils.bin_utils import SEQ_BIN_DIR
-from crumbs.seq.utils.file_formats import get_format, _guess_format
+from crumbs.seq.utils.file_formats import (get_format, _guess_format,
+                                          _FORMATS_BY_FILE)
 from crumbs.exceptions import (UnknownFormatError, FileIsEmptyError,
                                UndecidedFastqVersionError)
 
@@ -191,6 +192,32 @@ GAAGGATCGATCGGCCTCGGCGGTGTTCCCAAAAATCTAAGAGCGTTTACTCCAAGCTTC''')
         fhand = StringIO(txt)
         assert _guess_format(fhand, True) == 'fastq'
 
+    def test_big_illumina(self):
+        'Only the complete reads found in the peeked chunk are used'
+        read = '@read\n' + 'T' * 100 + '\n+\n' + 'h' * 100 + '\n'
+        fhand = StringIO(read * 1000)
+        assert get_format(fhand) == 'fastq-illumina'
+
+    def test_format_cache(self):
+        'The format of a file is not guessed again for every fhand'
+        fhand = NamedTemporaryFile(suffix='.fastq')
+        fhand.write('@seq\nACTG\n+\n0000\n')
+        fhand.flush()
+        assert get_format(fhand) == 'fastq'
+        fpaths = [key[0] for key in _FORMATS_BY_FILE]
+        assert fpaths.count(os.path.realpath(fhand.name)) == 1
+
+        assert get_format(open(fhand.name)) == 'fastq'
+        fpaths = [key[0] for key in _FORMATS_BY_FILE]
+        assert fpaths.count(os.path.realpath(fhand.name)) == 1
+
+        # if the file changes the format is guessed again
+        fhand.write('@seq2\nACTG\n+\n0000\n')
+        fhand.flush()
+        assert get_format(open(fhand.name)) == 'fastq'
+        fpaths = [key[0] for key in _FORMATS_BY_FILE]
+        assert fpaths.count(os.path.realpath(fhand.name)) == 2
+
 if __name__ == '__main__':
     #import sys;sys.argv = ['', 'SffExtractTest.test_items_in_gff']
     unittest.main()
@@ -21,12 +21,14 @@ from tempfile import NamedTemporaryFile
 
 from crumbs.seq.mate_chimeras import (classify_mapped_reads, classify_chimeras,
                                       calculate_distance_distribution,
-    calculate_distance_distribution_in_bam)
+    calculate_distance_distribution_in_bam, classify_mapped_sam_stream,
+    _sample_pairs)
 from crumbs.utils.bin_utils import SEQ_BIN_DIR, BAM_BIN_DIR
 from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.utils.tags import NON_CHIMERIC, CHIMERA, UNKNOWN
 from crumbs.seq.seq import get_name
 from crumbs.mapping import map_with_bwamem, map_process_to_sortedbam
+from crumbs.utils.optional_modules import AlignmentFile
 
 
 class FilterByMappingType(unittest.TestCase):
@@ -63,6 +65,27 @@ class FilterByMappingType(unittest.TestCase):
             else:
                 self.fail()
 
+    def test_classify_sam_stream(self):
+        bam_fpath = os.path.join(TEST_DATA_DIR, 'pair_distance.bam')
+        bam = AlignmentFile(bam_fpath)
+        sam_fhand = NamedTemporaryFile(suffix='.sam')
+        sam = AlignmentFile(sam_fhand.name, 'wh', template=bam)
+        for aligned_read in bam:
+            sam.write(aligned_read)
+        sam.close()
+
+        result = list(classify_mapped_reads(open(bam_fpath),
+                                            mate_distance=2000))
+        kinds = [(get_name(pair[0]), kind) for pair, kind in result]
+        assert kinds == [('seq1 1:N:0:GATCAG', NON_CHIMERIC),
+                         ('seq2 1:N:0:GATCAG', CHIMERA),
+                         ('seq3 1:N:0:GATCAG', UNKNOWN)]
+        for processes in (1, 2):
+            stream_result = classify_mapped_sam_stream(open(sam_fhand.name),
+                                                       mate_distance=2000,
+                                                       processes=processes)
+            assert list(stream_result) == result
+
     def test_filter_chimeras(self):
         index_fpath = os.path.join(TEST_DATA_DIR, 'ref_example.fasta')
         # Non chimeric
@@ -152,6 +175,13 @@ class DrawDistanceDistribution(unittest.TestCase):
         assert stats['outies'][1776] == 1
         assert stats['innies'][82] == 1
         assert stats['others'][1417] == 1
+
+        # only a sample of the pairs is mapped
+        stats = calculate_distance_distribution(in_fhand, index_fpath,
+                                                max_clipping=0.05,
+                                                sample_size=2, random_seed=1)
+        assert sum(sum(counts.values()) for counts in stats.values()) == 2
+
         bam_fhand = open(os.path.join(TEST_DATA_DIR, 'pair_distance.bam'))
         stats = calculate_distance_distribution_in_bam(bam_fhand,
                                                        max_clipping=0.05)
@@ -160,6 +190,30 @@ class DrawDistanceDistribution(unittest.TestCase):
         assert stats['innies'][82] == 1
         assert stats['others'][1417] == 1
 
+    def test_sample_pairs(self):
+        seqs = ''
+        for index in range(10):
+            seqs += '>seq{0} 1:N:0:GATCAG\nACTG\n'.format(index)
+            seqs += '>seq{0} 2:N:0:GATCAG\nACTG\n'.format(index)
+        in_fhand = NamedTemporaryFile()
+        in_fhand.write(seqs)
+        in_fhand.flush()
+
+        sample_fhand = _sample_pairs(open(in_fhand.name), 3, random_seed=1)
+        sampled = open(sample_fhand.name).read()
+        names = [line for line in sampled.splitlines() if line[0] == '>']
+        assert len(names) == 6
+        # the mates are kept together
+        assert names[0].split()[0] == names[1].split()[0]
+        # the same seed yields the same sample
+        sample_fhand2 = _sample_pairs(open(in_fhand.name), 3,
+                                      random_seed=1)
+        assert open(sample_fhand2.name).read() == sampled
+
+        # not enough pairs
+        in_fhand = open(in_fhand.name)
+        assert _sample_pairs(in_fhand, 11) is in_fhand
+
     def test_draw_distance_distribution_bin(self):
         index_fpath = os.path.join(TEST_DATA_DIR, 'ref_example.fasta')
         # Non chimeric
@@ -24,7 +24,8 @@ from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
 
 from crumbs.seq.pairs import (match_pairs, interleave_pairs,
-                              deinterleave_pairs,
+                              deinterleave_pairs, interleave_pairs_threaded,
+                              deinterleave_pairs_threaded,
                               group_pairs, group_pairs_by_name,
                               _parse_pair_direction_and_name_from_title,
                               _parse_pair_direction_and_name)
@@ -33,7 +34,7 @@ from crumbs.utils.tags import FWD, SEQRECORD, SEQITEM
 from crumbs.utils.bin_utils import SEQ_BIN_DIR
 from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.seq.seq import get_str_seq
-from crumbs.seq.seqio import read_seqs, assing_kind_to_seqs
+from crumbs.seq.seqio import read_seqs, assing_kind_to_seqs, write_seqs
 from crumbs.exceptions import (InterleaveError, PairDirectionError,
                                ItemsNotSortedError)
 from crumbs.seq.seq import SeqWrapper, SeqItem
@@ -289,6 +290,45 @@ CCCFFFFFGHH
         assert '@seq7:136:FC706VJ:2:2104:15343:197393.hhhh' in orp
         assert '@seq2:136:FC706VJ:2:2104:15343:197393 2:Y:18:ATCAC' in orp
 
+    def test_match_pairs_by_hash(self):
+        'It matches unordered pairs without sorting them'
+        file1 = os.path.join(TEST_DATA_DIR, 'pairend1.sfastq')
+        file2 = os.path.join(TEST_DATA_DIR, 'pairend2_unordered.sfastq')
+        fhand = NamedTemporaryFile()
+        fhand.write(open(file1).read())
+        fhand.write(open(file2).read())
+        fhand.flush()
+
+        def _split_reads(fhand, lines_per_item=4):
+            lines = fhand.getvalue().splitlines()
+            return set('\n'.join(lines[idx: idx + lines_per_item])
+                       for idx in range(0, len(lines), lines_per_item))
+
+        out_fhand = StringIO()
+        orphan_out_fhand = StringIO()
+        match_pairs(read_seqs([open(fhand.name)]), out_fhand,
+                    orphan_out_fhand, 'fastq', ordered=False)
+        expected_pairs = _split_reads(out_fhand, lines_per_item=8)
+        expected_orphans = _split_reads(orphan_out_fhand)
+
+        # all unmatched reads in memory
+        out_fhand = StringIO()
+        orphan_out_fhand = StringIO()
+        match_pairs(read_seqs([open(fhand.name)]), out_fhand,
+                    orphan_out_fhand, 'fastq', ordered=False,
+                    group_by_hash=True)
+        assert _split_reads(out_fhand, lines_per_item=8) == expected_pairs
+        assert _split_reads(orphan_out_fhand) == expected_orphans
+
+        # the unmatched reads go to disk
+        out_fhand = StringIO()
+        orphan_out_fhand = StringIO()
+        match_pairs(read_seqs([open(fhand.name)]), out_fhand,
+                    orphan_out_fhand, 'fastq', ordered=False,
+                    group_by_hash=True, max_reads_memory=2)
+        assert _split_reads(out_fhand, lines_per_item=8) == expected_pairs
+        assert _split_reads(orphan_out_fhand) == expected_orphans
+
     def test_pair_direction_and_name(self):
         'it test the pair_name parser'
         title = 'seq8:136:FC706VJ:2:2104:15343:197393 1:Y:18:ATCACG'
@@ -374,6 +414,20 @@ class PairMatcherbinTest(unittest.TestCase):
         orp = open(orphan_fhand.name).read()
         assert '@seq8:136:FC706VJ:2:2104:15343:197393 2:Y:18:ATCACG' in orp
 
+        # unordered file grouped by hash
+        out_fhand = NamedTemporaryFile()
+        orphan_fhand = NamedTemporaryFile()
+        check_output([pair_matcher_bin, '-o', out_fhand.name,
+                      '-p', orphan_fhand.name, in_fpath, '-u',
+                      '--group_by_hash', '--limit', '2'])
+
+        result = open(out_fhand.name).read()
+        assert '@seq1:136:FC706VJ:2:2104:15343:197393 1:Y:18:ATCACG' in result
+        assert '@seq1:136:FC706VJ:2:2104:15343:197393 2:Y:18:ATCACG' in result
+
+        orp = open(orphan_fhand.name).read()
+        assert '@seq8:136:FC706VJ:2:2104:15343:197393 2:Y:18:ATCACG' in orp
+
 
 class InterleavePairsTest(unittest.TestCase):
     'It tests the interleaving and de-interleaving of pairs'
@@ -420,6 +474,47 @@ class InterleavePairsTest(unittest.TestCase):
         assert result1.strip() == open(fhand1).read().strip()
         assert result2.strip() == open(fhand2).read().strip()
 
+    def test_threaded_interleave(self):
+        'It interleaves and deinterleaves reading and writing in threads'
+        fpath1 = os.path.join(TEST_DATA_DIR, 'pairend1.sfastq')
+        fpath2 = os.path.join(TEST_DATA_DIR, 'pairend1b.sfastq')
+        fwd_seqs = read_seqs([open(fpath1)], 'fastq')
+        rev_seqs = read_seqs([open(fpath2)], 'fastq')
+        expected = StringIO()
+        write_seqs(interleave_pairs(fwd_seqs, rev_seqs), expected)
+
+        fwd_seqs = read_seqs([open(fpath1)], 'fastq')
+        rev_seqs = read_seqs([open(fpath2)], 'fastq')
+        out_fhand = StringIO()
+        interleave_pairs_threaded(fwd_seqs, rev_seqs, out_fhand,
+                                  packet_size=3)
+        assert out_fhand.getvalue() == expected.getvalue()
+
+        seqs = read_seqs([StringIO(out_fhand.getvalue())], 'fastq')
+        out_fhand1 = StringIO()
+        out_fhand2 = StringIO()
+        deinterleave_pairs_threaded(seqs, out_fhand1, out_fhand2, 'fastq',
+                                    packet_size=3)
+        assert out_fhand1.getvalue() == open(fpath1).read()
+        assert out_fhand2.getvalue() == open(fpath2).read()
+
+        # the names do not match
+        fpath2 = os.path.join(TEST_DATA_DIR, 'pairend2.sfastq')
+        fwd_seqs = read_seqs([open(fpath1)], 'fastq')
+        rev_seqs = read_seqs([open(fpath2)], 'fastq')
+        try:
+            interleave_pairs_threaded(fwd_seqs, rev_seqs, StringIO())
+            self.fail('InterleaveError expected')
+        except InterleaveError:
+            pass
+
+        fwd_seqs = read_seqs([open(fpath1)], 'fastq')
+        rev_seqs = read_seqs([open(fpath2)], 'fastq')
+        out_fhand = StringIO()
+        interleave_pairs_threaded(fwd_seqs, rev_seqs, out_fhand,
+                                  skip_checks=True)
+        assert out_fhand.getvalue().count('@seq') == 8
+
 
 class InterleaveBinTest(unittest.TestCase):
     'test of the interleave and deinterleave'
@@ -456,6 +551,17 @@ class InterleaveBinTest(unittest.TestCase):
         assert open(in_fpath1).read() == BgzfReader(out_fhand1.name).read(2000)
         assert open(in_fpath2).read() == BgzfReader(out_fhand2.name).read(2000)
 
+        # threaded
+        out_fhand = NamedTemporaryFile()
+        check_output([interleave_bin, '-o', out_fhand.name, '--threaded',
+                      in_fpath1, in_fpath2])
+        out_fhand1 = NamedTemporaryFile()
+        out_fhand2 = NamedTemporaryFile()
+        check_output([deinterleave_bin, '-o', out_fhand1.name, out_fhand2.name,
+                      '--threaded', out_fhand.name])
+        assert open(in_fpath1).read() == open(out_fhand1.name).read()
+        assert open(in_fpath2).read() == open(out_fhand2.name).read()
+
         # skip checks
         in_fpath1 = os.path.join(TEST_DATA_DIR, 'pairend1.sfastq')
         in_fpath2 = os.path.join(TEST_DATA_DIR, 'pairend2.sfastq')
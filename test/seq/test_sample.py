@@ -0,0 +1,108 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of ngs_crumbs.
+# ngs_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# ngs_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with ngs_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=R0201
+# pylint: disable=R0904
+# pylint: disable=C0111
+
+import os
+import unittest
+from tempfile import NamedTemporaryFile
+
+from Bio.bgzf import BgzfWriter
+
+from crumbs.seq.sample import sample_seqs_by_offset, write_offset_index
+from crumbs.seq.seq import get_name, get_str_seq
+from crumbs.exceptions import SampleSizeError
+
+FASTA = '>seq1\nACTG\nAACC\n>seq2\nGGTT\n>seq3\nACGT\nA\n'
+FASTQ = '@seq1\nACTG\n+\n5555\n@seq2\nGGT\nT\n+\n@55\n5\n@seq3\nAC\n+\n55\n'
+
+
+def _make_file(content, bgzf=False):
+    fhand = NamedTemporaryFile(suffix='.gz' if bgzf else '.txt')
+    if bgzf:
+        writer = BgzfWriter(fhand.name, 'wb')
+        writer.write(content)
+        writer.close()
+    else:
+        fhand.write(content)
+        fhand.flush()
+    return fhand
+
+
+class OffsetSampleTest(unittest.TestCase):
+    def test_offset_index(self):
+        fhand = _make_file(FASTA)
+        index_fhand = NamedTemporaryFile()
+        assert write_offset_index(fhand.name, index_fhand) == 3
+
+        fhand = _make_file(FASTQ)
+        index_fhand = NamedTemporaryFile()
+        assert write_offset_index(fhand.name, index_fhand) == 3
+
+    def test_sample_fasta(self):
+        fhand = _make_file(FASTA)
+        seqs = list(sample_seqs_by_offset([fhand.name], 3))
+        assert [get_name(seq) for seq in seqs] == ['seq1', 'seq2', 'seq3']
+        assert get_str_seq(seqs[0]) == 'ACTGAACC'
+        assert get_str_seq(seqs[2]) == 'ACGTA'
+
+        seqs = list(sample_seqs_by_offset([fhand.name], 2))
+        assert len(seqs) == 2
+
+        try:
+            list(sample_seqs_by_offset([fhand.name], 4))
+            self.fail('SampleSizeError expected')
+        except SampleSizeError:
+            pass
+
+    def test_sample_fastq(self):
+        fhand = _make_file(FASTQ)
+        seqs = list(sample_seqs_by_offset([fhand.name], 3))
+        assert [get_name(seq) for seq in seqs] == ['seq1', 'seq2', 'seq3']
+        assert seqs[1].object.lines == ['@seq2\n', 'GGTT\n', '+\n',
+                                        '@555\n']
+        assert seqs[1].file_format == 'fastq'
+
+    def test_sample_bgzf(self):
+        fhand = _make_file(FASTQ, bgzf=True)
+        seqs = list(sample_seqs_by_offset([fhand.name], 3))
+        assert [get_name(seq) for seq in seqs] == ['seq1', 'seq2', 'seq3']
+
+    def test_several_files_and_index(self):
+        fhand1 = _make_file(FASTA)
+        fhand2 = _make_file(FASTA.replace('seq', 'read'))
+        index_fpaths = [fhand1.name + '.offsets', fhand2.name + '.offsets']
+        try:
+            seqs = sample_seqs_by_offset([fhand1.name, fhand2.name], 6,
+                                         index_fpaths=index_fpaths)
+            names = [get_name(seq) for seq in seqs]
+            assert names == ['seq1', 'seq2', 'seq3', 'read1', 'read2',
+                             'read3']
+            assert os.path.getsize(index_fpaths[0]) > 0
+
+            # the index is reused
+            seqs = sample_seqs_by_offset([fhand1.name, fhand2.name], 4,
+                                         index_fpaths=index_fpaths)
+            assert len(list(seqs)) == 4
+        finally:
+            for index_fpath in index_fpaths:
+                if os.path.exists(index_fpath):
+                    os.remove(index_fpath)
+
+if __name__ == '__main__':
+    # import sys;sys.argv = ['', 'OffsetSampleTest']
+    unittest.main()
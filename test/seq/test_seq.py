@@ -18,10 +18,14 @@
 # pylint: disable=C0111
 
 import unittest
+import pickle
+from tempfile import NamedTemporaryFile
 
 from crumbs.seq.seq import (get_length, get_str_seq, get_int_qualities,
                             get_str_qualities, slice_seq, copy_seq, SeqItem,
-                            SeqWrapper)
+                            SeqWrapper, FeatureTable, get_feature_table,
+                            reverse_complement_seq)
+from crumbs.seq.seqio import read_seqs
 from crumbs.utils.tags import SEQITEM, ILLUMINA_QUALITY
 
 
@@ -180,6 +184,59 @@ class SeqMethodsTest(unittest.TestCase):
         assert seq.object == ('seq2', ['>seq2\n', 'aaaa\n'],
                               {})
 
+    def test_reverse_complement(self):
+        seq = SeqItem(name='seq', lines=['@seq\n', 'aaCTN\n', '+\n',
+                                         '!?!?5\n'])
+        seq = SeqWrapper(SEQITEM, seq, 'fastq')
+        get_feature_table(seq).add('ORF', 1, 3, 1)
+        rev_seq = reverse_complement_seq(seq)
+        assert rev_seq.object.lines == ['@seq\n', 'NAGtt\n', '+\n',
+                                        '5?!?!\n']
+        table = get_feature_table(rev_seq)
+        assert list(table.starts) == [2]
+        assert list(table.ends) == [4]
+        assert list(table.strands) == [-1]
+        assert list(get_feature_table(seq).strands) == [1]
+
+        # a multi-line fasta is written in one line
+        fhand = NamedTemporaryFile(suffix='.fasta')
+        fhand.write('>seq1 desc\nACGT\nAACC\nGG\n>seq2\nTTTT\n')
+        fhand.flush()
+        seqs = list(read_seqs([open(fhand.name)],
+                              prefered_seq_classes=[SEQITEM]))
+        rev_seqs = [reverse_complement_seq(seq) for seq in seqs]
+        assert rev_seqs[0].object.lines == ['>seq1 desc\n', 'CCGGTTACGT\n']
+        assert rev_seqs[1].object.lines == ['>seq2\n', 'AAAA\n']
+
+
+class FeatureTableTest(unittest.TestCase):
+    def test_feature_table(self):
+        table = FeatureTable()
+        table.add('polyA_sequence', 10, 20, -1)
+        table.add('match_part', 0, 5, 1, score=1e-20, source='db1')
+        table.add('match_part', 2, 5, 1, score=1e-10, source='db2')
+        assert len(table) == 3
+        assert table.types == ['polyA_sequence', 'match_part', 'match_part']
+        assert table.select('match_part') == [1, 2]
+        assert table.select('match_part', source='db2') == [2]
+        assert not table.select('ORF')
+        try:
+            table.add('gene', 1, 2)
+            self.fail('ValueError expected')
+        except ValueError:
+            pass
+
+        table2 = FeatureTable()
+        table2.add('ORF', 3, 9)
+        table2.extend(table)
+        assert table2.types == ['ORF'] + table.types
+        assert table2.sources == [None, None, 'db1', 'db2']
+
+        table2 = pickle.loads(pickle.dumps(table, pickle.HIGHEST_PROTOCOL))
+        assert list(table2.scores)[1:] == list(table.scores)[1:]
+        assert table2.sources == table.sources
+
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'SeqMethodsTest.test_int_qualities']
     unittest.main()
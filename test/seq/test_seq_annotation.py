@@ -22,7 +22,8 @@ from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 
 from crumbs.seq.annotation import (EstscanOrfAnnotator, _detect_polya_tail,
-                                   PolyaAnnotator, BlastAnnotator)
+                                   PolyaAnnotator, BlastAnnotator,
+                                   detect_polya_tails)
 from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.seq.seqio import read_seqs
 from crumbs.seq.seq import SeqWrapper
@@ -123,6 +124,18 @@ class AnnotationTest(unittest.TestCase):
         seq = 'TTTTT'
         assert _detect_polya_tail(seq, FIVE_PRIME, 2, 0) == (0, 5)
 
+        # all seqs at once
+        seqs = ['TTTTcTTcAAnAA', 'ccccc', '', 'TTTTTccccAAAA', 'GTtTTn' * 20]
+        starts, ends, strands = detect_polya_tails(seqs, 2, 1)
+        assert list(starts) == [0, 0, 0, 0, 0]
+        assert list(ends) == [7, 0, 0, 5, 120]
+        assert list(strands) == [-1, 0, 0, -1, -1]
+        seqs = ['GTtTTn' * 20]
+        starts, ends, strands = detect_polya_tails(seqs, 2, 0)
+        assert list(ends) == [0]
+        starts, ends, strands = detect_polya_tails([], 2, 0)
+        assert not len(strands)
+
     def test_blast_annotator(self):
         'It finds the seq direction looking to a blast result'
         blastdb = os.path.join(TEST_DATA_DIR, 'blastdbs', 'arabidopsis_genes')
@@ -176,6 +189,25 @@ class AnnotationTest(unittest.TestCase):
         assert len(seq2.object.features) == 1
         assert len(seq3.object.features) == 0
 
+        # a stream of packets is annotated like packet by packet
+        def _features(seqs):
+            return [[(feat.location.start.position, feat.location.end.position,
+                      feat.strand, feat.qualifiers['Target'])
+                     for feat in seq.object.features] for seq in seqs]
+
+        def _packets():
+            seqs = [seq1.object, seq2.object, seq3.object]
+            seqs = [_wrap_seq(SeqRecord(seq=seq.seq, id=seq.id))
+                    for seq in seqs]
+            return [seqs[:2], [], seqs[2:], seqs[1:]]
+
+        expected = [_features(annotator(packet)) for packet in _packets()]
+        for processes in (1, 2):
+            packets = annotator.annotate_packets(_packets(),
+                                                 processes=processes,
+                                                 threads=1)
+            assert [_features(packet) for packet in packets] == expected
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
@@ -39,7 +39,8 @@ from crumbs.utils.bin_utils import SEQ_BIN_DIR
 from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.utils.tags import (NUCL, SEQS_FILTERED_OUT, SEQS_PASSED, SEQITEM,
                                SEQRECORD)
-from crumbs.seq.seq import get_name, get_str_seq, SeqWrapper
+from crumbs.seq.seq import (get_name, get_str_seq, SeqWrapper, SeqItem,
+                            get_feature_table)
 from crumbs.seq.seqio import read_seq_packets
 
 
@@ -315,6 +316,20 @@ class BlastMatchFilterTest(unittest.TestCase):
         assert filter_packets[SEQS_PASSED] == []
         assert len(filter_packets[SEQS_FILTERED_OUT]) == 1
 
+        # a stream of packets
+        seq2 = SeqWrapper(object=SeqRecord(Seq('ACTGTTCAGTCG' * 4), id='seq2'),
+                          kind=SEQRECORD, file_format=None)
+        packets = [seqs, {SEQS_PASSED: [[seq2]], SEQS_FILTERED_OUT: []}, seqs]
+        filters = [{'kind': 'score_threshold', 'score_key': 'expect',
+                    'max_score': 0.001},
+                   {'kind': 'min_length', 'min_percentage': 60,
+                    'length_in_query': True}]
+        filter_ = FilterBlastMatch(blastdb, 'blastn', filters=filters)
+        filter_packets = list(filter_.filter_packets(packets, processes=2))
+        passed = [packet[SEQS_PASSED] for packet in filter_packets]
+        assert passed == [[], [[seq2]], []]
+        assert filter_packets[2][SEQS_FILTERED_OUT] == [[seq1]]
+
     def test_filter_blast_bin(self):
         'It test the binary of the filter_by_blast'
         filter_bin = os.path.join(SEQ_BIN_DIR, 'filter_by_blast')
@@ -576,6 +591,27 @@ class FilterBowtie2Test(unittest.TestCase):
                 assert _seqs_to_names(filter_packets[SEQS_FILTERED_OUT]) == [
                                                     'read1', 'read2', 'read3']
 
+    @staticmethod
+    def test_filter_packets_by_bowtie2():
+        index_fpath = os.path.join(TEST_DATA_DIR, 'arabidopsis_genes')
+        fastq_fpath = os.path.join(TEST_DATA_DIR, 'arabidopsis_reads.fastq')
+        fasta_fpath = os.path.join(TEST_DATA_DIR, 'arabidopsis_reads.fasta')
+
+        for preffered_classes in [[SEQITEM], [SEQRECORD]]:
+            for reads_fpath in [fastq_fpath, fasta_fpath]:
+                seq_packets = read_seq_packets([open(reads_fpath)], size=1,
+                                       prefered_seq_classes=preffered_classes)
+                filter_packets = seq_to_filterpackets(seq_packets)
+                filter_ = FilterBowtie2Match(index_fpath)
+                filter_packets = list(filter_.filter_packets(filter_packets))
+                assert len(filter_packets) == 4
+                passed = [_seqs_to_names(packet[SEQS_PASSED])
+                          for packet in filter_packets]
+                assert passed == [[], [], [], ['no_arabi']]
+                filtered = [_seqs_to_names(packet[SEQS_FILTERED_OUT])
+                            for packet in filter_packets]
+                assert filtered == [['read1'], ['read2'], ['read3'], []]
+
     @staticmethod
     def test_filter_by_bowtie2_bin():
         filter_bin = os.path.join(SEQ_BIN_DIR, 'filter_by_bowtie2')
@@ -608,6 +644,19 @@ class FilterByFeatureTypeTest(unittest.TestCase):
         assert len(seqs[SEQS_FILTERED_OUT]) == 1
         assert len(seqs[SEQS_PASSED]) == 1
 
+        # with feature tables
+        seq1 = SeqWrapper(SEQITEM, SeqItem('seq1', ['>seq1\n', 'aaaa\n']),
+                          'fasta')
+        get_feature_table(seq1).add('ORF', 3, 4)
+        seq2 = SeqWrapper(SEQITEM, SeqItem('seq2', ['>seq2\n', 'aaaa\n']),
+                          'fasta')
+        get_feature_table(seq2).add('polyA_sequence', 3, 4)
+        seq3 = SeqWrapper(SEQITEM, SeqItem('seq3', ['>seq3\n', 'aaaa\n']),
+                          'fasta')
+        seqs = {SEQS_PASSED: [[seq1], [seq2], [seq3]], SEQS_FILTERED_OUT: []}
+        seqs = filter_(seqs)
+        assert [get_name(pair[0]) for pair in seqs[SEQS_PASSED]] == ['seq1']
+
 
 class NsFilterTest(unittest.TestCase):
     'It tests the filtering by N content'
@@ -17,6 +17,7 @@ import unittest
 import os.path
 from tempfile import NamedTemporaryFile
 from subprocess import check_output, CalledProcessError
+from cStringIO import StringIO
 
 from crumbs.seq.sff_extract import SffExtractor
 from crumbs.utils.test_utils import TEST_DATA_DIR
@@ -109,6 +110,27 @@ class SffExtractTest(unittest.TestCase):
         assert len(seqs) == 10
         assert not extractor.clip_advice[sff_fpath]
 
+    def test_write_in_parallel(self):
+        'It extracts several SFF files in parallel'
+        sff_fpath = os.path.join(TEST_DATA_DIR, '10_454_reads.sff')
+        sff_fhand2 = NamedTemporaryFile(suffix='.sff')
+        sff_fhand2.write(open(sff_fpath, 'rb').read())
+        sff_fhand2.flush()
+        results = []
+        for processes in (1, 2):
+            sff_fhands = [open(sff_fpath, 'rb'), open(sff_fhand2.name, 'rb')]
+            extractor = SffExtractor(sff_fhands, min_left_clip=4,
+                                     processes=processes)
+            out_fhand = StringIO()
+            xml_fhand = StringIO()
+            extractor.write(out_fhand, xml_fhand=xml_fhand)
+            assert out_fhand.getvalue().count('@E3MFGYR02JWQ7T\n') == 2
+            assert xml_fhand.getvalue().count('<trace_name>') == 20
+            assert extractor.clip_advice[sff_fpath] == (5, 'A')
+            assert extractor.clip_advice[sff_fhand2.name] == (5, 'A')
+            results.append((out_fhand.getvalue(), xml_fhand.getvalue()))
+        assert results[0] == results[1]
+
 
 class SffExtractBinTest(unittest.TestCase):
     'It tests the sff_extract binary'
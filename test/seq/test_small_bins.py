@@ -205,6 +205,22 @@ class SampleSeqTest(unittest.TestCase):
                               stdin=open(fasta_fhand.name))
         assert count_seqs(read_seqs([StringIO(result)]))['num_seqs'] == 2
 
+        # two pass sample
+        result = check_output([sample_seq, '-n', '2', '--two_pass',
+                               fasta_fhand.name])
+        assert count_seqs(read_seqs([StringIO(result)]))['num_seqs'] == 2
+
+        # two pass sample keeping the index
+        index_fpath = fasta_fhand.name + '.offsets'
+        try:
+            result = check_output([sample_seq, '-n', '3', '--keep_index',
+                                   fasta_fhand.name])
+            assert result == '>seq\nACTA\n>seq2\nACTA\n>seq3\nACTA\n'
+            assert os.path.exists(index_fpath)
+        finally:
+            if os.path.exists(index_fpath):
+                os.remove(index_fpath)
+
 if __name__ == '__main__':
     # import sys;sys.argv = ['', 'SampleSeqTest']
     unittest.main()
@@ -25,8 +25,8 @@ from crumbs.seq.transcript_orientations import TranscriptOrientator
 from crumbs.settings import get_setting
 from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.utils.bin_utils import SEQ_BIN_DIR
-from crumbs.utils.tags import SEQRECORD
-from crumbs.seq.seq import get_str_seq, SeqWrapper
+from crumbs.utils.tags import SEQRECORD, SEQITEM
+from crumbs.seq.seq import get_str_seq, SeqWrapper, SeqItem, get_feature_table
 from crumbs.seq.seqio import read_seqs
 
 POLYA_ANNOTATOR_MISMATCHES = get_setting('POLYA_ANNOTATOR_MISMATCHES')
@@ -132,6 +132,66 @@ class TestTranscriptomeOrientator(unittest.TestCase):
         rev_str_seq6 = str(seqs[6].object.seq.reverse_complement())
         assert get_str_seq(seq7) == rev_str_seq6
 
+    def test_orientate_packets(self):
+        'It orientates a stream of packets'
+        estscan_matrix = os.path.join(TEST_DATA_DIR,
+                                      'Arabidopsis_thaliana.smat')
+        str_seqs = ['atccgtcagcatcCAATAAAAA', 'TTTTcTTcatccgtcag',
+                    'cTTcatccgtcag']
+        packets = [[_wrap_seq(SeqRecord(seq=Seq(str_seq), id='seq%d' % idx))
+                    for idx, str_seq in enumerate(str_seqs)], []]
+        packets.append([_wrap_seq(SeqRecord(seq=Seq(str_seqs[1]), id='s'))])
+        polya_params = {'min_len': 4,
+                        'max_cont_mismatches': POLYA_ANNOTATOR_MISMATCHES}
+        orientator = TranscriptOrientator(polya_params,
+                                        {'usage_matrix': estscan_matrix})
+        for processes in (1, 2):
+            packets_ = list(orientator.orientate_packets(packets,
+                                                         processes=processes))
+            assert [len(seqs) for seqs in packets_] == [3, 0, 1]
+            seqs = packets_[0]
+            assert get_str_seq(seqs[0]) == str_seqs[0]
+            assert get_str_seq(seqs[1]) == 'ctgacggatgAAgAAAA'
+            assert 'polyA' in seqs[1].object.description
+            assert get_str_seq(seqs[2]) == str_seqs[2]
+            assert get_str_seq(packets_[2][0]) == 'ctgacggatgAAgAAAA'
+
+        # with SeqItems and feature tables
+        seqs = [SeqWrapper(SEQITEM, SeqItem('seq%d' % idx,
+                                            ['>seq%d\n' % idx, seq + '\n']),
+                           'fasta') for idx, seq in enumerate(str_seqs)]
+        seqs = orientator(seqs)
+        assert get_str_seq(seqs[0]) == str_seqs[0]
+        assert get_str_seq(seqs[1]) == 'ctgacggatgAAgAAAA'
+        assert seqs[1].object.lines[0] == \
+                                    '>seq1 (reversed because of: polyA)\n'
+        table = get_feature_table(seqs[1])
+        assert table.types == ['polyA_sequence']
+        assert list(table.starts) == [13]
+        assert list(table.strands) == [1]
+
+    def test_bin_orientate_seqitems_with_description(self):
+        'The description of the reversed seqs is kept in the title line'
+        orientate_bin = os.path.join(SEQ_BIN_DIR, 'orientate_transcripts')
+        fasta = '>seq1 a description\nTTTTcTTcatccgtcag\n'
+        fasta += '>seq2 other description\ncTTcatccgtcag\n'
+        fastq = '@seq1 a description\nTTTTcTTcatccgtcag\n+\n'
+        fastq += 'ABCDEFGHIJKLMNOPQ\n'
+        expected_fasta = '>seq1 a description(reversed because of: polyA)\n'
+        expected_fasta += 'ctgacggatgAAgAAAA\n'
+        expected_fasta += '>seq2 other description\ncTTcatccgtcag\n'
+        expected_fastq = '@seq1 a description(reversed because of: polyA)\n'
+        expected_fastq += 'ctgacggatgAAgAAAA\n+\nQPONMLKJIHGFEDCBA\n'
+        for seqs, expected in ((fasta, expected_fasta),
+                               (fastq, expected_fastq)):
+            in_fhand = NamedTemporaryFile()
+            in_fhand.write(seqs)
+            in_fhand.flush()
+            out_fhand = NamedTemporaryFile()
+            check_output([orientate_bin, in_fhand.name, '-o', out_fhand.name,
+                          '--polya_min_len', '4'])
+            assert open(out_fhand.name).read() == expected
+
     def test_bin_transcrip_orientator(self):
         'it tests the transcript orientator binary'
         orientate_bin = os.path.join(SEQ_BIN_DIR, 'orientate_transcripts')
@@ -24,10 +24,13 @@ from Bio.SeqRecord import SeqRecord
 
 from crumbs.seq.trim import (TrimLowercasedLetters, TrimEdges, TrimOrMask,
                              TrimByQuality, TrimWithBlastShort,
-                             seq_to_trim_packets, TrimMatePairChimeras)
+                             seq_to_trim_packets, TrimMatePairChimeras,
+                             _TrimSegments, TrimAdapters)
+from crumbs.seq.adapters import calc_adapter_free_regions
 from crumbs.utils.bin_utils import SEQ_BIN_DIR
 from crumbs.utils.tags import (SEQRECORD, SEQITEM, TRIMMING_RECOMMENDATIONS,
-                               VECTOR, ORPHAN_SEQS, SEQS_PASSED, OTHER)
+                               VECTOR, ORPHAN_SEQS, SEQS_PASSED, OTHER,
+                               FIVE_PRIME, THREE_PRIME, ANYWHERE)
 from crumbs.seq.seq import (get_str_seq, get_annotations, get_int_qualities,
                             get_name)
 from crumbs.seq.seqio import read_seq_packets, read_seqs
@@ -302,6 +305,19 @@ class TrimAndMaskTest(unittest.TestCase):
         trim_packet2[SEQS_PASSED][0][0]
         assert TRIMMING_RECOMMENDATIONS not in get_annotations(trim_packet2[SEQS_PASSED][0][0])
 
+    def test_trim_segments(self):
+        'The trimming segments of a packet are kept by seq index'
+        seqs = [SeqWrapper(SEQITEM, SeqItem('s%d' % len_, ['>s\n',
+                                                          'A' * len_ + '\n']),
+                           'fasta') for len_ in (10, 20)]
+        trim_segments = _TrimSegments(seqs)
+        trim_segments.add_segments(0, [(0, 2), (8, 9), (4, 5)])
+        trim_segments.trim_edges(1, 3)
+        assert trim_segments.get_segments(0) == [(0, 2), (7, 9), (4, 5)]
+        assert trim_segments.get_segments(1) == [(0, 0), (17, 19)]
+        assert list(trim_segments.starts) == [3, 1]
+        assert list(trim_segments.ends) == [7, 17]
+
 
 class TrimByQualityTest(unittest.TestCase):
     'It test the quality trimming'
@@ -492,9 +508,8 @@ class TrimBlastShortTest(unittest.TestCase):
         trim_packets = list(seq_to_trim_packets(seq_packets))
         trim_packets2 = blast_trim(trim_packets[0])
         # It should trim the first and the second reads.
-        res = [get_annotations(s).get(TRIMMING_RECOMMENDATIONS, {}).get(VECTOR,
-                                                                        [])
-                              for l in trim_packets2[SEQS_PASSED] for s in l]
+        trim_rec = trim_packets2[TRIMMING_RECOMMENDATIONS]
+        res = [trim_rec.get_segments(index) for index in range(3)]
         assert res == [[(0, 29)], [(0, 29)], []]
 
         # With SeqItems
@@ -514,9 +529,8 @@ class TrimBlastShortTest(unittest.TestCase):
         trim_packets = list(seq_to_trim_packets(seq_packets))
         trim_packets2 = blast_trim(trim_packets[0])
         # It should trim the first and the second reads.
-        res = [get_annotations(s).get(TRIMMING_RECOMMENDATIONS, {}).get(VECTOR,
-                                                                        [])
-                            for l in trim_packets2[SEQS_PASSED] for s in l]
+        trim_rec = trim_packets2[TRIMMING_RECOMMENDATIONS]
+        res = [trim_rec.get_segments(index) for index in range(3)]
         assert res == [[(0, 29)], [(0, 29)], []]
 
     def test_trim_oligos_bin(self):
@@ -552,9 +566,8 @@ class TrimChimericRegions(unittest.TestCase):
         trim_packets = list(seq_to_trim_packets(seq_packets))
         trim_packets2 = trim_chimeras(trim_packets[0])
         # It should trim the first and the second reads.
-        res = [get_annotations(s).get(TRIMMING_RECOMMENDATIONS, {}).get(OTHER,
-                                                                        [])
-                            for l in trim_packets2[SEQS_PASSED] for s in l]
+        trim_rec = trim_packets2[TRIMMING_RECOMMENDATIONS]
+        res = [trim_rec.get_segments(index) for index in range(2)]
         assert res == [[(49, 105)], []]
 
     def test_trim_chimeras_bin(self):
@@ -641,66 +654,80 @@ class TrimChimericRegions(unittest.TestCase):
 #                             for l in trim_packets2[SEQS_PASSED] for s in l]
 #         assert res == [[(39, 100)], [(47, 100)], [], [(42, 60)]]
 
-#     def test_trim_with_cutadapt(self):
-#         #TODO finish it by importing the cutadapt code or remove it
-#         in_fhand = NamedTemporaryFile(suffix='.fastq')
-#         in_fhand.write(FASTQ5)
-#         in_fhand.flush()
-#         out_fhand = NamedTemporaryFile()
-#         summary_fhand = NamedTemporaryFile()
-#
-#         oligos = {_3END: ['CTGTCTCTTATACACATCT', 'AGATGTGTATAAGAGACAG']}
-#         trim_with_cutadapt(in_fhand.name, out_fhand.name, oligos,
-#                            summary_fpath=summary_fhand.name)
-#         trimmed_reads = read_seqs([open(out_fhand.name)])
-#         read3 = 'GGAAGAGGAACAAGTGAGCAGCAGGACTGTATGATATTCTCATCTGAAGACAGGGACCATC'
-#         read3 += 'ATATTCCCCGGGAAACTCCGATGCCAGAGTATTAGCATGC'
-#         expected_seqs = ['TTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT', read3,
-#                          'AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA']
-#         for seq in trimmed_reads:
-#             assert get_str_seq(seq) in expected_seqs
-
-#     def xtest_trim_nextera_adapters_bin(self):
-#         'It tests the trim nextera adapters  binary'
-#          TODO finish it by importing the cutadapt code or remove it
-#         trim_bin = os.path.join(BIN_DIR, 'trim_nextera_adapters')
-#         assert 'usage' in check_output([trim_bin, '-h'])
-#
-#         with blast algorithm
-#         in_fhand = NamedTemporaryFile(suffix='.fastq')
-#         in_fhand.write(FASTQ5)
-#         in_fhand.flush()
-#         out_fhand = NamedTemporaryFile()
-#
-#         cmd = [trim_bin, in_fhand.name, '-o', out_fhand.name]
-#         check_output(cmd)
-#         trimmed_reads = read_seqs([open(out_fhand.name)])
-#         read3 = 'GGAAGAGGAACAAGTGAGCAGCAGGACTGTATGATATTCTCATCTGAAGACAGGGACCATC'
-#         read3 += 'ATATTCCCCGGGAAACTCCGATGCCAGAGTATTAGCATGC'
-#         last read should no be trimmed this way, but keep 5 As more
-#         expected_seqs = ['TTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT', read3,
-#                          'AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA',
-#                          'AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA']
-#         for seq in trimmed_reads:
-#             assert get_str_seq(seq) in expected_seqs
-#
-#         with cutadapt
-#         in_fhand = NamedTemporaryFile(suffix='.fastq')
-#         in_fhand.write(FASTQ5)
-#         in_fhand.flush()
-#         out_fhand = NamedTemporaryFile()
-#         summary_fhand = NamedTemporaryFile()
-#
-#         cmd = [trim_bin, in_fhand.name, '-o', out_fhand.name, '-c',
-#                '-s', summary_fhand.name]
-#         check_output(cmd)
-#         trimmed_reads = read_seqs([open(out_fhand.name)])
-#         read3 = 'GGAAGAGGAACAAGTGAGCAGCAGGACTGTATGATATTCTCATCTGAAGACAGGGACCATC'
-#         read3 += 'ATATTCCCCGGGAAACTCCGATGCCAGAGTATTAGCATGC'
-#         expected_seqs = ['TTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT', read3,
-#                          'AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA']
-#         for seq in trimmed_reads:
-#             assert get_str_seq(seq) in expected_seqs
+
+class TrimAdaptersTest(unittest.TestCase):
+    'It tests the native adapter trimming'
+    def test_adapter_regions(self):
+        'It finds the adapters with errors and partial at the seq ends'
+        adapter = 'CTGTCTCTTATACACATCT'
+        seqs = ['GGGG' + adapter + 'GGGG', 'GGGGCTGTCTCTTAcACACATCTGGGG',
+                'GGGGCTGTCTCTTATCACATCTGGG', 'GGGGCTGTCTCTATACACATCTGGG',
+                'GGGGGGGGCTGTCTC', 'TATACACATCTGGGG', 'GGGGGGGGGGGGGG']
+        starts, ends = calc_adapter_free_regions(seqs, adapter)
+        assert list(starts) == [0] * 7
+        assert list(ends) == [4, 4, 4, 4, 8, 15, 14]
+        starts, ends = calc_adapter_free_regions(seqs, adapter, mode=FIVE_PRIME)
+        assert list(starts) == [23, 23, 22, 22, 0, 11, 0]
+        assert list(ends) == [27, 27, 25, 25, 15, 15, 14]
+        starts, ends = calc_adapter_free_regions(seqs, adapter,
+                                                 mode=ANYWHERE)
+        assert list(starts) == [0, 0, 0, 0, 0, 11, 0]
+        assert list(ends) == [4, 4, 4, 4, 8, 15, 14]
+        # a complete adapter at the start is a 5' one
+        starts, ends = calc_adapter_free_regions([adapter + 'G' * 20,
+                                                  'TACACATCT' + 'G' * 20],
+                                                 adapter, mode=ANYWHERE)
+        assert list(starts) == [19, 9]
+        assert list(ends) == [39, 29]
+
+        # too many errors
+        starts, ends = calc_adapter_free_regions(seqs[:1], 'CTGTCAAAAATACA')
+        assert list(ends) == [27]
+        starts, ends = calc_adapter_free_regions(seqs[:1], 'CTGTCAAAAATACA',
+                                                 max_error_rate=0.5)
+        assert list(ends) == [4]
+        assert not calc_adapter_free_regions([], adapter)[0].size
+
+        # only empty seqs
+        for mode in (FIVE_PRIME, THREE_PRIME, ANYWHERE):
+            starts, ends = calc_adapter_free_regions(['', ''], adapter,
+                                                     mode=mode)
+            assert list(starts) == [0, 0]
+            assert list(ends) == [0, 0]
+
+    def test_nextera_trimming(self):
+        'It trims the Nextera adapters from the 3 prime end'
+        oligos = [SeqWrapper(SEQITEM, SeqItem('oligo1',
+                                              ['>oligo1\n', oligo + '\n']),
+                             'fasta') for oligo in ('CTGTCTCTTATACACATCT',
+                                                    'AGATGTGTATAAGAGACAG')]
+        trim_adapters = TrimAdapters(oligos=oligos)
+        fhand = StringIO(FASTQ5)
+        seq_packets = list(read_seq_packets([fhand],
+                                            prefered_seq_classes=[SEQITEM]))
+        trim_packets = list(seq_to_trim_packets(seq_packets))
+        trim_packets2 = trim_adapters(trim_packets[0])
+        trim_rec = trim_packets2[TRIMMING_RECOMMENDATIONS]
+        res = [trim_rec.get_segments(index) for index in range(4)]
+        assert res == [[(39, 100)], [(47, 100)], [], [(47, 60)]]
+
+    def test_trim_nextera_adapters_bin(self):
+        'It tests the trim nextera adapters binary'
+        trim_bin = os.path.join(SEQ_BIN_DIR, 'trim_nextera_adapters')
+        assert 'usage' in check_output([trim_bin, '-h'])
+
+        in_fhand = _make_fhand(FASTQ5)
+        result = check_output([trim_bin, in_fhand.name])
+        trimmed_reads = read_seqs([StringIO(result)])
+        read3 = 'GGAAGAGGAACAAGTGAGCAGCAGGACTGTATGATATTCTCATCTGAAGACAGGGACCATC'
+        read3 += 'ATATTCCCCGGGAAACTCCGATGCCAGAGTATTAGCATGC'
+        expected_seqs = ['T' * 39, 'A' * 47, read3, 'A' * 47]
+        assert [get_str_seq(seq) for seq in trimmed_reads] == expected_seqs
+
+        # only empty reads
+        in_fhand = _make_fhand('@r1\n\n+\n\n')
+        check_output([trim_bin, in_fhand.name])
+
 
 if __name__ == '__main__':
     # import sys; sys.argv = ['', 'TrimChimericRegions']
@@ -13,6 +13,7 @@
 # You should have received a copy of the GNU General Public License
 # along with ngs_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
+import random
 import unittest
 import tempfile
 
@@ -20,8 +21,9 @@ from crumbs.iterutils import (sample, sample_low_mem, length, group_in_packets,
                               rolling_window, group_in_packets_fill_last,
                               sorted_items, unique, unique_unordered,
                               generate_windows, PeekableIterator,
-                              RandomAccessIterator, RandomAccessChromIterator)
-from crumbs.exceptions import SampleSizeError
+                              RandomAccessIterator, RandomAccessChromIterator,
+                              RandomAccessRegionIterator, iter_in_thread)
+from crumbs.exceptions import SampleSizeError, ItemsNotSortedError
 from collections import namedtuple
 
 # pylint: disable=R0201
@@ -59,6 +61,11 @@ class IterutilsTest(unittest.TestCase):
         sampled_items = list(sample(range(1000), 5, in_disk=True))
         self.check_sampled_items(range(1000), sampled_items, 5)
 
+        # with a seed the sample is always the same
+        sampled_items = list(sample(range(1000), 5, random_seed=1))
+        self.check_sampled_items(range(1000), sampled_items, 5)
+        assert list(sample(range(1000), 5, random_seed=1)) == sampled_items
+
     def test_sample_low_mem(self):
         'We can sample an iterator'
         length_ = 100
@@ -177,6 +184,21 @@ class IterutilsTest(unittest.TestCase):
         unique_items = unique(_sorted_items, key=lambda x: x[1])
         assert list(unique_items) == [(1, 'a'), (1, 'b')]
 
+    def test_iter_in_thread(self):
+        items = iter_in_thread(iter(range(10)), buffer_size=2)
+        assert list(items) == range(10)
+
+        def _failing_iter():
+            yield 1
+            raise ValueError('failed')
+        items = iter_in_thread(_failing_iter())
+        assert items.next() == 1
+        try:
+            items.next()
+            self.fail('ValueError expected')
+        except ValueError:
+            pass
+
 
 class GenerateWindowsTests(unittest.TestCase):
     def generate_wins(self, size, step, number):
@@ -480,6 +502,74 @@ class RandomAccessChromIteratorTest(unittest.TestCase):
         assert win == [('chrom3', 155, 155), ('chrom3', 165, 165)]
 
 
+class RandomAccessRegionIteratorTest(unittest.TestCase):
+    fake_pos = namedtuple('pos', ['chrom', 'pos'])
+
+    def test_iter(self):
+        items = [self.fake_pos('chrom1', 24),
+                 self.fake_pos('chrom1', 54),
+                 self.fake_pos('chrom1', 134),
+                 self.fake_pos('chrom1', 145),
+                 self.fake_pos('chrom1', 155),
+                 self.fake_pos('chrom2', 155),
+                 self.fake_pos('chrom3', 155),
+                 self.fake_pos('chrom3', 165)]
+        location_getter = lambda x: (x.chrom, x.pos)
+        random_iter = RandomAccessRegionIterator(iter(items), location_getter,
+                                                 max_distance=30)
+        assert list(random_iter) == items
+
+        random_iter = RandomAccessRegionIterator(iter(items), location_getter,
+                                                 max_distance=30)
+        counts = []
+        for item in random_iter:
+            counts.append(random_iter.count_close())
+            assert random_iter.chrom == item.chrom
+        assert counts == [2, 2, 3, 3, 3, 1, 2, 2]
+
+        random_iter = RandomAccessRegionIterator(iter(items), location_getter,
+                                                 max_distance=30)
+        random_iter.next()
+        random_iter.next()
+        assert random_iter.next() == ('chrom1', 134)
+        assert random_iter.close_items() == items[2:5]
+        assert random_iter.fetch(104, 146) == items[2:4]
+        assert random_iter.count(135, 165) == 2
+        assert random_iter.count(135, 145) == 0
+        try:
+            random_iter.fetch(100, 150)
+            self.fail('IndexError expected')
+        except IndexError:
+            pass
+
+        assert not list(RandomAccessRegionIterator(iter([]), location_getter,
+                                                   max_distance=30))
+
+        items = [self.fake_pos('chrom1', 24), self.fake_pos('chrom1', 4)]
+        random_iter = RandomAccessRegionIterator(iter(items), location_getter,
+                                                 max_distance=30)
+        try:
+            list(random_iter)
+            self.fail('ItemsNotSortedError expected')
+        except ItemsNotSortedError:
+            pass
+
+    def test_long_iter(self):
+        # more items than the ones kept before purging the buffer
+        poss = sorted(random.sample(xrange(100000), 5000))
+        items = [self.fake_pos('chrom1', pos) for pos in poss]
+        location_getter = lambda x: (x.chrom, x.pos)
+        random_iter = RandomAccessRegionIterator(iter(items), location_getter,
+                                                 max_distance=100)
+        for idx, item in enumerate(random_iter):
+            assert item.pos == poss[idx]
+            close = [pos for pos in poss[max(idx - 101, 0):idx + 102]
+                     if abs(pos - item.pos) <= 100]
+            assert random_iter.count_close() == len(close)
+            assert random_iter.count(item.pos - 50, item.pos + 50) == len(
+                [pos for pos in close if abs(pos - item.pos + 0.5) < 50])
+
+
 if __name__ == '__main__':
 #     import sys
 #     sys.argv = ['', 'RandomAccessChromIteratorTest']
@@ -13,11 +13,13 @@
 # You should have received a copy of the GNU General Public License
 # along with ngs_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
+import sys
 import unittest
 from tempfile import NamedTemporaryFile
 from os.path import exists
 from os import remove
 from StringIO import StringIO
+from subprocess import check_output
 
 from crumbs.utils.file_utils import (compress_with_bgzip, uncompress_gzip,
                                      fhand_is_seekable,
@@ -128,6 +130,28 @@ class CompressTest(unittest.TestCase):
         assert exists(compressed_fhand.name + '.tbi')
         remove(compressed_fhand.name + '.tbi')
 
+
+class OptionalModulesTest(unittest.TestCase):
+    def test_lazy_import(self):
+        code = 'import sys\n'
+        code += 'from crumbs.seq.seqio import read_seqs\n'
+        code += 'from crumbs.vcf.filters import MafFilter\n'
+        code += "print 'matplotlib' in sys.modules, 'Bio.SeqIO' in sys.modules\n"
+        code += 'from crumbs.utils.optional_modules import write_seqrecs\n'
+        code += "print 'Bio.SeqIO' in sys.modules\n"
+        result = check_output([sys.executable, '-c', code])
+        assert result == 'False False\nTrue\n'
+
+        from crumbs.utils import optional_modules
+        from Bio.SeqIO import write
+        assert optional_modules.write_seqrecs is write
+        assert 'write_seqrecs' in dir(optional_modules)
+        try:
+            optional_modules.non_existing_name
+            self.fail('AttributeError expected')
+        except AttributeError:
+            pass
+
 if __name__ == "__main__":
 #     import sys;sys.argv = ['', 'FilterTest.test_close_to_filter']
     unittest.main()
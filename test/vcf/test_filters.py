@@ -19,15 +19,19 @@ from tempfile import NamedTemporaryFile
 from subprocess import check_output, Popen, PIPE, check_call
 from StringIO import StringIO
 import os
+from math import isnan
 
+from crumbs.iterutils import RandomAccessIterator
 from crumbs.vcf.snv import VCFReader
+from crumbs.vcf.ld import calc_recomb_rate
 
 from crumbs.vcf.filters import (PASSED, FILTERED_OUT, group_in_filter_packets,
                                 CallRateFilter, BiallelicFilter, IsSNPFilter,
                                 SnvQualFilter, ObsHetFilter, MafFilter,
                                 filter_snvs, MonomorphicFilter,
                                 WeirdSegregationFilter,
-                                WeirdRecombFilter)
+                                WeirdRecombFilter, _SnvsAround,
+                                _calculate_segregation_rates)
 from crumbs.utils.bin_utils import VCF_BIN_DIR
 from crumbs.utils.test_utils import TEST_DATA_DIR
 
@@ -462,6 +466,21 @@ class ConsistentSegregationTest(unittest.TestCase):
 #         list(flt_snps)
 #         plot_dir.close()
 
+    def test_snvs_around(self):
+        vcf_fpath = os.path.join(TEST_DATA_DIR, 'scaff000025.vcf.gz')
+        reader = VCFReader(open(vcf_fpath))
+        snvs_around = _SnvsAround(VCFReader(open(vcf_fpath)).parse_snvs())
+        chrom = 'CP3_scaffold000025'
+        for start, end in [(0, 205000.5), (202677, 205175), (205174, None),
+                           (206537.5, 206604), (2856941, None)]:
+            snvs = snvs_around.fetch(chrom, start, end)
+            expected = reader.fetch_snvs(chrom, start, end)
+            assert [snv.pos for snv, _ in snvs] == [snv.pos for snv in expected]
+            counts = [snv.biallelic_genotype_counts for snv in
+                      reader.fetch_snvs(chrom, start, end)]
+            assert [cnts for _, cnts in snvs] == counts
+            snvs_around.remove_before(start)
+
     def test_bin(self):
         binary = join(VCF_BIN_DIR, 'filter_vcf_by_weird_segregation')
         cmd = [binary, '-h']
@@ -489,6 +508,21 @@ class ConsistentSegregationTest(unittest.TestCase):
 
 
 class ConsistentRecombinationTest(unittest.TestCase):
+    def test_segregation_rates(self):
+        vcf_fpath = os.path.join(TEST_DATA_DIR, 'scaff000025.vcf.gz')
+        snvs = list(VCFReader(open(vcf_fpath)).parse_snvs())[:30]
+        snvs_win = RandomAccessIterator(iter(snvs), rnd_access_win=11)
+        rates = _calculate_segregation_rates(snvs_win, 'ril_self', 11)
+        for index1, (snv1, _, _, snv_rates) in enumerate(rates):
+            assert [rate.index_in_vcf for rate in snv_rates] == range(
+                                        max(index1 - 5, 0), min(index1 + 5, 30))
+            for rate in snv_rates:
+                snv2 = snvs[rate.index_in_vcf]
+                expected = calc_recomb_rate(snv1.calls, snv2.calls, 'ril_self')
+                if expected is None:
+                    assert isnan(rate.recomb_rate)
+                else:
+                    assert rate.recomb_rate == expected[0]
 
     def test_cons_recomb(self):
         vcf_fpath = os.path.join(TEST_DATA_DIR, 'scaff000025.vcf.gz')
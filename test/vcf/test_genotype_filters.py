@@ -17,12 +17,16 @@ import os
 import unittest
 from tempfile import NamedTemporaryFile
 from StringIO import StringIO
+from gzip import GzipFile
 from subprocess import check_call, CalledProcessError, check_output
 
 from crumbs.utils.bin_utils import VCF_BIN_DIR
+from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.vcf.snv import VCFReader
 from crumbs.vcf.genotype_filters import (LowEvidenceAlleleFilter, RIL_SELF,
-                                         prob_aa_given_n_a_reads_hw)
+                                         prob_aa_given_n_a_reads_hw,
+                                         run_genotype_filters,
+                                         _GenotypeChunk)
 
 # Method could be a function
 # pylint: disable=R0201
@@ -179,6 +183,67 @@ class LowQualAlleleTest(unittest.TestCase):
         res = [call.call.data.GT for snp in snps for call in snp.calls]
         assert res == ['0/0', '1/1', '1/.', '0/.', '0/0', '0/1']
 
+    def test_filter_low_alle_evidence_by_chunks(self):
+        vcf = '''#CHROM POS ID REF ALT QUAL FILTER INFO FORMAT 1 2 3 4 5 6
+20\t14\t.\tG\tA\t29\tPASS\tNS=3\tGT:RO:AO\t0/0:14:0\t1/1:0:15\t1/1:0:1\t0/0:1:0\t0/0:9:0\t0/1:1:1
+20\t15\t.\tG\tA\t29\tPASS\tNS=3\tGT:RO:AO\t0/0:14:0\t1/1:0:15\t1/1:0:1\t0/0:1:0\t0/0:9:0\t0/1:1:1'''
+        exp = '0/0:14:0\t1/1:0:15\t1/.:0:1\t0/.:1:0\t0/.:9:0\t0/1:1:1'
+        for processes in (1, 2):
+            out_fhand = StringIO()
+            filter_ = LowEvidenceAlleleFilter()
+            run_genotype_filters(StringIO(VCF_HEADER + vcf), out_fhand,
+                                 [filter_], chunk_size=1, processes=processes,
+                                 reader_kwargs={'min_calls_for_pop_stats': 4})
+            assert filter_.log == {'tot': 12, 'not_enough_evidence': 6,
+                                   'enough_evidence': 4, 'was_het': 2}
+            assert out_fhand.getvalue().count(exp) == 2
+
+        out_fhand = StringIO()
+        kwargs = {'n_generation': 7}
+        filter_ = LowEvidenceAlleleFilter(genotypic_freqs_method=RIL_SELF,
+                                          genotypic_freqs_kwargs=kwargs)
+        run_genotype_filters(StringIO(VCF_HEADER + vcf), out_fhand, [filter_],
+                             chunk_size=10)
+        assert filter_.log == {'tot': 12, 'enough_evidence': 6,
+                               'not_enough_evidence': 4, 'was_het': 2}
+        exp = '0/0:14:0\t1/1:0:15\t1/.:0:1\t0/.:1:0\t0/0:9:0\t0/1:1:1'
+        assert out_fhand.getvalue().count(exp) == 2
+
+    def test_non_diploid_chunks(self):
+        # the polyploid genotypes are filtered as with the snv by snv filters
+        vcf_fpath = os.path.join(TEST_DATA_DIR, 'freebayes_sample.vcf.gz')
+        vcf = GzipFile(vcf_fpath).read()
+        results = []
+        for chunk_size, processes in ((None, 1), (100, 1), (100, 2)):
+            out_fhand = StringIO()
+            filter_ = LowEvidenceAlleleFilter(genotypic_freqs_method=RIL_SELF,
+                                    genotypic_freqs_kwargs={'n_generation': 7})
+            run_genotype_filters(StringIO(vcf), out_fhand, [filter_],
+                                 chunk_size=chunk_size, processes=processes)
+            results.append(out_fhand.getvalue())
+            assert filter_.log['tot'] == 944
+        assert results[0] == results[1] == results[2]
+        assert '1/1/1/1/1/1/1/1/1/1/1/1/1/1/1/1/1/1/1/.' in results[0]
+
+        # with different ploidies in the same chunk
+        vcf = '''#CHROM POS ID REF ALT QUAL FILTER INFO FORMAT 1 2 3 4 5 6
+20\t14\t.\tG\tA\t29\tPASS\tNS=3\tGT:RO:AO\t0/0/1/1:9:9\t1/1:0:15\t1/1/1/1:0:8\t0/0:9:0\t0/0:9:0\t0/1:5:5
+20\t15\t.\tG\tA\t29\tPASS\tNS=3\tGT:RO:AO\t0/0:14:0\t1/1:0:15\t0/0/0/0:8:0\t0/0:1:0\t0:9:0\t./.:0:0'''
+        reader = VCFReader(StringIO(VCF_HEADER + vcf),
+                           min_calls_for_pop_stats=4)
+        chunk = _GenotypeChunk(list(reader.parse_snvs()))
+        assert chunk.alleles.shape == (2, 6, 4)
+        assert chunk.is_het.tolist() == [[True, False, False, False, False,
+                                          True],
+                                         [False, False, False, False, False,
+                                          False]]
+        freqs = chunk.allele_freqs()
+        # the freq. of the first allele of every genotype, 7 of 16 are 0
+        assert list(freqs[0]) == [7. / 16, 9. / 16, 9. / 16, 7. / 16, 7. / 16,
+                                  7. / 16]
+        assert list(freqs[1, :5]) == [9. / 11, 2. / 11, 9. / 11, 9. / 11,
+                                      9. / 11]
+
     def test_prob_aa_given_a_reads(self):
         res = prob_aa_given_n_a_reads_hw(30, freq_a_in_pop=0.1)
         self.assertAlmostEqual(res, 0.999999983236, 4)
@@ -222,6 +287,12 @@ class LowQualAlleleTest(unittest.TestCase):
         exp = '0/0:14:0\t1/1:0:15\t1/.:0:1\t0/.:1:0\t0/0:9:0\t0/1:1:1'
         assert exp in open(out_fhand.name).read()
 
+        cmd = [binary, in_fhand.name, '-o', out_fhand.name, '-n', '7',
+               '-g', 'ril_self', '--processes', '2', '--chunk_size', '1']
+        stdout = check_output(cmd)
+        assert 'Tot. SNVs: 6' in stdout
+        assert exp in open(out_fhand.name).read()
+
         binary = os.path.join(VCF_BIN_DIR, 'filter_low_evidence_alleles')
         cmd = [binary, in_fhand.name, '-o', out_fhand.name, '-g', 'ril_self']
         err_fhand = NamedTemporaryFile()
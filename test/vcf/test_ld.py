@@ -22,7 +22,7 @@ from crumbs.vcf.snv import VCFReader
 from crumbs.vcf.ld import (_count_biallelic_haplotypes, calculate_r_sqr,
                            HaploCount, _calculate_r_sqr, _fisher_exact,
                            calculate_ld_stats, filter_snvs_by_ld, fisher_exact,
-                           _LDStatsCache)
+                           _LDStatsCache, WindowHaplotypeCounter)
 from crumbs.utils.bin_utils import VCF_BIN_DIR
 from crumbs.utils.test_utils import TEST_DATA_DIR
 from subprocess import check_call, Popen, PIPE
@@ -195,6 +195,44 @@ class LDTests(unittest.TestCase):
         assert counts.aB == 1
         assert counts.Ab == 0
 
+    def test_window_haplotype_counter(self):
+        vcf = '''#CHROM POS ID REF ALT QUAL FILTER INFO FORMAT 1 2 3 4 5 6 7 8
+20\t14\t.\tG\tA\t29\tPASS\tNS=3\tGT\t0/0\t1/1\t1/1\t0/0\t0/0\t0/1\t1/1\t0/0
+20\t15\t.\tG\tA\t29\tPASS\tNS=3\tGT\t0/0\t2/2\t1/1\t./.\t0/0\t0/1\t1/1\t0/0
+20\t16\t.\tG\tA\t29\tPASS\tNS=3\tGT\t1/1\t0/0\t1/1\t1/1\t0/0\t1/1\t0/.\t1/1
+20\t17\t.\tG\tA\t29\tPASS\tNS=3\tGT\t./.\t./.\t./.\t./.\t./.\t./.\t./.\t./.
+20\t18\t.\tG\tA\t29\tPASS\tNS=3\tGT\t0/0\t0/0\t0/0\t0/0\t0/0\t0/0\t0/0\t0/0'''
+        snps = [snp.record for snp in
+                VCFReader(StringIO(VCF_HEADER + vcf)).parse_snvs()]
+        samples = [call.sample for call in snps[0].samples]
+        counter = WindowHaplotypeCounter(samples, window=3)
+        for snp1 in snps:
+            for snp2 in snps:
+                expected = _count_biallelic_haplotypes(snp1.samples,
+                                                       snp2.samples,
+                                                       return_alleles=True)
+                assert counter.count_haplotypes(snp1, snp2) == expected
+        # the cached counts are returned
+        assert (counter.count_haplotypes(snps[-1], snps[0]) is
+                counter.count_haplotypes(snps[-1], snps[0]))
+
+        # the tied counts are solved like in the non coded counting
+        vcf = '''#CHROM POS ID REF ALT QUAL FILTER INFO FORMAT 1 2 3 4 5 6
+20\t14\t.\tG\tA\t29\tPASS\tNS=3\tGT\t2/2\t3/3\t3/3\t2/2\t./.\t./.
+20\t15\t.\tG\tA\t29\tPASS\tNS=3\tGT\t3/3\t11/11\t2/2\t2/2\t./.\t./.
+20\t16\t.\tG\tA\t29\tPASS\tNS=3\tGT\t0/0\t1/1\t2/2\t0/0\t1/1\t2/2
+20\t17\t.\tG\tA\t29\tPASS\tNS=3\tGT\t2/2\t1/1\t0/0\t1/1\t0/0\t2/2'''
+        snps = [snp.record for snp in
+                VCFReader(StringIO(VCF_HEADER + vcf)).parse_snvs()]
+        samples = [call.sample for call in snps[0].samples]
+        counter = WindowHaplotypeCounter(samples, window=3)
+        for snp1 in snps:
+            for snp2 in snps:
+                expected = _count_biallelic_haplotypes(snp1.samples,
+                                                       snp2.samples,
+                                                       return_alleles=True)
+                assert counter.count_haplotypes(snp1, snp2) == expected
+
     def test_r_example(self):
         # r examples
         self.assertAlmostEqual(_calculate_r_sqr(HaploCount(10, 10, 10, 10)),
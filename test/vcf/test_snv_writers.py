@@ -29,7 +29,7 @@ from crumbs.vcf.writers import (IlluminaWriter, _replace_snvs_with_iupac,
                                 RQTLWriter, DEF_PHYS_TO_GENET_DIST,
                                 write_parent_checker, write_map_maker)
 from crumbs.utils.bin_utils import VCF_BIN_DIR
-from crumbs.utils.test_utils import TEST_DATA_DIR
+from crumbs.utils.test_utils import TEST_DATA_DIR, get_temp_data_copy
 
 # Method could be a function
 # pylint: disable=R0201
@@ -39,7 +39,7 @@ from crumbs.utils.test_utils import TEST_DATA_DIR
 # pylint: disable=C0111
 
 VCF_PATH = pjoin(TEST_DATA_DIR, 'sample.vcf.gz')
-REF_PATH = pjoin(TEST_DATA_DIR, 'sample_ref.fasta')
+REF_PATH = get_temp_data_copy('sample_ref.fasta')
 VCF_INDEL_PATH = pjoin(TEST_DATA_DIR, 'sample_indel.vcf.gz')
 
 
@@ -204,7 +204,7 @@ ref 10 . A C 10 PASS .
         binary = pjoin(VCF_BIN_DIR, 'write_snps_for_illumina')
         assert 'usage' in check_output([binary, '-h'])
 
-        reference = pjoin(TEST_DATA_DIR, 'sample_ref.fasta')
+        reference = get_temp_data_copy('sample_ref.fasta')
         vcf = pjoin(TEST_DATA_DIR, 'sample.vcf.gz')
 
         cmd = [binary, '-r', reference, '-m', '0', vcf]
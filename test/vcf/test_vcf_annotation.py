@@ -20,7 +20,7 @@ from subprocess import check_output
 from StringIO import StringIO
 
 
-from crumbs.utils.test_utils import TEST_DATA_DIR
+from crumbs.utils.test_utils import TEST_DATA_DIR, get_temp_data_copy
 from crumbs.utils.bin_utils import VCF_BIN_DIR
 from crumbs.vcf.annotation import (CloseToSnv, HighVariableRegion,
                                    CloseToLimit, MafDepthLimit, CapEnzyme,
@@ -43,7 +43,7 @@ from crumbs.utils.file_utils import TemporaryDir
 
 VCF_PATH = join(TEST_DATA_DIR, 'sample.vcf.gz')
 VCF_INDEL_PATH = join(TEST_DATA_DIR, 'sample_indel.vcf.gz')
-REF_PATH = join(TEST_DATA_DIR, 'sample_ref.fasta')
+REF_PATH = get_temp_data_copy('sample_ref.fasta')
 VARI_VCF_PATH = join(TEST_DATA_DIR, 'vari_filter.vcf')
 GATK_VCF_PATH = join(TEST_DATA_DIR, 'gatk_sample.vcf.gz')
 FREEBAYES_VCF_PATH = join(TEST_DATA_DIR, 'freebayes_sample.vcf.gz')
@@ -53,7 +53,7 @@ FREEBAYES4_VCF_PATH = join(TEST_DATA_DIR, 'variable_in_sample_5.vcf.gz')
 FREEBAYES3_VCF_PATH = join(TEST_DATA_DIR, 'freebayes_sample3.vcf.gz')
 FREEBAYES5_VCF_PATH = join(TEST_DATA_DIR, 'freebayes5.vcf.gz')
 FREEBAYES6_VCF_PATH = join(TEST_DATA_DIR, 'freebayes6.vcf.gz')
-REF_FREEBAYES = join(TEST_DATA_DIR, 'calabaza_selection.fasta')
+REF_FREEBAYES = get_temp_data_copy('calabaza_selection.fasta')
 VCF_HEADER = '''##fileformat=VCFv4.1
 ##fileDate=20090805
 ##source=myImputationProgramV3.1
@@ -34,10 +34,10 @@ from crumbs.vcf.statistics import (VcfStats, HOM_REF, VCFcomparisons,
     calc_snv_read_pos_stats2)
 
 from crumbs.utils.bin_utils import VCF_BIN_DIR
-from crumbs.utils.test_utils import TEST_DATA_DIR
+from crumbs.utils.test_utils import TEST_DATA_DIR, get_temp_data_copy
 
 VARSCAN_VCF_PATH = join(TEST_DATA_DIR, 'sample.vcf.gz')
-REF_PATH = join(TEST_DATA_DIR, 'sample_ref.fasta')
+REF_PATH = get_temp_data_copy('sample_ref.fasta')
 GATK_VCF_PATH = join(TEST_DATA_DIR, 'gatk_sample.vcf.gz')
 FREEBAYES_VCF_PATH = join(TEST_DATA_DIR, 'freebayes_sample.vcf.gz')
 FREEBAYES_MULTI_VCF_PATH = join(TEST_DATA_DIR, 'freebayes_multisample.vcf.gz')
@@ -87,6 +87,11 @@ class AlleleCount2DTest(unittest.TestCase):
         allelecount.get_gt_depths_for_coverage(5)
 
 
+class _RecordList(list):
+    'A list of VCF records with the samples of the reader'
+    samples = None
+
+
 class VCFcomparisonsTest(unittest.TestCase):
     def test_calculate_statistics(self):
         # with freebayes
@@ -107,6 +112,33 @@ class VCFcomparisonsTest(unittest.TestCase):
         assert stats['different'] == 0
         assert stats['common_snps_prc'] == 100
 
+        # every sample is compared with all the samples in the other vcf
+        # with and without tabix index
+        not_indexed_fhand = NamedTemporaryFile(suffix='.vcf.gz')
+        not_indexed_fhand.write(open(FREEBAYES_MULTI_VCF_PATH).read())
+        not_indexed_fhand.flush()
+        for vcf_path in (FREEBAYES_MULTI_VCF_PATH, not_indexed_fhand.name):
+            reader = Reader(filename=FREEBAYES_MULTI_VCF_PATH)
+            vcf_to_compare = VCFcomparisons(vcf_path)
+            stats = vcf_to_compare.calculate_statistics(reader,
+                                                        samples=['sample01_gbs'])
+            assert stats['common'] == 256
+            assert stats['uncalled'] == 177
+            assert stats['different'] == 47
+
+        # a VCF not sorted by chromosome, the first one is found again
+        records = _RecordList(Reader(filename=FREEBAYES_MULTI_VCF_PATH))
+        records.samples = Reader(filename=FREEBAYES_MULTI_VCF_PATH).samples
+        records[1].CHROM = 'other_chrom'
+        for vcf_path in (FREEBAYES_MULTI_VCF_PATH, not_indexed_fhand.name):
+            vcf_to_compare = VCFcomparisons(vcf_path)
+            stats = vcf_to_compare.calculate_statistics(records,
+                                                        samples=['sample01_gbs'])
+            assert stats['common'] == 256
+            assert stats['uncalled'] == 165
+            assert stats['different'] == 47
+            assert stats['common_snps_prc'] == 97.5
+
     def xtest_compare_vcfs_samples(self):
         binary = join(VCF_BIN_DIR, 'compare_vcfs_samples')
         assert 'usage' in check_output([binary, '-h'])
@@ -158,6 +190,15 @@ reference2\t400\tmicrosat1\tGTC\tG,GTCT\t50\tPASS\tNS=3;DP=9;AA=G\tGT:GQ:DP\t./.
         assert repr(stats['3_read_pos_counts']) == """{'group1+454': IntCounter({73: 9, 50: 9, 45: 9, 30: 9}), 'group2+454': IntCounter({14: 6, 64: 3, 65: 3, 62: 3, 15: 3})}"""
         fhand = NamedTemporaryFile(suffix='.png')
         draw_read_pos_stats(stats, fhand)
+
+        # one process per chromosome
+        snvs = VCFReader(StringIO(vcf)).parse_snvs()
+        stats2 = calc_snv_read_pos_stats(sam, snvs, processes=2)
+        for key in ('5_read_pos_counts', '3_read_pos_counts'):
+            assert stats[key] == stats2[key]
+        for key in ('5_read_pos_boxplot', '3_read_pos_boxplot'):
+            for read_group, boxplot in stats[key].items():
+                assert boxplot.counts == stats2[key][read_group].counts
         # raw_input(fhand.name)
 
 if __name__ == "__main__":